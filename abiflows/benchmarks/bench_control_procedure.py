@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark of ControlProcedure.process with artificially slow controllers (e.g. controllers parsing large files or
+waiting for a subprocess). Compares the serial processing of the controllers with the concurrent processing of the
+controllers with the same priority, and checks that the two reports are identical.
+
+Usage: python -m abiflows.benchmarks.bench_control_procedure [--ngroups 3] [--nper_group 4] [--sleep 0.2]
+"""
+from __future__ import print_function, division, unicode_literals
+
+import argparse
+import time
+
+from abiflows.core.mastermind_abc import Controller, ControllerNote, ControlProcedure, ControlledItemType
+
+
+class SlowController(Controller):
+    """
+    Controller sleeping for a given time before returning a NOTHING_FOUND note.
+    """
+
+    _controlled_item_types = [ControlledItemType.task_completed()]
+
+    def __init__(self, priority, sleep):
+        super(SlowController, self).__init__()
+        self.priority = priority
+        self.sleep = sleep
+
+    def as_dict(self):
+        return {'@class': self.__class__.__name__,
+                '@module': self.__class__.__module__,
+                'priority': self.priority, 'sleep': self.sleep}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(priority=d['priority'], sleep=d['sleep'])
+
+    def process(self, **kwargs):
+        time.sleep(self.sleep)
+        return ControllerNote(controller=self, state=ControllerNote.NOTHING_FOUND)
+
+
+def run(ngroups, nper_group, sleep, max_workers):
+    controllers = [SlowController(priority=100 * (igroup + 1), sleep=sleep)
+                   for igroup in range(ngroups) for _ in range(nper_group)]
+    cp = ControlProcedure(controllers=controllers, max_workers=max_workers)
+    cp.set_controlled_item_type(ControlledItemType.task_completed())
+    start = time.time()
+    report = cp.process()
+    return time.time() - start, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ngroups', type=int, default=3, help='Number of priority groups')
+    parser.add_argument('--nper_group', type=int, default=4, help='Number of controllers in each group')
+    parser.add_argument('--sleep', type=float, default=0.2, help='Processing time of each controller (s)')
+    args = parser.parse_args()
+
+    serial_time, serial_report = run(args.ngroups, args.nper_group, args.sleep, max_workers=1)
+    concurrent_time, concurrent_report = run(args.ngroups, args.nper_group, args.sleep,
+                                             max_workers=args.nper_group)
+    print('{:d} groups of {:d} controllers ({:.2f} s each)'.format(args.ngroups, args.nper_group, args.sleep))
+    print('serial     : {:8.3f} s'.format(serial_time))
+    print('concurrent : {:8.3f} s (speedup {:.1f}x)'.format(concurrent_time, serial_time / concurrent_time))
+    print('identical reports : {}'.format(serial_report.as_dict() == concurrent_report.as_dict()))
+
+
+if __name__ == '__main__':
+    main()
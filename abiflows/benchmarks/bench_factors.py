@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Microbenchmark of the factorization kernel in abiflows.utils.factors, compared with the previous implementations:
+recursive trial division and cartesian product for the divisors, product of all the possible exponents for
+lowest_nn_gte_mm and reload of the json file for unprime_nband.
+The new implementations are timed with empty caches (cold) and with the caches filled by a first pass (warm).
+
+Usage: python -m abiflows.benchmarks.bench_factors [--nmax 5000]
+"""
+from __future__ import print_function, division, unicode_literals
+
+import argparse
+import itertools
+import json
+import math
+import os
+import sys
+import time
+from functools import reduce
+
+
+def legacy_prime_factors(n):
+    i = 2
+    while i <= math.sqrt(n):
+        if n % i == 0:
+            l = legacy_prime_factors(n // i)
+            l.append(i)
+            return l
+        i += 1
+    return [n]
+
+
+def legacy_divisors(n):
+    factors = {}
+    for p in legacy_prime_factors(n):
+        factors[p] = factors.get(p, 0) + 1
+    listexponents = [[k ** x for x in range(0, factors[k] + 1)] for k in factors]
+    return sorted(reduce(lambda x, y: x * y, f, 1) for f in itertools.product(*listexponents))
+
+
+def legacy_lowest_nn_gte_mm(mm, factors):
+    lowest = -1
+    current_exponents = -1
+    max_exponents_factors = [int(math.ceil(math.log(float(mm), factor))) for factor in factors]
+    exponents_possibilities = [range(max_exponent + 1) for max_exponent in max_exponents_factors]
+    for exponents in itertools.product(*exponents_possibilities):
+        nn = 1
+        for ifactor, factor in enumerate(factors):
+            nn *= factor ** exponents[ifactor]
+        if nn < mm:
+            continue
+        elif nn == mm:
+            lowest = nn
+            current_exponents = exponents
+            break
+        elif lowest == -1 or nn < lowest:
+            lowest = nn
+            current_exponents = exponents
+    return lowest, current_exponents
+
+
+def legacy_unprime_nband(nband, number_of_primes=10):
+    from abiflows.fireworks.tasks.abinit_common import module_dir
+    with open(os.path.join(module_dir, 'n1000multiples_primes.json'), 'r') as f:
+        allowed_nbands = json.load(f)['numbers{:d}primes'.format(number_of_primes)]
+    if nband <= 1000:
+        if nband in allowed_nbands:
+            return nband
+        return min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband])
+    elif nband <= 10000:
+        nband10 = int(math.ceil(float(nband) / 10.0))
+        if nband10 in allowed_nbands:
+            return nband10 * 10
+        return 10 * min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband10])
+
+
+def clear_caches():
+    from abiflows.utils import factors
+    from abiflows.fireworks.tasks import abinit_common
+    factors._spf = factors.array(str('l'))
+    factors._divisors_cache.clear()
+    factors._smooth_sequences.clear()
+    abinit_common._allowed_nbands.clear()
+
+
+def timeit(function, args_list):
+    start = time.time()
+    results = [function(*args) for args in args_list]
+    return time.time() - start, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nmax', type=int, default=5000, help="Largest number used in the benchmark.")
+    options = parser.parse_args()
+
+    from abiflows.utils.factors import divisors, lowest_nn_gte_mm
+    from abiflows.fireworks.tasks.abinit_common import unprime_nband
+
+    numbers = [(n,) for n in range(2, options.nmax + 1)]
+    benchmarks = [
+        ('divisors', legacy_divisors, lambda n: list(divisors(n)), numbers),
+        ('lowest_nn_gte_mm', legacy_lowest_nn_gte_mm, lowest_nn_gte_mm,
+         [(n, [2, 3, 5, 7]) for n in range(1, options.nmax + 1)]),
+        ('unprime_nband', legacy_unprime_nband, unprime_nband,
+         [(n,) for n in range(1, min(options.nmax, 10000) + 1)]),
+    ]
+
+    print("{:>18s} {:>8s} {:>12s} {:>12s} {:>12s} {:>10s} {:>10s}".format(
+        'function', 'ncalls', 'legacy [s]', 'cold [s]', 'warm [s]', 'speedup', 'warm spdup'))
+    for name, legacy, new, args_list in benchmarks:
+        legacy_time, legacy_results = timeit(legacy, args_list)
+        clear_caches()
+        cold_time, results = timeit(new, args_list)
+        warm_time, _ = timeit(new, args_list)
+        if results != legacy_results:
+            raise RuntimeError("Different results for {}".format(name))
+        print("{:>18s} {:8d} {:12.4f} {:12.4f} {:12.4f} {:10.1f} {:10.1f}".format(
+            name, len(args_list), legacy_time, cold_time, warm_time, legacy_time / max(cold_time, 1e-9),
+            legacy_time / max(warm_time, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
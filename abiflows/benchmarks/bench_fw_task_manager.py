@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark of the cache of the FWTaskManager and of the short single core specs.
+Builds a number of SRC trios with createSRCFireworks, each requiring the short single core spec for the setup and
+control fireworks, with the cached implementation and with the previous one, that parsed the YAML configuration
+file and selected the qadapter at each call. Reports the number of YAML parses and the build time.
+
+Usage: python -m abiflows.benchmarks.bench_fw_task_manager [--ntrios 5000]
+"""
+from __future__ import print_function, division, unicode_literals
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+from monty.serialization import loadfn
+
+
+MANAGER = """
+qadapters:
+    - priority: 1
+      queue:
+        qtype: slurm
+        qname: main
+      limits:
+        timelimit: 2:00:00
+        min_cores: 1
+        max_cores: 16
+      hardware:
+        num_nodes: 10
+        sockets_per_node: 1
+        cores_per_socket: 16
+        mem_per_node: 64 Gb
+      job:
+        mpi_runner: mpirun
+"""
+
+
+class LegacyShortSingleCoreSpec(object):
+    """
+    Previous implementation of get_short_single_core_spec, kept for comparison. Counts the YAML parses.
+    """
+
+    def __init__(self):
+        self.nparsed = 0
+
+    def __call__(self, fw_manager=None, master_mem_overhead=0, return_qtk=False, timelimit=None):
+        from pymatgen.io.abinit.tasks import ParalHints
+        from abiflows.fireworks.utils.fw_utils import FWTaskManager
+        if isinstance(fw_manager, FWTaskManager):
+            ftm = fw_manager
+        else:
+            path = fw_manager or FWTaskManager.get_user_config_path()
+            config = loadfn(path) if path else {}
+            self.nparsed += 1 if path else 0
+            ftm = FWTaskManager(**config)
+
+        if ftm.has_task_manager():
+            pconf = ParalHints({}, [{'tot_ncpus': 1, 'mpi_ncpus': 1, 'efficiency': 1}])
+            try:
+                tm = ftm.task_manager
+                tm.select_qadapter(pconf)
+                if timelimit is None:
+                    tm.qadapter.set_timelimit(timelimit=ftm.fw_policy.short_job_timelimit)
+                else:
+                    tm.qadapter.set_timelimit(timelimit=timelimit)
+                tm.qadapter.set_master_mem_overhead(master_mem_overhead)
+                qadapter_spec = tm.qadapter.get_subs_dict()
+                if return_qtk:
+                    return qadapter_spec, tm.qadapter
+                else:
+                    return qadapter_spec
+            except RuntimeError:
+                traceback.print_exc()
+        return {}
+
+
+def build_trios(ntrios, legacy):
+    from abiflows.core.mastermind_abc import ControlProcedure
+    from abiflows.fireworks.tasks import src_tasks_abc
+    from abiflows.fireworks.tasks.src_tasks_abc import SetupTask, ScriptRunTask, ControlTask, createSRCFireworks
+    from abiflows.fireworks.utils.fw_utils import clear_fw_task_manager_cache, FTM_CACHE_STATS
+
+    clear_fw_task_manager_cache()
+    original = src_tasks_abc.get_short_single_core_spec
+    legacy_spec = LegacyShortSingleCoreSpec()
+    if legacy:
+        src_tasks_abc.get_short_single_core_spec = legacy_spec
+    control_procedure = ControlProcedure(controllers=[])
+    try:
+        start = time.time()
+        for itrio in range(ntrios):
+            createSRCFireworks(setup_task=SetupTask(), run_task=ScriptRunTask('echo run', control_procedure),
+                               control_task=ControlTask(control_procedure), spec={},
+                               task_index='pert-{}'.format(itrio))
+        build_time = time.time() - start
+    finally:
+        src_tasks_abc.get_short_single_core_spec = original
+
+    nparsed = legacy_spec.nparsed if legacy else FTM_CACHE_STATS['parsed']
+    return {'mode': 'legacy' if legacy else 'cached', 'ntrios': ntrios, 'nparsed': nparsed,
+            'build_time': build_time}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ntrios', type=int, default=5000, help="Number of SRC trios to build.")
+    options = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filepath = os.path.join(tmp_dir, 'fw_manager.yaml')
+        with io.open(filepath, 'w') as f:
+            f.write(MANAGER)
+        os.environ['FW_TASK_MANAGER'] = filepath
+
+        print("{:>8s} {:>8s} {:>12s} {:>12s}".format('mode', 'ntrios', 'YAML parses', 'build [s]'))
+        results = [build_trios(options.ntrios, legacy=legacy) for legacy in [True, False]]
+        for res in results:
+            print("{mode:>8s} {ntrios:8d} {nparsed:12d} {build_time:12.2f}".format(**res))
+        print("YAML parses avoided: {}".format(results[0]['nparsed'] - results[1]['nparsed']))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
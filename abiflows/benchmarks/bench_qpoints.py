@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark of the matching of the q-points of the phonon perturbations with the q-points of the NSCF calculations
+of the WFQ, as done in the generation of the phonon workflows. Compares the loop over all the NSCF q-points with the
+QptIndex and checks that the matches are identical.
+The loop is quadratic in the number of q-points: it is timed only on a subset of the queries and its total time
+is extrapolated.
+
+Usage: python -m abiflows.benchmarks.bench_qpoints [--ngqpt 16] [--nloop 200]
+"""
+from __future__ import print_function, division, unicode_literals
+
+import argparse
+import time
+
+import numpy as np
+
+from abiflows.fireworks.utils.qpoints import QptIndex
+
+
+def loop_match(qpts, qpt):
+    for i, q in enumerate(qpts):
+        if np.allclose(q, qpt):
+            return i
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--ngqpt', type=int, default=16, help='Divisions of the q-mesh along each direction')
+    parser.add_argument('--nloop', type=int, default=200, help='Number of queries timed with the loop')
+    args = parser.parse_args()
+
+    ngqpt = args.ngqpt
+    qpts = [np.array([i, j, k]) / ngqpt for i in range(ngqpt) for j in range(ngqpt) for k in range(ngqpt)]
+    # Phonon perturbations: three per q-point, in a different order
+    rng = np.random.RandomState(0)
+    queries = [qpts[i] + rng.uniform(-1e-9, 1e-9, 3) for i in rng.permutation(len(qpts)) for _ in range(3)]
+    loop_queries = [queries[i] for i in rng.choice(len(queries), min(args.nloop, len(queries)), replace=False)]
+
+    start = time.time()
+    loop_matches = [loop_match(qpts, q) for q in loop_queries]
+    loop_time = (time.time() - start) * len(queries) / len(loop_queries)
+
+    start = time.time()
+    index = QptIndex(qpts)
+    index_matches = [index.get_index(q) for q in queries]
+    index_time = time.time() - start
+
+    index_loop_matches = [index.get_index(q) for q in loop_queries]
+    print('{:d} q-points, {:d} perturbations'.format(len(qpts), len(queries)))
+    print('loop  : {:8.3f} s (extrapolated from {:d} perturbations)'.format(loop_time, len(loop_queries)))
+    print('index : {:8.3f} s (speedup {:.0f}x)'.format(index_time, loop_time / index_time))
+    print('all matched : {}'.format(None not in index_matches))
+    print('identical matches : {}'.format(index_loop_matches == loop_matches))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+"""
+Benchmark of the creation of the Setup/Run/Control fireworks with createSRCFireworks.
+Compares the layered (copy-on-write) specs with the previous implementation, that deep-copied the spec four times
+and computed the short single core spec twice for each trio. Each implementation is run in a separate process
+to measure the peak RSS.
+
+Usage: python -m abiflows.benchmarks.bench_src_specs [--ntrios 5000]
+"""
+from __future__ import print_function, division, unicode_literals
+
+import argparse
+import copy
+import json
+import resource
+import subprocess
+import sys
+import time
+
+from fireworks.core.firework import Firework
+
+
+def get_spec(npayload=200):
+    """
+    Spec with a previous_fws payload similar to the one of a large DFPT workflow.
+    """
+    previous_fws = {'scf': [{'dir': '/path/to/scf/run', 'input': {'ecut': 10, 'ngkpt': [8, 8, 8],
+                                                                  'kpts': [[0.1 * i, 0.2, 0.3] for i in range(64)]}}],
+                    'phonon': [{'dir': '/path/to/phonon_{}/run'.format(i), 'qpt': [0.25, 0.0, 0.5],
+                                'data': list(range(50))} for i in range(npayload)]}
+    return {'previous_fws': previous_fws, 'initialization_info': {'kppa': 1000, 'ecut': 10},
+            '_preserve_fworker': True}
+
+
+def legacy_create_src_fireworks(setup_task, run_task, control_task, spec=None, initialization_info=None,
+                                task_index=None, setup_spec_update=None, run_spec_update=None):
+    """
+    Previous implementation of createSRCFireworks, kept for comparison.
+    """
+    from abiflows.fireworks.tasks.src_tasks_abc import SRCTaskIndex
+    from abiflows.fireworks.utils.fw_utils import set_short_single_core_to_spec
+    if spec is None:
+        spec = {}
+    if initialization_info is None:
+        initialization_info = {}
+    spec = copy.deepcopy(spec)
+    spec['_add_launchpad_and_fw_id'] = True
+    spec['_add_fworker'] = True
+    if task_index is not None:
+        src_task_index = SRCTaskIndex.from_any(task_index)
+    else:
+        src_task_index = SRCTaskIndex.from_task(run_task)
+    spec['SRC_task_index'] = src_task_index
+
+    setup_spec = copy.deepcopy(spec)
+    setup_spec.pop('queue_adapter_update', None)
+    setup_spec = set_short_single_core_to_spec(setup_spec)
+    setup_spec['_preserve_fworker'] = True
+    setup_spec['_pass_job_info'] = True
+    setup_spec['initialization_info'] = initialization_info
+    setup_spec.update({} if setup_spec_update is None else setup_spec_update)
+    setup_fw = Firework(setup_task, spec=setup_spec, name=src_task_index.setup_str)
+
+    run_spec = copy.deepcopy(spec)
+    run_spec['SRC_task_index'] = src_task_index
+    run_spec['_preserve_fworker'] = True
+    run_spec['_pass_job_info'] = True
+    run_spec.update({} if run_spec_update is None else run_spec_update)
+    run_fw = Firework(run_task, spec=run_spec, name=src_task_index.run_str)
+
+    control_spec = copy.deepcopy(spec)
+    control_spec = set_short_single_core_to_spec(control_spec)
+    control_spec['SRC_task_index'] = src_task_index
+    control_spec['_allow_fizzled_parents'] = True
+    control_fw = Firework(control_task, spec=control_spec, name=src_task_index.control_str)
+
+    links_dict = {setup_fw.fw_id: [run_fw.fw_id],
+                  run_fw.fw_id: [control_fw.fw_id]}
+    return {'setup_fw': setup_fw, 'run_fw': run_fw, 'control_fw': control_fw, 'links_dict': links_dict,
+            'fws': [setup_fw, run_fw, control_fw]}
+
+
+def build_trios(mode, ntrios):
+    from abiflows.core.mastermind_abc import ControlProcedure
+    from abiflows.fireworks.tasks.src_tasks_abc import SetupTask, ScriptRunTask, ControlTask, createSRCFireworks
+    from abiflows.fireworks.utils.fw_utils import LayeredSpec
+
+    control_procedure = ControlProcedure(controllers=[])
+    spec = get_spec()
+    if mode == 'layered':
+        # The same base is shared by all the trios, as done for the perturbations in the generation tasks
+        spec = LayeredSpec(base=spec)
+        create = createSRCFireworks
+    else:
+        create = legacy_create_src_fireworks
+
+    fws = []
+    start = time.time()
+    for itrio in range(ntrios):
+        src_fws = create(setup_task=SetupTask(), run_task=ScriptRunTask('echo run', control_procedure),
+                         control_task=ControlTask(control_procedure), spec=spec,
+                         task_index='pert-{}'.format(itrio))
+        fws.extend(src_fws['fws'])
+    build_time = time.time() - start
+
+    start = time.time()
+    for fw in fws:
+        fw.to_dict()
+    serialization_time = time.time() - start
+
+    # ru_maxrss is in kilobytes on linux and in bytes on mac os
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss /= 1024
+    return {'mode': mode, 'ntrios': ntrios, 'build_time': build_time, 'serialization_time': serialization_time,
+            'peak_rss_mb': maxrss / 1024}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--ntrios', type=int, default=5000, help="Number of SRC trios to build.")
+    parser.add_argument('--mode', choices=['layered', 'legacy'], default=None,
+                        help="Run a single implementation in the current process and print the results as json.")
+    options = parser.parse_args()
+
+    if options.mode is not None:
+        print(json.dumps(build_trios(options.mode, options.ntrios)))
+        return 0
+
+    print("{:>8s} {:>8s} {:>12s} {:>12s} {:>14s}".format('mode', 'ntrios', 'build [s]', 'to_dict [s]',
+                                                         'peak RSS [MB]'))
+    for mode in ['legacy', 'layered']:
+        out = subprocess.check_output([sys.executable, '-m', 'abiflows.benchmarks.bench_src_specs',
+                                       '--ntrios', str(options.ntrios), '--mode', mode])
+        res = json.loads(out.decode('utf-8').strip().splitlines()[-1])
+        print("{mode:>8s} {ntrios:8d} {build_time:12.2f} {serialization_time:12.2f} {peak_rss_mb:14.1f}".format(
+            **res))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
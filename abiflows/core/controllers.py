@@ -12,6 +12,8 @@ from abiflows.core.mastermind_abc import ControlledItemType
 from abiflows.core.mastermind_abc import PRIORITY_HIGH
 from abiflows.core.mastermind_abc import PRIORITY_VERY_LOW
 from abiflows.core.mastermind_abc import PRIORITY_LOWEST
+from abiflows.core.mastermind_abc import get_artifact_cache
+from abiflows.core.event_parsing import IncrementalEventsParser
 
 from monty.json import MontyDecoder
 from pymatgen.io.abinit import events
@@ -25,7 +27,9 @@ from pymatgen.analysis.transition_state import NEBAnalysis
 from pymatgen.core.structure import Structure
 from abipy.abio.inputs import AbinitInput
 import logging
+import math
 import os
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -41,6 +45,7 @@ class AbinitController(Controller):
     can_validate = True
     #_controlled_item_types = [ControlledItemType.task_completed(), ControlledItemType.task_failed()]
     _controlled_item_types = [ControlledItemType.task_completed()]
+    uses_artifact_cache = True
 
     def __init__(self, critical_events=None, handlers=None):
         """
@@ -80,9 +85,15 @@ class AbinitController(Controller):
         # Initialize the actions for everything that is passed to kwargs
         actions = {}
 
+        artifact_cache = kwargs.get('artifact_cache', None)
+        if artifact_cache is None:
+            artifact_cache = get_artifact_cache()
+
         report = None
         try:
-            report = self.get_event_report(abinit_log_file, abinit_mpi_abort_file)
+            report = artifact_cache.get_parsed('abinit_event_report',
+                                               [abinit_log_file.path, abinit_mpi_abort_file.path],
+                                               lambda: self.get_event_report(abinit_log_file, abinit_mpi_abort_file))
         except Exception as exc:
             msg = "%s exception while parsing event_report:\n%s" % (self, exc)
             logger.critical(msg)
@@ -246,7 +257,8 @@ class AbinitController(Controller):
                 return abort_report
 
         try:
-            report = parser.parse(ofile.path)
+            # The (possibly huge) main output file is parsed incrementally
+            report = IncrementalEventsParser().parse(ofile.path)
 
             # Add events found in the ABI_MPIABORTFILE.
             if mpiabort_file.exists:
@@ -329,6 +341,148 @@ class AbinitController(Controller):
         return cls(critical_events=helper.CRITICAL_EVENTS, handlers=None)
 
 
+def lower_scf_mixing(abinit_input, factor=0.5, min_diemix=0.05):
+    """
+    Multiplies the mixing factor (diemix) of the SCF cycle of an abinit input by factor. Raises a ValueError if the
+    mixing factor cannot be lowered below min_diemix.
+    """
+    # default of abinit: 0.7 with PAW, 1.0 otherwise
+    diemix = abinit_input.get('diemix', 0.7 if getattr(abinit_input, 'ispaw', False) else 1.0)
+    if diemix <= min_diemix:
+        raise ValueError('SCF cycle diverging with diemix {:.3f}: the mixing cannot be lowered further'.format(diemix))
+    abinit_input.set_vars(diemix=max(diemix * factor, min_diemix))
+
+
+class AbinitScfDivergenceMonitor(Controller):
+    """
+    Monitor controller checking the residuals of the SCF cycles in the log of abinit while it is running.
+    The run is aborted when the residual (last column of the ETOT lines) increased during nincreasing consecutive
+    iterations and is larger than factor times the lowest residual of the current SCF cycle. The mixing factor
+    (diemix) of the input is multiplied by mixing_factor for the restart (see lower_scf_mixing), down to min_diemix.
+    """
+
+    _controlled_item_types = [ControlledItemType.task_running()]
+
+    def __init__(self, nincreasing=5, factor=100.0, mixing_factor=0.5, min_diemix=0.05):
+        """
+        Args:
+            nincreasing: Number of consecutive iterations with an increasing residual.
+            factor: Minimum ratio between the last residual and the lowest residual of the SCF cycle.
+            mixing_factor: Factor applied to the mixing factor (diemix) of the input for the restart.
+            min_diemix: Minimum mixing factor. If the SCF cycle diverges with this mixing the error is unrecoverable.
+        """
+        super(AbinitScfDivergenceMonitor, self).__init__()
+        self.nincreasing = nincreasing
+        self.factor = factor
+        self.mixing_factor = mixing_factor
+        self.min_diemix = min_diemix
+        self.set_priority(PRIORITY_HIGH)
+        self.reset()
+
+    def reset(self):
+        self._residuals = []
+        self._last_iteration = 0
+
+    def as_dict(self):
+        return {'@class': self.__class__.__name__,
+                '@module': self.__class__.__module__,
+                'nincreasing': self.nincreasing,
+                'factor': self.factor,
+                'mixing_factor': self.mixing_factor,
+                'min_diemix': self.min_diemix}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(nincreasing=d['nincreasing'], factor=d['factor'], mixing_factor=d.get('mixing_factor', 0.5),
+                   min_diemix=d.get('min_diemix', 0.05))
+
+    def process(self, **kwargs):
+        for line in kwargs.get('new_output', '').splitlines():
+            tokens = line.split()
+            if len(tokens) < 5 or tokens[0] != 'ETOT':
+                continue
+            try:
+                iteration = int(tokens[1])
+                residual = float(tokens[-1])
+            except ValueError:
+                continue
+            # A new SCF cycle is starting (e.g. new relaxation step)
+            if iteration <= self._last_iteration:
+                self._residuals = []
+            self._last_iteration = iteration
+            self._residuals.append(residual)
+
+        note = ControllerNote(controller=self)
+        if self.is_diverging():
+            note.state = ControllerNote.ERROR_RECOVERABLE
+            note.add_problem('SCF cycle diverging: residual increased from {:.3E} to {:.3E} during the last {:d} '
+                             'iterations'.format(min(self._residuals), self._residuals[-1], self.nincreasing))
+            # The wavefunctions and density of the diverging cycle should not be used
+            note.reset_restart()
+            note.actions = {'abinit_input': Action(callable=lower_scf_mixing, factor=self.mixing_factor,
+                                                   min_diemix=self.min_diemix)}
+        else:
+            note.state = ControllerNote.NOTHING_FOUND
+        return note
+
+    def is_diverging(self):
+        if len(self._residuals) <= self.nincreasing:
+            return False
+        last_residuals = self._residuals[-self.nincreasing - 1:]
+        increasing = all(r2 > r1 for r1, r2 in zip(last_residuals[:-1], last_residuals[1:]))
+        return increasing and self._residuals[-1] > self.factor * min(self._residuals)
+
+
+class AbinitCriticalEventsMonitor(Controller):
+    """
+    Monitor controller aborting the run as soon as one of the critical events appears in the log of abinit
+    (e.g. to avoid waiting until the walltime when one of the MPI processes is stuck after an error).
+    """
+
+    _controlled_item_types = [ControlledItemType.task_running()]
+
+    def __init__(self, critical_events=None):
+        """
+        Args:
+            critical_events: List of events aborting the run. Defaults to errors and bugs.
+        """
+        super(AbinitCriticalEventsMonitor, self).__init__()
+        if critical_events is None:
+            critical_events = [events.AbinitError, events.AbinitBug]
+        self.critical_events = critical_events if isinstance(critical_events, (list, tuple)) else [critical_events]
+        self.set_priority(PRIORITY_HIGH)
+
+    def as_dict(self):
+        critical_events = [{'module': ce.__module__, 'name': ce.__name__} for ce in self.critical_events]
+        return {'@class': self.__class__.__name__,
+                '@module': self.__class__.__module__,
+                'critical_events': critical_events}
+
+    @classmethod
+    def from_dict(cls, d):
+        import importlib
+        critical_events = []
+        for ced in d['critical_events']:
+            mod = importlib.import_module(ced['module'])
+            critical_events.append(getattr(mod, ced['name']))
+        return cls(critical_events=critical_events)
+
+    def process(self, **kwargs):
+        note = ControllerNote(controller=self)
+        note.state = ControllerNote.NOTHING_FOUND
+        output_filepath = kwargs.get('output_filepath', None)
+        if output_filepath is None or not os.path.exists(output_filepath):
+            return note
+        # The log is parsed incrementally: only the output appended since the previous check is scanned
+        report = IncrementalEventsParser().parse(output_filepath)
+        critical_events_found = report.filter_types(self.critical_events)
+        if critical_events_found:
+            note.state = ControllerNote.ERROR_UNRECOVERABLE
+            note.add_problem('Critical events found during the run: '
+                             '{}'.format(', '.join(e.name for e in critical_events_found)))
+        return note
+
+
 class QueueControllerMixin(object):
 
     def get_queue_errors(self, **kwargs):
@@ -337,6 +491,9 @@ class QueueControllerMixin(object):
         qout_filepath = kwargs.get('qout_filepath', None)
         queue_adapter = kwargs.get('queue_adapter', None)
         memory_policy = kwargs.get('memory_policy', None)
+        artifact_cache = kwargs.get('artifact_cache', None)
+        if artifact_cache is None:
+            artifact_cache = get_artifact_cache()
         #TODO: deal with the memory policy in the scheduler parser (whether it is vmem or mem in PBS for example ...)
         if 'queue_adapter' is None:
             raise ValueError('WalltimeController should have access to the queue_adapter')
@@ -344,38 +501,41 @@ class QueueControllerMixin(object):
             raise ValueError('WalltimeController should have access to the qerr_filepath')
         if 'qout_filepath' is None:
             raise ValueError('WalltimeController should have access to the qout_filepath')
-        # Analyze the stderr and stdout files of the resource manager system.
-        qerr_info = None
-        qout_info = None
-        if qerr_filepath is not None and os.path.exists(qerr_filepath):
-            with open(qerr_filepath, "r") as f:
-                qerr_info = f.read()
-        if qout_filepath is not None and os.path.exists(qout_filepath):
-            with open(qout_filepath, "r") as f:
-                qout_info = f.read()
-        if qerr_info or qout_info:
-            from pymatgen.io.abinit.scheduler_error_parsers import get_parser
+        # Analyze the stderr and stdout files of the resource manager system (only if one of them is not empty).
+        #  The files are parsed only once for all the queue controllers through the artifact cache.
+        if artifact_cache.get_size(qerr_filepath) or artifact_cache.get_size(qout_filepath):
             qtype = queue_adapter.QTYPE
-            scheduler_parser = get_parser(qtype, err_file=qerr_filepath,
-                                          out_file=qout_filepath)
-
-            if scheduler_parser is None:
-                raise ValueError('Cannot find scheduler_parser for qtype {}'.format(qtype))
-
-            scheduler_parser.parse()
-            queue_errors = scheduler_parser.errors
-            return queue_errors
+            queue_errors = artifact_cache.get_parsed('scheduler_errors_{}'.format(qtype),
+                                                     [qerr_filepath, qout_filepath],
+                                                     lambda: self._parse_queue_errors(qtype, qerr_filepath,
+                                                                                      qout_filepath))
+            return list(queue_errors)
         else:
             return None
 
+    @staticmethod
+    def _parse_queue_errors(qtype, qerr_filepath, qout_filepath):
+        from pymatgen.io.abinit.scheduler_error_parsers import get_parser
+        scheduler_parser = get_parser(qtype, err_file=qerr_filepath,
+                                      out_file=qout_filepath)
+
+        if scheduler_parser is None:
+            raise ValueError('Cannot find scheduler_parser for qtype {}'.format(qtype))
+
+        scheduler_parser.parse()
+        return scheduler_parser.errors
+
 
 class WalltimeController(Controller, QueueControllerMixin):
     """
-    Controller for walltime infringements of the resource manager.
+    Controller for walltime infringements of the resource manager. The runs stopped by the checkpoint supervisor
+    before the end of the walltime (see the checkpoint object) are also restarted with an increased timelimit,
+    reusing the checkpoint files if they were written.
     """
 
     is_handler = True
-    _controlled_item_types = [ControlledItemType.task_failed()]
+    _controlled_item_types = [ControlledItemType.task_completed(), ControlledItemType.task_failed()]
+    uses_artifact_cache = True
 
     def __init__(self, max_timelimit=None, timelimit_increase=None):
         """
@@ -416,31 +576,38 @@ class WalltimeController(Controller, QueueControllerMixin):
         queue_adapter = kwargs.get('queue_adapter', None)
         if queue_adapter is None:
             raise ValueError('No queue adapter passed to the WalltimeController')
-        queue_errors = self.get_queue_errors(**kwargs)
+        # Checkpoint info of the run, if it was stopped before the end of the walltime
+        checkpoint = kwargs.get('checkpoint', None)
 
         # Create the Controller Note and the actions
         note = ControllerNote(controller=self)
         actions = {}
 
-        # No errors found
-        if not queue_errors:
-            note.state = ControllerNote.NOTHING_FOUND
-            return note
+        if checkpoint is not None:
+            note.add_problem('Task has been stopped before the timelimit')
+        else:
+            queue_errors = self.get_queue_errors(**kwargs)
 
-        # Get the timelimit error if there is one
-        timelimit_error = None
-        for error in queue_errors:
-            if isinstance(error, TimeCancelError):
-                logger.debug('found timelimit error.')
-                timelimit_error = error
+            # No errors found
+            if not queue_errors:
+                note.state = ControllerNote.NOTHING_FOUND
+                return note
 
-        # No timelimit error found
-        if timelimit_error is None:
-            note.state = ControllerNote.NOTHING_FOUND
-            return note
+            # Get the timelimit error if there is one
+            timelimit_error = None
+            for error in queue_errors:
+                if isinstance(error, TimeCancelError):
+                    logger.debug('found timelimit error.')
+                    timelimit_error = error
+
+            # No timelimit error found
+            if timelimit_error is None:
+                note.state = ControllerNote.NOTHING_FOUND
+                return note
+
+            note.add_problem('Task has been stopped due to timelimit')
 
         # Setup the new timelimit
-        note.add_problem('Task has been stopped due to timelimit')
         if self.max_timelimit is None:
             max_timelimit = queue_adapter.timelimit_hard
         else:
@@ -455,7 +622,8 @@ class WalltimeController(Controller, QueueControllerMixin):
             note.state = ControllerNote.ERROR_UNRECOVERABLE
             note.add_problem('Maximum timelimit has been reached, cannot increase further')
             return note
-        new_timelimit = old_timelimit + timelimit_increase
+        new_timelimit = self.get_new_timelimit(old_timelimit=old_timelimit, timelimit_increase=timelimit_increase,
+                                               note=note, **kwargs)
         # If the new timelimit exceeds the max timelimit, just put it to the max timelimit
         if new_timelimit > max_timelimit:
             new_timelimit = max_timelimit
@@ -465,9 +633,191 @@ class WalltimeController(Controller, QueueControllerMixin):
                                           timelimit=new_timelimit)
         note.state = ControllerNote.ERROR_RECOVERABLE
         note.actions = actions
-        note.reset_restart()
+        # the restart reuses the checkpoint files written before the end of the walltime
+        if checkpoint is not None and checkpoint.get('checkpoint_written', False):
+            note.simple_restart()
+        else:
+            note.reset_restart()
         return note
 
+    def get_new_timelimit(self, old_timelimit, timelimit_increase, note, **kwargs):
+        """
+        Returns the new timelimit (before it is capped to the maximum timelimit).
+        """
+        return old_timelimit + timelimit_increase
+
+
+_RELAX_ITERATION_RE = re.compile(r'--- Iteration:\s*\(\s*(\d+)\s*/\s*(\d+)\s*\)')
+_SCF_ITERATION_RE = re.compile(r'ETOT\s+(\d+)\s')
+_IRRED_PERTURBATION_RE = re.compile(r'\d+\)\s+idir=\s*\d+\s+ipert=\s*\d+')
+_MAX_GRAD_RE = re.compile(r'max grad \(force/stress\)\s*=\s*([0-9.EeDd+-]+)\s*[<>]\s*tolmxf\s*=\s*([0-9.EeDd+-]+)')
+
+# Index in the ETOT lines (split) of the quantity compared with each SCF tolerance
+_SCF_TOLERANCE_COLUMNS = {'tolvrs': -1, 'tolrff': -1, 'toldfe': 3, 'tolwfr': 4}
+
+
+def estimate_remaining_steps(values, target, max_remaining, npoints=5):
+    """
+    Estimates the number of steps needed by a quantity converging exponentially (e.g. the residual of an SCF cycle
+    or the maximum force of a relaxation) to go below target, from the linear fit of the logarithm of its last
+    npoints values. Returns max_remaining if the values are not decreasing or if there are less than two values.
+    """
+    if not values:
+        return max_remaining
+    if abs(values[-1]) < target:
+        return 0
+    points = [(i, math.log10(abs(v))) for i, v in enumerate(values) if v != 0][-npoints:]
+    if len(points) < 2:
+        return max_remaining
+    mean_x = sum(x for x, y in points) / float(len(points))
+    mean_y = sum(y for x, y in points) / float(len(points))
+    slope = (sum((x - mean_x) * (y - mean_y) for x, y in points) /
+             sum((x - mean_x) ** 2 for x, y in points))
+    if slope >= 0:
+        return max_remaining
+    return min(int(math.ceil((math.log10(target) - math.log10(abs(values[-1]))) / slope)), max_remaining)
+
+
+def _get_scf_tolerance(abinit_input):
+    if abinit_input is None:
+        return None, None
+    for tolerance, column in _SCF_TOLERANCE_COLUMNS.items():
+        if abinit_input.get(tolerance, None):
+            return abinit_input.get(tolerance), column
+    return None, None
+
+
+def _to_float(token):
+    return float(token.replace('D', 'E').replace('d', 'e'))
+
+
+def get_abinit_progress(log_filepath, abinit_input=None):
+    """
+    Gets the progress of an (interrupted) abinit run from its log file. The progress is given by the relaxation
+    steps if any, otherwise by the perturbations of a DFPT run, otherwise by the iterations of the last SCF cycle
+    (the maximum number of iterations being nstep).
+    The number of remaining units is estimated from the convergence trend of the maximum force with respect to
+    tolmxf for the relaxations and of the quantity checked by the SCF tolerance of the input (e.g. the residual of
+    the potential for tolvrs) for the SCF cycles. If the trend cannot be found, all the units up to the maximum
+    are assumed to be needed. All the remaining perturbations are needed.
+
+    Returns:
+        dict with the kind of progress ("relaxation", "perturbations" or "scf"), the number of completed units
+        ("done"), the maximum number of units ("total") and the estimated number of units still needed
+        ("remaining"), or None if no progress information could be found.
+    """
+    if log_filepath is None or not os.path.exists(log_filepath):
+        return None
+    relax_done, relax_total = None, None
+    max_grads, tolmxf = [], None
+    nperturbations, nperturbations_started = 0, 0
+    in_perturbations_list = False
+    scf_iteration = 0
+    scf_values = []
+    scf_tolerance, scf_column = _get_scf_tolerance(abinit_input)
+    with open(log_filepath, 'r') as f:
+        for line in f:
+            stripped = line.strip()
+            if in_perturbations_list:
+                if _IRRED_PERTURBATION_RE.match(stripped):
+                    nperturbations += 1
+                    continue
+                in_perturbations_list = False
+            if stripped.startswith('ETOT'):
+                match = _SCF_ITERATION_RE.match(stripped)
+                if match:
+                    iteration = int(match.group(1))
+                    # A new SCF cycle is starting
+                    if iteration <= scf_iteration:
+                        scf_values = []
+                    scf_iteration = iteration
+                    if scf_column is not None:
+                        try:
+                            scf_values.append(_to_float(stripped.split()[scf_column]))
+                        except (IndexError, ValueError):
+                            pass
+            elif stripped.startswith('--- Iteration'):
+                match = _RELAX_ITERATION_RE.match(stripped)
+                if match:
+                    # The current relaxation step is not completed
+                    relax_done, relax_total = int(match.group(1)) - 1, int(match.group(2))
+            elif stripped.startswith('The list of irreducible perturbations'):
+                in_perturbations_list = True
+            elif stripped.startswith('Perturbation :'):
+                nperturbations_started += 1
+            elif 'max grad (force/stress)' in stripped:
+                match = _MAX_GRAD_RE.search(stripped)
+                if match:
+                    max_grads.append(_to_float(match.group(1)))
+                    tolmxf = _to_float(match.group(2))
+    if relax_total is not None and relax_done > 0:
+        remaining = relax_total - relax_done
+        if tolmxf:
+            remaining = estimate_remaining_steps(max_grads, tolmxf, remaining)
+        return {'kind': 'relaxation', 'done': relax_done, 'total': relax_total, 'remaining': remaining}
+    if nperturbations > 0 and nperturbations_started > 1:
+        done = nperturbations_started - 1
+        return {'kind': 'perturbations', 'done': done, 'total': nperturbations, 'remaining': nperturbations - done}
+    if scf_iteration > 0:
+        nstep = 30
+        if abinit_input is not None and abinit_input.get('nstep', None) is not None:
+            nstep = abinit_input.get('nstep')
+        total = max(nstep, scf_iteration)
+        remaining = total - scf_iteration
+        if scf_tolerance is not None:
+            remaining = estimate_remaining_steps(scf_values, scf_tolerance, remaining)
+        return {'kind': 'scf', 'done': scf_iteration, 'total': total, 'remaining': remaining}
+    return None
+
+
+class ProgressWalltimeController(WalltimeController):
+    """
+    Controller for walltime infringements of the resource manager extrapolating the time needed by the task from
+    the progress of the interrupted run (relaxation steps, perturbations or SCF iterations found in the abinit log).
+    The new timelimit is set in one step to the time extrapolated for the remaining units (see get_abinit_progress)
+    increased by a safety margin (and capped to the maximum timelimit). If no progress information can be found in
+    the log, the timelimit is increased by the fixed increment as in the WalltimeController.
+    """
+
+    def __init__(self, max_timelimit=None, timelimit_increase=None, safety_margin=0.2):
+        """
+        Args:
+            max_timelimit: Maximum timelimit (in seconds).
+            timelimit_increase: Amount of time (in seconds) to increase the timelimit when no progress information
+                is available. The new timelimit is never lower than the one obtained with this increase.
+            safety_margin: Relative margin added to the extrapolated time.
+        """
+        super(ProgressWalltimeController, self).__init__(max_timelimit=max_timelimit,
+                                                         timelimit_increase=timelimit_increase)
+        self.safety_margin = safety_margin
+
+    def as_dict(self):
+        d = super(ProgressWalltimeController, self).as_dict()
+        d['safety_margin'] = self.safety_margin
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(max_timelimit=d['max_timelimit'],
+                   timelimit_increase=d['timelimit_increase'],
+                   safety_margin=d.get('safety_margin', 0.2))
+
+    def get_new_timelimit(self, old_timelimit, timelimit_increase, note, **kwargs):
+        fixed_timelimit = old_timelimit + timelimit_increase
+        progress = get_abinit_progress(kwargs.get('abinit_log_filepath', None),
+                                       abinit_input=kwargs.get('abinit_input', None))
+        if progress is None or progress['done'] == 0:
+            note.add_problem('No progress information found, timelimit increased by {}'.format(timelimit_increase))
+            return fixed_timelimit
+        # The run was stopped at the timelimit and is restarted from its last state: extrapolate the time needed by
+        #  the remaining units assuming a constant time per unit
+        extrapolated_timelimit = (old_timelimit * float(progress['remaining']) / progress['done'] *
+                                  (1.0 + self.safety_margin))
+        note.add_problem('Run stopped after {:d}/{:d} {} units with {:d} units remaining, extrapolated '
+                         'timelimit is {:.0f} s'.format(progress['done'], progress['total'], progress['kind'],
+                                                        progress['remaining'], extrapolated_timelimit))
+        return max(int(round(extrapolated_timelimit)), fixed_timelimit)
+
 
 class MemoryController(Controller, QueueControllerMixin):
     """
@@ -478,6 +828,7 @@ class MemoryController(Controller, QueueControllerMixin):
     is_handler = True
     #_controlled_item_types = [ControlledItemType.task_failed()]
     _controlled_item_types = [ControlledItemType.task_completed(), ControlledItemType.task_failed()]
+    uses_artifact_cache = True
 
 #
 #     def __init__(self, job_rundir='.', qout_file='queue.qout', qerr_file='queue.qerr', queue_adapter=None,
@@ -585,16 +936,11 @@ class MemoryController(Controller, QueueControllerMixin):
         if memory_error or slave_memory_error:
             note.add_problem('Task has been stopped due to memory infringement'
                              '{}'.format('' if memory_error else ' by a slave process'))
-            old_mem_per_proc = queue_adapter.mem_per_proc
-            if old_mem_per_proc == self.max_mem_per_proc_mb:
+            mem_actions = self.get_mem_per_proc_actions(note=note, **kwargs)
+            if mem_actions is None:
                 note.state = ControllerNote.ERROR_UNRECOVERABLE
-                note.add_problem('Maximum mem_per_proc has been reached, cannot increase further')
                 return note
-            new_mem_per_proc = old_mem_per_proc + self.mem_per_proc_increase_mb
-            if new_mem_per_proc > self.max_mem_per_proc_mb:
-                new_mem_per_proc = self.max_mem_per_proc_mb
-            actions['queue_adapter'] = Action(callable=queue_adapter.__class__.set_mem_per_proc,
-                                              mem_mb=new_mem_per_proc)
+            actions.update(mem_actions)
         if master_memory_error:
             note.add_problem('Task has been stopped due to memory infringement by the master process')
             old_mem_overhead = self.queue_adapter.master_mem_overhead
@@ -614,6 +960,191 @@ class MemoryController(Controller, QueueControllerMixin):
         note.reset_restart()
         return note
 
+    def get_mem_per_proc_actions(self, queue_adapter, note, **kwargs):
+        """
+        Returns the actions (dict with the target objects as keys) to be applied after a memory infringement by the
+        (slave) processes or None if the memory cannot be increased further.
+        """
+        old_mem_per_proc = queue_adapter.mem_per_proc
+        if old_mem_per_proc == self.max_mem_per_proc_mb:
+            note.add_problem('Maximum mem_per_proc has been reached, cannot increase further')
+            return None
+        new_mem_per_proc = old_mem_per_proc + self.mem_per_proc_increase_mb
+        if new_mem_per_proc > self.max_mem_per_proc_mb:
+            new_mem_per_proc = self.max_mem_per_proc_mb
+        return {'queue_adapter': Action(callable=queue_adapter.__class__.set_mem_per_proc, mem_mb=new_mem_per_proc)}
+
+
+_ABINIT_MEMORY_ESTIMATE_RE = re.compile(r'This job should need less than\s+([0-9.]+)\s+Mbytes')
+# Memory used by the job (in kB) when it is killed by the resource manager. PBS/Torque:
+#  "=>> PBS: job killed: mem job total 10485760 kb exceeded limit 4194304 kb"
+# Slurm (jobacct_gather memory enforcement):
+#  "slurmstepd: error: Step 1234.0 exceeded memory limit (10485760 > 4194304), being killed"
+# The oom-kill messages of the cgroup plugin of Slurm ("Detected 1 oom-kill event(s)") do not give the memory used:
+#  in that case the estimate of abinit is used.
+_MEMORY_EXCEEDED_RES = [re.compile(r'job killed: (?:v?mem|mem job total)\s+(\d+)\s*kb exceeded limit'),
+                        re.compile(r'exceeded memory limit \((\d+) > \d+\)')]
+
+
+def get_peak_memory_mb(qerr_filepath=None, qout_filepath=None, abinit_log_filepath=None, mpi_procs=1):
+    """
+    Gets the peak memory per process (in megabytes) of a run stopped because of a memory infringement. The total
+    memory used by the job reported by the resource manager (PBS/Torque or Slurm, when it reports it) is preferred
+    to the memory estimated by abinit at the beginning of the run.
+
+    Returns:
+        The peak memory per process in megabytes or None if it could not be found.
+    """
+    for filepath in [qerr_filepath, qout_filepath]:
+        if filepath is None or not os.path.exists(filepath):
+            continue
+        peak_kb = None
+        with open(filepath, 'r') as f:
+            for line in f:
+                for memory_exceeded_re in _MEMORY_EXCEEDED_RES:
+                    match = memory_exceeded_re.search(line)
+                    if match:
+                        peak_kb = max(peak_kb or 0, int(match.group(1)))
+        if peak_kb is not None:
+            return peak_kb / 1024.0 / mpi_procs
+    if abinit_log_filepath is not None and os.path.exists(abinit_log_filepath):
+        with open(abinit_log_filepath, 'r') as f:
+            for line in f:
+                match = _ABINIT_MEMORY_ESTIMATE_RE.search(line)
+                if match:
+                    return float(match.group(1))
+    return None
+
+
+def set_mpi_procs_and_mem_per_proc(queue_adapter, mpi_procs, mem_mb):
+    """
+    Sets both the number of MPI processes and the memory per process of a queue adapter.
+    """
+    queue_adapter.set_mpi_procs(mpi_procs)
+    queue_adapter.set_mem_per_proc(mem_mb)
+
+
+# Variables of abinit defining the distribution of the work among the MPI processes
+PARAL_VARS = ['npkpt', 'npspinor', 'npband', 'npfft', 'bandpp']
+
+
+def set_paral_vars(abinit_input, **paral_vars):
+    """
+    Replaces the variables of the parallel configuration of an abinit input.
+    """
+    abinit_input.remove_vars(PARAL_VARS, strict=False)
+    abinit_input.set_vars(**paral_vars)
+
+
+class EstimatedMemoryController(MemoryController):
+    """
+    Controller for memory infringements of the resource manager using the memory estimates of the parallel
+    configurations computed by abinit's autoparal (the ParalHints passed as "paral_hints") and the peak memory
+    reported by the resource manager or by abinit in the log. Instead of increasing the memory by fixed steps, the
+    memory per process is set in one step to the predicted memory (increased by a safety margin). If the predicted
+    memory exceeds the maximum memory per process, the parallel configuration with the lowest number of MPI
+    processes for which the predicted memory per process fits is used instead, together with its parallel variables
+    (npkpt, npband, ...) set in the abinit input. If no information is available, the memory is increased by the
+    fixed increment as in the MemoryController.
+    """
+
+    def __init__(self, max_mem_per_proc_mb=8000, mem_per_proc_increase_mb=1000,
+                 max_master_mem_overhead_mb=8000, master_mem_overhead_increase_mb=1000,
+                 memory_policy='physical_memory', safety_margin=0.2):
+        """
+        Args:
+            max_mem_per_proc_mb: Maximum memory per process in megabytes.
+            mem_per_proc_increase_mb: Minimum amount of memory to increase the memory per process in megabytes.
+            max_master_mem_overhead_mb: Maximum overhead memory for the master process in megabytes.
+            master_mem_overhead_increase_mb: Amount of memory to increase the overhead memory for the master process
+                                             in megabytes.
+            memory_policy: Policy for the memory (some weird clusters sometimes use the virtual memory to stop jobs
+                           that overcome some virtual memory limit)
+            safety_margin: Relative margin added to the predicted memory.
+        """
+        super(EstimatedMemoryController, self).__init__(max_mem_per_proc_mb=max_mem_per_proc_mb,
+                                                        mem_per_proc_increase_mb=mem_per_proc_increase_mb,
+                                                        max_master_mem_overhead_mb=max_master_mem_overhead_mb,
+                                                        master_mem_overhead_increase_mb=master_mem_overhead_increase_mb,
+                                                        memory_policy=memory_policy)
+        self.safety_margin = safety_margin
+
+    def as_dict(self):
+        d = super(EstimatedMemoryController, self).as_dict()
+        d['safety_margin'] = self.safety_margin
+        return d
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(max_mem_per_proc_mb=d['max_mem_per_proc_mb'],
+                   mem_per_proc_increase_mb=d['mem_per_proc_increase_mb'],
+                   max_master_mem_overhead_mb=d['max_master_mem_overhead_mb'],
+                   master_mem_overhead_increase_mb=d['master_mem_overhead_increase_mb'],
+                   memory_policy=d['memory_policy'],
+                   safety_margin=d.get('safety_margin', 0.2))
+
+    @staticmethod
+    def get_paral_confs(paral_hints):
+        """
+        Returns the list of parallel configurations (dicts with mpi_ncpus, omp_ncpus, mem_per_cpu, efficiency and
+        vars) from a ParalHints object or from its dict representation.
+        """
+        if paral_hints is None:
+            return []
+        if isinstance(paral_hints, dict):
+            return list(paral_hints['confs'])
+        return list(paral_hints)
+
+    def get_mem_per_proc_actions(self, queue_adapter, note, **kwargs):
+        old_mem_per_proc = queue_adapter.mem_per_proc
+        mpi_procs = queue_adapter.mpi_procs
+        confs = self.get_paral_confs(kwargs.get('paral_hints', None))
+        current_confs = [conf for conf in confs if conf['mpi_ncpus'] == mpi_procs and conf['mem_per_cpu'] > 0]
+        estimated_mem_per_proc = current_confs[0]['mem_per_cpu'] if current_confs else None
+        peak_mem_per_proc = get_peak_memory_mb(qerr_filepath=kwargs.get('qerr_filepath', None),
+                                               qout_filepath=kwargs.get('qout_filepath', None),
+                                               abinit_log_filepath=kwargs.get('abinit_log_filepath', None),
+                                               mpi_procs=mpi_procs)
+        known_mems = [mem for mem in [estimated_mem_per_proc, peak_mem_per_proc] if mem is not None]
+        if not known_mems:
+            note.add_problem('No memory estimate found, mem_per_proc increased by {}'.format(
+                self.mem_per_proc_increase_mb))
+            return super(EstimatedMemoryController, self).get_mem_per_proc_actions(queue_adapter=queue_adapter,
+                                                                                    note=note, **kwargs)
+
+        # The run needed more than the memory it was given: never predict less than the fixed increase
+        required_mem_per_proc = max(int(round(max(known_mems) * (1.0 + self.safety_margin))),
+                                    old_mem_per_proc + self.mem_per_proc_increase_mb)
+        if required_mem_per_proc <= self.max_mem_per_proc_mb:
+            note.add_problem('Predicted memory per process is {:d} MB'.format(required_mem_per_proc))
+            return {'queue_adapter': Action(callable=queue_adapter.__class__.set_mem_per_proc,
+                                            mem_mb=required_mem_per_proc)}
+
+        # Use more MPI processes with less memory per process. The memory estimates of autoparal are rescaled with
+        #  the ratio between the required memory and the estimate for the current configuration.
+        if estimated_mem_per_proc is not None:
+            scaling = float(required_mem_per_proc) / estimated_mem_per_proc
+        else:
+            scaling = 1.0 + self.safety_margin
+        fitting_confs = []
+        for iconf, conf in enumerate(confs):
+            if conf['mpi_ncpus'] <= mpi_procs or conf['mem_per_cpu'] <= 0:
+                continue
+            predicted_mem_per_proc = int(round(conf['mem_per_cpu'] * scaling))
+            if predicted_mem_per_proc <= self.max_mem_per_proc_mb:
+                fitting_confs.append((conf['mpi_ncpus'], -conf.get('efficiency', 0.0), predicted_mem_per_proc, iconf))
+        if not fitting_confs:
+            note.add_problem('Predicted memory per process ({:d} MB) exceeds the maximum mem_per_proc and no parallel '
+                             'configuration with less memory per process is available'.format(required_mem_per_proc))
+            return None
+        new_mpi_procs, _, new_mem_per_proc, iconf = min(fitting_confs)
+        note.add_problem('Predicted memory per process ({:d} MB) exceeds the maximum mem_per_proc, switching to {:d} '
+                         'MPI processes with {:d} MB per process'.format(required_mem_per_proc, new_mpi_procs,
+                                                                         new_mem_per_proc))
+        return {'queue_adapter': Action(callable=set_mpi_procs_and_mem_per_proc, mpi_procs=new_mpi_procs,
+                                        mem_mb=new_mem_per_proc),
+                'abinit_input': Action(callable=set_paral_vars, **confs[iconf].get('vars', {}))}
+
 
 class AbinitZenobeSlaveMemoryController(Controller, QueueControllerMixin):
     """
@@ -841,6 +1372,7 @@ class UltimateMemoryController(Controller, QueueControllerMixin):
     #_controlled_item_types = [ControlledItemType.task_failed()]
     _controlled_item_types = [ControlledItemType.task_completed(), ControlledItemType.task_failed()]
     _only_unfinalized = True
+    uses_artifact_cache = True
 
 #
 #     def __init__(self, job_rundir='.', qout_file='queue.qout', qerr_file='queue.qerr', queue_adapter=None,
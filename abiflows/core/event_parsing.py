@@ -0,0 +1,225 @@
+# coding: utf-8
+"""
+Incremental parser of the events (errors, warnings, comments, ...) written by abinit in its log and output files.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import hashlib
+import io
+import json
+import logging
+import mmap
+import os
+
+import yaml
+
+from monty.fnmatch import WildCard
+from monty.inspect import all_subclasses
+from monty.json import jsanitize
+from pymatgen.io.abinit.abiinspect import YamlDoc
+from pymatgen.io.abinit.events import EventReport, AbinitEvent, AbinitYamlError
+
+
+logger = logging.getLogger(__name__)
+
+
+class EventsLoader(yaml.SafeLoader):
+    """
+    Safe YAML loader that can only construct the events of abinit (the subclasses of AbinitEvent with a yaml_tag),
+    in addition to the standard YAML types.
+    """
+
+
+def _get_event_classes():
+    # the subclasses inheriting the tag (e.g. AbinitYamlError) are not constructed from the documents
+    return dict((cls.yaml_tag, cls) for cls in all_subclasses(AbinitEvent) if cls.__dict__.get('yaml_tag'))
+
+
+for _tag, _cls in _get_event_classes().items():
+    EventsLoader.add_constructor(_tag, lambda loader, node, cls=_cls: loader.construct_yaml_object(node, cls))
+
+
+class IncrementalEventsParser(object):
+    """
+    Parser of the YAML documents of abinit's events giving the same EventReport as events.EventsParser, without
+    reading the whole file each time it is called.
+    The event documents already found, loaded with their byte offsets, as well as the position up to which the file
+    has been scanned, are stored in a small sidecar file next to the parsed file. On each call, only the bytes
+    appended since the previous call are scanned (the "--- !" markers of the documents are searched in a memory map
+    of the file) and only the new event documents are read and loaded.
+    The documents are loaded with a safe loader only constructing the events of abinit.
+    The sidecar is discarded if the file is shorter than the scanned position or if its beginning changed
+    (e.g. when the file is overwritten by a new run).
+    """
+
+    EVENTS_WILDCARD = "*Error|*Warning|*Comment|*Bug|*ERROR|*WARNING|*COMMENT|*BUG"
+    FINAL_SUMMARY_TAG = "!FinalSummary"
+    DOC_MARKER = b"--- !"
+    DOC_END = b"\n..."
+    # Number of bytes at the beginning of the file used to check that the file is the one that has been scanned
+    HEAD_SIZE = 1024
+    SIDECAR_VERSION = 2
+
+    def __init__(self, sidecar_filepath=None):
+        """
+        Args:
+            sidecar_filepath: path of the sidecar file. If None, ".<filename>.events_offsets.json" in the directory
+                of the parsed file is used.
+        """
+        self.sidecar_filepath = sidecar_filepath
+        self._events_wildcard = WildCard(self.EVENTS_WILDCARD)
+        self._event_classes = _get_event_classes()
+        # Number of bytes of the parsed file read during the last call to parse
+        self.nbytes_read = 0
+
+    def get_sidecar_filepath(self, filename):
+        if self.sidecar_filepath is not None:
+            return self.sidecar_filepath
+        dirname, basename = os.path.split(filename)
+        return os.path.join(dirname, '.{}.events_offsets.json'.format(basename))
+
+    def _is_tracked_tag(self, tag):
+        return tag == self.FINAL_SUMMARY_TAG or self._events_wildcard.match(tag)
+
+    def _initial_state(self):
+        return {'version': self.SIDECAR_VERSION, 'offset': 0, 'nlines': 0, 'head_size': 0, 'head_md5': None,
+                'docs': []}
+
+    def _load_state(self, sidecar_filepath):
+        try:
+            with io.open(sidecar_filepath, 'rt') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            return self._initial_state()
+        if state.get('version') != self.SIDECAR_VERSION:
+            return self._initial_state()
+        return state
+
+    @staticmethod
+    def _save_state(sidecar_filepath, state):
+        # Write to a temporary file and rename it so that a concurrent reader never sees a partial sidecar
+        tmp_filepath = '{}.{:d}.tmp'.format(sidecar_filepath, os.getpid())
+        try:
+            with open(tmp_filepath, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_filepath, sidecar_filepath)
+        except (IOError, OSError) as exc:
+            logger.warning('Could not write events sidecar file "{}": {}'.format(sidecar_filepath, str(exc)))
+
+    def _read(self, mm, start, end):
+        self.nbytes_read += end - start
+        return mm[start:end]
+
+    def _head_md5(self, mm, head_size):
+        return hashlib.md5(self._read(mm, 0, head_size)).hexdigest()
+
+    def _scan(self, mm, size, state):
+        """
+        Scans the file from the offset of the state up to the last complete line (or up to the beginning of the last
+        incomplete document) and adds the tracked documents found to the state.
+        """
+        pos = state['offset']
+        nlines = state['nlines']
+        while True:
+            start = mm.find(self.DOC_MARKER, pos, size)
+            # Only markers at the beginning of a line start a document
+            while start > 0 and mm[start - 1:start] != b'\n':
+                start = mm.find(self.DOC_MARKER, start + 1, size)
+            if start < 0:
+                break
+            end = mm.find(self.DOC_END, start, size)
+            if end < 0:
+                # Incomplete document, it will be scanned again in the next call
+                break
+            end = mm.find(b'\n', end + 1, size)
+            if end < 0:
+                break
+            end += 1
+            nlines += self._read(mm, pos, start).count(b'\n')
+            marker_line_end = mm.find(b'\n', start, end)
+            tag = self._read(mm, start + 3, marker_line_end).decode('utf-8', 'replace').strip()
+            if self._is_tracked_tag(tag):
+                text = self._read(mm, start, end).decode('utf-8', 'replace')
+                state['docs'].append([start, end, nlines + 1, tag, self._load_doc(text, tag, nlines + 1)])
+            nlines += self._read(mm, start, end).count(b'\n')
+            pos = end
+        # Stop at the beginning of the incomplete document if any, otherwise after the last complete line
+        if start >= 0:
+            new_offset = start
+        else:
+            new_offset = mm.rfind(b'\n', pos, size) + 1
+            if new_offset <= pos:
+                new_offset = pos
+        nlines += self._read(mm, pos, new_offset).count(b'\n')
+        state['offset'] = new_offset
+        state['nlines'] = nlines
+
+    def _load_doc(self, text, tag, lineno):
+        """
+        Loads a tracked document. Returns the (JSON serializable) attributes of the event, the dates of the final
+        summary or, for a malformatted event, the message of the AbinitYamlError.
+        """
+        if tag == self.FINAL_SUMMARY_TAG:
+            d = YamlDoc(text=text, lineno=lineno, tag=tag).as_dict()
+            return {'start_datetime': d["start_datetime"], 'end_datetime': d["end_datetime"]}
+        try:
+            event = yaml.load(text, Loader=EventsLoader)
+            if not isinstance(event, AbinitEvent):
+                raise TypeError('Not an event: {}'.format(tag))
+            return {'event': jsanitize(event.__dict__)}
+        except Exception:
+            message = "Malformatted YAML document at line: %d\n" % lineno
+            message += text
+            return {'yaml_error': message}
+
+    def _get_event(self, tag, data):
+        if 'yaml_error' in data:
+            return AbinitYamlError(message=data['yaml_error'], src_file=__file__, src_line=0)
+        cls = self._event_classes[tag]
+        event = cls.__new__(cls)
+        event.__dict__.update(data['event'])
+        return event
+
+    def parse(self, filename, verbose=0):
+        """
+        Parses the given file and returns the EventReport.
+        """
+        filename = os.path.abspath(filename)
+        sidecar_filepath = self.get_sidecar_filepath(filename)
+        state = self._load_state(sidecar_filepath)
+        self.nbytes_read = 0
+
+        report = EventReport(filename)
+        size = os.path.getsize(filename)
+        if size == 0:
+            report.set_run_completed(False, None, None)
+            return report
+
+        with open(filename, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if state['offset'] > size or (state['offset'] > 0 and
+                                              self._head_md5(mm, state['head_size']) != state['head_md5']):
+                    state = self._initial_state()
+                if state['offset'] < size:
+                    self._scan(mm, size, state)
+                if state['head_size'] < min(size, self.HEAD_SIZE):
+                    state['head_size'] = min(size, self.HEAD_SIZE)
+                    state['head_md5'] = self._head_md5(mm, state['head_size'])
+            finally:
+                mm.close()
+        self._save_state(sidecar_filepath, state)
+
+        # Same processing of the documents as in events.EventsParser, from the documents loaded in the sidecar
+        run_completed, start_datetime, end_datetime = False, None, None
+        for start, end, lineno, tag, data in state['docs']:
+            if self._events_wildcard.match(tag):
+                event = self._get_event(tag, data)
+                event.lineno = lineno
+                report.append(event)
+            if tag == self.FINAL_SUMMARY_TAG:
+                run_completed = True
+                start_datetime, end_datetime = data["start_datetime"], data["end_datetime"]
+
+        report.set_run_completed(run_completed, start_datetime, end_datetime)
+        return report
@@ -9,8 +9,12 @@ import fnmatch
 import logging
 import os
 import shutil
+import threading
+import time
 import traceback
 
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from six import add_metaclass
 from monty.json import MontyDecoder
 from monty.json import MSONable
@@ -40,6 +44,95 @@ PRIORITY_VERY_LOW = PRIORITIES['PRIORITY_VERY_LOW']
 PRIORITY_LOWEST = PRIORITIES['PRIORITY_LOWEST']
 
 
+class ArtifactCache(object):
+    """
+    Cache of the files (artifacts) read and parsed by the controllers, e.g. the standard output and error files of
+    the resource manager or the log file of abinit.
+    The parsed objects are stored with a key made of the name of the parser and of the path, size and modification
+    time of each file, so that a file is read and parsed only once as long as it is not modified. The least recently
+    used entries are removed when more than maxsize entries are stored.
+    The parsed objects are shared between the controllers and should not be modified. The cache can be used by
+    controllers processed concurrently: a given file is still parsed only once.
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # the lock protects the entries, the parsing of each key is protected by its own lock
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.nparsed = 0
+
+    @staticmethod
+    def file_key(filepath):
+        """
+        Returns the key (path, size and modification time) of the file or None if the file does not exist.
+        """
+        if filepath is None:
+            return None
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return None
+        return os.path.abspath(filepath), stat.st_size, stat.st_mtime
+
+    def get_size(self, filepath):
+        """
+        Returns the size of the file or None if the file does not exist.
+        """
+        key = self.file_key(filepath)
+        return None if key is None else key[1]
+
+    def get_parsed(self, parser_name, filepaths, parse_function):
+        """
+        Returns the object obtained by calling parse_function (without arguments) on the files in filepaths.
+        The parse_function is only called if the object is not in the cache or if one of the files has been
+        modified since it was parsed.
+
+        Args:
+            parser_name: Name of the parser, used as part of the key.
+            filepaths: List of the paths of the files parsed by parse_function.
+            parse_function: Callable returning the parsed object.
+        """
+        key = (parser_name, tuple(self.file_key(filepath) for filepath in filepaths))
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = self._entries.pop(key)
+                return self._entries[key]
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        # only the controllers parsing the same files wait for each other
+        with key_lock:
+            with self._lock:
+                if key in self._entries:
+                    return self._entries[key]
+            parsed = parse_function()
+            with self._lock:
+                self.nparsed += 1
+                self._entries[key] = parsed
+                self._key_locks.pop(key, None)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return parsed
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_ARTIFACT_CACHE = ArtifactCache()
+
+
+def get_artifact_cache():
+    """
+    Returns the artifact cache of the current process.
+    """
+    return _ARTIFACT_CACHE
+
+
 #TODO: find a good name (is barrier ok ?). This is a container of controllers ...
 # class ControlStep(MSONable):
 # class ControlStage(MSONable):
@@ -48,24 +141,49 @@ PRIORITY_LOWEST = PRIORITIES['PRIORITY_LOWEST']
 # class ControlProcess(MSONable):
 # class ControlBarrier(MSONable):
 class ControlProcedure(MSONable):
+    """
+    Container of the controllers applied to a task.
+    The controllers are applied by decreasing priority. Controllers with the same priority cannot affect each other
+    and can be processed concurrently in a pool of max_workers threads. By default (max_workers=1) they are processed
+    serially.
+    The controller notes are always added to the report in the order of the controllers, so that the report does
+    not depend on max_workers.
+    """
 
-    def __init__(self, controllers, monitors=None, sorting=None):
+    def __init__(self, controllers, monitors=None, sorting=None, max_workers=1):
         self.controllers = []
+        self._compiled_groups = {}
+        self.max_workers = max_workers
         self.add_controllers(controllers=controllers)
         self.controlled_item_type = None
 
     def set_controlled_item_type(self, controlled_item_type):
         self.controlled_item_type = controlled_item_type
 
+    def _compile_groups(self):
+        """
+        Groups the controllers by priority once for all (and for each controlled item type) when controllers are
+        added. The groups for a given controlled item type are filtered from these groups the first time they are
+        needed.
+        """
+        grouped_controllers = {}
+        for controller in self.controllers:
+            grouped_controllers.setdefault(controller.priority, []).append(controller)
+        self._priority_groups = [(priority, grouped_controllers[priority])
+                                 for priority in sorted(grouped_controllers.keys(), reverse=True)]
+        self._compiled_groups = {}
+
     def setup_controllers(self, controlled_item_type):
-        self.grouped_controllers = {}
-        controllers = [controller for controller in self.controllers
-                       if controlled_item_type in controller.controlled_item_types]
-        for controller in controllers:
-            if controller.priority in self.grouped_controllers:
-                self.grouped_controllers[controller.priority].append(controller)
-            else:
-                self.grouped_controllers[controller.priority] = [controller]
+        key = None if controlled_item_type is None else controlled_item_type.as_dict()['item_type']
+        if key not in self._compiled_groups:
+            grouped_controllers = {}
+            for priority, controllers in self._priority_groups:
+                controllers = [controller for controller in controllers
+                               if controlled_item_type in controller.controlled_item_types]
+                if controllers:
+                    grouped_controllers[priority] = controllers
+            self._compiled_groups[key] = grouped_controllers
+        self.grouped_controllers = self._compiled_groups[key]
         self.priorities = sorted(self.grouped_controllers.keys(), reverse=True)
         self._ncontrollers = sum([len(v) for v in self.grouped_controllers.values()])
 
@@ -83,21 +201,41 @@ class ControlProcedure(MSONable):
         else:
             raise ValueError('controllers should be either a list of subclasses of Controller or a single '
                              'subclass of Controller')
+        self._compile_groups()
 
     def process(self, **kwargs):
         self.setup_controllers(controlled_item_type=self.controlled_item_type)
+        # The files needed by the controllers are read and parsed only once and shared between the controllers
+        artifact_cache = kwargs.pop('artifact_cache', None)
+        if artifact_cache is None:
+            artifact_cache = get_artifact_cache()
         report = ControlReport()
         if self.ncontrollers == 0:
             report.state = ControlReport.UNRECOVERABLE
             return report
+
+        def process_controller(controller):
+            if controller.uses_artifact_cache:
+                return controller.process(artifact_cache=artifact_cache, **kwargs)
+            return controller.process(**kwargs)
+
         for priority in self.priorities:
             skip_lower_priority = False
             #skip_other_controllers = False
-            for controller in self.grouped_controllers[priority]:
-                if controller._only_unfinalized and report.finalized:
-                    #TODO: clean up here ... otherwise the ultimate could always be applied .....
-                    continue
-                controller_note = controller.process(**kwargs)
+            controllers = self.grouped_controllers[priority]
+            # The controllers that are only applied when the report is not finalized depend on the notes of the
+            #  previous controllers and are processed when their turn comes. The other ones are processed beforehand.
+            controller_notes = self._process_concurrently(process_controller,
+                                                          [controller for controller in controllers
+                                                           if not controller._only_unfinalized])
+            for controller in controllers:
+                if controller._only_unfinalized:
+                    if report.finalized:
+                        #TODO: clean up here ... otherwise the ultimate could always be applied .....
+                        continue
+                    controller_note = process_controller(controller)
+                else:
+                    controller_note = controller_notes[id(controller)]
                 # TODO: clean up this ...
                 report.add_controller_note(controller_note=controller_note)
             #    if controller_note.state in ControllerNote.ERROR_STATES:
@@ -113,6 +251,34 @@ class ControlProcedure(MSONable):
         #     self.cleaner.clean()
         return report
 
+    def _process_concurrently(self, process_controller, controllers):
+        """
+        Processes the controllers in a pool of threads. Returns a dict with the notes of the controllers (the keys
+        are the ids of the controllers). If some controllers raise, the exception of the first of them (in the order
+        of the controllers) is raised.
+        """
+        if self.max_workers is None or self.max_workers <= 1 or len(controllers) <= 1:
+            return {id(controller): process_controller(controller) for controller in controllers}
+
+        def safe_process_controller(controller):
+            try:
+                return process_controller(controller), None
+            except Exception as exc:
+                return None, exc
+
+        pool = ThreadPool(processes=min(self.max_workers, len(controllers)))
+        try:
+            results = pool.map(safe_process_controller, controllers)
+        finally:
+            pool.close()
+            pool.join()
+        controller_notes = {}
+        for controller, (controller_note, exc) in zip(controllers, results):
+            if exc is not None:
+                raise exc
+            controller_notes[id(controller)] = controller_note
+        return controller_notes
+
     @property
     def ncontrollers(self):
         return self._ncontrollers
@@ -120,12 +286,13 @@ class ControlProcedure(MSONable):
     @classmethod
     def from_dict(cls, d):
         dec = MontyDecoder()
-        return cls(controllers=dec.process_decoded(d['controllers']))
+        return cls(controllers=dec.process_decoded(d['controllers']), max_workers=d.get('max_workers', 1))
 
     def as_dict(self):
         return {'@class': self.__class__.__name__,
                 '@module': self.__class__.__module__,
-                'controllers': [controller.as_dict() for controller in self.controllers]}
+                'controllers': [controller.as_dict() for controller in self.controllers],
+                'max_workers': self.max_workers}
 
 
 class ControlledItemType(MSONable):
@@ -204,7 +371,7 @@ class ControlledItemType(MSONable):
         return self._item_type == other._item_type
 
     def __hash__(self):
-        return self._item_type
+        return hash(self._item_type)
 
     @classmethod
     def from_dict(cls, d):
@@ -217,9 +384,123 @@ class ControlledItemType(MSONable):
 
 
 
-@add_metaclass(abc.ABCMeta)
-class Monitor:
-    pass
+class Monitor(object):
+    """
+    Monitors a running process in a separate thread. At regular intervals, the new (complete) lines of the output
+    file of the process are read and passed to the monitor controllers (i.e. controllers with the task_running
+    controlled item type) as the "new_output" kwarg, together with the "output_filepath" and the kwargs given to
+    start. If a monitor controller finds an error (recoverable or not), the process is terminated and the controller
+    note is stored in controller_notes, so that it can be passed to the control step.
+    Monitor controllers can keep information between two checks. They are reset (if they have a reset method) when
+    the monitor is started.
+    """
+
+    def __init__(self, controllers, interval=60, terminate_timeout=10):
+        """
+        Args:
+            controllers: list of monitor controllers.
+            interval: time (in seconds) between two checks.
+            terminate_timeout: time (in seconds) given to the process to terminate before it is killed.
+        """
+        self.controllers = sorted(controllers, key=lambda controller: controller.priority, reverse=True)
+        self.interval = interval
+        self.terminate_timeout = terminate_timeout
+        self.controller_notes = []
+        self._offset = 0
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_control_procedure(cls, control_procedure, interval=60, terminate_timeout=10):
+        """
+        Returns the monitor for the monitor controllers of the control procedure or None if there are none.
+        """
+        controllers = [controller for controller in control_procedure.controllers
+                       if ControlledItemType.task_running() in controller.controlled_item_types]
+        if not controllers:
+            return None
+        return cls(controllers=controllers, interval=interval, terminate_timeout=terminate_timeout)
+
+    @property
+    def aborted(self):
+        return len(self.controller_notes) > 0
+
+    def start(self, process, output_filepath, **kwargs):
+        """
+        Starts monitoring the process (subprocess.Popen object) writing its output in output_filepath.
+        """
+        for controller in self.controllers:
+            if hasattr(controller, 'reset'):
+                controller.reset()
+        self._offset = 0
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._monitor, args=(process, output_filepath, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops monitoring. Should be called when the process has completed.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def read_new_output(self, output_filepath):
+        """
+        Returns the lines completed in the output file since the previous call.
+        """
+        if not os.path.exists(output_filepath):
+            return ''
+        with open(output_filepath, 'rb') as f:
+            f.seek(self._offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        self._offset += end
+        return data[:end].decode('utf-8', 'replace')
+
+    def check(self, output_filepath, **kwargs):
+        """
+        Processes the monitor controllers with the new output. Returns the note of the first controller
+        (by decreasing priority) that found an error, None otherwise.
+        """
+        new_output = self.read_new_output(output_filepath)
+        for controller in self.controllers:
+            note = controller.process(new_output=new_output, output_filepath=output_filepath, **kwargs)
+            if note.state in [ControllerNote.ERROR_RECOVERABLE, ControllerNote.ERROR_UNRECOVERABLE]:
+                return note
+        return None
+
+    def _monitor(self, process, output_filepath, kwargs):
+        while not self._stop_event.wait(self.interval):
+            if process.poll() is not None:
+                break
+            try:
+                note = self.check(output_filepath, **kwargs)
+            except Exception:
+                logger.warning('Error while monitoring the process:\n{}'.format(traceback.format_exc()))
+                continue
+            if note is not None:
+                logger.info('Process terminated by the monitor: {}'.format(', '.join(note.problems or [])))
+                self.controller_notes.append(note)
+                self.terminate(process)
+                break
+
+    def terminate(self, process):
+        """
+        Terminates the process, kills it if it is still running after terminate_timeout seconds.
+        """
+        if process.poll() is not None:
+            return
+        process.terminate()
+        for _ in range(int(self.terminate_timeout / 0.1)):
+            if process.poll() is not None:
+                return
+            time.sleep(0.1)
+        if process.poll() is None:
+            process.kill()
+
 
 @add_metaclass(abc.ABCMeta)
 #class ControlStep(MSONable):
@@ -250,6 +531,10 @@ class Controller(MSONable):
 
     can_validate = False
 
+    # Whether the controller uses the ArtifactCache passed by the ControlProcedure (as the artifact_cache kwarg)
+    #  to read and parse the files it needs
+    uses_artifact_cache = False
+
     def __init__(self):
         pass
 
@@ -633,17 +918,32 @@ class Action(MSONable):
     def from_dict(cls, d):
         import importlib
         mod = importlib.import_module(d['callable']['module'])
-        class_ = getattr(mod, d['callable']['class'])
-        callable = getattr(class_, d['callable']['func_name'])
-        return cls(callable=callable)
+        # The callable is either a method of a class of the module or a function of the module (class is None)
+        owner = mod
+        if d['callable'].get('class') is not None:
+            for name in d['callable']['class'].split('.'):
+                owner = getattr(owner, name)
+        callable = getattr(owner, d['callable']['func_name'])
+        return cls(callable=callable, **d.get('kwargs', {}))
 
     def as_dict(self):
+        if hasattr(self.callable, 'im_class'):
+            # unbound method in python 2
+            callable_dict = {'module': self.callable.im_class.__module__,
+                             'class': self.callable.im_class.__name__,
+                             'func_name': self.callable.__name__}
+        else:
+            qualname = getattr(self.callable, '__qualname__', self.callable.__name__)
+            if '<locals>' in qualname or '<lambda>' in qualname:
+                raise ValueError('Action with callable "{}" cannot be serialized'.format(qualname))
+            class_name = qualname.rsplit('.', 1)[0] if '.' in qualname else None
+            callable_dict = {'module': self.callable.__module__,
+                             'class': class_name,
+                             'func_name': self.callable.__name__}
         return {'@class': self.__class__.__name__,
                 '@module': self.__class__.__module__,
-                'callable': {'module': self.callable.im_class.__module__,
-                             'class': self.callable.im_class.__name__,
-                             'func_name': self.callable.im_func.func_name}
-                }
+                'callable': callable_dict,
+                'kwargs': self.kwargs}
 
     @classmethod
     def from_string(cls, callable_string, **kwargs):
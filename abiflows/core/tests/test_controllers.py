@@ -0,0 +1,436 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+import threading
+
+from six import string_types
+from six.moves import builtins
+from abiflows.core.mastermind_abc import ArtifactCache, ControlProcedure, ControlledItemType, ControllerNote
+from abiflows.core.controllers import WalltimeController, MemoryController, UltimateMemoryController
+from abiflows.core.controllers import ProgressWalltimeController, get_abinit_progress
+from abiflows.core.controllers import estimate_remaining_steps
+from abiflows.core.controllers import EstimatedMemoryController, get_peak_memory_mb
+
+from pymatgen.util.testing import PymatgenTest
+
+
+class FakeSlurmQueueAdapter(object):
+    QTYPE = 'slurm'
+    mem_per_proc = 1000
+    mpi_procs = 4
+    timelimit = 3600
+    timelimit_hard = 86400
+
+    def set_mem_per_proc(self, mem_mb):
+        self.mem_per_proc = mem_mb
+
+    def set_mpi_procs(self, mpi_procs):
+        self.mpi_procs = mpi_procs
+
+    def set_timelimit(self, timelimit):
+        self.timelimit = timelimit
+
+
+class FakeAbinitInput(object):
+
+    def __init__(self, **kwargs):
+        self.vars = dict(kwargs)
+
+    def set_vars(self, **kwargs):
+        self.vars.update(kwargs)
+
+    def remove_vars(self, keys, strict=True):
+        for key in keys:
+            self.vars.pop(key, None)
+
+
+SLURM_TIMELIMIT_ERROR = 'slurmstepd: *** JOB 1234 CANCELLED AT 2016-01-01T00:00:00 DUE TO TIME LIMIT ***\n'
+
+SLURM_MEMORY_ERROR = 'slurmstepd: error: Exceeded job memory limit at some point.\n'
+
+PBS_MEMORY_ERROR = '=>> PBS: job killed: mem job total 10485760 kb exceeded limit 4194304 kb\n'
+
+SLURM_MEMORY_EXCEEDED_ERROR = 'slurmstepd: error: Step 1234.0 exceeded memory limit (6291456 > 4194304), being killed\n'
+
+# Synthetic autoparal results (as given by ParalHints.as_dict)
+PARAL_HINTS = {'info': {'autoparal': 1, 'max_ncpus': 16},
+               'confs': [{'tot_ncpus': 4, 'mpi_ncpus': 4, 'omp_ncpus': 1, 'mem_per_cpu': 1500.0, 'efficiency': 0.98,
+                          'vars': {'npkpt': 4}},
+                         {'tot_ncpus': 8, 'mpi_ncpus': 8, 'omp_ncpus': 1, 'mem_per_cpu': 900.0, 'efficiency': 0.95,
+                          'vars': {'npkpt': 8}},
+                         {'tot_ncpus': 16, 'mpi_ncpus': 16, 'omp_ncpus': 1, 'mem_per_cpu': 600.0, 'efficiency': 0.9,
+                          'vars': {'npkpt': 8, 'npband': 2}},
+                         {'tot_ncpus': 16, 'mpi_ncpus': 16, 'omp_ncpus': 1, 'mem_per_cpu': 500.0, 'efficiency': 0.7,
+                          'vars': {'npkpt': 4, 'npband': 4}}]}
+
+RELAX_LOG = """
+--- Iteration: ( 1/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8600412283652  -8.860E+00 2.351E-04 3.532E+00
+ ETOT  2  -8.8604213467418  -3.801E-04 2.017E-08 1.212E-01
+--- Iteration: ( 2/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8604213467418  -8.860E+00 2.351E-04 3.532E+00
+--- Iteration: ( 3/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8604213467418  -8.860E+00 2.351E-04 3.532E+00
+ ETOT  2  -8.8604213467418  -8.860E+00 2.351E-04 3.532E+00
+"""
+
+RELAX_FORCES_LOG = """
+--- Iteration: ( 1/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8600412283652  -8.860E+00 2.351E-04 3.532E+00
+ At Broyd/MD step   1, gradients are not converged :
+ max grad (force/stress) = 1.0000E-01 > tolmxf= 5.0000E-05 ha/bohr (free atoms)
+--- Iteration: ( 2/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8604213467418  -8.860E+00 2.351E-04 3.532E+00
+ At Broyd/MD step   2, gradients are not converged :
+ max grad (force/stress) = 1.0000E-02 > tolmxf= 5.0000E-05 ha/bohr (free atoms)
+--- Iteration: ( 3/20) Internal Cycle: (1/1)
+ ETOT  1  -8.8604213467418  -8.860E+00 2.351E-04 3.532E+00
+"""
+
+DFPT_LOG = """
+ The list of irreducible perturbations for this q vector is:
+    1)    idir= 1    ipert=   1
+    2)    idir= 2    ipert=   1
+    3)    idir= 1    ipert=   2
+    4)    idir= 2    ipert=   2
+    5)    idir= 3    ipert=   2
+================================================================================
+
+--------------------------------------------------------------------------------
+ Perturbation wavevector (in red.coord.)   0.000000  0.000000  0.000000
+ Perturbation : displacement of atom   1   along direction   1
+ ETOT  1  -8.8600412283652  -8.860E+00 2.351E-04 3.532E+00
+--------------------------------------------------------------------------------
+ Perturbation wavevector (in red.coord.)   0.000000  0.000000  0.000000
+ Perturbation : displacement of atom   1   along direction   2
+ ETOT  1  -8.8600412283652  -8.860E+00 2.351E-04 3.532E+00
+"""
+
+SCF_LOG = """
+ ETOT  1  -8.8600412283652  -8.860E+00 2.351E-04 3.532E+00
+ ETOT  2  -8.8604213467418  -3.801E-04 2.017E-08 1.212E-01
+ ETOT  3  -8.8604274532318  -6.106E-06 2.121E-10 2.523E-03
+ ETOT  4  -8.8604274964471  -4.322E-08 7.893E-12 4.126E-05
+"""
+
+
+class TestArtifactCache(PymatgenTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.qerr_filepath = os.path.join(self.tmp_dir, 'queue.qerr')
+        self.qout_filepath = os.path.join(self.tmp_dir, 'queue.qout')
+        with io.open(self.qerr_filepath, 'w') as f:
+            f.write('Some error message of the resource manager\n')
+        with io.open(self.qout_filepath, 'w') as f:
+            f.write('Some output of the resource manager\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_parsed(self):
+        cache = ArtifactCache(maxsize=2)
+        calls = []
+
+        def parse():
+            calls.append(1)
+            return len(calls)
+
+        self.assertEqual(cache.get_parsed('parser', [self.qerr_filepath], parse), 1)
+        self.assertEqual(cache.get_parsed('parser', [self.qerr_filepath], parse), 1)
+        self.assertEqual(cache.get_parsed('other_parser', [self.qerr_filepath], parse), 2)
+        self.assertEqual(cache.get_size(self.qerr_filepath), os.path.getsize(self.qerr_filepath))
+        self.assertIsNone(cache.get_size(os.path.join(self.tmp_dir, 'missing')))
+
+        # Modifying the file invalidates the entry
+        with io.open(self.qerr_filepath, 'a') as f:
+            f.write('Another line\n')
+        self.assertEqual(cache.get_parsed('parser', [self.qerr_filepath], parse), 3)
+
+        # Least recently used entries are removed
+        self.assertEqual(len(cache), 2)
+        cache.get_parsed('parser', [self.qout_filepath], parse)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nparsed, 4)
+
+    def test_concurrent_parsing(self):
+        cache = ArtifactCache()
+        qout_parsed = threading.Event()
+        results = {}
+
+        def parse_qerr():
+            # waits for the parsing of the other file: it would time out with a lock on the whole cache
+            results['qout_parsed_first'] = qout_parsed.wait(5)
+            return 'qerr'
+
+        def parse_qout():
+            qout_parsed.set()
+            return 'qout'
+
+        threads = [threading.Thread(target=cache.get_parsed, args=('parser', [self.qerr_filepath], parse_qerr))]
+        threads.extend(threading.Thread(target=cache.get_parsed, args=('parser', [self.qout_filepath], parse_qout))
+                       for i in range(4))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(results['qout_parsed_first'])
+        # the same file is still parsed only once
+        self.assertEqual(cache.nparsed, 2)
+        self.assertEqual(cache.get_parsed('parser', [self.qerr_filepath], parse_qout), 'qerr')
+
+    def test_queue_controllers_file_opens(self):
+        cp = ControlProcedure(controllers=[WalltimeController(), MemoryController(), UltimateMemoryController()])
+        cp.set_controlled_item_type(ControlledItemType.task_failed())
+        cache = ArtifactCache()
+
+        opened_files = []
+        original_open = builtins.open
+
+        def counting_open(file, *args, **kwargs):
+            opened_files.append(os.path.abspath(file) if isinstance(file, string_types) else file)
+            return original_open(file, *args, **kwargs)
+
+        kwargs = {'queue_adapter': FakeSlurmQueueAdapter(), 'qerr_filepath': self.qerr_filepath,
+                  'qout_filepath': self.qout_filepath, 'artifact_cache': cache}
+        builtins.open = counting_open
+        try:
+            report = cp.process(**kwargs)
+        finally:
+            builtins.open = original_open
+
+        self.assertEqual(len(report.controller_notes), 3)
+        # Each file is read only once for the three queue controllers
+        self.assertEqual(opened_files.count(self.qerr_filepath), 1)
+        self.assertEqual(opened_files.count(self.qout_filepath), 1)
+        self.assertEqual(cache.nparsed, 1)
+
+        # The unchanged files are not read again in another control step
+        builtins.open = counting_open
+        try:
+            del opened_files[:]
+            cp.process(**kwargs)
+        finally:
+            builtins.open = original_open
+        self.assertNotIn(self.qerr_filepath, opened_files)
+        self.assertNotIn(self.qout_filepath, opened_files)
+        self.assertEqual(cache.nparsed, 1)
+
+
+class TestProgressWalltimeController(PymatgenTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.qerr_filepath = os.path.join(self.tmp_dir, 'queue.qerr')
+        self.qout_filepath = os.path.join(self.tmp_dir, 'queue.qout')
+        self.log_filepath = os.path.join(self.tmp_dir, 'run.log')
+        with io.open(self.qerr_filepath, 'w') as f:
+            f.write(SLURM_TIMELIMIT_ERROR)
+        with io.open(self.qout_filepath, 'w') as f:
+            f.write('')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_log(self, text):
+        with io.open(self.log_filepath, 'w') as f:
+            f.write(text)
+
+    def get_new_timelimit(self, controller, **kwargs):
+        queue_adapter = FakeSlurmQueueAdapter()
+        note = controller.process(queue_adapter=queue_adapter, qerr_filepath=self.qerr_filepath,
+                                  qout_filepath=self.qout_filepath, abinit_log_filepath=self.log_filepath,
+                                  artifact_cache=ArtifactCache(), **kwargs)
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        note.actions['queue_adapter'].apply(queue_adapter)
+        return queue_adapter.timelimit
+
+    def test_get_abinit_progress(self):
+        self.write_log(RELAX_LOG)
+        self.assertEqual(get_abinit_progress(self.log_filepath),
+                         {'kind': 'relaxation', 'done': 2, 'total': 20, 'remaining': 18})
+        # The forces decrease by a factor 10 per step: 3 more steps to go below tolmxf
+        self.write_log(RELAX_FORCES_LOG)
+        self.assertEqual(get_abinit_progress(self.log_filepath),
+                         {'kind': 'relaxation', 'done': 2, 'total': 20, 'remaining': 3})
+        self.write_log(DFPT_LOG)
+        self.assertEqual(get_abinit_progress(self.log_filepath),
+                         {'kind': 'perturbations', 'done': 1, 'total': 5, 'remaining': 4})
+        self.write_log(SCF_LOG)
+        self.assertEqual(get_abinit_progress(self.log_filepath),
+                         {'kind': 'scf', 'done': 4, 'total': 30, 'remaining': 26})
+        self.assertEqual(get_abinit_progress(self.log_filepath, abinit_input={'nstep': 10}),
+                         {'kind': 'scf', 'done': 4, 'total': 10, 'remaining': 6})
+        # Trend of the residual of the potential (last column) towards tolvrs
+        self.assertEqual(get_abinit_progress(self.log_filepath, abinit_input={'nstep': 10, 'tolvrs': 1e-10}),
+                         {'kind': 'scf', 'done': 4, 'total': 10, 'remaining': 4})
+        progress = get_abinit_progress(self.log_filepath, abinit_input={'nstep': 10, 'tolvrs': 1e-4})
+        self.assertEqual(progress['remaining'], 0)
+        self.write_log('Some output of abinit without any iteration\n')
+        self.assertIsNone(get_abinit_progress(self.log_filepath))
+        self.assertIsNone(get_abinit_progress(os.path.join(self.tmp_dir, 'missing.log')))
+
+    def test_extrapolated_timelimit(self):
+        controller = ProgressWalltimeController(max_timelimit=86400, timelimit_increase=600, safety_margin=0.2)
+        # 2 relaxation steps out of 20 in one hour, without information on the forces: 18 remaining steps
+        self.write_log(RELAX_LOG)
+        self.assertEqual(self.get_new_timelimit(controller), 38880)
+        # 1 perturbation out of 5 in one hour
+        self.write_log(DFPT_LOG)
+        self.assertEqual(self.get_new_timelimit(controller), 17280)
+        # 4 SCF iterations out of nstep (30 by default)
+        self.write_log(SCF_LOG)
+        self.assertEqual(self.get_new_timelimit(controller), 28080)
+        # Capped to the maximum timelimit
+        self.assertEqual(self.get_new_timelimit(controller, abinit_input={'nstep': 100}), 86400)
+        # Never lower than the fixed increase
+        self.assertEqual(self.get_new_timelimit(controller, abinit_input={'nstep': 4}), 4200)
+        no_margin_controller = ProgressWalltimeController(max_timelimit=86400, timelimit_increase=600,
+                                                          safety_margin=0.0)
+        self.assertEqual(self.get_new_timelimit(no_margin_controller, abinit_input={'nstep': 4}), 3600 + 600)
+
+        controller = ProgressWalltimeController.from_dict(controller.as_dict())
+        self.assertEqual(controller.safety_margin, 0.2)
+
+    def test_convergence_trend(self):
+        controller = ProgressWalltimeController(max_timelimit=86400, timelimit_increase=600, safety_margin=0.2)
+        # 3 more relaxation steps at 1800 s per step instead of the 18 steps up to ntime
+        self.write_log(RELAX_FORCES_LOG)
+        new_timelimit = self.get_new_timelimit(controller)
+        self.assertEqual(new_timelimit, 6480)
+        self.assertGreater(new_timelimit, 3600)
+        self.assertLess(new_timelimit, 86400)
+        # 4 more SCF iterations to reach tolvrs instead of the 96 iterations up to nstep
+        self.write_log(SCF_LOG)
+        new_timelimit = self.get_new_timelimit(controller, abinit_input={'nstep': 100, 'tolvrs': 1e-10})
+        self.assertEqual(new_timelimit, 4320)
+        self.assertGreater(new_timelimit, 3600)
+        self.assertLess(new_timelimit, 86400)
+
+    def test_estimate_remaining_steps(self):
+        self.assertEqual(estimate_remaining_steps([1e-1, 1e-2, 1e-3], 1e-6, 50), 3)
+        self.assertEqual(estimate_remaining_steps([1e-1, 1e-2, 1e-3], 1e-2, 50), 0)
+        # not converging or not enough points
+        self.assertEqual(estimate_remaining_steps([1e-3, 1e-2], 1e-6, 50), 50)
+        self.assertEqual(estimate_remaining_steps([1e-3], 1e-6, 50), 50)
+        self.assertEqual(estimate_remaining_steps([], 1e-6, 50), 50)
+        # bounded by the maximum
+        self.assertEqual(estimate_remaining_steps([1.0, 0.9], 1e-6, 50), 50)
+
+    def test_fallback_to_fixed_increase(self):
+        self.write_log('Some output of abinit without any iteration\n')
+        controller = ProgressWalltimeController(max_timelimit=86400, timelimit_increase=600)
+        self.assertEqual(self.get_new_timelimit(controller), 3600 + 600)
+        self.assertEqual(self.get_new_timelimit(WalltimeController(max_timelimit=86400, timelimit_increase=600)),
+                         3600 + 600)
+
+    def test_checkpoint(self):
+        # abinit stopped by the checkpoint supervisor: no timelimit error in the queue files
+        with io.open(self.qerr_filepath, 'w') as f:
+            f.write('')
+        controller = WalltimeController(max_timelimit=86400, timelimit_increase=600)
+        kwargs = {'queue_adapter': FakeSlurmQueueAdapter(), 'qerr_filepath': self.qerr_filepath,
+                  'qout_filepath': self.qout_filepath, 'artifact_cache': ArtifactCache()}
+        self.assertEqual(controller.process(**kwargs).state, ControllerNote.NOTHING_FOUND)
+
+        checkpoint = {'triggered': True, 'exited': True, 'killed': False, 'checkpoint_written': True,
+                      'checkpoint_files': ['out_WFK']}
+        note = controller.process(checkpoint=checkpoint, **kwargs)
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        # the checkpoint files are reused
+        self.assertEqual(note.restart, ControllerNote.SIMPLE_RESTART)
+        self.assertEqual(self.get_new_timelimit(controller, checkpoint=checkpoint), 3600 + 600)
+
+        # abinit killed before writing the checkpoint
+        checkpoint = {'triggered': True, 'exited': False, 'killed': True, 'checkpoint_written': False,
+                      'checkpoint_files': []}
+        note = controller.process(checkpoint=checkpoint, **kwargs)
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        self.assertEqual(note.restart, ControllerNote.RESET_RESTART)
+
+
+class TestEstimatedMemoryController(PymatgenTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.qerr_filepath = os.path.join(self.tmp_dir, 'queue.qerr')
+        self.qout_filepath = os.path.join(self.tmp_dir, 'queue.qout')
+        self.log_filepath = os.path.join(self.tmp_dir, 'run.log')
+        with io.open(self.qout_filepath, 'w') as f:
+            f.write('')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_qerr(self, text):
+        with io.open(self.qerr_filepath, 'w') as f:
+            f.write(text)
+
+    def process(self, controller, queue_adapter, paral_hints=PARAL_HINTS):
+        note = controller.process(queue_adapter=queue_adapter, qerr_filepath=self.qerr_filepath,
+                                  qout_filepath=self.qout_filepath, abinit_log_filepath=self.log_filepath,
+                                  paral_hints=paral_hints, artifact_cache=ArtifactCache())
+        if note.state == ControllerNote.ERROR_RECOVERABLE:
+            note.actions['queue_adapter'].apply(queue_adapter)
+        return note
+
+    def test_get_peak_memory(self):
+        self.write_qerr(PBS_MEMORY_ERROR)
+        self.assertAlmostEqual(get_peak_memory_mb(qerr_filepath=self.qerr_filepath, mpi_procs=4), 2560)
+        with io.open(self.log_filepath, 'w') as f:
+            f.write(' P This job should need less than                    1876.343 Mbytes of memory.\n')
+        self.assertAlmostEqual(get_peak_memory_mb(qerr_filepath=self.qout_filepath,
+                                                  abinit_log_filepath=self.log_filepath), 1876.343)
+        self.assertIsNone(get_peak_memory_mb(qerr_filepath=self.qout_filepath))
+        self.write_qerr(SLURM_MEMORY_EXCEEDED_ERROR)
+        self.assertAlmostEqual(get_peak_memory_mb(qerr_filepath=self.qerr_filepath, mpi_procs=4), 1536)
+
+    def test_jump_to_estimate(self):
+        # The autoparal estimate for 4 MPI processes is 1500 MB: one step to 1800 MB instead of 1000 + 250
+        self.write_qerr(SLURM_MEMORY_ERROR)
+        controller = EstimatedMemoryController(max_mem_per_proc_mb=4000, mem_per_proc_increase_mb=250)
+        queue_adapter = FakeSlurmQueueAdapter()
+        note = self.process(controller, queue_adapter)
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        self.assertEqual(queue_adapter.mem_per_proc, 1800)
+        self.assertEqual(queue_adapter.mpi_procs, 4)
+
+        # Without any estimate, the memory is increased by the fixed increment
+        queue_adapter = FakeSlurmQueueAdapter()
+        self.process(controller, queue_adapter, paral_hints=None)
+        self.assertEqual(queue_adapter.mem_per_proc, 1250)
+
+        controller = EstimatedMemoryController.from_dict(controller.as_dict())
+        self.assertEqual(controller.safety_margin, 0.2)
+
+    def test_switch_to_more_mpi_procs(self):
+        # The resource manager reports 2560 MB per process, more than the maximum: the memory estimates are
+        #  rescaled by 2560 * 1.2 / 1500 and the configuration with 16 processes is the first one that fits
+        self.write_qerr(PBS_MEMORY_ERROR)
+        controller = EstimatedMemoryController(max_mem_per_proc_mb=1500, mem_per_proc_increase_mb=250)
+        queue_adapter = FakeSlurmQueueAdapter()
+        queue_adapter.QTYPE = 'pbs'
+        note = self.process(controller, queue_adapter)
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        self.assertEqual(queue_adapter.mpi_procs, 16)
+        self.assertEqual(queue_adapter.mem_per_proc, 1229)
+
+        # The parallel variables of the configuration are set in the input, also after the serialization of the note
+        for note in [note, ControllerNote.from_dict(note.as_dict())]:
+            abinit_input = FakeAbinitInput(npkpt=4, npfft=2, ecut=10)
+            note.actions['abinit_input'].apply(abinit_input)
+            self.assertEqual(abinit_input.vars, {'npkpt': 8, 'npband': 2, 'ecut': 10})
+            queue_adapter = FakeSlurmQueueAdapter()
+            note.actions['queue_adapter'].apply(queue_adapter)
+            self.assertEqual((queue_adapter.mpi_procs, queue_adapter.mem_per_proc), (16, 1229))
+
+        # No configuration fits
+        controller = EstimatedMemoryController(max_mem_per_proc_mb=1000, mem_per_proc_increase_mb=250)
+        queue_adapter = FakeSlurmQueueAdapter()
+        queue_adapter.QTYPE = 'pbs'
+        note = self.process(controller, queue_adapter)
+        self.assertEqual(note.state, ControllerNote.ERROR_UNRECOVERABLE)
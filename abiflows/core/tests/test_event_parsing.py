@@ -0,0 +1,154 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+
+from pymatgen.io.abinit import events
+from pymatgen.util.testing import PymatgenTest
+from abiflows.core.event_parsing import IncrementalEventsParser
+
+
+COMMENT = """--- !COMMENT
+src_file: m_fake.F90
+src_line: {line:d}
+message: |
+    Comment number {line:d}
+...
+"""
+
+WARNING = """--- !WARNING
+src_file: m_fake.F90
+src_line: {line:d}
+message: |
+    Warning number {line:d}
+...
+"""
+
+FINAL_SUMMARY = """--- !FinalSummary
+program: abinit
+version: 8.0.8
+start_datetime: Fri Mar 13 20:08:51 2015
+end_datetime: Fri Mar 13 20:08:57 2015
+overall_cpu_time: 1.5
+overall_wall_time: 1.6
+exit_requested_by_user: no
+timelimit: 0
+pseudos:
+    Si: 1a2b3c
+usepaw: 0
+mpi_procs: 1
+omp_threads: -1
+num_warnings: 1
+num_comments: 2
+...
+"""
+
+
+class TestIncrementalEventsParser(PymatgenTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_filepath = os.path.join(self.tmp_dir, 'run.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def append(self, text):
+        with io.open(self.log_filepath, 'a') as f:
+            f.write(text)
+
+    def append_iterations(self, nlines):
+        self.append(''.join(' ETOT {:4d}  -8.8600412 -8.860E+00 1.234E-04 --- ! not a document\n'.format(i)
+                            for i in range(nlines)))
+
+    def assert_same_report(self, report):
+        full_report = events.EventsParser().parse(self.log_filepath)
+        self.assertEqual(len(report), len(full_report))
+        for event, full_event in zip(report, full_report):
+            self.assertEqual(event.__class__, full_event.__class__)
+            self.assertEqual(event.message, full_event.message)
+            self.assertEqual(event.lineno, full_event.lineno)
+        self.assertEqual(report.run_completed, full_report.run_completed)
+        self.assertEqual(report.filename, full_report.filename)
+
+    def test_incremental_parse(self):
+        parser = IncrementalEventsParser()
+        # Large log with a few events
+        self.append_iterations(20000)
+        self.append(COMMENT.format(line=1))
+        self.append_iterations(20000)
+        self.append(WARNING.format(line=2))
+        size = os.path.getsize(self.log_filepath)
+        self.assertGreater(size, 1000000)
+
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 2)
+        self.assertFalse(report.run_completed)
+        self.assert_same_report(report)
+        self.assertTrue(os.path.exists(parser.get_sidecar_filepath(self.log_filepath)))
+
+        # Nothing appended: only the beginning of the file is read, the events are loaded from the sidecar
+        report = parser.parse(self.log_filepath)
+        self.assert_same_report(report)
+        self.assertLessEqual(parser.nbytes_read, IncrementalEventsParser.HEAD_SIZE)
+
+        # Incomplete document at the end of the file
+        appended = ''.join(' ETOT {:4d}  -8.8600412\n'.format(i) for i in range(100)) + COMMENT.format(line=3)
+        self.append(appended[:-10])
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 2)
+        self.assertLess(parser.nbytes_read, len(appended) + 2 * IncrementalEventsParser.HEAD_SIZE)
+
+        # Complete the document and the run
+        self.append(appended[-10:])
+        self.append_iterations(10)
+        self.append(FINAL_SUMMARY)
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 3)
+        self.assertTrue(report.run_completed)
+        self.assert_same_report(report)
+        self.assertLess(parser.nbytes_read, len(appended) + len(FINAL_SUMMARY) + 2000 +
+                        2 * IncrementalEventsParser.HEAD_SIZE)
+
+    def test_overwritten_file(self):
+        parser = IncrementalEventsParser()
+        self.append_iterations(2000)
+        self.append(COMMENT.format(line=1))
+        self.append(WARNING.format(line=2))
+        self.assertEqual(len(parser.parse(self.log_filepath)), 2)
+
+        # New run writing a new (shorter) log
+        os.remove(self.log_filepath)
+        self.append(WARNING.format(line=3))
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 1)
+        self.assert_same_report(report)
+
+        # New run writing a log with a different beginning
+        os.remove(self.log_filepath)
+        self.append('New run\n')
+        self.append_iterations(3000)
+        self.append(COMMENT.format(line=4))
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 1)
+        self.assert_same_report(report)
+
+    def test_unsafe_document(self):
+        parser = IncrementalEventsParser()
+        self.append(COMMENT.format(line=1))
+        self.append("""--- !WARNING
+src_file: !!python/object/apply:os.getcwd []
+src_line: 2
+message: |
+    Unsafe warning
+...
+""")
+        report = parser.parse(self.log_filepath)
+        self.assertEqual(len(report), 2)
+        # the python objects are not constructed
+        self.assertIsInstance(report[1], events.AbinitYamlError)
+        self.assertIn('Malformatted YAML document at line: 7', report[1].message)
+        self.assertEqual(report[0].message, 'Comment number 1\n')
@@ -0,0 +1,112 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import time
+
+from abiflows.core.mastermind_abc import Controller, ControllerNote, ControlProcedure, ControlledItemType
+from abiflows.core.mastermind_abc import PRIORITY_HIGH, PRIORITY_MEDIUM, PRIORITY_LOWEST
+
+from pymatgen.util.testing import PymatgenTest
+
+
+class SleepingController(Controller):
+    """
+    Controller sleeping for a given time before returning a note with the given state.
+    """
+
+    can_validate = True
+    _controlled_item_types = [ControlledItemType.task_completed()]
+
+    def __init__(self, name, state, priority, sleep=0.0, skip_lower_priority=False, only_unfinalized=False):
+        super(SleepingController, self).__init__()
+        self.name = name
+        self.state = state
+        self.priority = priority
+        self.sleep = sleep
+        self.skip_lower_priority = skip_lower_priority
+        self._only_unfinalized = only_unfinalized
+
+    def as_dict(self):
+        return {'@class': self.__class__.__name__,
+                '@module': self.__class__.__module__,
+                'name': self.name, 'state': self.state, 'priority': self.priority, 'sleep': self.sleep,
+                'skip_lower_priority': self.skip_lower_priority, 'only_unfinalized': self._only_unfinalized}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(name=d['name'], state=d['state'], priority=d['priority'], sleep=d['sleep'],
+                   skip_lower_priority=d['skip_lower_priority'], only_unfinalized=d['only_unfinalized'])
+
+    @property
+    def skip_lower_priority_controllers(self):
+        return self.skip_lower_priority
+
+    def process(self, **kwargs):
+        time.sleep(self.sleep)
+        note = ControllerNote(controller=self, state=self.state)
+        note.is_valid = self.state == ControllerNote.EVERYTHING_OK
+        if self.state == ControllerNote.ERROR_RECOVERABLE:
+            note.simple_restart()
+            note.add_problem('Problem found by {}'.format(self.name))
+        return note
+
+
+class FailingController(SleepingController):
+
+    def process(self, **kwargs):
+        raise RuntimeError('Failure of {}'.format(self.name))
+
+
+class TestControlProcedure(PymatgenTest):
+
+    def get_controllers(self, sleep=0.0):
+        # The notes of the first controllers finishing last should still be first in the report
+        return [SleepingController('high_1', ControllerNote.NOTHING_FOUND, PRIORITY_HIGH, sleep=3 * sleep),
+                SleepingController('high_2', ControllerNote.NOTHING_FOUND, PRIORITY_HIGH, sleep=sleep),
+                SleepingController('medium_1', ControllerNote.EVERYTHING_OK, PRIORITY_MEDIUM, sleep=2 * sleep),
+                SleepingController('medium_2', ControllerNote.ERROR_RECOVERABLE, PRIORITY_MEDIUM, sleep=sleep,
+                                   skip_lower_priority=True),
+                SleepingController('medium_3', ControllerNote.EVERYTHING_OK, PRIORITY_MEDIUM, sleep=sleep,
+                                   only_unfinalized=True),
+                SleepingController('lowest', ControllerNote.EVERYTHING_OK, PRIORITY_LOWEST, sleep=sleep)]
+
+    def process(self, controllers, max_workers):
+        cp = ControlProcedure(controllers=controllers, max_workers=max_workers)
+        cp.set_controlled_item_type(ControlledItemType.task_completed())
+        return cp.process()
+
+    def test_concurrent_report_identical_to_serial(self):
+        serial_report = self.process(self.get_controllers(sleep=0.05), max_workers=1)
+        concurrent_report = self.process(self.get_controllers(sleep=0.05), max_workers=4)
+        self.assertEqual(serial_report.as_dict(), concurrent_report.as_dict())
+        self.assertEqual([cn.controller.name for cn in concurrent_report.controller_notes],
+                         ['high_1', 'high_2', 'medium_1', 'medium_2', 'medium_3'])
+        self.assertEqual(concurrent_report.state, serial_report.state)
+
+    def test_grouping(self):
+        controllers = self.get_controllers()
+        cp = ControlProcedure(controllers=controllers[:2])
+        cp.setup_controllers(ControlledItemType.task_completed())
+        self.assertEqual(cp.priorities, [PRIORITY_HIGH])
+        cp.add_controllers(controllers[2:])
+        cp.setup_controllers(ControlledItemType.task_completed())
+        self.assertEqual(cp.priorities, [PRIORITY_HIGH, PRIORITY_MEDIUM, PRIORITY_LOWEST])
+        self.assertEqual(cp.ncontrollers, 6)
+        cp.setup_controllers(ControlledItemType.task_failed())
+        self.assertEqual(cp.ncontrollers, 0)
+        self.assertEqual(cp.max_workers, 1)
+        cp_dict = cp.as_dict()
+        cp_dict.pop('max_workers')
+        # documents written before max_workers are processed serially
+        self.assertEqual(ControlProcedure.from_dict(cp_dict).max_workers, 1)
+        cp = ControlProcedure(controllers=controllers, max_workers=4)
+        self.assertEqual(ControlProcedure.from_dict(cp.as_dict()).max_workers, 4)
+
+    def test_exceptions(self):
+        controllers = [SleepingController('high_1', ControllerNote.NOTHING_FOUND, PRIORITY_HIGH, sleep=0.05),
+                       FailingController('high_2', ControllerNote.NOTHING_FOUND, PRIORITY_HIGH),
+                       FailingController('high_3', ControllerNote.NOTHING_FOUND, PRIORITY_HIGH)]
+        for max_workers in [1, 4]:
+            with self.assertRaises(RuntimeError) as ctx:
+                self.process(controllers, max_workers=max_workers)
+            self.assertIn('high_2', str(ctx.exception))
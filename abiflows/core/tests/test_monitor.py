@@ -0,0 +1,107 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from abiflows.core.mastermind_abc import Monitor, ControlProcedure, ControllerNote
+from abiflows.core.controllers import AbinitScfDivergenceMonitor, SimpleValidatorController, lower_scf_mixing
+
+from pymatgen.util.testing import PymatgenTest
+
+
+FAKE_ABINIT = """from __future__ import print_function
+import sys
+import time
+
+diverging = sys.argv[1] == 'diverging'
+for iteration in range(1, 101):
+    if diverging:
+        residual = 1.0e-3 * 2 ** max(0, iteration - 3)
+    else:
+        residual = 1.0e-3 / 2 ** iteration
+    print(' ETOT {:3d}  -8.8600412283652  -8.860E-04 2.351E-08 {:.3E}'.format(iteration, residual))
+    sys.stdout.flush()
+    time.sleep(0.05)
+"""
+
+
+class FakeAbinitInput(dict):
+
+    ispaw = False
+
+    def set_vars(self, **kwargs):
+        self.update(kwargs)
+
+
+class TestMonitor(PymatgenTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.script_filepath = os.path.join(self.tmp_dir, 'fake_abinit.py')
+        with io.open(self.script_filepath, 'w') as f:
+            f.write(FAKE_ABINIT)
+        self.log_filepath = os.path.join(self.tmp_dir, 'run.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_fake_abinit(self, mode, monitor):
+        start = time.time()
+        with open(self.log_filepath, 'w') as stdout:
+            process = subprocess.Popen([sys.executable, self.script_filepath, mode], stdout=stdout)
+        monitor.start(process, output_filepath=self.log_filepath)
+        process.communicate()
+        monitor.stop()
+        return process, time.time() - start
+
+    def test_diverging_scf(self):
+        monitor = Monitor(controllers=[AbinitScfDivergenceMonitor(nincreasing=5, factor=100)], interval=0.1)
+        process, elapsed = self.run_fake_abinit('diverging', monitor)
+
+        # The run is stopped well before the end of the 100 iterations (5 seconds)
+        self.assertTrue(monitor.aborted)
+        self.assertNotEqual(process.returncode, 0)
+        self.assertLess(elapsed, 4)
+        self.assertEqual(len(monitor.controller_notes), 1)
+        note = monitor.controller_notes[0]
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        self.assertEqual(note.restart, ControllerNote.RESET_RESTART)
+        self.assertIn('SCF cycle diverging', note.problems[0])
+        # The note can be passed to the control step, where the mixing of the input is lowered for the restart
+        note = ControllerNote.from_dict(note.as_dict())
+        self.assertEqual(note.state, ControllerNote.ERROR_RECOVERABLE)
+        abinit_input = FakeAbinitInput(ecut=10)
+        note.actions['abinit_input'].apply(abinit_input)
+        self.assertAlmostEqual(abinit_input['diemix'], 0.5)
+
+    def test_lower_scf_mixing(self):
+        abinit_input = FakeAbinitInput(diemix=0.08)
+        lower_scf_mixing(abinit_input, factor=0.5, min_diemix=0.05)
+        self.assertAlmostEqual(abinit_input['diemix'], 0.05)
+        # still diverging with the minimum mixing
+        with self.assertRaises(ValueError):
+            lower_scf_mixing(abinit_input, factor=0.5, min_diemix=0.05)
+        abinit_input = FakeAbinitInput()
+        abinit_input.ispaw = True
+        lower_scf_mixing(abinit_input, factor=0.5)
+        self.assertAlmostEqual(abinit_input['diemix'], 0.35)
+
+    def test_converging_scf(self):
+        monitor = Monitor(controllers=[AbinitScfDivergenceMonitor(nincreasing=5, factor=100)], interval=0.1)
+        process, elapsed = self.run_fake_abinit('converging', monitor)
+        self.assertFalse(monitor.aborted)
+        self.assertEqual(process.returncode, 0)
+
+    def test_from_control_procedure(self):
+        cp = ControlProcedure(controllers=[SimpleValidatorController()])
+        self.assertIsNone(Monitor.from_control_procedure(cp))
+        cp.add_controller(AbinitScfDivergenceMonitor())
+        monitor = Monitor.from_control_procedure(cp, interval=5)
+        self.assertEqual(len(monitor.controllers), 1)
+        self.assertEqual(monitor.interval, 5)
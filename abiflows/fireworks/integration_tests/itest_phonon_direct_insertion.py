@@ -0,0 +1,108 @@
+from __future__ import print_function, division, unicode_literals
+
+import mock
+import pytest
+
+from bson import BSON
+from fireworks.core.firework import Firework, FireTaskBase, FWAction, Workflow
+from fireworks.core.rocket_launcher import rapidfire
+from fireworks.user_objects.firetasks.script_task import ScriptTask
+from fireworks.utilities.fw_utilities import explicit_serialize
+
+from abiflows.fireworks.utils.fw_utils import insert_wf_as_detour
+
+pytestmark = pytest.mark.usefixtures("cleandb")
+
+NUM_PERTURBATIONS = 5000
+# Size budget (in bytes) for any document in the database, well below the 16MB limit of mongodb
+DOCUMENT_SIZE_BUDGET = 1024 ** 2
+# Fake input of a perturbation, to get fireworks of realistic size
+FAKE_INPUT = "\n".join("var{} {}".format(i, 0.1 * i) for i in range(200))
+
+
+def get_perturbations_wf(num_perturbations):
+    pert_fws = [Firework(ScriptTask.from_str('echo perturbation'), spec={'input': FAKE_INPUT, 'qpt_index': i},
+                         name='pert_{}'.format(i))
+                for i in range(num_perturbations)]
+    merge_fw = Firework(ScriptTask.from_str('echo merge'), name='merge')
+    return Workflow(pert_fws + [merge_fw], {pert_fw: [merge_fw] for pert_fw in pert_fws})
+
+
+@explicit_serialize
+class FakePhononGenerationTask(FireTaskBase):
+    """
+    Generates the perturbations directly in the LaunchPad, as the GeneratePhononFlowFWAbinitTask with
+    direct_insertion=True.
+    """
+
+    def run_task(self, fw_spec):
+        fw_ids = insert_wf_as_detour(self.launchpad, get_perturbations_wf(self['num_perturbations']), self.fw_id,
+                                     max_batch_size=DOCUMENT_SIZE_BUDGET, max_document_size=DOCUMENT_SIZE_BUDGET)
+        return FWAction(stored_data={'direct_insertion': {'num_fws': len(fw_ids), 'first_fw_id': fw_ids[0],
+                                                          'last_fw_id': fw_ids[-1]}})
+
+
+def get_document_sizes(collection):
+    return [len(BSON.encode(doc)) for doc in collection.find()]
+
+
+class ItestPhononDirectInsertion():
+
+    def itest_direct_insertion(self, lp, fworker, tmpdir):
+        gen_fw = Firework(FakePhononGenerationTask(num_perturbations=NUM_PERTURBATIONS),
+                          spec={'_add_launchpad_and_fw_id': True}, name='gen_ph')
+        anaddb_fw = Firework(ScriptTask.from_str('echo anaddb'), name='anaddb')
+        old_new = lp.add_wf(Workflow([gen_fw, anaddb_fw], {gen_fw: [anaddb_fw]}))
+        gen_fw_id = old_new[gen_fw.fw_id]
+        anaddb_fw_id = old_new[anaddb_fw.fw_id]
+
+        rapidfire(lp, fworker, m_dir=str(tmpdir), nlaunches=1)
+
+        assert lp.get_fw_by_id(gen_fw_id).state == "COMPLETED"
+
+        # No document exceeds the budget
+        for collection in [lp.fireworks, lp.workflows, lp.launches]:
+            assert max(get_document_sizes(collection)) <= DOCUMENT_SIZE_BUDGET
+
+        # The perturbations are linked between the generation and its original child
+        wf = lp.get_wf_by_fw_id_lzyfw(gen_fw_id)
+        assert len(wf.links) == NUM_PERTURBATIONS + 3
+        pert_fw_ids = wf.links[gen_fw_id]
+        assert len(pert_fw_ids) == NUM_PERTURBATIONS
+        merge_fw_id = wf.links[pert_fw_ids[0]][0]
+        assert wf.links[merge_fw_id] == [anaddb_fw_id]
+        assert wf.links.parent_links[anaddb_fw_id] == [merge_fw_id]
+        assert lp.get_fw_by_id(pert_fw_ids[0]).state == "READY"
+        assert lp.get_fw_by_id(merge_fw_id).state == "WAITING"
+        assert lp.get_fw_by_id(anaddb_fw_id).state == "WAITING"
+
+        # Only a small reference is stored in the launch
+        launch = lp.get_fw_by_id(gen_fw_id).launches[-1]
+        assert launch.action.stored_data['direct_insertion']['num_fws'] == NUM_PERTURBATIONS + 1
+        assert not launch.action.detours
+
+    def itest_document_too_large(self, lp):
+        gen_fw = Firework(ScriptTask.from_str('echo gen'), name='gen_ph')
+        gen_fw_id = lp.add_wf(Workflow([gen_fw]))[gen_fw.fw_id]
+        num_fws = lp.fireworks.count()
+
+        with pytest.raises(ValueError):
+            insert_wf_as_detour(lp, get_perturbations_wf(10), gen_fw_id, max_document_size=1000)
+
+        # Nothing is left in the LaunchPad
+        assert lp.fireworks.count() == num_fws
+        assert lp.get_wf_by_fw_id_lzyfw(gen_fw_id).links[gen_fw_id] == []
+
+    def itest_workflow_update_failure(self, lp):
+        gen_fw = Firework(ScriptTask.from_str('echo gen'), name='gen_ph')
+        gen_fw_id = lp.add_wf(Workflow([gen_fw]))[gen_fw.fw_id]
+        num_fws = lp.fireworks.count()
+
+        # The fireworks are inserted in several batches, then the update of the workflow fails
+        with mock.patch.object(lp.workflows, 'update_one', side_effect=RuntimeError('update failed')):
+            with pytest.raises(RuntimeError):
+                insert_wf_as_detour(lp, get_perturbations_wf(10), gen_fw_id, max_batch_size=20000)
+
+        # The inserted fireworks are removed
+        assert lp.fireworks.count() == num_fws
+        assert lp.get_wf_by_fw_id_lzyfw(gen_fw_id).links[gen_fw_id] == []
@@ -0,0 +1,180 @@
+from __future__ import print_function, division, unicode_literals
+
+import os
+import pytest
+
+from fireworks.core.firework import Workflow
+from monty.json import jsanitize
+from fireworks.core.rocket_launcher import rapidfire
+from fireworks.utilities.fw_utilities import explicit_serialize
+from pymatgen.io.abinit.tasks import TaskManager
+
+from abiflows.core.mastermind_abc import Controller, ControllerNote, ControlledItemType, PRIORITY_LOWEST
+from abiflows.fireworks.tasks.src_tasks_abc import SetupTask, ScriptRunTask, ControlTask, createSRCFireworks
+
+pytestmark = pytest.mark.usefixtures("cleandb")
+
+MODULE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAKE_EXECUTABLE = """from __future__ import print_function
+import os
+import sys
+
+counter_filepath = sys.argv[1]
+nfailures = int(sys.argv[2])
+if os.path.exists(counter_filepath):
+    with open(counter_filepath) as f:
+        ncalls = int(f.read())
+else:
+    ncalls = 0
+with open(counter_filepath, 'w') as f:
+    f.write(str(ncalls + 1))
+with open('fake_run.log', 'w') as f:
+    f.write('CONVERGED' if ncalls >= nfailures else 'NOT CONVERGED')
+"""
+
+
+def get_fake_qadapter():
+    return TaskManager.from_file(os.path.join(MODULE_DIR, "manager.yml")).qads[0]
+
+
+@explicit_serialize
+class FakeSetupTask(SetupTask):
+    """
+    Setup task using the first queue adapter of the manager of the integration tests.
+    """
+
+    task_type = 'fake'
+
+    def _setup_run_parameters(self, fw_spec, parameters):
+        qadapter = get_fake_qadapter()
+        params = {'_queueadapter': qadapter.get_subs_dict(), 'mpi_ncpus': 1, 'qtk_queueadapter': qadapter}
+        return {param: params[param] for param in parameters}
+
+
+@explicit_serialize
+class FakeControlTask(ControlTask):
+
+    def get_initial_objects_info(self, setup_fw, run_fw, src_directories):
+        return {'run_dir': {'object': src_directories['run_dir']}}
+
+
+class FakeConvergenceController(Controller):
+    """
+    Validates the run if the fake executable reports convergence, asks for a simple restart otherwise.
+    """
+
+    can_validate = True
+    _controlled_item_types = [ControlledItemType.task_completed()]
+
+    def __init__(self):
+        super(FakeConvergenceController, self).__init__()
+        self.priority = PRIORITY_LOWEST
+
+    def as_dict(self):
+        return {'@class': self.__class__.__name__,
+                '@module': self.__class__.__module__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls()
+
+    def process(self, **kwargs):
+        note = ControllerNote(controller=self)
+        with open(os.path.join(kwargs['run_dir'], 'fake_run.log')) as f:
+            converged = f.read() == 'CONVERGED'
+        if converged:
+            note.state = ControllerNote.EVERYTHING_OK
+            note.is_valid = True
+        else:
+            note.state = ControllerNote.ERROR_RECOVERABLE
+            note.is_valid = False
+            note.simple_restart()
+        return note
+
+
+def get_controller_states(stored_data):
+    return [cn['state'] for cn in jsanitize(stored_data['control_report'], strict=True)['controller_notes']]
+
+
+class ItestSRCFused():
+
+    def _run_src(self, lp, fworker, tmpdir, fused, nfailures=2, mpi_ncpus=1):
+        fake_executable = tmpdir.join('fake_executable.py')
+        fake_executable.write(FAKE_EXECUTABLE)
+        counter_filepath = str(tmpdir.join('counter.txt'))
+        script_str = 'python {} {} {:d}'.format(str(fake_executable), counter_filepath, nfailures)
+        control_task = FakeControlTask.from_controllers([FakeConvergenceController()])
+        run_task = ScriptRunTask(script_str=script_str, control_procedure=control_task.control_procedure)
+        # The allocation of the fused job
+        run_spec_update = {'_queueadapter': get_fake_qadapter().get_subs_dict(), 'mpi_ncpus': mpi_ncpus}
+        src_fws = createSRCFireworks(setup_task=FakeSetupTask(), run_task=run_task, control_task=control_task,
+                                     task_index='fake', run_spec_update=run_spec_update, fused=fused)
+        wf = Workflow(fireworks=src_fws['fws'], links_dict=src_fws['links_dict'])
+        lp.add_wf(wf)
+
+        rapidfire(lp, fworker, m_dir=str(tmpdir))
+
+        with open(counter_filepath) as f:
+            assert int(f.read()) == nfailures + 1
+
+        fw_ids = lp.get_fw_ids()
+        fws = [lp.get_fw_by_id(fw_id) for fw_id in fw_ids]
+        nlaunches = sum(len(fw.launches) for fw in fws)
+        states = sorted(fw.state for fw in fws)
+        wf_state = lp.get_wf_by_fw_id(fw_ids[0]).state
+
+        # stored_data of each control step, ordered by SRC_task_index
+        stored_data = {}
+        for fw in fws:
+            data = fw.launches[-1].action.stored_data
+            if fw.name.startswith('control_'):
+                stored_data[fw.name.split('_', 1)[1]] = data
+            elif fw.name.startswith('fused_'):
+                for step_data in data['src_fused_steps']:
+                    if 'control_report' in step_data:
+                        stored_data[step_data['SRC_task_index']] = step_data
+        steps_stored_data = [stored_data[k] for k in sorted(stored_data)]
+        return nlaunches, states, wf_state, steps_stored_data, fws
+
+    def itest_fused_vs_unfused(self, lp, fworker, tmpdir):
+        nlaunches, states, wf_state, unfused_data, fws = self._run_src(lp, fworker, tmpdir.mkdir('unfused'),
+                                                                       fused=False)
+        assert nlaunches == 3 * 3
+        assert set(states) == {'COMPLETED'}
+
+        lp.reset(password=None, require_password=False)
+
+        fused_tmpdir = tmpdir.mkdir('fused')
+        nlaunches, states, fused_wf_state, fused_data, fws = self._run_src(lp, fworker, fused_tmpdir, fused=True)
+        # All the restarts are performed locally in the same launch
+        assert nlaunches == 1
+        assert states == ['COMPLETED']
+        # The directories of the three SRC steps are created in the launch directory
+        launch_dir = [d for d in fused_tmpdir.listdir() if d.basename.startswith('launcher_')][0]
+        for index in range(1, 4):
+            assert launch_dir.join('fake_{:d}'.format(index), 'run', 'fake_run.log').check()
+
+        # Same final state and same history of the control steps in the two modes
+        assert fused_wf_state == wf_state == 'COMPLETED'
+        assert len(fused_data) == len(unfused_data) == 3
+        assert [get_controller_states(d) for d in fused_data] == [get_controller_states(d) for d in unfused_data]
+        assert [d.get('finalized', False) for d in fused_data] == [d.get('finalized', False) for d in unfused_data]
+        assert unfused_data[-1]['finalized']
+        # The last step is also the stored_data of the fused firework
+        fused_fw_data = fws[0].launches[-1].action.stored_data
+        assert fused_fw_data['finalized']
+        assert len(fused_fw_data['src_fused_steps']) == 3
+
+    def itest_fused_different_resources(self, lp, fworker, tmpdir):
+        # The setup asks for 1 mpi process while the fused job has 2: the step is run as a standard SRC trio
+        nlaunches, states, wf_state, steps_data, fws = self._run_src(lp, fworker, tmpdir, fused=True, mpi_ncpus=2)
+        assert nlaunches == 1 + 3 * 3
+        assert set(states) == {'COMPLETED'}
+        assert wf_state == 'COMPLETED'
+        assert len(steps_data) == 3
+        assert steps_data[-1]['finalized']
+        fused_fw = [fw for fw in fws if fw.name.startswith('fused_')][0]
+        detour_data = fused_fw.launches[-1].action.stored_data['src_fused_detour']
+        assert detour_data['launch_resources']['mpi_ncpus'] == 2
+        assert detour_data['setup_resources']['mpi_ncpus'] == 1
@@ -1,6 +1,7 @@
 __author__ = 'waroquiers'
 
 import json
+from bisect import bisect_left
 from math import ceil
 import os
 from monty.dev import deprecated
@@ -20,6 +21,8 @@ DUMMY_FILENAME = "__DUMMY__"
 ELPHON_OUTPUT_FILE_NAME = "run.abo_elphon"
 DDK_FILES_FILE_NAME = "ddk.files"
 HISTORY_JSON = "history.json"
+HISTORY_JSONL = "history.jsonl"
+MRGDDB_TREE_DIR = "mrgddb_tree"
 
 
 module_dir = os.path.dirname(os.path.abspath(__file__))
@@ -62,19 +65,34 @@ class Cut3DInput(object):
 
         return cls.hirshfeld(density_file_path, all_el_dens_paths)
 
+# Allowed numbers of bands for each number of primes, loaded once by get_allowed_nbands
+_allowed_nbands = {}
+
+
+def get_allowed_nbands(number_of_primes=10):
+    """
+    Sorted list of the numbers up to 1000 whose prime factors are among the first number_of_primes primes.
+    """
+    if not _allowed_nbands:
+        with open('{}/n1000multiples_primes.json'.format(module_dir), 'r') as f:
+            dd = json.load(f)
+        _allowed_nbands.update((k, sorted(v)) for k, v in dd.items())
+    key = 'numbers{:d}primes'.format(number_of_primes)
+    if key not in _allowed_nbands:
+        raise ValueError('Number of primes is wrong ...')
+    return _allowed_nbands[key]
+
+
 def unprime_nband(nband, number_of_primes=10):
-    allowed_nbands = []
-    with open('{}/n1000multiples_primes.json'.format(module_dir), 'r') as f:
-        dd = json.load(f)
-        if 'numbers{:d}primes'.format(number_of_primes) not in dd:
-            raise ValueError('Number of primes is wrong ...')
-        allowed_nbands = dd['numbers{:d}primes'.format(number_of_primes)]
+    allowed_nbands = get_allowed_nbands(number_of_primes)
     if nband <= 1000:
-        if nband in allowed_nbands:
-            return nband
-        return min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband])
+        i = bisect_left(allowed_nbands, nband)
+        if i == len(allowed_nbands):
+            raise ValueError('No allowed number of bands larger than {}'.format(nband))
+        return allowed_nbands[i]
     elif nband <= 10000:
         nband10 = int(ceil(float(nband)/10.0))
-        if nband10 in allowed_nbands:
-            return nband10*10
-        return 10*min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband10])
\ No newline at end of file
+        i = bisect_left(allowed_nbands, nband10)
+        if i == len(allowed_nbands):
+            raise ValueError('No allowed number of bands larger than {}'.format(nband))
+        return 10*allowed_nbands[i]
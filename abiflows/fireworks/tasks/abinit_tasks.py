@@ -5,6 +5,7 @@ Task classes for Fireworks.
 from __future__ import print_function, division, unicode_literals
 
 import inspect
+import contextlib
 import subprocess
 import logging
 import collections
@@ -15,14 +16,27 @@ import threading
 import glob
 import os
 import errno
+import multiprocessing
 import numpy as np
+from multiprocessing.pool import ThreadPool
 from fireworks.core.firework import Firework, FireTaskBase, FWAction, Workflow
 from fireworks.utilities.fw_utilities import explicit_serialize
 from fireworks.utilities.fw_serializers import serialize_fw
 from collections import namedtuple, defaultdict
+from abiflows.core.event_parsing import IncrementalEventsParser
 from abiflows.fireworks.utils.task_history import TaskHistory
-from abiflows.fireworks.utils.fw_utils import links_dict_update
+from abiflows.fireworks.utils.autoparal_cache import get_autoparal_pconfs
+from abiflows.fireworks.utils.autoparal_calibration import record_run
+from abiflows.fireworks.utils.autoparal_probes import run_autoparal_probes
+from abiflows.fireworks.utils.fw_utils import links_dict_update, insert_wf_as_detour
+from abiflows.fireworks.utils.fw_utils import DIRECT_INSERTION_MAX_BATCH_SIZE, DIRECT_INSERTION_MAX_DOCUMENT_SIZE
 from abiflows.fireworks.utils.fw_utils import set_short_single_core_to_spec
+from abiflows.fireworks.utils.qpoints import QptIndex
+from abiflows.fireworks.utils.ddb_utils import get_ddb_section, patch_ddb_section
+from abiflows.fireworks.utils.staging import stage_file, stage_files
+from abiflows.fireworks.utils.scratch import scratch_run
+from abiflows.fireworks.utils.checkpoint import CheckpointSupervisor
+from abiflows.fireworks.utils.manifest import ManifestDirectory, write_manifest
 from abiflows.fireworks.tasks.utility_tasks import SRC_TIMELIMIT_BUFFER, get_queue_adapter_update
 from pymatgen.io.abinit.utils import Directory, File
 from pymatgen.io.abinit import events, tasks
@@ -41,7 +55,7 @@ from abipy.core import Structure
 
 from abiflows.fireworks.tasks.abinit_common import TMPDIR_NAME, OUTDIR_NAME, INDIR_NAME, STDERR_FILE_NAME, \
     LOG_FILE_NAME, FILES_FILE_NAME, OUTPUT_FILE_NAME, INPUT_FILE_NAME, MPIABORTFILE, DUMMY_FILENAME, \
-    ELPHON_OUTPUT_FILE_NAME, DDK_FILES_FILE_NAME, HISTORY_JSON
+    ELPHON_OUTPUT_FILE_NAME, DDK_FILES_FILE_NAME, HISTORY_JSONL, MRGDDB_TREE_DIR
 from abiflows.fireworks.utils.fw_utils import FWTaskManager
 from abiflows.fireworks.tasks.utility_tasks import createSRCFireworksOld
 
@@ -92,26 +106,31 @@ class BasicAbinitTaskMixin(object):
         ftm.update_fw_policy(fw_spec.get('fw_policy', {}))
         return ftm
 
-    def run_autoparal(self, abiinput, autoparal_dir, ftm, clean_up='move'):
+    def run_autoparal(self, abiinput, autoparal_dir, ftm, clean_up='move', pconfs=None):
         """
         Runs the autoparal using AbinitInput abiget_autoparal_pconfs method.
         The information are retrieved from the FWTaskManager that should be present and contain the standard
         abipy TaskManager, that provides information about the queue adapters.
         No check is performed on the autoparal_dir. If there is a possibility of overwriting output data due to
         reuse of the same folder, it should be handled by the caller.
+        If pconfs is given (e.g. obtained with probe_autoparal), the autoparal is not run again and only the
+        configuration is selected.
         """
         manager = ftm.task_manager
         if not manager:
             msg = 'No task manager available: autoparal could not be performed.'
             logger.error(msg)
             raise InitializationError(msg)
-        pconfs = abiinput.abiget_autoparal_pconfs(max_ncpus=manager.max_cores, workdir=autoparal_dir,
-                                                       manager=manager)
+        if pconfs is None:
+            pconfs = get_autoparal_pconfs(abiinput, manager=manager, workdir=autoparal_dir, fw_policy=ftm.fw_policy)
         optconf = manager.select_qadapter(pconfs)
         qadapter_spec = manager.qadapter.get_subs_dict()
 
         d = pconfs.as_dict()
         d["optimal_conf"] = optconf
+        # the directory is not created if the configurations do not come from a run of abinit
+        if not os.path.isdir(autoparal_dir):
+            os.makedirs(autoparal_dir)
         json_pretty_dump(d, os.path.join(autoparal_dir, "autoparal.json"))
 
         # Method to clean the output files
@@ -157,6 +176,27 @@ class BasicAbinitTaskMixin(object):
 
         return optconf, qadapter_spec, manager.qadapter
 
+    def probe_autoparal(self, multi_inputs, task_classes, ftm):
+        """
+        Runs concurrently the autoparal for the first input of each of the multi_inputs, that will be used to
+        create the tasks of the corresponding task_classes (see run_autoparal_probes).
+        The number of concurrent probes and their timeout are set by the autoparal_max_workers and
+        autoparal_timeout of the fw_policy.
+        Returns a dictionary with the ParalHints for each task class, None if the probe failed.
+        """
+        manager = ftm.task_manager
+        if not manager:
+            msg = 'No task manager available: autoparal could not be performed.'
+            logger.error(msg)
+            raise InitializationError(msg)
+        probes = [(task_class, multi_inp[0]) for multi_inp, task_class in zip(multi_inputs, task_classes) if multi_inp]
+        workdirs = [os.path.join(os.path.abspath('.'), "autoparal_{}_0".format(task_class.__name__))
+                    for task_class, inp in probes]
+        pconfs_list = run_autoparal_probes([inp for task_class, inp in probes], manager, ftm.fw_policy, workdirs,
+                                           max_workers=ftm.fw_policy.autoparal_max_workers,
+                                           timeout=ftm.fw_policy.autoparal_timeout)
+        return {task_class: pconfs for (task_class, inp), pconfs in zip(probes, pconfs_list)}
+
     def run_fake_autoparal(self, ftm):
         """
         In cases where the autoparal is not supported a fake run autoparal can be used to set the queueadapter.
@@ -200,6 +240,33 @@ class BasicAbinitTaskMixin(object):
         logging.getLogger('abipy').addHandler(log_handler)
         logging.getLogger('abiflows').addHandler(log_handler)
 
+    def stage_dep(self, source, dest):
+        """
+        Copies a dependency to dest with the cheapest method allowed by the fw_policy (see stage_file).
+        Inside deps_staging the copy is only scheduled and performed, concurrently with the others, at its exit.
+        """
+        if getattr(self, '_deps_to_stage', None) is not None:
+            self._deps_to_stage.append((source, dest))
+        else:
+            stage_file(source, dest, methods=self.ftm.fw_policy.copy_deps_methods,
+                       checksum=self.ftm.fw_policy.copy_deps_checksum)
+
+    @contextlib.contextmanager
+    def deps_staging(self):
+        """
+        Context manager collecting the dependencies that should be copied by link_ext and link_1ext and staging
+        them concurrently at the exit. The paths returned by the link methods can be used only after the exit.
+        """
+        self._deps_to_stage = []
+        try:
+            yield
+            if self._deps_to_stage:
+                stage_files(self._deps_to_stage, methods=self.ftm.fw_policy.copy_deps_methods,
+                            checksum=self.ftm.fw_policy.copy_deps_checksum,
+                            max_workers=self.ftm.fw_policy.copy_deps_max_workers)
+        finally:
+            self._deps_to_stage = None
+
     def link_ext(self, ext, source_dir, strict=True):
         source = os.path.join(source_dir, self.prefix.odata + "_" + ext)
         logger.info("Need path {} with ext {}".format(source, ext))
@@ -221,7 +288,7 @@ class BasicAbinitTaskMixin(object):
         logger.info("Linking path {} --> {}".format(source, dest))
         if not os.path.exists(dest) or not strict:
             if self.ftm.fw_policy.copy_deps:
-                shutil.copyfile(source, dest)
+                self.stage_dep(source, dest)
             else:
                 os.symlink(source, dest)
             return dest
@@ -238,7 +305,7 @@ class BasicAbinitTaskMixin(object):
         # handle the custom DDK extension on its own
         # accept more than one DDK file in the outdir: multiple perturbations are allowed in a
         # single calculation
-        outdata_dir = Directory(os.path.join(source_dir, OUTDIR_NAME))
+        outdata_dir = ManifestDirectory(os.path.join(source_dir, OUTDIR_NAME))
         ddks = []
         for f in outdata_dir.list_filepaths():
             if f.endswith('_DDK'):
@@ -261,7 +328,7 @@ class BasicAbinitTaskMixin(object):
         # but the real extension in DEN.
         if "1DEN" in ext:
             ext = "DEN"
-        source = Directory(os.path.join(source_dir,os.path.split(self.prefix.odata)[0])).has_abiext(ext)
+        source = ManifestDirectory(os.path.join(source_dir,os.path.split(self.prefix.odata)[0])).has_abiext(ext)
         if not source:
             if strict:
                 msg = "output file with extension {} is needed from {} dir, " \
@@ -281,7 +348,7 @@ class BasicAbinitTaskMixin(object):
         logger.info("Linking path {} --> {}".format(source, dest))
         if not os.path.exists(dest) or not strict:
             if self.ftm.fw_policy.copy_deps:
-                shutil.copyfile(source, dest)
+                self.stage_dep(source, dest)
             else:
                 os.symlink(source, dest)
             return dest
@@ -450,7 +517,8 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
 
         # Copy the appropriate dependencies in the in dir
         #TODO it should be clarified if this should stay here or in setup_task().
-        self.resolve_deps(fw_spec)
+        with self.deps_staging():
+            self.resolve_deps(fw_spec)
 
         # if it's the restart of a previous task, perform specific task updates.
         # perform these updates before writing the input, but after creating the dirs.
@@ -459,6 +527,11 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
             self.history.log_restart(self.restart_info)
             self.restart()
 
+        # abinit checks the trigger file of the checkpoint supervisor only if chkexit is set
+        if self.ftm.fw_policy.checkpoint_margin is not None and self.ftm.fw_policy.checkpoint_method == 'file' \
+                and 'chkexit' not in self.abiinput:
+            self.abiinput.set_vars(chkexit=1)
+
         # Write files file and input file.
         if not self.files_file.exists:
             self.files_file.write(self.filesfile_string)
@@ -473,6 +546,11 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
         Note that in case of missing definition of these parameters, the values fall back to the default
         values of  mpirun_cmd and abinit_cmd: 'mpirun' and 'abinit', assuming that these are properly retrived
         from the PATH
+        If the scratch_dir is set in the fw_policy, abinit runs in a node-local scratch directory and only the
+        outputs with the scratch_copy_back_exts are copied back to the outdata (see utils.scratch.ScratchRun).
+        If the checkpoint_margin is set in the fw_policy and the walltime is known, abinit is asked to stop that
+        margin before the end of the walltime, so that the restart can use the checkpoint files
+        (see utils.checkpoint.CheckpointSupervisor).
         """
 
         def abinit_process():
@@ -488,27 +566,45 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
                 if mytimelimit < 120:
                     raise ValueError('Abinit timelimit less than 2 min. Probably wrong queue/job configuration')
                 command.extend(['--timelimit', time2slurm(mytimelimit)])
-            with open(self.files_file.path, 'r') as stdin, open(self.log_file.path, 'w') as stdout, \
+            with open(files_file_path, 'r') as stdin, open(self.log_file.path, 'w') as stdout, \
                     open(self.stderr_file.path, 'w') as stderr:
                 self.process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr)
+            if scratch is not None:
+                scratch.process = self.process
+            if supervisor is not None:
+                supervisor.start(self.process)
 
             (stdoutdata, stderrdata) = self.process.communicate()
             self.returncode = self.process.returncode
+            if supervisor is not None:
+                supervisor.stop()
 
         # initialize returncode to avoid missing references in case of exception in the other thread
         self.returncode = None
 
-        thread = threading.Thread(target=abinit_process)
-        # the amount of time left plus a buffer of 2 minutes
-        timeout = (self.walltime - (time.time() - self.start_time) - 120) if self.walltime else None
-        start_abinit_time = time.time()
-        thread.start()
-        thread.join(timeout)
-        self.history.log_abinit_stop(run_time=(time.time() - start_abinit_time))
-        if thread.is_alive():
-            self.process.terminate()
-            thread.join()
-            raise WalltimeError("The task couldn't be terminated within the time limit. Killed.")
+        with scratch_run(self.workdir, self.ftm.fw_policy) as scratch:
+            files_file_path = scratch.write_filesfile(self.files_file.path) if scratch else self.files_file.path
+            deadline = (self.start_time + self.walltime) if self.walltime else None
+            supervisor = CheckpointSupervisor.from_fw_policy(self.ftm.fw_policy, deadline, self.workdir,
+                                                             scratch.outdir if scratch else self.outdir.path,
+                                                             scratch=scratch)
+            thread = threading.Thread(target=abinit_process)
+            # the amount of time left plus a buffer of 2 minutes. The supervisor, if present, should stop abinit
+            # before: the timeout is kept as a backstop.
+            timeout = (self.walltime - (time.time() - self.start_time) - 120) if self.walltime else None
+            start_abinit_time = time.time()
+            thread.start()
+            thread.join(timeout)
+            self.history.log_abinit_stop(run_time=(time.time() - start_abinit_time))
+            if supervisor is not None and supervisor.triggered:
+                self.history.log_checkpoint(supervisor.as_dict())
+            if thread.is_alive():
+                self.process.terminate()
+                thread.join()
+                raise WalltimeError("The task couldn't be terminated within the time limit. Killed.")
+            if supervisor is not None and supervisor.killed:
+                raise WalltimeError("Abinit didn't stop within {} s before the end of the walltime. "
+                                    "Killed.".format(supervisor.grace_period))
 
     def get_event_report(self, source='log'):
         """
@@ -532,7 +628,8 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
                 return abort_report
 
         try:
-            report = parser.parse(ofile.path)
+            # The (possibly huge) main output file is parsed incrementally
+            report = IncrementalEventsParser().parse(ofile.path)
 
             # Add events found in the ABI_MPIABORTFILE.
             if self.mpiabort_file.exists:
@@ -885,8 +982,12 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
                 self.abiinput = exception_details.abiinput
                 self.restart_info = exception_details.restart_info
                 self.history = exception_details.history
+                self.history.attach_log(HISTORY_JSONL)
 
     def run_task(self, fw_spec):
+        # The history is written in the launch dir as soon as the events are logged, for automatic parsing
+        # of the folders
+        self.history.attach_log(HISTORY_JSONL)
         if self.use_SRC_scheme:
             try:
                 self.setup_task(fw_spec)
@@ -910,10 +1011,6 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
                 # log the error in history and reraise
                 self.history.log_error(exc)
                 raise
-            finally:
-                # Always dump the history for automatic parsing of the folders
-                with open(HISTORY_JSON, "w") as f:
-                    json.dump(self.history, f, cls=MontyEncoder, indent=4, sort_keys=4)
         else:
             try:
                 self.setup_task(fw_spec)
@@ -933,10 +1030,6 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
                 # log the error in history and reraise
                 self.history.log_error(exc)
                 raise
-            finally:
-                # Always dump the history for automatic parsing of the folders
-                with open(HISTORY_JSON, "w") as f:
-                    json.dump(self.history, f, cls=MontyEncoder, indent=4, sort_keys=4)
 
     def restart(self):
         """
@@ -946,9 +1039,12 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
         pass
 
     def conclude_task(self, fw_spec):
+        # list the produced files for the following tasks
+        write_manifest(self.outdir.path)
         stored_data = self.report.as_dict()
         stored_data['finalized'] = True
         self.history.log_finalized(self.abiinput)
+        record_run(self.history, self.abiinput, self.ftm.fw_policy)
         stored_data['history'] = self.history.as_dict()
         update_spec = {}
         mod_spec = self.get_final_mod_spec(fw_spec)
@@ -959,7 +1055,8 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
 
     def setupSRC(self, fw_spec):
         # Copy the appropriate dependencies in the in dir. needed in some cases
-        self.resolve_deps(fw_spec)
+        with self.deps_staging():
+            self.resolve_deps(fw_spec)
 
         optconf, qadapter_spec, qtk_qadapter = self.run_autoparal(self.abiinput, os.path.abspath('.'), self.ftm)
         #TODO: handle the update of the queue adapter more cleanly ...
@@ -984,7 +1081,8 @@ class AbiFireTask(BasicAbinitTaskMixin, FireTaskBase):
 
     def autoparal(self, fw_spec):
         # Copy the appropriate dependencies in the in dir. needed in some cases
-        self.resolve_deps(fw_spec)
+        with self.deps_staging():
+            self.resolve_deps(fw_spec)
 
         optconf, qadapter_spec, qtk_qadapter = self.run_autoparal(self.abiinput, os.path.abspath('.'), self.ftm)
         # if self.use_SRC_scheme:
@@ -1658,13 +1756,19 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
 
     #TODO: make it possible to use "any" task and in particular, this MergeDdbTask for the SRC
     # scheme (to be rationalized)
-    def __init__(self, ddb_source_task_types=None, delete_source_ddbs=True, num_ddbs=None, task_type=None):
+    def __init__(self, ddb_source_task_types=None, delete_source_ddbs=True, num_ddbs=None, task_type=None,
+                 chunk_size=None, fan_in=None, max_workers=None):
         """
         ddb_source_task_type: list of task types that will be used as source for the DDB to be merged.
         The default is [PhononTask.task_type, DdeTask.task_type, BecTask.task_type]
         delete_ddbs: delete the ddb files used after the merge
         num_ddbs: number of ddbs to be merged. If set will be used to check that the correct number of ddbs have been
          passed to the task. Tha task will fizzle if the numbers do not match
+        chunk_size: if set and smaller than the number of ddbs, the ddbs are merged hierarchically: the list is split
+         in chunks of chunk_size ddbs that are merged concurrently, then the partial ddbs are merged in groups of
+         fan_in ddbs until a single ddb is left. If None all the ddbs are merged with a single call to mrgddb.
+        fan_in: number of partial ddbs merged by each mrgddb in the upper levels of the tree. Defaults to chunk_size.
+        max_workers: maximum number of mrgddb running concurrently. Defaults to the number of cpus.
         """
 
         if ddb_source_task_types is None:
@@ -1675,6 +1779,12 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
         self.ddb_source_task_types = ddb_source_task_types
         self.delete_source_ddbs = delete_source_ddbs
         self.num_ddbs = num_ddbs
+        for n in (chunk_size, fan_in):
+            if n is not None and n < 2:
+                raise ValueError("chunk_size and fan_in should be at least 2")
+        self.chunk_size = chunk_size
+        self.fan_in = fan_in
+        self.max_workers = max_workers
 
         if task_type is not None:
             self.task_type = task_type
@@ -1689,7 +1799,7 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             # previous_fws contains duplicates ... (might be due to _push_all or SRC scheme somewhere)
             if t['dir'] in mydirs:
                 continue
-            filepaths = Directory(os.path.join(t['dir'], OUTDIR_NAME)).list_filepaths()
+            filepaths = ManifestDirectory(os.path.join(t['dir'], OUTDIR_NAME)).list_filepaths()
             # ddb = Directory(os.path.join(t['dir'], OUTDIR_NAME)).has_abiext('DDB')
             ddb = self.get_ddb_from_filepaths(filepaths=filepaths)
             if not ddb:
@@ -1719,8 +1829,8 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
 
         return files[0]
 
-    def get_event_report(self, ofile_name="mrgddb.stdout"):
-        ofile = File(os.path.join(self.workdir, ofile_name))
+    def get_event_report(self, ofile_name="mrgddb.stdout", workdir=None):
+        ofile = File(os.path.join(workdir or self.workdir, ofile_name))
         parser = events.EventsParser()
 
         if not ofile.exists:
@@ -1738,15 +1848,69 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
         self.workdir = workdir
         self.outdir = Directory(os.path.join(self.workdir, OUTDIR_NAME))
 
+    def merge_ddb_files(self, ddb_files, out_ddb, description, manager, executable):
+        """
+        Merges the ddb files in out_ddb with mrgddb. The files are merged with a single call to mrgddb, unless
+        chunk_size is smaller than the number of files. In this case the files are merged in a tree: the chunks of
+        each level are merged concurrently, each one by a different mrgddb run in its own directory inside
+        MRGDDB_TREE_DIR, preserving the order of the files. The last merge is performed in the workdir.
+        Returns the path of the merged ddb.
+        """
+        files = list(ddb_files)
+        level = 0
+        if self.chunk_size and len(files) > self.chunk_size:
+            size = self.chunk_size
+            pool = ThreadPool(processes=self.max_workers or multiprocessing.cpu_count())
+            try:
+                while len(files) > size:
+                    level_dir = os.path.join(self.workdir, MRGDDB_TREE_DIR, 'level_{}'.format(level))
+                    chunks = [files[i:i + size] for i in range(0, len(files), size)]
+                    # the original files are deleted only at the end, the partial ddbs as soon as they are merged
+                    delete_chunk_ddbs = level > 0
+
+                    def merge_chunk(ichunk):
+                        chunk_dir = os.path.join(level_dir, 'chunk_{}'.format(ichunk))
+                        Directory(chunk_dir).makedirs()
+                        mrgddb = Mrgddb(manager=manager, executable=executable, verbose=0)
+                        chunk_ddb = mrgddb.merge(chunk_dir, chunks[ichunk], out_ddb=os.path.join(chunk_dir, "out_DDB"),
+                                                 description=description, delete_source_ddbs=delete_chunk_ddbs)
+                        report = self.get_event_report(workdir=chunk_dir)
+                        if not os.path.isfile(chunk_ddb) or (report and report.errors):
+                            msg = "Error during mrgddb of the chunk in {}.".format(chunk_dir)
+                            if report:
+                                raise AbinitRuntimeError(msg=msg, num_errors=report.num_errors,
+                                                         num_warnings=report.num_warnings, errors=report.errors,
+                                                         warnings=report.warnings)
+                            raise AbinitRuntimeError(msg=msg)
+                        return chunk_ddb
+
+                    files = pool.map(merge_chunk, range(len(chunks)), chunksize=1)
+                    level += 1
+                    size = self.fan_in or self.chunk_size
+            finally:
+                pool.close()
+                pool.join()
+
+        mrgddb = Mrgddb(manager=manager, executable=executable, verbose=0)
+        out_ddb = mrgddb.merge(self.workdir, files, out_ddb=out_ddb, description=description,
+                               delete_source_ddbs=self.delete_source_ddbs or level > 0)
+        if level > 0 and self.delete_source_ddbs and os.path.isfile(out_ddb):
+            for f in ddb_files:
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+        return out_ddb
+
     def run_task(self, fw_spec):
         self.set_workdir(workdir=os.getcwd())
         self.outdir.makedirs()
         self.history = TaskHistory()
+        self.history.attach_log(HISTORY_JSONL)
         try:
             ftm = self.get_fw_task_manager(fw_spec)
             if not ftm.has_task_manager():
                 raise InitializationError("No task manager available: mrgddb could not be performed.")
-            mrgddb = Mrgddb(manager=ftm.task_manager, executable=ftm.fw_policy.mrgddb_cmd, verbose=0)
 
             previous_fws = fw_spec['previous_fws']
             ddb_files = []
@@ -1768,8 +1932,8 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             out_ddb = os.path.join(self.workdir, OUTDIR_NAME, "out_DDB")
             desc = "DDB file merged by %s on %s" % (self.__class__.__name__, time.asctime())
 
-            out_ddb = mrgddb.merge(self.workdir, ddb_files, out_ddb=out_ddb, description=desc,
-                                   delete_source_ddbs=self.delete_source_ddbs)
+            out_ddb = self.merge_ddb_files(ddb_files, out_ddb=out_ddb, description=desc, manager=ftm.task_manager,
+                                           executable=ftm.fw_policy.mrgddb_cmd)
 
             # Temporary fix ... mrgddb doesnt seem to work when I merge the GS DDB file with the Strain DDB file
             # because the info on the pseudopotentials is not in the GS DDB file ...
@@ -1777,55 +1941,23 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             if 'PAW_datasets_description_correction' in fw_spec:
                 if len(ddb_files) != 2:
                     raise ValueError('Fix is temporary and only for a number of DDBs equal to 2')
-                fname_with_psp = None
-                psp_lines = []
-
+                psp_lines = None
                 for fname in ddb_files:
-                    in_psp_info = False
-                    with open(fname, 'r') as fh:
-                        dd = fh.readlines()
-                        for iline, line in enumerate(dd):
-                            if 'No information on the potentials yet' in line:
-                                break
-                            if 'Description of the PAW dataset(s)' in line:
-                                in_psp_info = True
-                                fname_with_psp = fname
-                            if in_psp_info:
-                                if '**** Database of total energy derivatives ****' in line:
-                                    break
-                                psp_lines.append(line)
-                    if fname_with_psp:
+                    psp_lines = get_ddb_section(fname)
+                    if psp_lines is not None:
                         break
 
-                if not fname_with_psp:
+                if psp_lines is None:
                     raise ValueError('Should have at least one DDB with the psp info ...')
 
-                out_ddb_backup = '{}.backup'.format(out_ddb)
-                shutil.move(out_ddb, out_ddb_backup)
-
-                fw = open(out_ddb, 'w')
-                with open(out_ddb_backup, 'r') as fh:
-                    dd = fh.readlines()
-                    just_copy = True
-                    for line in dd:
-                        if 'Description of the PAW dataset(s)' in line:
-                            just_copy = False
-                            for pspline in psp_lines:
-                                fw.write(pspline)
-                        if just_copy:
-                            fw.write(line)
-                            continue
-                        if '**** Database of total energy derivatives ****' in line:
-                            just_copy = True
-                            fw.write(line)
-                            continue
-                fw.close()
+                patch_ddb_section(out_ddb, psp_lines)
 
             self.report = self.get_event_report()
 
             if not os.path.isfile(out_ddb) or (self.report and self.report.errors):
                 raise AbinitRuntimeError(self, msg="Error during mrgddb.")
 
+            write_manifest(self.outdir.path)
             stored_data = dict(finalized=True)
             mod_spec = self.get_final_mod_spec(fw_spec)
 
@@ -1837,9 +1969,6 @@ class MergeDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             # log the error in history and reraise
             self.history.log_error(exc)
             raise
-        finally:
-            with open(HISTORY_JSON, "w") as f:
-                json.dump(self.history, f, cls=MontyEncoder, indent=4, sort_keys=4)
 
 
     def current_task_info(self, fw_spec):
@@ -1919,7 +2048,7 @@ class AnaDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
     def get_ddb_list(self, previous_fws, task_type):
         ddb_files = []
         for t in previous_fws.get(task_type, []):
-            ddb = Directory(os.path.join(t['dir'], OUTDIR_NAME)).has_abiext('DDB')
+            ddb = ManifestDirectory(os.path.join(t['dir'], OUTDIR_NAME)).has_abiext('DDB')
             if not ddb:
                 msg = "One of the task of type {} (folder: {}) " \
                       "did not produce a DDB file!".format(task_type, t['dir'])
@@ -2056,7 +2185,8 @@ class AnaDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
         self.gkk_filepath = None
         self.ddk_filepaths = []
 
-        self.resolve_deps(fw_spec)
+        with self.deps_staging():
+            self.resolve_deps(fw_spec)
 
         # the DDB file is needed. If not set as a dependency, look for it in all the possible sources
         #FIXME check if we can remove this case and just rely on deps
@@ -2083,6 +2213,7 @@ class AnaDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
         self.input_file.write(str(self.anaddb_input))
 
     def run_task(self, fw_spec):
+        self.history.attach_log(HISTORY_JSONL)
         try:
             self.setup_task(fw_spec)
             self.run_anaddb(fw_spec)
@@ -2091,10 +2222,6 @@ class AnaDdbAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             # log the error in history and reraise
             self.history.log_error(exc)
             raise
-        finally:
-            # Always dump the history for automatic parsing of the folders
-            with open(HISTORY_JSON, "w") as f:
-                json.dump(self.history, f, cls=MontyEncoder, indent=4, sort_keys=4)
 
     def task_analysis(self, fw_spec):
         if self.returncode != 0:
@@ -2223,7 +2350,8 @@ class AutoparalTask(AbiFireTask):
         """
 
         # Copy the appropriate dependencies in the in dir. needed in some cases
-        self.resolve_deps(fw_spec)
+        with self.deps_staging():
+            self.resolve_deps(fw_spec)
 
         if self.abiinput is None:
             optconf, qadapter_spec, qtk_qadapter = self.run_fake_autoparal(self.ftm)
@@ -2250,7 +2378,15 @@ class AutoparalTask(AbiFireTask):
 
 @explicit_serialize
 class GeneratePhononFlowFWAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
-    def __init__(self, phonon_factory, previous_task_type=ScfFWTask.task_type, handlers=None, with_autoparal=None, ddb_file=None):
+    """
+    Generates the fireworks of the phonon perturbations. By default the fireworks are returned as a detour in the
+    FWAction. If direct_insertion is True, the fireworks are inserted directly in the LaunchPad by bounded-size
+    batches (see insert_wf_as_detour) and only a reference to the inserted fireworks is stored in the FWAction.
+    This requires "_add_launchpad_and_fw_id" in the spec and is needed for workflows with thousands of
+    perturbations, whose detour would exceed the maximum size of the launch document.
+    """
+    def __init__(self, phonon_factory, previous_task_type=ScfFWTask.task_type, handlers=None, with_autoparal=None, ddb_file=None,
+                 direct_insertion=False, max_document_size=DIRECT_INSERTION_MAX_DOCUMENT_SIZE):
         if handlers is None:
             handlers = []
         self.phonon_factory = phonon_factory
@@ -2258,19 +2394,24 @@ class GeneratePhononFlowFWAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
         self.handlers = handlers
         self.with_autoparal=with_autoparal
         self.ddb_file = ddb_file
+        self.direct_insertion = direct_insertion
+        self.max_document_size = max_document_size
 
-    def get_fws(self, multi_inp, task_class, deps, new_spec, ftm, nscf_fws=None):
+    def get_fws(self, multi_inp, task_class, deps, new_spec, ftm, nscf_fws=None, pconfs=None):
         formula = multi_inp[0].structure.composition.reduced_formula
         fws = []
         fw_deps = defaultdict(list)
         autoparal_spec = {}
+        nscf_qpts_index = None
+        if nscf_fws:
+            nscf_qpts_index = QptIndex([nscf_fw.tasks[0].abiinput['qpt'] for nscf_fw in nscf_fws])
         for i, inp in enumerate(multi_inp):
             new_spec = dict(new_spec)
             start_task_index = 1
             if self.with_autoparal:
                 if not autoparal_spec:
                     autoparal_dir = os.path.join(os.path.abspath('.'), "autoparal_{}_{}".format(task_class.__name__, str(i)))
-                    optconf, qadapter_spec, qadapter = self.run_autoparal(inp, autoparal_dir, ftm)
+                    optconf, qadapter_spec, qadapter = self.run_autoparal(inp, autoparal_dir, ftm, pconfs=pconfs)
                     autoparal_spec['_queueadapter'] = qadapter_spec
                     autoparal_spec['mpi_ncpus'] = optconf['mpi_ncpus']
                 new_spec.update(autoparal_spec)
@@ -2279,12 +2420,10 @@ class GeneratePhononFlowFWAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
             current_deps = dict(deps)
             parent_fw = None
             if nscf_fws:
-                qpt = inp['qpt']
-                for nscf_fw in nscf_fws:
-                    if np.allclose(nscf_fw.tasks[0].abiinput['qpt'], qpt):
-                        parent_fw = nscf_fw
-                        current_deps[nscf_fw.tasks[0].task_type] = "WFQ"
-                        break
+                inscf = nscf_qpts_index.get_index(inp['qpt'])
+                if inscf is not None:
+                    parent_fw = nscf_fws[inscf]
+                    current_deps[parent_fw.tasks[0].task_type] = "WFQ"
 
 
             task = task_class(inp, handlers=self.handlers, deps=current_deps, is_autoparal=False)
@@ -2337,32 +2476,43 @@ class GeneratePhononFlowFWAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
 
         nscf_inputs = ph_inputs.filter_by_tags(NSCF)
 
+        for multi_inp in [ph_q_pert_inputs, dde_inputs, bec_inputs]:
+            if multi_inp:
+                multi_inp.set_vars(prtwf=-1)
+
+        # the autoparal of the different types of perturbations run concurrently
+        probes = {}
+        if self.with_autoparal:
+            probes = self.probe_autoparal([nscf_inputs, ph_q_pert_inputs, ddk_inputs, dde_inputs, bec_inputs],
+                                          [NscfWfqFWTask, PhononTask, DdkTask, DdeTask, BecTask], ftm)
+
         nscf_fws = []
         if nscf_inputs is not None:
             nscf_fws, nscf_fw_deps= self.get_fws(nscf_inputs, NscfWfqFWTask,
-                                                 {self.previous_task_type: "WFK", self.previous_task_type: "DEN"}, new_spec, ftm)
+                                                 {self.previous_task_type: "WFK", self.previous_task_type: "DEN"}, new_spec, ftm,
+                                                 pconfs=probes.get(NscfWfqFWTask))
 
         ph_fws = []
         if ph_q_pert_inputs:
-            ph_q_pert_inputs.set_vars(prtwf=-1)
             ph_fws, ph_fw_deps = self.get_fws(ph_q_pert_inputs, PhononTask, {self.previous_task_type: "WFK"}, new_spec,
-                                              ftm, nscf_fws)
+                                              ftm, nscf_fws, pconfs=probes.get(PhononTask))
 
         ddk_fws = []
         if ddk_inputs:
-            ddk_fws, ddk_fw_deps = self.get_fws(ddk_inputs, DdkTask, {self.previous_task_type: "WFK"}, new_spec, ftm)
+            ddk_fws, ddk_fw_deps = self.get_fws(ddk_inputs, DdkTask, {self.previous_task_type: "WFK"}, new_spec, ftm,
+                                                pconfs=probes.get(DdkTask))
 
         dde_fws = []
         if dde_inputs:
-            dde_inputs.set_vars(prtwf=-1)
             dde_fws, dde_fw_deps = self.get_fws(dde_inputs, DdeTask,
-                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm)
+                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm,
+                                                pconfs=probes.get(DdeTask))
 
         bec_fws = []
         if bec_inputs:
-            bec_inputs.set_vars(prtwf=-1)
             bec_fws, bec_fw_deps = self.get_fws(bec_inputs, BecTask,
-                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm)
+                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm,
+                                                pconfs=probes.get(BecTask))
 
 
         mrgddb_spec = dict(new_spec)
@@ -2401,6 +2551,16 @@ class GeneratePhononFlowFWAbinitTask(BasicAbinitTaskMixin, FireTaskBase):
 
         stored_data = dict(finalized=True)
 
+        if self.direct_insertion:
+            if '_add_launchpad_and_fw_id' not in fw_spec:
+                raise InitializationError('The direct insertion of the phonon fireworks requires '
+                                          '"_add_launchpad_and_fw_id" in the spec')
+            fw_ids = insert_wf_as_detour(self.launchpad, ph_wf, self.fw_id,
+                                         max_batch_size=min(self.max_document_size, DIRECT_INSERTION_MAX_BATCH_SIZE),
+                                         max_document_size=self.max_document_size)
+            stored_data['direct_insertion'] = dict(num_fws=len(fw_ids), first_fw_id=fw_ids[0], last_fw_id=fw_ids[-1])
+            return FWAction(stored_data=stored_data)
+
         return FWAction(stored_data=stored_data, detours=ph_wf)
 
 
@@ -2410,7 +2570,8 @@ class PhononWFGenerator(BasicAbinitTaskMixin, FireTaskBase):
     to be storead in the FWAction will be large in this cases. Like all the documents in mongodb the launch cannot
     exceed the 16MB size, which is often reached when the number of FWs generated is around 1000.
     To avoid this problem it is mandatory to generate the whole workflow immediately. This mimics the behaviour
-    of the GeneratePhononFlowFWAbinitTask.
+    of the GeneratePhononFlowFWAbinitTask. Alternatively, the GeneratePhononFlowFWAbinitTask can insert the
+    fireworks directly in the LaunchPad with direct_insertion=True.
     """
     def __init__(self, scf_input, phonon_factory, previous_task_type=ScfFWTask.task_type, handlers=[],
                  with_autoparal=True, ddb_file=None, fw_task_manager=None, initialization_info={}):
@@ -2423,26 +2584,31 @@ class PhononWFGenerator(BasicAbinitTaskMixin, FireTaskBase):
         self.fw_task_manager = fw_task_manager
         self.initialization_info = initialization_info or {}
 
-    def run_autoparal(self, abiinput, autoparal_dir, ftm, clean_up='move'):
+    def run_autoparal(self, abiinput, autoparal_dir, ftm, clean_up='move', pconfs=None):
         """
         Runs the autoparal using AbinitInput abiget_autoparal_pconfs method.
         The information are retrieved from the FWTaskManager that should be present and contain the standard
         abipy TaskManager, that provides information about the queue adapters.
         No check is performed on the autoparal_dir. If there is a possibility of overwriting output data due to
         reuse of the same folder, it should be handled by the caller.
+        If pconfs is given (e.g. obtained with probe_autoparal), the autoparal is not run again and only the
+        configuration is selected.
         """
         manager = ftm.task_manager
         if not manager:
             msg = 'No task manager available: autoparal could not be performed.'
             logger.error(msg)
             raise InitializationError(msg)
-        pconfs = abiinput.abiget_autoparal_pconfs(max_ncpus=manager.max_cores, workdir=autoparal_dir,
-                                                       manager=manager)
+        if pconfs is None:
+            pconfs = get_autoparal_pconfs(abiinput, manager=manager, workdir=autoparal_dir, fw_policy=ftm.fw_policy)
         optconf = manager.select_qadapter(pconfs)
         qadapter_spec = manager.qadapter.get_subs_dict()
 
         d = pconfs.as_dict()
         d["optimal_conf"] = optconf
+        # the directory is not created if the configurations do not come from a run of abinit
+        if not os.path.isdir(autoparal_dir):
+            os.makedirs(autoparal_dir)
         json_pretty_dump(d, os.path.join(autoparal_dir, "autoparal.json"))
 
         # Method to clean the output files
@@ -2488,18 +2654,21 @@ class PhononWFGenerator(BasicAbinitTaskMixin, FireTaskBase):
 
         return optconf, qadapter_spec, manager.qadapter
 
-    def get_fws(self, multi_inp, task_class, deps, new_spec, ftm, nscf_fws=None):
+    def get_fws(self, multi_inp, task_class, deps, new_spec, ftm, nscf_fws=None, pconfs=None):
         formula = multi_inp[0].structure.composition.reduced_formula
         fws = []
         fw_deps = defaultdict(list)
         autoparal_spec = {}
+        nscf_qpts_index = None
+        if nscf_fws:
+            nscf_qpts_index = QptIndex([nscf_fw.tasks[0].abiinput['qpt'] for nscf_fw in nscf_fws])
         for i, inp in enumerate(multi_inp):
             new_spec = dict(new_spec)
             start_task_index = 1
             if self.with_autoparal:
                 if not autoparal_spec:
                     autoparal_dir = os.path.join(os.path.abspath('.'), "autoparal_{}_{}".format(task_class.__name__, str(i)))
-                    optconf, qadapter_spec, qadapter = self.run_autoparal(inp, autoparal_dir, ftm)
+                    optconf, qadapter_spec, qadapter = self.run_autoparal(inp, autoparal_dir, ftm, pconfs=pconfs)
                     autoparal_spec['_queueadapter'] = qadapter_spec
                     autoparal_spec['mpi_ncpus'] = optconf['mpi_ncpus']
                 new_spec.update(autoparal_spec)
@@ -2508,12 +2677,10 @@ class PhononWFGenerator(BasicAbinitTaskMixin, FireTaskBase):
             current_deps = dict(deps)
             parent_fw = None
             if nscf_fws:
-                qpt = inp['qpt']
-                for nscf_fw in nscf_fws:
-                    if np.allclose(nscf_fw.tasks[0].abiinput['qpt'], qpt):
-                        parent_fw = nscf_fw
-                        current_deps[nscf_fw.tasks[0].task_type] = "WFQ"
-                        break
+                inscf = nscf_qpts_index.get_index(inp['qpt'])
+                if inscf is not None:
+                    parent_fw = nscf_fws[inscf]
+                    current_deps[parent_fw.tasks[0].task_type] = "WFQ"
 
 
             task = task_class(inp, handlers=self.handlers, deps=current_deps, is_autoparal=False)
@@ -2553,32 +2720,43 @@ class PhononWFGenerator(BasicAbinitTaskMixin, FireTaskBase):
 
         nscf_inputs = ph_inputs.filter_by_tags(NSCF)
 
+        for multi_inp in [ph_q_pert_inputs, dde_inputs, bec_inputs]:
+            if multi_inp:
+                multi_inp.set_vars(prtwf=-1)
+
+        # the autoparal of the different types of perturbations run concurrently
+        probes = {}
+        if self.with_autoparal:
+            probes = self.probe_autoparal([nscf_inputs, ph_q_pert_inputs, ddk_inputs, dde_inputs, bec_inputs],
+                                          [NscfFWTask, PhononTask, DdkTask, DdeTask, BecTask], ftm)
+
         nscf_fws = []
         if nscf_inputs is not None:
             nscf_fws, nscf_fw_deps= self.get_fws(nscf_inputs, NscfFWTask,
-                                                 {self.previous_task_type: "WFK", self.previous_task_type: "DEN"}, new_spec, ftm)
+                                                 {self.previous_task_type: "WFK", self.previous_task_type: "DEN"}, new_spec, ftm,
+                                                 pconfs=probes.get(NscfFWTask))
 
         ph_fws = []
         if ph_q_pert_inputs:
-            ph_q_pert_inputs.set_vars(prtwf=-1)
             ph_fws, ph_fw_deps = self.get_fws(ph_q_pert_inputs, PhononTask, {self.previous_task_type: "WFK"}, new_spec,
-                                              ftm, nscf_fws)
+                                              ftm, nscf_fws, pconfs=probes.get(PhononTask))
 
         ddk_fws = []
         if ddk_inputs:
-            ddk_fws, ddk_fw_deps = self.get_fws(ddk_inputs, DdkTask, {self.previous_task_type: "WFK"}, new_spec, ftm)
+            ddk_fws, ddk_fw_deps = self.get_fws(ddk_inputs, DdkTask, {self.previous_task_type: "WFK"}, new_spec, ftm,
+                                                pconfs=probes.get(DdkTask))
 
         dde_fws = []
         if dde_inputs:
-            dde_inputs.set_vars(prtwf=-1)
             dde_fws, dde_fw_deps = self.get_fws(dde_inputs, DdeTask,
-                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm)
+                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm,
+                                                pconfs=probes.get(DdeTask))
 
         bec_fws = []
         if bec_inputs:
-            bec_inputs.set_vars(prtwf=-1)
             bec_fws, bec_fw_deps = self.get_fws(bec_inputs, BecTask,
-                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm)
+                                                {self.previous_task_type: "WFK", DdkTask.task_type: "DDK"}, new_spec, ftm,
+                                                pconfs=probes.get(BecTask))
 
 
         mrgddb_spec = dict(new_spec)
@@ -2881,7 +3059,7 @@ class RestartInfo(MSONable):
 
     @property
     def prev_outdir(self):
-        return Directory(os.path.join(self.previous_dir, OUTDIR_NAME))
+        return ManifestDirectory(os.path.join(self.previous_dir, OUTDIR_NAME))
 
     @property
     def prev_indir(self):
@@ -16,11 +16,18 @@ from abiflows.fireworks.tasks.src_tasks_abc import SetupTask, RunTask, ControlTa
 from abiflows.core.mastermind_abc import ControllerNote, ControlProcedure
 from abiflows.core.controllers import AbinitController, WalltimeController, MemoryController
 from abiflows.fireworks.utils.fw_utils import FWTaskManager, links_dict_update, set_short_single_core_to_spec
+from abiflows.fireworks.utils.fw_utils import LayeredSpec
+from abiflows.fireworks.utils.autoparal_cache import get_autoparal_pconfs
 from abiflows.fireworks.utils.math_utils import divisors
+from abiflows.fireworks.utils.staging import stage_file
+from abiflows.fireworks.utils.scratch import scratch_run
+from abiflows.fireworks.utils.checkpoint import CheckpointSupervisor
+from abiflows.fireworks.utils.task_history import TaskHistory
+from abiflows.fireworks.utils.manifest import ManifestDirectory, write_manifest
 from abiflows.fireworks.tasks.abinit_tasks import MergeDdbAbinitTask
 from abiflows.fireworks.tasks.abinit_common import TMPDIR_NAME, OUTDIR_NAME, INDIR_NAME, STDERR_FILE_NAME, \
     LOG_FILE_NAME, FILES_FILE_NAME, OUTPUT_FILE_NAME, INPUT_FILE_NAME, MPIABORTFILE, DUMMY_FILENAME, \
-    ELPHON_OUTPUT_FILE_NAME, DDK_FILES_FILE_NAME, HISTORY_JSON
+    ELPHON_OUTPUT_FILE_NAME, DDK_FILES_FILE_NAME, HISTORY_JSON, HISTORY_JSONL
 from fireworks import explicit_serialize
 from fireworks.utilities.fw_serializers import serialize_fw
 from fireworks.core.firework import Firework, FireTaskBase, FWAction, Workflow
@@ -90,7 +97,7 @@ class AbinitSRCMixin(object):
 @explicit_serialize
 class AbinitSetupTask(AbinitSRCMixin, SetupTask):
 
-    RUN_PARAMETERS = ['_queueadapter', 'qtk_queueadapter']
+    RUN_PARAMETERS = ['_queueadapter', 'qtk_queueadapter', 'paral_hints']
 
     def __init__(self, abiinput, deps=None, task_helper=None, task_type=None, restart_info=None, pass_input=False):
         if task_type is None:
@@ -121,13 +128,23 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         #setup the FWTaskManager
         self.ftm = self.get_fw_task_manager(fw_spec)
         if 'previous_src' in fw_spec:
-            self.prev_outdir = Directory(os.path.join(fw_spec['previous_src']['src_directories']['run_dir'],
-                                                      OUTDIR_NAME))
+            self.prev_outdir = ManifestDirectory(os.path.join(fw_spec['previous_src']['src_directories']['run_dir'],
+                                                              OUTDIR_NAME))
         return super(AbinitSetupTask, self).run_task(fw_spec)
 
     def setup_run_parameters(self, fw_spec, parameters=RUN_PARAMETERS):
         self.abiinput.remove_vars(['npkpt', 'npspinor', 'npband', 'npfft', 'bandpp'], strict=False)
-        optconf, qtk_qadapter = self.run_autoparal(self.abiinput, fw_spec)
+        optconf, qtk_qadapter, pconfs = self.run_autoparal(self.abiinput, fw_spec)
+        # If the number of MPI processes of the queue adapter has been modified by a controller (e.g. after a memory
+        #  infringement), use the parallel configuration corresponding to the modified queue adapter
+        modified_qadapter = fw_spec.get('src_modified_objects', {}).get('qtk_queueadapter', None)
+        if modified_qadapter is not None and modified_qadapter.mpi_procs != optconf.mpi_procs:
+            matching_confs = [conf for conf in pconfs if conf.mpi_procs == modified_qadapter.mpi_procs]
+            if matching_confs:
+                optconf = max(matching_confs, key=lambda conf: conf.efficiency)
+            else:
+                logger.warning('No parallel configuration with {:d} MPI processes found by '
+                               'autoparal'.format(modified_qadapter.mpi_procs))
 
         # if 'queue_adapter_update' in fw_spec:
         #     for qa_key, qa_val in fw_spec['queue_adapter_update'].items():
@@ -141,7 +158,9 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         #             raise ValueError('queue_adapter update "{}" is not valid'.format(qa_key))
         self.abiinput.set_vars(optconf.vars)
 
-        return {'_queueadapter': qtk_qadapter.get_subs_dict(), 'qtk_queueadapter': qtk_qadapter}
+        # The parallel configurations and their memory estimates are passed to the control step
+        return {'_queueadapter': qtk_qadapter.get_subs_dict(), 'qtk_queueadapter': qtk_qadapter,
+                'paral_hints': pconfs.as_dict()}
 
     def file_transfers(self, fw_spec):
         pass
@@ -213,6 +232,11 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
             # self.history.log_restart(self.restart_info)
             self.task_helper.restart(self.restart_info)
 
+        # abinit checks the trigger file of the checkpoint supervisor only if chkexit is set
+        if self.ftm.fw_policy.checkpoint_margin is not None and self.ftm.fw_policy.checkpoint_method == 'file' \
+                and 'chkexit' not in self.abiinput:
+            self.abiinput.set_vars(chkexit=1)
+
         # Write files file and input file.
         if not self.files_file.exists:
             self.files_file.write(self.filesfile_string)
@@ -224,6 +248,7 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         Runs the autoparal using AbinitInput abiget_autoparal_pconfs method.
         The information are retrieved from the FWTaskManager that should be present and contain the standard
         abipy TaskManager, that provides information about the queue adapters.
+        Returns the optimal parallel configuration, the queue adapter and the ParalHints with all the configurations.
         """
         #FIXME autoparal may need the deps in some cases. here they are not resolved
         manager = self.ftm.task_manager
@@ -249,8 +274,8 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
                     npfft_set = npfft_set.intersection(set(divsy))
                     npfft_set = npfft_set.intersection(set(divsz))
                 abiinput['npfft'] = max(npfft_set)
-        pconfs = abiinput.abiget_autoparal_pconfs(max_ncpus=manager.max_cores, workdir=autoparal_dir,
-                                                  manager=manager)
+        pconfs = get_autoparal_pconfs(abiinput, manager=manager, workdir=autoparal_dir,
+                                      fw_policy=self.ftm.fw_policy)
         optconf = manager.select_qadapter(pconfs)
 
         d = pconfs.as_dict()
@@ -276,7 +301,7 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         elif clean_up == 'full':
             shutil.rmtree(autoparal_dir)
 
-        return optconf, manager.qadapter
+        return optconf, manager.qadapter, pconfs
 
     def link_ext(self, ext, source_dir, strict=True):
         source = os.path.join(source_dir, self.prefix.odata + "_" + ext)
@@ -299,7 +324,8 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         logger.info("Linking path {} --> {}".format(source, dest))
         if not os.path.exists(dest) or not strict:
             if self.ftm.fw_policy.copy_deps:
-                shutil.copyfile(source, dest)
+                stage_file(source, dest, methods=self.ftm.fw_policy.copy_deps_methods,
+                           checksum=self.ftm.fw_policy.copy_deps_checksum)
             else:
                 os.symlink(source, dest)
             return dest
@@ -308,7 +334,7 @@ class AbinitSetupTask(AbinitSRCMixin, SetupTask):
         # handle the custom DDK extension on its own
         # accept more than one DDK file in the outdir: multiple perturbations are allowed in a
         # single calculation
-        outdata_dir = Directory(os.path.join(source_dir, OUTDIR_NAME))
+        outdata_dir = ManifestDirectory(os.path.join(source_dir, OUTDIR_NAME))
         ddks = []
         for f in outdata_dir.list_filepaths():
             if f.endswith('_DDK'):
@@ -563,9 +589,25 @@ class AbinitRunTask(AbinitSRCMixin, RunTask):
         self.task_helper.set_task(self)
 
     def config(self, fw_spec):
+        self.start_time = time.time()
         self.ftm = self.get_fw_task_manager(fw_spec)
         self.setup_rundir(self.run_dir, create_dirs=False)
 
+        # set walltime, if possible
+        self.walltime = None
+        if self.ftm.fw_policy.walltime_command:
+            try:
+                p = subprocess.Popen(self.ftm.fw_policy.walltime_command, shell=True, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                out, err =p.communicate()
+                status = p.returncode
+                if status == 0:
+                    self.walltime = int(out)
+                else:
+                    logger.warning("Impossible to get the walltime: " + err)
+            except Exception as e:
+                logger.warning("Impossible to get the walltime: ", exc_info=True)
+
     def run(self, fw_spec):
         #TODO switch back to a simple process instead of a separate thread?
         def abinit_process():
@@ -580,19 +622,63 @@ class AbinitRunTask(AbinitSRCMixin, RunTask):
             if mytimelimit < 120:
                 raise ValueError('Abinit timelimit less than 2 min. Probably wrong queue/job configuration')
             command.extend(['--timelimit', time2slurm(mytimelimit)])
-            with open(self.files_file.path, 'r') as stdin, open(self.log_file.path, 'w') as stdout, \
+            with open(files_file_path, 'r') as stdin, open(self.log_file.path, 'w') as stdout, \
                     open(self.stderr_file.path, 'w') as stderr:
                 self.process = subprocess.Popen(command, stdin=stdin, stdout=stdout, stderr=stderr)
+            if scratch is not None:
+                scratch.process = self.process
+            if supervisor is not None:
+                supervisor.start(self.process)
+
+            # Monitor the log while abinit is running (the process may be terminated by the monitor)
+            self.monitor = self.get_monitor(interval=self.ftm.fw_policy.monitor_interval)
+            if self.monitor is not None:
+                self.monitor.start(self.process, output_filepath=self.log_file.path)
 
             (stdoutdata, stderrdata) = self.process.communicate()
             self.returncode = self.process.returncode
+            if self.monitor is not None:
+                self.monitor.stop()
+            if supervisor is not None:
+                supervisor.stop()
 
         # initialize returncode to avoid missing references in case of exception in the other thread
         self.returncode = None
 
-        thread = threading.Thread(target=abinit_process)
-        thread.start()
-        thread.join()
+        # run in the node-local scratch directory, if set in the fw_policy
+        with scratch_run(self.run_dir, self.ftm.fw_policy) as scratch:
+            files_file_path = scratch.write_filesfile(self.files_file.path) if scratch else self.files_file.path
+            # without the walltime_command, the job is assumed to start with the run
+            if self.walltime:
+                deadline = self.start_time + self.walltime
+            else:
+                deadline = self.start_time + fw_spec['qtk_queueadapter'].timelimit
+            supervisor = CheckpointSupervisor.from_fw_policy(self.ftm.fw_policy, deadline, self.run_dir,
+                                                             scratch.outdir if scratch else self.outdir.path,
+                                                             scratch=scratch)
+            thread = threading.Thread(target=abinit_process)
+            # the amount of time left plus a buffer of 2 minutes. The supervisor, if present, should stop abinit
+            # before: the timeout is kept as a backstop.
+            timeout = (self.walltime - (time.time() - self.start_time) - 120) if self.walltime else None
+            start_abinit_time = time.time()
+            thread.start()
+            thread.join(timeout)
+            if thread.is_alive():
+                self.process.terminate()
+                thread.join()
+                raise WalltimeError("The task couldn't be terminated within the time limit. Killed.")
+
+        if supervisor is not None:
+            # recorded in the history of the run directory, read by the control step (see get_initial_objects_info)
+            history_filepath = os.path.join(self.run_dir, HISTORY_JSONL)
+            history = TaskHistory.from_jsonl(history_filepath) if os.path.isfile(history_filepath) else TaskHistory()
+            history.attach_log(history_filepath)
+            history.log_abinit_stop(run_time=(time.time() - start_abinit_time))
+            if supervisor.triggered:
+                history.log_checkpoint(supervisor.as_dict())
+            if supervisor.killed:
+                raise WalltimeError("Abinit didn't stop within {} s before the end of the walltime. "
+                                    "Killed.".format(supervisor.grace_period))
 
     def postrun(self, fw_spec):
         #TODO should this be a general feature of the SRC?
@@ -608,6 +694,21 @@ class AbinitControlTask(AbinitSRCMixin, ControlTask):
                              src_cleaning=src_cleaning)
         self.task_helper = task_helper
 
+    def finalize(self):
+        # list the produced files for the following tasks
+        write_manifest(os.path.join(self.run_dir, OUTDIR_NAME))
+
+    @staticmethod
+    def get_checkpoint(run_dir):
+        """
+        The checkpoint info of the last run in run_dir (see CheckpointSupervisor.as_dict), None if abinit was not
+        stopped before the walltime.
+        """
+        history_filepath = os.path.join(run_dir, HISTORY_JSONL)
+        if not os.path.isfile(history_filepath):
+            return None
+        return TaskHistory.from_jsonl(history_filepath).get_last_checkpoint()
+
     def get_initial_objects_info(self, setup_fw, run_fw, src_directories):
         run_dir = src_directories['run_dir']
         run_task = run_fw.tasks[-1]
@@ -621,7 +722,9 @@ class AbinitControlTask(AbinitSRCMixin, ControlTask):
                          'abinit_log_filepath': {'object': os.path.join(run_dir, LOG_FILE_NAME)},
                          'abinit_mpi_abort_filepath': {'object': os.path.join(run_dir, MPIABORTFILE)},
                          'abinit_outdir_path': {'object': os.path.join(run_dir, OUTDIR_NAME)},
-                         'abinit_err_filepath': {'object': os.path.join(run_dir, STDERR_FILE_NAME)}}
+                         'abinit_err_filepath': {'object': os.path.join(run_dir, STDERR_FILE_NAME)},
+                         'paral_hints': {'object': run_fw.spec.get('paral_hints', None)},
+                         'checkpoint': {'object': self.get_checkpoint(run_dir)}}
         # 'structure': {'object': task_helper.get_final_structure(),
         #               'updates': [{'target': 'setup_task.abiinput',
         #                            'setter': 'set_structure'}]}}
@@ -1615,6 +1718,9 @@ class GeneratePiezoElasticFlowFWSRCAbinitTask(FireTaskBase):
 
         prev_src_pert = None
 
+        # All the SRC trios share the same base spec
+        src_spec = LayeredSpec(base=new_spec)
+
         for istrain_pert, rf_strain_input in enumerate(rf_strain_inputs):
             strain_task_type = 'strain-pert-{:d}'.format(istrain_pert+1)
             if self.additional_input_vars is not None:
@@ -1628,7 +1734,7 @@ class GeneratePiezoElasticFlowFWSRCAbinitTask(FireTaskBase):
 
             rf_fws = createSRCFireworks(setup_task=setup_rf_task, run_task=run_rf_task,
                                         control_task=control_rf_task,
-                                        spec=new_spec, initialization_info=initialization_info)
+                                        spec=src_spec, initialization_info=initialization_info)
             all_SRC_rf_fws.append(rf_fws)
             total_list_fws.extend(rf_fws['fws'])
             strain_task_types.append(strain_task_type)
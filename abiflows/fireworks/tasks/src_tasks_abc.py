@@ -1,28 +1,36 @@
 from __future__ import print_function, division, unicode_literals
 
 import abc
-import copy
 import inspect
 import json
+import logging
 import os
+import traceback
 
 from fireworks.core.firework import FireTaskBase
 from fireworks.core.firework import FWAction
 from fireworks.core.firework import Workflow
 from fireworks.core.firework import Firework
+from fireworks.core.firework import Launch
 from fireworks.core.launchpad import LaunchPad
 from fireworks.utilities.fw_utilities import explicit_serialize
 from fireworks.utilities.fw_serializers import serialize_fw
+from fireworks.utilities.fw_serializers import load_object
 
-from monty.json import MontyDecoder, MontyEncoder
+from pymongo import UpdateOne
+
+from monty.json import MontyDecoder, MontyEncoder, jsanitize
 from monty.json import MSONable
 from monty.serialization import loadfn
 from monty.subprocess import Command
 
 from abiflows.core.mastermind_abc import ControlProcedure, ControlledItemType
 from abiflows.core.mastermind_abc import ControllerNote
+from abiflows.core.mastermind_abc import Monitor
 from abiflows.core.mastermind_abc import Cleaner
-from abiflows.fireworks.utils.fw_utils import set_short_single_core_to_spec, get_short_single_core_spec
+from abiflows.fireworks.utils.fw_utils import get_short_single_core_spec, LayeredSpec
+
+logger = logging.getLogger(__name__)
 
 RESTART_FROM_SCRATCH = ControllerNote.RESTART_FROM_SCRATCH
 RESET_RESTART = ControllerNote.RESET_RESTART
@@ -119,7 +127,9 @@ class SetupTask(SRCTaskMixin, FireTaskBase):
         # Set up and create the directory tree of the Setup/Run/Control trio,
         self.setup_directories(fw_spec=fw_spec, create_dirs=True)
         #  Forward directory information to run and control fireworks #HACK in _setup_run_and_control_dirs
-        self._setup_run_and_control_dirs_and_fworker(fw_spec=fw_spec)
+        #  In the fused mode, this is done directly by the FusedSRCTask
+        if not fw_spec.get('src_fused', False):
+            self._setup_run_and_control_dirs_and_fworker(fw_spec=fw_spec)
         # Move to the setup directory
         os.chdir(self.setup_dir)
         # Make the file transfers from another worker if needed
@@ -183,43 +193,21 @@ class SetupTask(SRCTaskMixin, FireTaskBase):
         WARNING: This is a bit hackish! Do not change this unless you know exactly what you are doing!
         :param fw_spec: Firework's spec
         """
-        # Get the launchpad
-        if '_add_launchpad_and_fw_id' in fw_spec:
-            lp = self.launchpad
-            setup_fw_id = self.fw_id
-        else:
-            try:
-                fw_dict = loadfn('FW.json')
-            except IOError:
-                try:
-                    fw_dict = loadfn('FW.yaml')
-                except IOError:
-                    raise RuntimeError("Launchpad/fw_id not present in spec and No FW.json nor FW.yaml file present: "
-                                       "impossible to determine fw_id")
-            lp = LaunchPad.auto_load()
-            setup_fw_id = fw_dict['fw_id']
+        # Get the access layer to the launchpad
+        lp_access, setup_fw_id = SRCLaunchPadAccess.from_task(task=self, fw_spec=fw_spec)
         if '_add_fworker' in fw_spec:
             fworker = self.fworker
         else:
             raise ValueError('Should have access to the fworker in SetupTask ...')
-        this_lzy_wf = lp.get_wf_by_fw_id_lzyfw(setup_fw_id)
-        # Check that SetupTask and RunTask have only one child firework
-        child_fw_ids = this_lzy_wf.links[setup_fw_id]
-        if len(child_fw_ids) != 1:
-            raise ValueError('SetupTask\'s Firework should have exactly one child firework')
-        run_fw_id = child_fw_ids[0]
-        child_run_fw_ids = this_lzy_wf.links[run_fw_id]
-        if len(child_run_fw_ids) != 1:
-            raise ValueError('RunTask\'s Firework should have exactly one child firework')
-        control_fw_id = child_run_fw_ids[0]
+        src_fw_ids = lp_access.get_src_fw_ids(fw_id=setup_fw_id, src_type=self.src_type)
         spec_update = {'_launch_dir': self.run_dir,
                        'src_directories': self.src_directories,
                        '_fworker': fworker.name}
-        lp.update_spec(fw_ids=[run_fw_id],
-                       spec_document=spec_update)
-        spec_update['_launch_dir'] = self.control_dir
-        lp.update_spec(fw_ids=[control_fw_id],
-                       spec_document=spec_update)
+        control_spec_update = dict(spec_update)
+        control_spec_update['_launch_dir'] = self.control_dir
+        lp_access.update_specs({src_fw_ids['run']: spec_update,
+                                src_fw_ids['control']: control_spec_update})
+        self.lp_access = lp_access
 
     def additional_task_info(self):
         return {}
@@ -249,10 +237,15 @@ class RunTask(SRCTaskMixin, FireTaskBase):
         f.close()
         # The Run and Control tasks have to run on the same worker
 
-        #TODO: do something here with the monitoring controllers ...
-        #      should stop the RunTask but the correction should be applied in control !
+        # The monitor (if any) is set up in the run method. If one of the monitoring controllers aborts the run,
+        #  its notes are passed to the control firework, where the correction is applied.
+        self.monitor = None
         self.config(fw_spec=fw_spec)
         self.run(fw_spec=fw_spec)
+        if self.monitor is not None and self.monitor.aborted:
+            update_spec = {'src_run_task_aborted': {'controller_notes': [cn.as_dict() for cn in
+                                                                         self.monitor.controller_notes]}}
+            return FWAction(update_spec=update_spec)
         update_spec = self.postrun(fw_spec=fw_spec)
 
         if update_spec is None:
@@ -269,6 +262,13 @@ class RunTask(SRCTaskMixin, FireTaskBase):
     def config(self, fw_spec):
         pass
 
+    def get_monitor(self, interval=60):
+        """
+        Returns the Monitor for the monitoring controllers of the control procedure or None if there are none.
+        To be used in the run method, the monitor should be stored in self.monitor.
+        """
+        return Monitor.from_control_procedure(self.control_procedure, interval=interval)
+
     @abc.abstractmethod
     def run(self, fw_spec):
         pass
@@ -377,6 +377,11 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
                                      'qout_filepath': {'object': qout_filepath}})
         initial_objects = {name: obj_info['object'] for name, obj_info in initial_objects_info.items()}
         control_report = self.control_procedure.process(**initial_objects)
+        # Add the notes of the monitoring controllers that aborted the run
+        if 'src_run_task_aborted' in fw_spec:
+            controller_notes = [cn if isinstance(cn, ControllerNote) else ControllerNote.from_dict(cn)
+                                for cn in fw_spec['src_run_task_aborted']['controller_notes']]
+            control_report.add_controller_notes(controller_notes)
 
         if control_report.unrecoverable:
             f = open(os.path.join(self.control_dir, 'control_report.json'), 'w')
@@ -389,6 +394,7 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
 
         # If everything is ok, update the spec of the children
         if control_report.finalized:
+            self.finalize()
             stored_data = {'control_report': control_report, 'finalized': True}
             update_spec = {}
             mod_spec = []
@@ -428,8 +434,9 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
         #     else:
         #         modified_objects[target] = action.apply(initial_objects[target])
 
-        # New spec
-        new_spec = copy.deepcopy(self.run_fw.spec)
+        # New spec. The spec of the run firework has just been loaded from the database and is not shared: use it
+        # as the base of the new specs instead of copying it.
+        new_spec = LayeredSpec(base=self.run_fw.spec)
 
         # New tasks
         setup_task = self.setup_fw.tasks[-1]
@@ -511,10 +518,9 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
         new_spec.pop('_launch_dir')
         new_spec.pop('src_directories')
         new_spec['previous_src'] = {'src_directories': self.src_directories}
-        if 'all_src_directories' in new_spec:
-            new_spec['all_src_directories'].append({'src_directories': self.src_directories})
-        else:
-            new_spec['all_src_directories'] = [{'src_directories': self.src_directories}]
+        # The base of new_spec should not be modified in place: create a new list
+        new_spec['all_src_directories'] = (list(new_spec.get('all_src_directories', [])) +
+                                           [{'src_directories': self.src_directories}])
         # if '_queueadapter' in modified_objects:
         #     new_spec['_queueadapter'] = modified_objects['_queueadapter']
         #TODO: what to do here ? Right now this should work, just transfer information from the run_fw to the
@@ -525,34 +531,23 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
         # TODO: check initialization info, deps, ... previous_fws, ... src_previous_fws ? ...
         new_SRC_fws = createSRCFireworks(setup_task=setup_task, run_task=run_task, control_task=control_task,
                                          spec=new_spec, initialization_info=None, task_index=task_index,
-                                         run_spec_update=run_spec_update, setup_spec_update=setup_spec_update)
+                                         run_spec_update=run_spec_update, setup_spec_update=setup_spec_update,
+                                         fused=fw_spec.get('src_fused', False))
         wf = Workflow(fireworks=new_SRC_fws['fws'], links_dict=new_SRC_fws['links_dict'])
         return FWAction(stored_data={'control_report': control_report}, detours=[wf])
 
     def get_setup_and_run_fw(self, fw_spec):
-        # Get the launchpad
-        if '_add_launchpad_and_fw_id' in fw_spec:
-            lp = self.launchpad
-            control_fw_id = self.fw_id
-        else:
-            try:
-                fw_dict = loadfn('FW.json')
-            except IOError:
-                try:
-                    fw_dict = loadfn('FW.yaml')
-                except IOError:
-                    raise RuntimeError("Launchpad/fw_id not present in spec and No FW.json nor FW.yaml file present: "
-                                       "impossible to determine fw_id")
-            lp = LaunchPad.auto_load()
-            control_fw_id = fw_dict['fw_id']
-        # Check that this ControlTask has only one parent firework
-        this_lzy_wf = lp.get_wf_by_fw_id_lzyfw(control_fw_id)
-        parents_fw_ids = this_lzy_wf.links.parent_links[control_fw_id]
-        if len(parents_fw_ids) != 1:
-            raise ValueError('ControlTask\'s Firework should have exactly one parent firework')
-        run_fw_id = parents_fw_ids[0]
-        # Get the Run Firework and its state
-        run_fw = lp.get_fw_by_id(fw_id=run_fw_id)
+        # In the fused mode, the Setup and Run fireworks are provided directly by the FusedSRCTask
+        if getattr(self, 'src_fused_fws', None) is not None:
+            return self.src_fused_fws
+        # Get the access layer to the launchpad
+        lp_access, control_fw_id = SRCLaunchPadAccess.from_task(task=self, fw_spec=fw_spec)
+        self.lp_access = lp_access
+        # Get the Setup and Run Fireworks at once
+        src_fw_ids = lp_access.get_src_fw_ids(fw_id=control_fw_id, src_type=self.src_type)
+        src_fws = lp_access.get_fireworks(fw_ids=[src_fw_ids['setup'], src_fw_ids['run']])
+        # Check the state of the Run Firework
+        run_fw = src_fws[src_fw_ids['run']]
         run_is_fizzled = '_fizzled_parents' in fw_spec
         if run_is_fizzled and not run_fw.state == 'FIZZLED':
             raise ValueError('ControlTask has "_fizzled_parents" key but parent Run firework is not fizzled ...')
@@ -561,12 +556,15 @@ class ControlTask(SRCTaskMixin, FireTaskBase):
             raise ValueError('Run firework is FIZZLED and COMPLETED ...')
         if (not run_is_completed) and (not run_is_fizzled):
             raise ValueError('Run firework is neither FIZZLED nor COMPLETED ...')
-        # Get the Setup Firework
-        setup_job_info = run_fw.spec['_job_info'][-1]
-        setup_fw_id = setup_job_info['fw_id']
-        setup_fw = lp.get_fw_by_id(fw_id=setup_fw_id)
+        setup_fw = src_fws[src_fw_ids['setup']]
         return {'setup_fw': setup_fw, 'run_fw': run_fw}
 
+    def finalize(self):
+        """
+        Hook called when the control procedure has finalized the task, before the children are updated.
+        """
+        pass
+
     def get_initial_objects_info(self, setup_fw, run_fw, src_directories):
         return {}
 
@@ -863,50 +861,86 @@ class SRCCleaning(MSONable):
         return cls(src_cleaners=[SRCCleaner.from_dict(d_src_c) for d_src_c in d['src_cleaners']])
 
 
-def createSRCFireworks(setup_task, run_task, control_task, spec=None, initialization_info=None,
-                       task_index=None, setup_spec_update=None, run_spec_update=None):
-    # Make a full copy of the spec
-    if spec is None:
-        spec = {}
+def get_src_specs(spec, initialization_info=None, setup_spec_update=None, run_spec_update=None):
+    """
+    Returns a dict with the specs of the setup, run and control steps of a SRC trio as LayeredSpecs sharing the
+    same base spec. The spec should already contain the keys common to the three fireworks (e.g. SRC_task_index).
+    """
     if initialization_info is None:
         initialization_info = {}
-    spec = copy.deepcopy(spec)
-    spec['_add_launchpad_and_fw_id'] = True
-    spec['_add_fworker'] = True
-    # Initialize the SRC task_index
-    if task_index is not None:
-        src_task_index = SRCTaskIndex.from_any(task_index)
-    else:
-        # src_task_index = SRCTaskIndex.from_any('unknown-task')
-        src_task_index = SRCTaskIndex.from_task(run_task)
-    spec['SRC_task_index'] = src_task_index
+    # Short single core parameters shared by the setup and control fireworks
+    short_single_core_qadapter_spec = get_short_single_core_spec()
 
     # SetupTask
-    setup_spec = copy.deepcopy(spec)
+    setup_spec = spec.copy()
     # Remove any initial queue_adapter_update from the spec
     setup_spec.pop('queue_adapter_update', None)
 
-    setup_spec = set_short_single_core_to_spec(setup_spec)
+    setup_spec['mpi_ncpus'] = 1
+    setup_spec['_queueadapter'] = short_single_core_qadapter_spec
     setup_spec['_preserve_fworker'] = True
     setup_spec['_pass_job_info'] = True
     setup_spec['initialization_info'] = initialization_info
     setup_spec.update({} if setup_spec_update is None else setup_spec_update)
-    setup_fw = Firework(setup_task, spec=setup_spec, name=src_task_index.setup_str)
 
     # RunTask
-    run_spec = copy.deepcopy(spec)
-    run_spec['SRC_task_index'] = src_task_index
+    run_spec = spec.copy()
     run_spec['_preserve_fworker'] = True
     run_spec['_pass_job_info'] = True
     run_spec.update({} if run_spec_update is None else run_spec_update)
-    run_fw = Firework(run_task, spec=run_spec, name=src_task_index.run_str)
 
     # ControlTask
-    control_spec = copy.deepcopy(spec)
-    control_spec = set_short_single_core_to_spec(control_spec)
-    control_spec['SRC_task_index'] = src_task_index
+    control_spec = spec.copy()
+    control_spec['mpi_ncpus'] = 1
+    control_spec['_queueadapter'] = short_single_core_qadapter_spec
     control_spec['_allow_fizzled_parents'] = True
-    control_fw = Firework(control_task, spec=control_spec, name=src_task_index.control_str)
+
+    return {'setup': setup_spec, 'run': run_spec, 'control': control_spec}
+
+
+def createSRCFireworks(setup_task, run_task, control_task, spec=None, initialization_info=None,
+                       task_index=None, setup_spec_update=None, run_spec_update=None, fused=False):
+    """
+    Creates the Setup, Run and Control fireworks of a SRC trio.
+    If fused is True, a single firework running the three steps in the same job (see FusedSRCTask) is created
+    instead. For compatibility with the links defined by the callers, the setup_fw, run_fw and control_fw entries
+    of the returned dict are then all set to this fused firework.
+    """
+    # The specs of the fireworks share the same base spec (deep-copied once, or shared if spec is already
+    # a LayeredSpec) and only store their own modifications.
+    spec = LayeredSpec.from_spec(spec)
+    if initialization_info is None:
+        initialization_info = {}
+    spec['_add_launchpad_and_fw_id'] = True
+    spec['_add_fworker'] = True
+    # Initialize the SRC task_index
+    if task_index is not None:
+        src_task_index = SRCTaskIndex.from_any(task_index)
+    else:
+        # src_task_index = SRCTaskIndex.from_any('unknown-task')
+        src_task_index = SRCTaskIndex.from_task(run_task)
+    spec['SRC_task_index'] = src_task_index
+
+    if fused:
+        fused_spec = spec.copy()
+        fused_spec['src_fused'] = True
+        # The whole trio runs with the resources of the run
+        run_spec_update = {} if run_spec_update is None else run_spec_update
+        for key in ['_queueadapter', 'mpi_ncpus']:
+            if key in run_spec_update:
+                fused_spec[key] = run_spec_update[key]
+        fused_task = FusedSRCTask(setup_task=setup_task, run_task=run_task, control_task=control_task,
+                                  initialization_info=initialization_info, setup_spec_update=setup_spec_update,
+                                  run_spec_update=run_spec_update)
+        fused_fw = Firework(fused_task, spec=fused_spec, name=src_task_index.fused_str)
+        return {'setup_fw': fused_fw, 'run_fw': fused_fw, 'control_fw': fused_fw, 'fused_fw': fused_fw,
+                'links_dict': {}, 'fws': [fused_fw]}
+
+    src_specs = get_src_specs(spec=spec, initialization_info=initialization_info,
+                              setup_spec_update=setup_spec_update, run_spec_update=run_spec_update)
+    setup_fw = Firework(setup_task, spec=src_specs['setup'], name=src_task_index.setup_str)
+    run_fw = Firework(run_task, spec=src_specs['run'], name=src_task_index.run_str)
+    control_fw = Firework(control_task, spec=src_specs['control'], name=src_task_index.control_str)
 
     links_dict = {setup_fw.fw_id: [run_fw.fw_id],
                   run_fw.fw_id: [control_fw.fw_id]}
@@ -914,6 +948,205 @@ def createSRCFireworks(setup_task, run_task, control_task, spec=None, initializa
             'fws': [setup_fw, run_fw, control_fw]}
 
 
+@explicit_serialize
+class FusedSRCTask(FireTaskBase):
+    """
+    Runs the Setup, Run and Control steps of a SRC trio in sequence in the same launch (i.e. in the same job).
+    The run step is performed locally only if the resources chosen by the setup step (queue adapter and number of
+    mpi processes) are those of the allocation of the launch, i.e. the _queueadapter and mpi_ncpus of the spec of
+    the fused firework. Otherwise, the step is submitted again as a standard SRC trio, whose run firework gets a job
+    with the resources chosen by the setup. If the control step asks for a restart, the next step is performed in
+    the same launch, with the same check of the resources, until the task is finalized.
+    Each step uses the same directories (setup, run and control), specs and tasks as the corresponding fireworks
+    in the standard SRC scheme. The src_root_dir of each step is a subdirectory of the launch directory named
+    after the SRC_task_index (e.g. scf_1, scf_2, ...).
+    The stored_data of the returned action are those of the last step, with the stored_data of all the steps
+    (including the ControlReports of the intermediate control steps) in the "src_fused_steps" list.
+    """
+
+    src_type = 'fused'
+
+    # Keys of the spec of the launch that are not forwarded to a standard SRC trio
+    LAUNCH_KEYS = ['_tasks', '_launch_dir', '_fw_env', '_job_info', 'src_fused']
+
+    def __init__(self, setup_task, run_task, control_task, initialization_info=None, setup_spec_update=None,
+                 run_spec_update=None):
+        # Note that the tasks are not stored as "run_task", ... to avoid shadowing the run_task method
+        self.src_setup_task = setup_task
+        self.src_run_task = run_task
+        self.src_control_task = control_task
+        self.initialization_info = initialization_info or {}
+        self.setup_spec_update = setup_spec_update or {}
+        self.run_spec_update = run_spec_update or {}
+
+    def run_task(self, fw_spec):
+        launch_dir = os.getcwd()
+        # The allocation of the job is the one requested by the spec of the launched firework
+        launch_resources = self._get_resources(fw_spec)
+        fused_task = self
+        steps_stored_data = []
+        while True:
+            action, local_step = fused_task.run_src_step(fw_spec=fw_spec, launch_dir=launch_dir,
+                                                         launch_resources=launch_resources)
+            os.chdir(launch_dir)
+            steps_stored_data.append(dict(action.stored_data or {},
+                                          SRC_task_index=str(SRCTaskIndex.from_any(fw_spec['SRC_task_index']))))
+            if not local_step or not action.detours:
+                logger.info('SRC task left after {:d} fused step(s)'.format(len(steps_stored_data)))
+                action.stored_data = dict(action.stored_data or {}, src_fused_steps=steps_stored_data)
+                return action
+            # Get the next fused SRC step as it would be retrieved from the database
+            new_fused_fw = Firework.from_dict(action.detours[0].fws[0].to_dict())
+            fused_task = new_fused_fw.tasks[-1]
+            self._set_fireworks_attributes(fused_task)
+            fw_spec = new_fused_fw.spec
+
+    def run_src_step(self, fw_spec, launch_dir, launch_resources=None):
+        """
+        Runs the setup, run and control steps for the spec of the fused firework fw_spec, emulating the
+        fireworks that are used in the standard SRC scheme.
+        If the resources chosen by the setup differ from the launch_resources (by default those of fw_spec),
+        the run and control steps are not performed and a detour with a standard SRC trio for the same step is
+        returned.
+        Returns the FWAction and True if the step has been performed locally (the action is then the one of the
+        control step), False if the detour with the standard SRC trio is returned.
+        """
+        if launch_resources is None:
+            launch_resources = self._get_resources(fw_spec)
+        base_spec = LayeredSpec(base={k: v for k, v in fw_spec.items() if k != '_tasks'})
+        src_task_index = SRCTaskIndex.from_any(base_spec['SRC_task_index'])
+        src_specs = get_src_specs(spec=base_spec, initialization_info=self.initialization_info,
+                                  setup_spec_update=self.setup_spec_update, run_spec_update=self.run_spec_update)
+        setup_spec = src_specs['setup'].to_dict()
+        run_spec = src_specs['run'].to_dict()
+        control_spec = src_specs['control'].to_dict()
+
+        # Setup
+        setup_spec['_launch_dir'] = os.path.join(launch_dir, str(src_task_index))
+        setup_fw_dict = Firework(self.src_setup_task, spec=setup_spec, name=src_task_index.setup_str).to_dict()
+        setup_fw = Firework.from_dict(setup_fw_dict)
+        setup_task = setup_fw.tasks[-1]
+        self._set_fireworks_attributes(setup_task)
+        os.chdir(launch_dir)
+        setup_action = setup_task.run_task(setup_fw.spec)
+        setup_fw = self._get_completed_firework(setup_fw_dict, state='COMPLETED', launch_dir=launch_dir)
+
+        # The run can only be performed in this job if the setup chose the resources of its allocation
+        setup_update_spec = setup_action.update_spec if setup_action is not None and setup_action.update_spec \
+            else {}
+        setup_resources = self._get_resources(setup_update_spec)
+        if not self._same_resources(setup_resources, launch_resources):
+            logger.info('The resources chosen by the setup of {} differ from those of the job: the step is '
+                        'submitted as a standard SRC trio'.format(src_task_index))
+            return self._get_standard_src_action(fw_spec, src_task_index, setup_resources, launch_resources), False
+
+        # Forward the directories and the fworker to the run and control steps
+        # (done with the launchpad in SetupTask._setup_run_and_control_dirs_and_fworker in the standard scheme)
+        src_update = {'src_directories': setup_task.src_directories}
+        if getattr(self, 'fworker', None) is not None:
+            src_update['_fworker'] = self.fworker.name
+        run_spec.update(src_update)
+        run_spec['_launch_dir'] = setup_task.run_dir
+        control_spec.update(src_update)
+        control_spec['_launch_dir'] = setup_task.control_dir
+        run_spec.update(setup_update_spec)
+
+        # Run
+        run_fw_dict = Firework(self.src_run_task, spec=run_spec, name=src_task_index.run_str).to_dict()
+        run_fw = Firework.from_dict(run_fw_dict)
+        run_task = run_fw.tasks[-1]
+        self._set_fireworks_attributes(run_task)
+        os.chdir(launch_dir)
+        try:
+            run_action = run_task.run_task(run_fw.spec)
+            run_state = 'COMPLETED'
+            if run_action is not None and run_action.update_spec:
+                control_spec.update(run_action.update_spec)
+        except Exception:
+            logger.warning('Run step of {} failed:\n{}'.format(src_task_index, traceback.format_exc()))
+            run_state = 'FIZZLED'
+            control_spec['_fizzled_parents'] = [{'fw_id': run_fw.fw_id, 'name': run_fw.name, 'state': run_state}]
+        run_fw = self._get_completed_firework(run_fw_dict, state=run_state, launch_dir=launch_dir)
+
+        # Control
+        control_fw = Firework.from_dict(Firework(self.src_control_task, spec=control_spec,
+                                                 name=src_task_index.control_str).to_dict())
+        control_task = control_fw.tasks[-1]
+        self._set_fireworks_attributes(control_task)
+        control_task.src_fused_fws = {'setup_fw': setup_fw, 'run_fw': run_fw}
+        os.chdir(launch_dir)
+        control_action = control_task.run_task(control_fw.spec)
+        return control_action, True
+
+    def _get_standard_src_action(self, fw_spec, src_task_index, setup_resources, launch_resources):
+        """
+        Returns the FWAction with the detour performing the SRC step of fw_spec as a standard SRC trio.
+        The setup is performed again by the new trio, that then sets the resources of its run firework.
+        """
+        spec = {k: v for k, v in fw_spec.items() if k not in self.LAUNCH_KEYS}
+        src_fws = createSRCFireworks(setup_task=self.src_setup_task, run_task=self.src_run_task,
+                                     control_task=self.src_control_task, spec=spec,
+                                     initialization_info=self.initialization_info, task_index=src_task_index,
+                                     setup_spec_update=self.setup_spec_update, run_spec_update=self.run_spec_update,
+                                     fused=False)
+        wf = Workflow(fireworks=src_fws['fws'], links_dict=src_fws['links_dict'])
+        stored_data = {'src_fused_detour': {'setup_resources': setup_resources,
+                                            'launch_resources': launch_resources}}
+        return FWAction(stored_data=stored_data, detours=[wf])
+
+    @staticmethod
+    def _get_resources(spec):
+        """
+        Returns the resources (queue adapter and number of mpi processes) in the spec of a firework or in the
+        update_spec of a setup step.
+        """
+        return {key: spec.get(key) for key in ['_queueadapter', 'mpi_ncpus']}
+
+    @staticmethod
+    def _same_resources(resources1, resources2):
+        # compared through their serialization, since the specs loaded from the database contain lists in place of
+        # tuples and unicode strings
+        return json.dumps(jsanitize(resources1), sort_keys=True) == json.dumps(jsanitize(resources2), sort_keys=True)
+
+    def _set_fireworks_attributes(self, task):
+        """
+        Sets the attributes (launchpad, fw_id and fworker) set by fireworks to the tasks of the fused firework.
+        """
+        for attr in ['launchpad', 'fw_id', 'fworker']:
+            if hasattr(self, attr):
+                setattr(task, attr, getattr(self, attr))
+
+    @staticmethod
+    def _get_completed_firework(fw_dict, state, launch_dir):
+        """
+        Returns the firework as it would be retrieved from the database after its launch in launch_dir.
+        """
+        fw = Firework.from_dict(fw_dict)
+        fw.launches = [Launch(state=state, launch_dir=launch_dir, fw_id=fw.fw_id)]
+        fw.state = state
+        return fw
+
+    @serialize_fw
+    def to_dict(self):
+        return {'setup_task': self.src_setup_task.to_dict(),
+                'run_task': self.src_run_task.to_dict(),
+                'control_task': self.src_control_task.to_dict(),
+                'initialization_info': self.initialization_info,
+                'setup_spec_update': self.setup_spec_update,
+                'run_spec_update': self.run_spec_update}
+
+    @classmethod
+    def from_dict(cls, d):
+        tasks = {}
+        for key in ['setup_task', 'run_task', 'control_task']:
+            # The tasks might have already been deserialized by fireworks
+            tasks[key] = d[key] if hasattr(d[key], 'run_task') else load_object(d[key])
+        dec = MontyDecoder()
+        return cls(initialization_info=dec.process_decoded(d.get('initialization_info', {})),
+                   setup_spec_update=dec.process_decoded(d.get('setup_spec_update', {})),
+                   run_spec_update=dec.process_decoded(d.get('run_spec_update', {})), **tasks)
+
+
 class SRCTaskIndex(MSONable):
 
     ALLOWED_CHARS = ['-']
@@ -974,6 +1207,10 @@ class SRCTaskIndex(MSONable):
     def control_str(self):
         return '_'.join(['control', self.__str__()])
 
+    @property
+    def fused_str(self):
+        return '_'.join(['fused', self.__str__()])
+
     @classmethod
     def from_string(cls, SRC_task_index_string):
         sp = SRC_task_index_string.split('_')
@@ -987,9 +1224,9 @@ class SRCTaskIndex(MSONable):
         if len(sp) == 2:
             return cls(task_type=sp[0], index=sp[1])
         elif len(sp) == 3:
-            if sp[0] not in ['setup', 'run', 'control']:
-                raise ValueError('SRC_task_index_string should start with "setup", "run" or "control" when 3 parts are '
-                                 'identified')
+            if sp[0] not in ['setup', 'run', 'control', 'fused']:
+                raise ValueError('SRC_task_index_string should start with "setup", "run", "control" or "fused" when 3 '
+                                 'parts are identified')
             return cls(task_type=sp[1], index=sp[2])
 
     @classmethod
@@ -1039,6 +1276,135 @@ def get_queue_adapter_update(qtk_queueadapter, corrections, qa_params=None):
     return queue_adapter_update
 
 
+class SRCLaunchPadAccess(object):
+    """
+    Access layer to the LaunchPad for the fireworks of a Setup/Run/Control trio.
+
+    The ids of the trio are resolved with a single projected query on the workflows collection, the fireworks are
+    retrieved with a single projected query on the fireworks collection (plus one on the launches collection) and the
+    updates of the specs are applied with a single bulk write. The number of queries and writes issued is tracked
+    in n_queries and n_writes and does not depend on the size of the workflow.
+    """
+
+    FW_PROJECTION = {'fw_id': 1, 'spec': 1, 'state': 1, 'name': 1, 'launches': 1,
+                     'created_on': 1, 'updated_on': 1}
+    LAUNCH_PROJECTION = {'action': 0}
+    # Same states as in LaunchPad.update_spec
+    UPDATE_SPEC_ALLOWED_STATES = ['READY', 'WAITING', 'FIZZLED', 'DEFUSED', 'PAUSED']
+
+    def __init__(self, launchpad):
+        self.launchpad = launchpad
+        self.reset_counters()
+
+    @classmethod
+    def from_task(cls, task, fw_spec):
+        """
+        Returns the access layer and the fw_id of the Firework running the task. The launchpad and fw_id are taken
+        from the task if "_add_launchpad_and_fw_id" is in the spec, from the FW.json/FW.yaml file otherwise.
+        """
+        if '_add_launchpad_and_fw_id' in fw_spec:
+            lp = task.launchpad
+            fw_id = task.fw_id
+        else:
+            try:
+                fw_dict = loadfn('FW.json')
+            except IOError:
+                try:
+                    fw_dict = loadfn('FW.yaml')
+                except IOError:
+                    raise RuntimeError("Launchpad/fw_id not present in spec and No FW.json nor FW.yaml file present: "
+                                       "impossible to determine fw_id")
+            lp = LaunchPad.auto_load()
+            fw_id = fw_dict['fw_id']
+        return cls(launchpad=lp), fw_id
+
+    def reset_counters(self):
+        self.n_queries = 0
+        self.n_writes = 0
+
+    def get_workflow_links(self, fw_id, links_type='links'):
+        """
+        Returns the links (or the parent_links if links_type is "parent_links") of the workflow containing the
+        firework with the given fw_id. Only this field of the workflow document is retrieved.
+        """
+        self.n_queries += 1
+        wf_doc = self.launchpad.workflows.find_one({'nodes': fw_id}, {links_type: 1})
+        if wf_doc is None:
+            raise ValueError('No workflow found for the firework with fw_id {}'.format(fw_id))
+        return {int(k): v for k, v in wf_doc.get(links_type, {}).items()}
+
+    def get_src_fw_ids(self, fw_id, src_type):
+        """
+        Returns a dict with the fw_ids of the setup, run and control fireworks of the SRC trio to which the firework
+        with the given fw_id and src_type belongs.
+        """
+        if src_type == 'setup':
+            links = self.get_workflow_links(fw_id, links_type='links')
+            child_fw_ids = links.get(fw_id, [])
+            if len(child_fw_ids) != 1:
+                raise ValueError('SetupTask\'s Firework should have exactly one child firework')
+            run_fw_id = child_fw_ids[0]
+            child_run_fw_ids = links.get(run_fw_id, [])
+            if len(child_run_fw_ids) != 1:
+                raise ValueError('RunTask\'s Firework should have exactly one child firework')
+            return {'setup': fw_id, 'run': run_fw_id, 'control': child_run_fw_ids[0]}
+        elif src_type == 'control':
+            parent_links = self.get_workflow_links(fw_id, links_type='parent_links')
+            parents_fw_ids = parent_links.get(fw_id, [])
+            if len(parents_fw_ids) != 1:
+                raise ValueError('ControlTask\'s Firework should have exactly one parent firework')
+            run_fw_id = parents_fw_ids[0]
+            parents_run_fw_ids = parent_links.get(run_fw_id, [])
+            if len(parents_run_fw_ids) != 1:
+                raise ValueError('RunTask\'s Firework should have exactly one parent firework')
+            return {'setup': parents_run_fw_ids[0], 'run': run_fw_id, 'control': fw_id}
+        else:
+            raise ValueError('Cannot get the SRC fireworks for "src_type" = "{}"'.format(src_type))
+
+    def get_fireworks(self, fw_ids):
+        """
+        Returns a dict {fw_id: Firework} with the fireworks corresponding to the given fw_ids. The fireworks are
+        retrieved with one projected query and their launches with another one. The archived launches and the
+        actions of the launches are not retrieved.
+        """
+        self.n_queries += 1
+        fw_docs = list(self.launchpad.fireworks.find({'fw_id': {'$in': list(fw_ids)}}, self.FW_PROJECTION))
+        if len(fw_docs) != len(set(fw_ids)):
+            found_fw_ids = [fw_doc['fw_id'] for fw_doc in fw_docs]
+            raise ValueError('Fireworks with fw_ids {} not found in the launchpad'.format(
+                [fw_id for fw_id in fw_ids if fw_id not in found_fw_ids]))
+        launch_ids = [launch_id for fw_doc in fw_docs for launch_id in fw_doc.get('launches', [])]
+        launches = {}
+        if launch_ids:
+            self.n_queries += 1
+            for launch_doc in self.launchpad.launches.find({'launch_id': {'$in': launch_ids}},
+                                                           self.LAUNCH_PROJECTION):
+                launch_doc['action'] = None
+                launches[launch_doc['launch_id']] = launch_doc
+        fws = {}
+        for fw_doc in fw_docs:
+            fw_doc.pop('_id', None)
+            fw_doc['launches'] = [launches[launch_id] for launch_id in fw_doc.get('launches', [])
+                                  if launch_id in launches]
+            fw_doc['archived_launches'] = []
+            fws[fw_doc['fw_id']] = Firework.from_dict(fw_doc)
+        return fws
+
+    def update_specs(self, spec_updates):
+        """
+        Updates the specs of several fireworks with a single bulk write. spec_updates is a dict
+        {fw_id: spec_document}. As in LaunchPad.update_spec, only the fireworks that are not running,
+        reserved or completed are updated.
+        """
+        requests = [UpdateOne({'fw_id': fw_id, 'state': {'$in': self.UPDATE_SPEC_ALLOWED_STATES}},
+                              {'$set': {'spec.{}'.format(k): v for k, v in spec_document.items()}})
+                    for fw_id, spec_document in spec_updates.items()]
+        if not requests:
+            return None
+        self.n_writes += 1
+        return self.launchpad.fireworks.bulk_write(requests, ordered=False)
+
+
 ################
 # Exceptions
 ################
@@ -0,0 +1,38 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import json
+import os
+from math import ceil
+
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.tasks.abinit_common import unprime_nband, module_dir
+
+
+def ref_unprime_nband(nband, number_of_primes=10):
+    """
+    Previous implementation of unprime_nband, reading the file at each call.
+    """
+    with open(os.path.join(module_dir, 'n1000multiples_primes.json'), 'r') as f:
+        allowed_nbands = json.load(f)['numbers{:d}primes'.format(number_of_primes)]
+    if nband <= 1000:
+        if nband in allowed_nbands:
+            return nband
+        return min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband])
+    elif nband <= 10000:
+        nband10 = int(ceil(float(nband)/10.0))
+        if nband10 in allowed_nbands:
+            return nband10*10
+        return 10*min([larger_nband for larger_nband in allowed_nbands if larger_nband > nband10])
+
+
+class TestUnprimeNband(AbipyTest):
+
+    def test_unprime_nband(self):
+        for number_of_primes in [3, 4, 5, 7, 10]:
+            for nband in range(1, 10001, 7 if number_of_primes != 10 else 3):
+                self.assertEqual(unprime_nband(nband, number_of_primes=number_of_primes),
+                                 ref_unprime_nband(nband, number_of_primes=number_of_primes))
+        self.assertIsNone(unprime_nband(10001))
+        with self.assertRaises(ValueError):
+            unprime_nband(10, number_of_primes=6)
@@ -0,0 +1,130 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import stat
+import sys
+import tempfile
+
+from abipy.core.testing import AbipyTest
+from pymatgen.io.abinit.tasks import TaskManager
+from abiflows.fireworks.tasks.abinit_tasks import MergeDdbAbinitTask
+
+
+# Fake mrgddb concatenating the input files in the output file and logging the start and end time of each run
+FAKE_MRGDDB = """#!{python}
+from __future__ import print_function
+import sys
+import time
+
+lines = [l.strip() for l in sys.stdin]
+out_ddb, description, nddbs = lines[0], lines[1], int(lines[2])
+with open('{log}', 'a') as f:
+    f.write('start {{}} {{}}\\n'.format(time.time(), nddbs))
+time.sleep(0.3)
+with open(out_ddb, 'w') as f:
+    for ddb in lines[3:3 + nddbs]:
+        f.write(open(ddb).read())
+with open('{log}', 'a') as f:
+    f.write('end {{}} {{}}\\n'.format(time.time(), nddbs))
+"""
+
+MANAGER = """
+qadapters:
+    - priority: 1
+      queue:
+        qtype: shell
+        qname: localhost
+      limits:
+        timelimit: 1:00:00
+        max_cores: 1
+      hardware:
+        num_nodes: 1
+        sockets_per_node: 1
+        cores_per_socket: 4
+        mem_per_node: 4 Gb
+"""
+
+
+class TestMergeDdbTree(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_filepath = os.path.join(self.tmp_dir, 'mrgddb.log')
+        self.mrgddb_filepath = os.path.join(self.tmp_dir, 'fake_mrgddb')
+        with io.open(self.mrgddb_filepath, 'w') as f:
+            f.write(FAKE_MRGDDB.format(python=sys.executable, log=self.log_filepath))
+        os.chmod(self.mrgddb_filepath, os.stat(self.mrgddb_filepath).st_mode | stat.S_IEXEC)
+        self.manager = TaskManager.from_string(MANAGER)
+
+        self.ddb_files = []
+        for i in range(20):
+            filepath = os.path.join(self.tmp_dir, 'pert_{}_DDB'.format(i))
+            with io.open(filepath, 'w') as f:
+                f.write('ddb {}\n'.format(i))
+            self.ddb_files.append(filepath)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def merge(self, task):
+        workdir = os.path.join(self.tmp_dir, 'mrgddb_task')
+        task.set_workdir(workdir)
+        task.outdir.makedirs()
+        out_ddb = task.merge_ddb_files(self.ddb_files, out_ddb=os.path.join(workdir, 'outdata', 'out_DDB'),
+                                       description='test', manager=self.manager, executable=self.mrgddb_filepath)
+        with io.open(out_ddb, 'r') as f:
+            return f.read()
+
+    def get_runs(self):
+        """
+        Returns the list of (start, end, number of ddbs) of the fake mrgddb runs.
+        """
+        starts, ends = [], []
+        with io.open(self.log_filepath, 'r') as f:
+            for line in f:
+                kind, t, nddbs = line.split()
+                (starts if kind == 'start' else ends).append((float(t), int(nddbs)))
+        starts.sort()
+        ends.sort()
+        return [(s[0], e[0], s[1]) for s, e in zip(starts, ends)]
+
+    def get_max_concurrency(self):
+        events = []
+        for start, end, nddbs in self.get_runs():
+            events.extend([(start, 1), (end, -1)])
+        running = max_running = 0
+        for t, n in sorted(events):
+            running += n
+            max_running = max(max_running, running)
+        return max_running
+
+    def test_serial(self):
+        merged = self.merge(MergeDdbAbinitTask(delete_source_ddbs=False))
+        self.assertEqual(merged, ''.join('ddb {}\n'.format(i) for i in range(20)))
+        self.assertEqual([r[2] for r in self.get_runs()], [20])
+
+    def test_tree(self):
+        task = MergeDdbAbinitTask(delete_source_ddbs=True, chunk_size=4, fan_in=3, max_workers=3)
+        merged = self.merge(task)
+
+        # The order of the ddbs is preserved
+        self.assertEqual(merged, ''.join('ddb {}\n'.format(i) for i in range(20)))
+        # 5 chunks of 4 ddbs, then 2 chunks of the 5 partial ddbs and the final merge of the 2 partial ddbs
+        self.assertEqual(sorted(r[2] for r in self.get_runs()), [2, 2, 3, 4, 4, 4, 4, 4])
+        self.assertEqual(self.get_max_concurrency(), 3)
+
+        # Source and partial ddbs are deleted
+        for filepath in self.ddb_files:
+            self.assertFalse(os.path.exists(filepath))
+        for dirpath, dirnames, filenames in os.walk(os.path.join(task.workdir, 'mrgddb_tree')):
+            self.assertNotIn('out_DDB', filenames)
+
+        self.assertFwSerializable(task)
+        self.assertEqual(MergeDdbAbinitTask.from_dict(task.to_dict()).chunk_size, 4)
+
+    def test_wrong_parameters(self):
+        with self.assertRaises(ValueError):
+            MergeDdbAbinitTask(chunk_size=1)
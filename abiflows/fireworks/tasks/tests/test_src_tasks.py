@@ -1,8 +1,21 @@
 # coding: utf-8
 from __future__ import unicode_literals, division, print_function
 
+import tempfile
+import unittest
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
 from abipy.core.testing import AbipyTest
+from fireworks.core.firework import Firework, Workflow, Launch
+from fireworks.core.fworker import FWorker
+from fireworks.user_objects.firetasks.script_task import ScriptTask
+from abiflows.core.mastermind_abc import ControlProcedure
 from abiflows.fireworks.tasks.src_tasks_abc import SRCCleanerOptions
+from abiflows.fireworks.tasks.src_tasks_abc import SRCLaunchPadAccess, SetupTask, ControlTask
 
 
 class TestSRCCleanerOptions(AbipyTest):
@@ -144,4 +157,111 @@ class TestSRCCleanerOptions(AbipyTest):
 
 
         # ['all', 'this_one', 'all_before_this_one', 'all_before_the_previous_one',
-        #                                 'the_one_before_this_one', 'the_one_before_the_previous_one']
\ No newline at end of file
+        #                                 'the_one_before_this_one', 'the_one_before_the_previous_one']
+
+
+class MongomockLaunchPad(object):
+    """
+    Minimal object exposing the collections of a LaunchPad backed by mongomock.
+    """
+    def __init__(self):
+        db = mongomock.MongoClient().fireworks
+        self.fireworks = db.fireworks
+        self.workflows = db.workflows
+        self.launches = db.launches
+
+    def add_chained_src_trios(self, ntrios, launch_dir):
+        """
+        Adds a workflow made of ntrios SRC trios linked one after the other. All the trios are COMPLETED except the
+        last one, whose Run firework is COMPLETED and whose Setup and Control fireworks are WAITING. Returns the ids
+        of the last trio.
+        """
+        fws = []
+        links = {}
+        fw_id = 0
+        for itrio in range(ntrios):
+            setup_fw = Firework(ScriptTask.from_str('echo setup'), fw_id=fw_id + 1, name='setup_test_{}'.format(itrio))
+            run_fw = Firework(ScriptTask.from_str('echo run'), fw_id=fw_id + 2, name='run_test_{}'.format(itrio))
+            control_fw = Firework(ScriptTask.from_str('echo control'), fw_id=fw_id + 3,
+                                  name='control_test_{}'.format(itrio))
+            links[setup_fw.fw_id] = [run_fw.fw_id]
+            links[run_fw.fw_id] = [control_fw.fw_id]
+            if fws:
+                links[fws[-1].fw_id] = [setup_fw.fw_id]
+            fws.extend([setup_fw, run_fw, control_fw])
+            fw_id += 3
+        for fw in fws:
+            launch = Launch(state='COMPLETED', launch_dir=launch_dir, fworker=FWorker(), launch_id=fw.fw_id,
+                            fw_id=fw.fw_id)
+            self.launches.insert_one(launch.to_db_dict())
+            fw.launches = [launch]
+            fw.state = 'COMPLETED'
+        setup_fw, run_fw, control_fw = fws[-3:]
+        setup_fw.launches = []
+        setup_fw.state = 'WAITING'
+        control_fw.launches = []
+        control_fw.state = 'WAITING'
+        wf = Workflow(fws, links_dict=links)
+        for fw in fws:
+            self.fireworks.insert_one(fw.to_db_dict())
+        self.workflows.insert_one(wf.to_db_dict())
+        return {'setup': setup_fw.fw_id, 'run': run_fw.fw_id, 'control': control_fw.fw_id}
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class TestSRCLaunchPadAccess(AbipyTest):
+
+    def setUp(self):
+        self.launch_dir = tempfile.mkdtemp()
+
+    def test_control_step_queries(self):
+        n_queries = []
+        for ntrios in [1, 5, 50]:
+            lp = MongomockLaunchPad()
+            src_fw_ids = lp.add_chained_src_trios(ntrios=ntrios, launch_dir=self.launch_dir)
+            control_task = ControlTask(control_procedure=ControlProcedure(controllers=[]))
+            control_task.launchpad = lp
+            control_task.fw_id = src_fw_ids['control']
+            setup_and_run_fws = control_task.get_setup_and_run_fw(fw_spec={'_add_launchpad_and_fw_id': True})
+            self.assertEqual(setup_and_run_fws['setup_fw'].fw_id, src_fw_ids['setup'])
+            self.assertEqual(setup_and_run_fws['run_fw'].fw_id, src_fw_ids['run'])
+            self.assertEqual(setup_and_run_fws['run_fw'].state, 'COMPLETED')
+            self.assertEqual(setup_and_run_fws['run_fw'].launches[-1].launch_dir, self.launch_dir)
+            self.assertEqual(control_task.lp_access.n_writes, 0)
+            n_queries.append(control_task.lp_access.n_queries)
+        # One query for the links, one for the fireworks and one for the launches, whatever the size of the workflow
+        self.assertEqual(n_queries, [3, 3, 3])
+
+    def test_setup_step_updates(self):
+        for ntrios in [1, 50]:
+            lp = MongomockLaunchPad()
+            src_fw_ids = lp.add_chained_src_trios(ntrios=ntrios, launch_dir=self.launch_dir)
+            setup_task = SetupTask()
+            setup_task.launchpad = lp
+            setup_task.fw_id = src_fw_ids['setup']
+            setup_task.fworker = FWorker(name='test_worker')
+            setup_task.setup_directories(fw_spec={'_launch_dir': self.launch_dir}, create_dirs=False)
+            setup_task._setup_run_and_control_dirs_and_fworker(fw_spec={'_add_launchpad_and_fw_id': True,
+                                                                        '_add_fworker': True})
+            self.assertEqual(setup_task.lp_access.n_queries, 1)
+            self.assertEqual(setup_task.lp_access.n_writes, 1)
+            # The Run firework is already COMPLETED and should not be updated
+            run_spec = lp.fireworks.find_one({'fw_id': src_fw_ids['run']})['spec']
+            self.assertNotIn('src_directories', run_spec)
+            control_spec = lp.fireworks.find_one({'fw_id': src_fw_ids['control']})['spec']
+            self.assertEqual(control_spec['_launch_dir'], setup_task.control_dir)
+            self.assertEqual(control_spec['_fworker'], 'test_worker')
+            self.assertEqual(control_spec['src_directories'], setup_task.src_directories)
+
+    def test_update_specs(self):
+        lp = MongomockLaunchPad()
+        src_fw_ids = lp.add_chained_src_trios(ntrios=3, launch_dir=self.launch_dir)
+        lp_access = SRCLaunchPadAccess(launchpad=lp)
+        lp_access.update_specs({src_fw_ids['setup']: {'a': 1}, src_fw_ids['control']: {'b': 2}})
+        self.assertEqual(lp_access.n_writes, 1)
+        self.assertEqual(lp_access.n_queries, 0)
+        self.assertEqual(lp.fireworks.find_one({'fw_id': src_fw_ids['setup']})['spec']['a'], 1)
+        self.assertEqual(lp.fireworks.find_one({'fw_id': src_fw_ids['control']})['spec']['b'], 2)
+        lp_access.reset_counters()
+        self.assertEqual(lp_access.n_writes, 0)
+        self.assertRaises(ValueError, lp_access.get_src_fw_ids, fw_id=src_fw_ids['control'], src_type='unknown')
@@ -0,0 +1,267 @@
+# coding: utf-8
+"""
+Persistent cache of the results of abinit's autoparal
+"""
+from __future__ import print_function, division, unicode_literals
+
+import collections
+import errno
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.autoparal_calibration import calibrate_pconfs
+from abiflows.fireworks.utils.paral_planner import plan_paral_hints
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# Input variables of abinit affecting the parallel configurations proposed by autoparal: cutoffs and FFT grids,
+#  k-points, bands and spins, type of calculation and perturbations.
+PARALLELIZATION_VARS = ['ecut', 'pawecutdg', 'ngfft', 'ngfftdg', 'boxcutmin',
+                        'nkpt', 'kptopt', 'ngkpt', 'kptrlatt', 'nshiftk', 'shiftk', 'kpt', 'nsym',
+                        'nband', 'nbdbuf', 'occopt', 'nsppol', 'nspinor', 'nspden',
+                        'optdriver', 'iscf', 'paral_kgb', 'npfft',
+                        'rfphon', 'rfelfd', 'rfstrs', 'rfddk', 'rfuser', 'rfdir', 'rfatpol', 'nqpt', 'qpt',
+                        'rf2_dkdk', 'rf2_dkde', 'd3e_pert1_phon', 'd3e_pert2_phon', 'd3e_pert3_phon']
+
+# Threading locks complementing the file locks, that are only effective between processes
+_THREAD_LOCKS = collections.defaultdict(threading.Lock)
+_THREAD_LOCKS_LOCK = threading.Lock()
+
+
+def _canonical(obj):
+    """
+    Converts an object to a JSON compatible object with a unique representation (numpy arrays converted to lists,
+    floats rounded).
+    """
+    if isinstance(obj, dict):
+        return {str(k): _canonical(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple, np.ndarray)):
+        return [_canonical(v) for v in obj]
+    if isinstance(obj, (float, np.floating)):
+        return round(float(obj), 8)
+    if isinstance(obj, np.integer):
+        return int(obj)
+    if isinstance(obj, (bool, int, type(None))):
+        return obj
+    return str(obj)
+
+
+def get_autoparal_key(abiinput, manager):
+    """
+    Returns the canonical dictionary of the quantities affecting the result of the autoparal for an AbinitInput
+    and a TaskManager: the structure, the pseudopotentials, the input variables in PARALLELIZATION_VARS, the
+    maximum number of cores and the policy of the manager.
+    """
+    structure = abiinput.structure
+    policy = {k: str(v) for k, v in vars(manager.policy).items() if not k.startswith('_')}
+    key = {'lattice': structure.lattice.matrix,
+           'species': [str(site.specie) for site in structure],
+           'frac_coords': structure.frac_coords,
+           'pseudos': [getattr(pseudo, 'md5', None) or os.path.basename(pseudo.filepath)
+                       for pseudo in abiinput.pseudos],
+           'vars': {var: abiinput[var] for var in PARALLELIZATION_VARS if var in abiinput},
+           'max_ncpus': manager.max_cores,
+           'policy': policy}
+    return _canonical(key)
+
+
+def get_autoparal_hash(key):
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class AutoparalCache(object):
+    """
+    On-disk cache of the ParalHints obtained by the autoparal of abinit, keyed by a hash of the quantities affecting
+    the parallel configurations (see get_autoparal_key).
+    Each entry is a JSON file in the cache directory, written to a temporary file and renamed so that readers never
+    see a partial entry. The computation of a missing entry is protected by a lock file (fcntl lock, also working
+    on NFS), so that workers sharing the cache directory and needing the same entry run the autoparal only once.
+    The lock files are shared by the entries whose hashes have the same first characters and are never removed.
+    When the number of entries exceeds maxsize, the least recently used entries are removed.
+    """
+
+    ENTRY_EXTENSION = '.json'
+    # Number of characters of the hash used in the name of the lock files
+    LOCK_PREFIX_LENGTH = 2
+
+    def __init__(self, cache_dir, maxsize=1000):
+        """
+        Args:
+            cache_dir: directory of the cache. Created if it does not exist.
+            maxsize: maximum number of entries in the cache.
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.maxsize = maxsize
+        # Number of autoparal runs performed through this object
+        self.nmisses = 0
+        try:
+            os.makedirs(self.cache_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+    def _entry_filepath(self, key_hash):
+        return os.path.join(self.cache_dir, key_hash + self.ENTRY_EXTENSION)
+
+    def _lock_filepath(self, key_hash):
+        return os.path.join(self.cache_dir, '.{}.lock'.format(key_hash[:self.LOCK_PREFIX_LENGTH]))
+
+    def _read_entry(self, key_hash, key):
+        filepath = self._entry_filepath(key_hash)
+        try:
+            with io.open(filepath, 'rt') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if entry.get('key') != key:
+            logger.warning('Autoparal cache entry "{}" does not match its key: ignored'.format(filepath))
+            return None
+        # Update the modification time used for the eviction of the least recently used entries
+        try:
+            os.utime(filepath, None)
+        except OSError:
+            pass
+        return ParalHints.from_dict(entry['paral_hints'])
+
+    def _write_entry(self, key_hash, key, pconfs):
+        filepath = self._entry_filepath(key_hash)
+        tmp_filepath = '{}.{:d}.{:d}.tmp'.format(filepath, os.getpid(), threading.current_thread().ident or 0)
+        entry = {'key': key, 'paral_hints': pconfs.as_dict(), 'created': time.time()}
+        try:
+            with io.open(tmp_filepath, 'wt') as f:
+                f.write(json.dumps(_canonical(entry)))
+            os.rename(tmp_filepath, filepath)
+        except (IOError, OSError) as exc:
+            logger.warning('Could not write autoparal cache entry "{}": {}'.format(filepath, str(exc)))
+
+    def _lock(self, lock_filepath):
+        """
+        Acquires the lock associated to the lock file. Returns the objects needed to release it.
+        """
+        with _THREAD_LOCKS_LOCK:
+            thread_lock = _THREAD_LOCKS[lock_filepath]
+        thread_lock.acquire()
+        lock_file = None
+        if fcntl is not None:
+            try:
+                lock_file = open(lock_filepath, 'a')
+                fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            except (IOError, OSError) as exc:
+                logger.warning('Could not lock "{}": {}'.format(lock_filepath, str(exc)))
+                if lock_file is not None:
+                    lock_file.close()
+                lock_file = None
+        return thread_lock, lock_file
+
+    @staticmethod
+    def _unlock(lock):
+        thread_lock, lock_file = lock
+        if lock_file is not None:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+        thread_lock.release()
+
+    def get(self, abiinput, manager):
+        """
+        Returns the cached ParalHints for the AbinitInput and the TaskManager or None if not present.
+        """
+        key = get_autoparal_key(abiinput, manager)
+        return self._read_entry(get_autoparal_hash(key), key)
+
+    def get_pconfs(self, abiinput, manager, workdir):
+        """
+        Returns the ParalHints for the AbinitInput and the TaskManager, running the autoparal of abinit in workdir
+        only if they are not already in the cache.
+        """
+        key = get_autoparal_key(abiinput, manager)
+        key_hash = get_autoparal_hash(key)
+        pconfs = self._read_entry(key_hash, key)
+        if pconfs is not None:
+            return pconfs
+
+        lock = self._lock(self._lock_filepath(key_hash))
+        try:
+            # The entry may have been computed by another worker while waiting for the lock
+            pconfs = self._read_entry(key_hash, key)
+            if pconfs is not None:
+                return pconfs
+            pconfs = abiinput.abiget_autoparal_pconfs(max_ncpus=manager.max_cores, workdir=workdir, manager=manager)
+            self.nmisses += 1
+            self._write_entry(key_hash, key, pconfs)
+        finally:
+            self._unlock(lock)
+
+        self.evict()
+        return pconfs
+
+    def evict(self):
+        """
+        Removes the least recently used entries if the number of entries exceeds maxsize.
+        """
+        lock = self._lock(os.path.join(self.cache_dir, '.eviction.lock'))
+        try:
+            entries = []
+            for filename in os.listdir(self.cache_dir):
+                if not filename.endswith(self.ENTRY_EXTENSION):
+                    continue
+                filepath = os.path.join(self.cache_dir, filename)
+                try:
+                    entries.append((os.path.getmtime(filepath), filepath))
+                except OSError:
+                    continue
+            if len(entries) <= self.maxsize:
+                return
+            entries.sort()
+            for mtime, filepath in entries[:len(entries) - self.maxsize]:
+                try:
+                    os.remove(filepath)
+                except OSError:
+                    pass
+        finally:
+            self._unlock(lock)
+
+    def __len__(self):
+        return len([filename for filename in os.listdir(self.cache_dir) if filename.endswith(self.ENTRY_EXTENSION)])
+
+
+def get_autoparal_pconfs(abiinput, manager, workdir, fw_policy):
+    """
+    Runs the autoparal of abinit for the AbinitInput with the TaskManager and returns the ParalHints. If the
+    autoparal_cache_dir of the fw_policy is set, the persistent cache is used.
+    If the autoparal_planner of the fw_policy is set (True or a dictionary with the parameters of the cost model)
+    the configurations are obtained with the analytical planner, falling back to abinit for the inputs that it
+    does not support.
+    If the autoparal_calibration_dir of the fw_policy is set, the efficiencies are corrected with the wall times
+    of the previous runs on the machine (see autoparal_calibration).
+    """
+    pconfs = None
+    if fw_policy.autoparal_planner:
+        cost_model = fw_policy.autoparal_planner if isinstance(fw_policy.autoparal_planner, dict) else None
+        try:
+            pconfs = plan_paral_hints(abiinput, manager, cost_model=cost_model)
+        except ValueError as exc:
+            logger.warning('Analytical planner not used, running the autoparal of abinit: {}'.format(str(exc)))
+
+    if pconfs is None:
+        if not fw_policy.autoparal_cache_dir:
+            pconfs = abiinput.abiget_autoparal_pconfs(max_ncpus=manager.max_cores, workdir=workdir, manager=manager)
+        else:
+            cache = AutoparalCache(fw_policy.autoparal_cache_dir, maxsize=fw_policy.autoparal_cache_maxsize)
+            pconfs = cache.get_pconfs(abiinput, manager, workdir)
+
+    return calibrate_pconfs(pconfs, fw_policy)
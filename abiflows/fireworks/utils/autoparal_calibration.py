@@ -0,0 +1,225 @@
+# coding: utf-8
+"""
+Calibration of the efficiencies predicted by the autoparal (or by the analytical planner) with the wall times
+measured on a machine. Each completed run adds a record with the chosen configuration, its predicted efficiency,
+the measured wall time and the sizes of the calculation to a local store. The records are fitted with a model
+correcting the efficiency by a factor exp(-c log2(n)) for each parallelization level with n processes or threads, and
+the corrected efficiencies are used to reorder the configurations proposed for the following runs.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import io
+import json
+import logging
+import math
+import os
+import socket
+import time
+
+import numpy as np
+
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.paral_planner import get_input_sizes
+from abiflows.fireworks.utils.task_history import TaskEvent
+
+
+logger = logging.getLogger(__name__)
+
+
+# Parallelization levels with a correction factor: variables of the configurations and number of threads
+CALIBRATION_LEVELS = ['npkpt', 'npband', 'npfft', 'bandpp', 'omp_ncpus']
+
+
+def get_machine_name():
+    """
+    Default name of the machine for the calibration: the domain of the host, shared by the nodes of a cluster, or
+    the name of the host if it has no domain.
+    """
+    fqdn = socket.getfqdn()
+    return fqdn.split('.', 1)[1] if '.' in fqdn else fqdn
+
+
+def get_work(sizes):
+    """
+    Estimate of the amount of work of a calculation, up to a constant, from its sizes (see
+    paral_planner.get_input_sizes): number of bands and k-points times the cost of an FFT.
+    """
+    nfft = sizes['ngfft'][0] * sizes['ngfft'][1] * sizes['ngfft'][2]
+    return sizes['nkpt'] * sizes['nsppol'] * sizes['nband'] * sizes['nspinor'] * nfft * math.log(nfft, 2)
+
+
+def get_features(conf):
+    """
+    log2 of the number of processes or threads of each level in CALIBRATION_LEVELS for a configuration.
+    """
+    values = dict(conf.get('vars', {}), omp_ncpus=conf.get('omp_ncpus', 1))
+    return [math.log(max(int(values.get(level, 1)), 1), 2) for level in CALIBRATION_LEVELS]
+
+
+def get_run_wall_time(history):
+    """
+    Wall time of the runs of abinit after the last autoparal in a TaskHistory, together with the configuration
+    chosen by the autoparal. Returns (None, None) if the history does not contain an autoparal event.
+    """
+    optconf = None
+    wall_time = 0
+    for event in history.get_events_by_types([TaskEvent.AUTOPARAL, TaskEvent.ABINIT_STOP]):
+        if event.event_type == TaskEvent.AUTOPARAL:
+            optconf = event.details['optconf']
+            wall_time = 0
+        elif event.details.get('run_time'):
+            wall_time += event.details['run_time']
+    if optconf is None:
+        return None, None
+    return wall_time, optconf
+
+
+class AutoparalCalibration(object):
+    """
+    Store of the run records of a machine and calibration of the efficiencies of the parallel configurations.
+    The records are appended as JSON lines to a file named after the machine in the store directory.
+    """
+
+    EXTENSION = '.jsonl'
+
+    def __init__(self, store_dir, machine=None, regularization=1.0, min_records=2):
+        """
+        Args:
+            store_dir: directory of the store. Created if it does not exist.
+            machine: name of the machine. If None get_machine_name is used.
+            regularization: weight of the ridge regularization of the correction coefficients, that keeps them
+                close to zero when few records are available.
+            min_records: minimum number of records to apply the corrections.
+        """
+        self.store_dir = os.path.abspath(store_dir)
+        self.machine = machine or get_machine_name()
+        self.regularization = regularization
+        self.min_records = min_records
+        if not os.path.isdir(self.store_dir):
+            try:
+                os.makedirs(self.store_dir)
+            except OSError:
+                if not os.path.isdir(self.store_dir):
+                    raise
+
+    @property
+    def filepath(self):
+        return os.path.join(self.store_dir, self.machine + self.EXTENSION)
+
+    def add_record(self, sizes, conf, wall_time):
+        """
+        Adds the record of a completed run with the sizes of the calculation, the chosen configuration and the
+        measured wall time in seconds. The predicted efficiency is the one of the autoparal, before the calibration.
+        """
+        if not wall_time or wall_time <= 0:
+            raise ValueError('The wall time should be positive')
+        conf = dict(conf)
+        record = {'sizes': sizes,
+                  'conf': {'tot_ncpus': conf['tot_ncpus'], 'omp_ncpus': conf.get('omp_ncpus', 1),
+                           'vars': dict(conf.get('vars', {}))},
+                  'predicted_efficiency': conf.get('predicted_efficiency', conf['efficiency']),
+                  'wall_time': wall_time,
+                  'created': time.time()}
+        # a single write of a line in append mode, not interleaved with the records of other processes
+        with io.open(self.filepath, 'ab') as f:
+            f.write((json.dumps(record, sort_keys=True) + '\n').encode('utf-8'))
+
+    def add_history_record(self, history, sizes):
+        """
+        Adds the record of a run from the autoparal and abinit stop events of its TaskHistory. Returns True if the
+        record has been added.
+        """
+        wall_time, optconf = get_run_wall_time(history)
+        if not wall_time:
+            return False
+        self.add_record(sizes, optconf, wall_time)
+        return True
+
+    def get_records(self):
+        records = []
+        if not os.path.isfile(self.filepath):
+            return records
+        with io.open(self.filepath, 'rt') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # partially written line
+                    logger.warning('Invalid record in the calibration store "{}": ignored'.format(self.filepath))
+        return records
+
+    def fit(self, records=None):
+        """
+        Fits the correction coefficients of the levels in CALIBRATION_LEVELS to the records. The log of the
+        measured wall time times the number of cores and the predicted efficiency over the work is fitted with a
+        constant, the time per unit of work on the machine, plus the sum of the coefficients times the log2 of the
+        number of processes of each level. Returns a dictionary with the coefficients, all zero if there are less
+        than min_records records.
+        """
+        if records is None:
+            records = self.get_records()
+        if len(records) < self.min_records:
+            return {level: 0. for level in CALIBRATION_LEVELS}
+
+        x = np.array([[1.] + get_features(r['conf']) for r in records])
+        y = np.array([math.log(r['wall_time'] * r['conf']['tot_ncpus'] * r['predicted_efficiency'] /
+                               get_work(r['sizes'])) for r in records])
+        # ridge regression, without regularization of the constant
+        penalty = self.regularization * np.eye(x.shape[1])
+        penalty[0, 0] = 0
+        coefficients = np.linalg.solve(x.T.dot(x) + penalty, x.T.dot(y))
+        return dict(zip(CALIBRATION_LEVELS, [float(c) for c in coefficients[1:]]))
+
+    def calibrate(self, pconfs, coefficients=None):
+        """
+        Returns new ParalHints with the efficiencies of the configurations corrected with the fitted coefficients
+        and ordered by decreasing corrected speedup. The original efficiency is kept as predicted_efficiency.
+        """
+        if coefficients is None:
+            coefficients = self.fit()
+        coefficients_list = [coefficients[level] for level in CALIBRATION_LEVELS]
+        confs = []
+        for conf in pconfs:
+            conf = dict(conf)
+            predicted_efficiency = conf.get('predicted_efficiency', conf['efficiency'])
+            correction = math.exp(-np.dot(coefficients_list, get_features(conf)))
+            conf['predicted_efficiency'] = predicted_efficiency
+            conf['efficiency'] = predicted_efficiency * correction
+            confs.append(conf)
+        confs.sort(key=lambda c: -c['efficiency'] * c['tot_ncpus'])
+        info = dict(pconfs.info, calibration={'machine': self.machine, 'coefficients': coefficients})
+        return ParalHints(info, confs)
+
+
+def calibrate_pconfs(pconfs, fw_policy):
+    """
+    Calibrates the ParalHints with the records of the store in the autoparal_calibration_dir of the fw_policy,
+    if set.
+    """
+    if not fw_policy.autoparal_calibration_dir:
+        return pconfs
+    calibration = AutoparalCalibration(fw_policy.autoparal_calibration_dir,
+                                       machine=fw_policy.autoparal_calibration_machine)
+    return calibration.calibrate(pconfs)
+
+
+def record_run(history, abiinput, fw_policy):
+    """
+    Adds the record of a completed run to the store in the autoparal_calibration_dir of the fw_policy, if set.
+    The runs whose sizes can not be determined are not recorded. Failures are only logged, since the calibration
+    should never make a task fail.
+    """
+    if not fw_policy.autoparal_calibration_dir:
+        return False
+    try:
+        sizes = get_input_sizes(abiinput)
+    except (ValueError, KeyError, AttributeError) as exc:
+        logger.debug('Run not recorded for the autoparal calibration: {}'.format(str(exc)))
+        return False
+    try:
+        calibration = AutoparalCalibration(fw_policy.autoparal_calibration_dir,
+                                           machine=fw_policy.autoparal_calibration_machine)
+        return calibration.add_history_record(history, sizes)
+    except (IOError, OSError, ValueError) as exc:
+        logger.warning('Run not recorded for the autoparal calibration: {}'.format(str(exc)))
+        return False
@@ -0,0 +1,126 @@
+# coding: utf-8
+"""
+Concurrent autoparal probes for a list of inputs, used when generating workflows with several types of
+calculations, each requiring its own autoparal run.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import collections
+import logging
+import multiprocessing
+import os
+import signal
+import time
+
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.autoparal_cache import get_autoparal_pconfs, get_autoparal_key, get_autoparal_hash
+
+
+logger = logging.getLogger(__name__)
+
+
+def _run_probe(conn, abiinput, manager, workdir, fw_policy_dict):
+    """
+    Target of the probe processes: sends through the connection a tuple with a boolean telling if the autoparal
+    succeeded and the dictionary of the ParalHints or the error message.
+    """
+    # a new process group, so that the processes started by the autoparal are killed as well in case of timeout
+    try:
+        os.setpgid(0, 0)
+    except (AttributeError, OSError):
+        pass
+    try:
+        fw_policy = collections.namedtuple('FWPolicy', fw_policy_dict.keys())(**fw_policy_dict)
+        pconfs = get_autoparal_pconfs(abiinput, manager=manager, workdir=workdir, fw_policy=fw_policy)
+        conn.send((True, pconfs.as_dict()))
+    except BaseException as exc:
+        conn.send((False, '{}: {}'.format(exc.__class__.__name__, str(exc))))
+    finally:
+        conn.close()
+
+
+def _kill_probe(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except (AttributeError, OSError):
+        process.terminate()
+    process.join()
+
+
+def run_autoparal_probes(abiinputs, manager, fw_policy, workdirs, max_workers=4, timeout=None, poll_interval=0.05):
+    """
+    Runs the autoparal for a list of inputs (see get_autoparal_pconfs) in at most max_workers concurrent
+    processes. The inputs with the same autoparal key (see get_autoparal_key) are probed only once.
+
+    Args:
+        abiinputs: list of AbinitInputs.
+        manager: the TaskManager.
+        fw_policy: the fw_policy of the FWTaskManager.
+        workdirs: list with the working directory of the autoparal of each input.
+        max_workers: maximum number of probes running at the same time.
+        timeout: maximum time in seconds of each probe. The probes exceeding it are killed, together with the
+            processes that they started.
+        poll_interval: interval in seconds between the checks of the running probes.
+
+    Returns:
+        A list with the ParalHints of each input, None for the inputs whose probe failed or timed out.
+    """
+    if len(workdirs) != len(abiinputs):
+        raise ValueError('A working directory should be given for each input')
+    max_workers = max(int(max_workers), 1)
+    fw_policy_dict = dict(fw_policy._asdict())
+
+    # indices of the inputs with the same key, the first one is probed
+    indices = collections.OrderedDict()
+    for i, abiinput in enumerate(abiinputs):
+        indices.setdefault(get_autoparal_hash(get_autoparal_key(abiinput, manager)), []).append(i)
+
+    pending = collections.deque(indices.keys())
+    running = {}
+    results = {}
+    while pending or running:
+        while pending and len(running) < max_workers:
+            key = pending.popleft()
+            i = indices[key][0]
+            recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(target=_run_probe,
+                                              args=(send_conn, abiinputs[i], manager, workdirs[i], fw_policy_dict))
+            process.daemon = True
+            process.start()
+            send_conn.close()
+            running[key] = (process, recv_conn, time.time())
+
+        for key, (process, conn, start) in list(running.items()):
+            error = None
+            if conn.poll():
+                try:
+                    success, value = conn.recv()
+                except EOFError:
+                    success, value = False, 'the probe exited without a result'
+                process.join()
+                if success:
+                    results[key] = ParalHints.from_dict(value)
+                else:
+                    error = value
+            elif timeout is not None and time.time() - start > timeout:
+                _kill_probe(process)
+                error = 'timed out after {} s'.format(timeout)
+            elif not process.is_alive():
+                process.join()
+                error = 'the probe exited with code {}'.format(process.exitcode)
+            else:
+                continue
+            conn.close()
+            del running[key]
+            if error is not None:
+                results[key] = None
+                logger.warning('Autoparal probe in "{}" failed: {}'.format(workdirs[indices[key][0]], error))
+
+        if running:
+            time.sleep(poll_interval)
+
+    pconfs_list = [None] * len(abiinputs)
+    for key, key_indices in indices.items():
+        for i in key_indices:
+            pconfs_list[i] = results[key]
+    return pconfs_list
@@ -0,0 +1,178 @@
+# coding: utf-8
+"""
+Supervision of the runs of abinit close to the end of the allocation. A margin before the end of the walltime the
+supervisor asks abinit to stop gracefully, creating the abinit.exit file checked by abinit when chkexit is set or
+sending a signal to the process, and waits for a bounded grace period. If abinit exits in time, the checkpoint files
+(e.g. WFK, DEN) written in the output directory can be used by the following restart, otherwise the process is
+killed.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import logging
+import os
+import signal
+import threading
+import time
+
+from abiflows.fireworks.utils.scratch import match_exts
+
+
+logger = logging.getLogger(__name__)
+
+
+# File whose presence makes abinit exit gracefully (if chkexit > 0), searched in the working directory
+ABINIT_EXIT_FILE = 'abinit.exit'
+
+# Extensions of the outputs that can be used to restart a calculation
+CHECKPOINT_EXTS = ['WFK', 'DEN', 'WFQ', '1WF*', '1DEN*', 'HIST', 'DDB']
+
+
+class CheckpointSupervisor(object):
+    """
+    Supervisor of an abinit process, running in a separate thread. At deadline - margin it creates the abinit.exit
+    trigger file in the workdir or sends the signal given as method to the process and waits for at most
+    grace_period seconds for the process to exit. If the process does not exit it is killed.
+    The stop method should be called as soon as the process exits.
+    """
+
+    def __init__(self, deadline, margin, workdir, outdir, method='file', grace_period=120, checkpoint_exts=None,
+                 scratch=None):
+        """
+        Args:
+            deadline: end of the allocation, as a time in seconds since the epoch.
+            margin: time in seconds before the deadline when the stop is triggered.
+            workdir: the working directory of abinit, where the trigger file is created.
+            outdir: the directory where abinit writes the outputs.
+            method: "file" to create the trigger file, or the name of the signal sent to the process (e.g. SIGUSR1).
+            grace_period: maximum time in seconds given to abinit to write the checkpoint and exit.
+            checkpoint_exts: list of the extensions of the checkpoint files. Shell-style wildcards are allowed.
+                If None CHECKPOINT_EXTS is used.
+            scratch: the ScratchRun, if abinit runs in a scratch directory. When the stop is triggered the
+                checkpoint_exts are added to the extensions copied back, so that the checkpoint files are not
+                removed with the scratch directory.
+        """
+        if method != 'file' and not isinstance(getattr(signal, str(method), None), int):
+            raise ValueError('Unknown checkpoint method {}: should be "file" or a signal name'.format(method))
+        self.deadline = deadline
+        self.margin = margin
+        self.workdir = workdir
+        self.outdir = outdir
+        self.method = method
+        self.grace_period = grace_period
+        self.checkpoint_exts = checkpoint_exts if checkpoint_exts is not None else CHECKPOINT_EXTS
+        self.scratch = scratch
+
+        self.process = None
+        self.triggered_time = None
+        self.exited = False
+        self.killed = False
+        self.checkpoint_files = []
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @classmethod
+    def from_fw_policy(cls, fw_policy, deadline, workdir, outdir, scratch=None):
+        """
+        Creates the supervisor from the checkpoint options of the fw_policy. Returns None if the checkpoint_margin
+        is not set, the deadline is not known or the stop would be triggered immediately, since the margin is larger
+        than the time left.
+        """
+        if fw_policy.checkpoint_margin is None or deadline is None:
+            return None
+        if deadline - fw_policy.checkpoint_margin <= time.time():
+            logger.warning('Checkpoint margin of {} s larger than the time left before the end of the walltime: '
+                           'abinit will not be stopped before the walltime'.format(fw_policy.checkpoint_margin))
+            return None
+        return cls(deadline, fw_policy.checkpoint_margin, workdir, outdir, method=fw_policy.checkpoint_method,
+                   grace_period=fw_policy.checkpoint_grace_period, checkpoint_exts=fw_policy.checkpoint_exts,
+                   scratch=scratch)
+
+    @property
+    def trigger_filepath(self):
+        return os.path.join(self.workdir, ABINIT_EXIT_FILE)
+
+    @property
+    def triggered(self):
+        return self.triggered_time is not None
+
+    @property
+    def checkpoint_written(self):
+        return self.exited and bool(self.checkpoint_files)
+
+    def start(self, process):
+        """
+        Starts the supervision of the process (a Popen object).
+        """
+        self.process = process
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._supervise)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Notifies the supervisor that the process exited and waits for the end of the supervision. The trigger file
+        is removed, so that it does not stop the following runs.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if os.path.exists(self.trigger_filepath):
+            os.remove(self.trigger_filepath)
+
+    def trigger(self):
+        self.triggered_time = time.time()
+        if self.scratch is not None:
+            self.scratch.add_copy_back_exts(self.checkpoint_exts)
+        if self.method == 'file':
+            logger.warning('Creating {} to stop abinit before the walltime'.format(self.trigger_filepath))
+            with open(self.trigger_filepath, 'w') as f:
+                f.write('exit\n')
+        else:
+            logger.warning('Sending {} to abinit to stop it before the walltime'.format(self.method))
+            self.process.send_signal(getattr(signal, self.method))
+
+    def _supervise(self):
+        # the process exited before the trigger time
+        if self._stop_event.wait(max(self.deadline - self.margin - time.time(), 0)):
+            return
+        try:
+            self.trigger()
+        except (IOError, OSError) as exc:
+            logger.error('Could not trigger the checkpoint: {}'.format(exc))
+        # the process can not be polled while it is waited for in another thread: the stop is waited instead
+        if self._stop_event.wait(self.grace_period):
+            self.exited = True
+            self.checkpoint_files = self.get_checkpoint_files()
+        else:
+            logger.error('Abinit did not stop within {} s after the trigger. Killing it.'.format(self.grace_period))
+            self.killed = True
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+
+    def get_checkpoint_files(self):
+        """
+        List of the names of the files in the outdir with the checkpoint extensions modified after the trigger.
+        """
+        if not os.path.isdir(self.outdir):
+            return []
+        files = []
+        for f in sorted(os.listdir(self.outdir)):
+            filepath = os.path.join(self.outdir, f)
+            # one second of tolerance for the filesystems with a coarse resolution of the modification times
+            if (os.path.isfile(filepath) and os.path.getmtime(filepath) >= self.triggered_time - 1 and
+                    match_exts(f, self.checkpoint_exts)):
+                files.append(f)
+        return files
+
+    def as_dict(self):
+        """
+        Summary of the supervision, as stored in the checkpoint event of the TaskHistory.
+        """
+        return dict(method=self.method, margin=self.margin, grace_period=self.grace_period,
+                    triggered=self.triggered, exited=self.exited, killed=self.killed,
+                    checkpoint_written=self.checkpoint_written, checkpoint_files=self.checkpoint_files,
+                    time_left=(self.deadline - self.triggered_time) if self.triggered else None)
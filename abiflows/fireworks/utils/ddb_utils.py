@@ -0,0 +1,261 @@
+# coding: utf-8
+"""
+Streaming utilities for DDB files: patching of the header sections and index of the blocks of the database.
+The files are processed line by line, so that the memory usage does not depend on the size of the DDB.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import io
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from monty.json import MSONable
+from pymatgen.serializers.json_coders import pmg_serialize
+
+
+PAW_DATASETS_DESCRIPTION_MARKER = b'Description of the PAW dataset(s)'
+NO_POTENTIALS_MARKER = b'No information on the potentials yet'
+DATABASE_MARKER = b'**** Database of total energy derivatives ****'
+BLOCK_MARKER = b'- # elements'
+
+DDB_INDEX_SUFFIX = '.index.json'
+
+
+def _to_bytes(s):
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def get_ddb_section(filepath, start_marker=PAW_DATASETS_DESCRIPTION_MARKER, end_marker=DATABASE_MARKER,
+                    stop_marker=NO_POTENTIALS_MARKER):
+    """
+    Reads a section of the header of a DDB file, from the line containing start_marker to the line preceding the
+    one containing end_marker.
+    Returns the list of the lines (as bytes) or None if start_marker is not found or if stop_marker is found
+    before start_marker.
+    """
+    start_marker, end_marker = _to_bytes(start_marker), _to_bytes(end_marker)
+    stop_marker = _to_bytes(stop_marker) if stop_marker else None
+    lines = None
+    with io.open(filepath, 'rb') as f:
+        for line in f:
+            if lines is None:
+                if stop_marker and stop_marker in line:
+                    break
+                if start_marker in line:
+                    lines = []
+            if lines is not None:
+                if end_marker in line:
+                    break
+                lines.append(line)
+    return lines
+
+
+def patch_ddb_section(filepath, section_lines, start_marker=PAW_DATASETS_DESCRIPTION_MARKER,
+                      end_marker=DATABASE_MARKER, write_index=True):
+    """
+    Replaces the section of the header of a DDB file going from the line containing start_marker to the line
+    preceding the one containing end_marker with section_lines. If start_marker is not present the file is
+    unchanged.
+    The patched file is written line by line in a temporary file in the same directory, that then replaces the
+    original one with an atomic rename. The index of the blocks of the patched file is built in the same pass.
+
+    Args:
+        filepath: path to the DDB file.
+        section_lines: list of the lines of the new section, including the line with start_marker.
+        start_marker: marker of the beginning of the section.
+        end_marker: marker of the line following the section.
+        write_index: if True the index is saved next to the DDB file (see DdbIndex.from_ddb).
+
+    Returns:
+        The DdbIndex of the patched file.
+    """
+    start_marker, end_marker = _to_bytes(start_marker), _to_bytes(end_marker)
+    section_lines = [_to_bytes(l) for l in section_lines]
+    filepath = os.path.abspath(filepath)
+    fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(filepath), prefix=os.path.basename(filepath) + '.',
+                                        suffix='.tmp')
+    builder = DdbIndexBuilder()
+    try:
+        with io.open(fd, 'wb') as fout, io.open(filepath, 'rb') as fin:
+            just_copy = True
+            for line in fin:
+                if start_marker in line:
+                    just_copy = False
+                    for section_line in section_lines:
+                        builder.add_line(section_line)
+                        fout.write(section_line)
+                if just_copy:
+                    builder.add_line(line)
+                    fout.write(line)
+                    continue
+                if end_marker in line:
+                    just_copy = True
+                    builder.add_line(line)
+                    fout.write(line)
+            fout.flush()
+            os.fsync(fout.fileno())
+        shutil.copymode(filepath, tmp_filepath)
+        os.rename(tmp_filepath, filepath)
+    except BaseException:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+        raise
+
+    index = builder.get_index(filepath)
+    if write_index:
+        index.to_file(DdbIndex.get_index_filepath(filepath))
+    return index
+
+
+class DdbIndexBuilder(object):
+    """
+    Builds the DdbIndex of a DDB file from its lines, passed in order with add_line.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.in_database = False
+        self.blocks = []
+        self._block = None
+
+    def _close_block(self):
+        if self._block is not None:
+            self._block['perturbations'] = sorted([list(p) for p in self._block['perturbations']])
+            self.blocks.append(self._block)
+            self._block = None
+
+    def add_line(self, line):
+        offset = self.offset
+        self.offset += len(line)
+        if not self.in_database:
+            self.in_database = DATABASE_MARKER in line
+            return
+        if BLOCK_MARKER in line:
+            self._close_block()
+            self._block = {'type': line.split(BLOCK_MARKER)[0].strip().decode('utf-8'),
+                           'nelements': int(line.split(b':')[-1]),
+                           'offset': offset, 'nbytes': len(line), 'qpts': [], 'perturbations': set()}
+            return
+        if self._block is None:
+            return
+        tokens = line.split()
+        if not tokens:
+            self._close_block()
+            return
+        self._block['nbytes'] = self.offset - self._block['offset']
+        if tokens[0] == b'qpt':
+            values = [float(t.replace(b'D', b'E').replace(b'd', b'e')) for t in tokens[1:5]]
+            # the fourth value is the normalization of the q-point
+            norm = values[3] if len(values) > 3 and values[3] else 1.
+            self._block['qpts'].append([v / norm for v in values[:3]])
+            return
+        try:
+            # first direction and perturbation of the element
+            self._block['perturbations'].add((int(tokens[0]), int(tokens[1])))
+        except (ValueError, IndexError):
+            pass
+
+    def get_index(self, filepath=None):
+        """
+        Returns the DdbIndex of the lines added. If filepath is given, its size and modification time are stored
+        to check if the index is up to date.
+        """
+        self._close_block()
+        ddb_size = ddb_mtime = None
+        if filepath is not None:
+            stat = os.stat(filepath)
+            ddb_size, ddb_mtime = stat.st_size, stat.st_mtime
+        return DdbIndex(blocks=self.blocks, ddb_size=ddb_size, ddb_mtime=ddb_mtime)
+
+
+class DdbIndex(MSONable):
+    """
+    Index of the blocks of the database of a DDB file. Each block is described by a dictionary with its type
+    (e.g. "2nd derivatives (non-stat.)"), the number of elements, the byte offset and length of the block in the
+    file, the q-points and the list of the [idir, ipert] of the first perturbation of its elements.
+    """
+
+    def __init__(self, blocks, ddb_size=None, ddb_mtime=None):
+        self.blocks = blocks
+        self.ddb_size = ddb_size
+        self.ddb_mtime = ddb_mtime
+
+    @pmg_serialize
+    def as_dict(self):
+        return dict(blocks=self.blocks, ddb_size=self.ddb_size, ddb_mtime=self.ddb_mtime)
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(blocks=d['blocks'], ddb_size=d.get('ddb_size'), ddb_mtime=d.get('ddb_mtime'))
+
+    @staticmethod
+    def get_index_filepath(ddb_filepath):
+        return ddb_filepath + DDB_INDEX_SUFFIX
+
+    def to_file(self, filepath):
+        with io.open(filepath, 'wt') as f:
+            f.write(json.dumps(self.as_dict()))
+
+    @classmethod
+    def from_file(cls, filepath):
+        with io.open(filepath, 'rt') as f:
+            return cls.from_dict(json.load(f))
+
+    @classmethod
+    def from_ddb(cls, ddb_filepath, use_saved=True):
+        """
+        Returns the index of a DDB file. If use_saved is True and the index saved next to the DDB file matches the
+        size and modification time of the file it is loaded, otherwise the index is built reading the file once.
+        """
+        index_filepath = cls.get_index_filepath(ddb_filepath)
+        if use_saved and os.path.isfile(index_filepath):
+            try:
+                index = cls.from_file(index_filepath)
+                if index.is_up_to_date(ddb_filepath):
+                    return index
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        builder = DdbIndexBuilder()
+        with io.open(ddb_filepath, 'rb') as f:
+            for line in f:
+                builder.add_line(line)
+        return builder.get_index(ddb_filepath)
+
+    def is_up_to_date(self, ddb_filepath):
+        stat = os.stat(ddb_filepath)
+        return stat.st_size == self.ddb_size and stat.st_mtime == self.ddb_mtime
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def find(self, qpt=None, perturbation=None, block_type=None):
+        """
+        Returns the list of blocks with the given q-point (compared with np.allclose), including the perturbation
+        [idir, ipert] and with a type starting with block_type. None matches any value.
+        """
+        blocks = []
+        for block in self.blocks:
+            if block_type is not None and not block['type'].startswith(block_type):
+                continue
+            if qpt is not None and not any(np.allclose(q, qpt) for q in block['qpts']):
+                continue
+            if perturbation is not None and list(perturbation) not in block['perturbations']:
+                continue
+            blocks.append(block)
+        return blocks
+
+    @staticmethod
+    def read_block(ddb_filepath, block):
+        """
+        Reads the lines of a block from the DDB file, without parsing the rest of the file.
+        Returns the block as a string.
+        """
+        with io.open(ddb_filepath, 'rb') as f:
+            f.seek(block['offset'])
+            return f.read(block['nbytes']).decode('utf-8')
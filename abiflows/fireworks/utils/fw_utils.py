@@ -4,8 +4,13 @@ Utilities for fireworks
 """
 
 from __future__ import print_function, division, unicode_literals
-from collections import namedtuple
+from collections import namedtuple, Counter
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
 import copy
+import datetime
 from monty.serialization import loadfn
 import os
 from pymatgen.io.abinit import TaskManager
@@ -14,6 +19,7 @@ from pymatgen.io.abinit.tasks import ParalHints
 from fireworks import Workflow
 import traceback
 import logging
+import weakref
 from abiflows.fireworks.utils.time_utils import TimeReport
 from fireworks.core.firework import Firework
 
@@ -21,6 +27,24 @@ logger = logging.getLogger(__name__)
 
 SHORT_SINGLE_CORE_SPEC = {'_queueadapter': {'ntasks': 1, 'time': '00:10:00'}, 'mpi_ncpus': 1}
 
+# Process wide caches of the FWTaskManagers read from the configuration files, keyed by path (the modification time
+# is checked at each access), and of the short single core specs of each manager.
+_FTM_CACHE = {}
+_SHORT_SINGLE_CORE_CACHE = weakref.WeakKeyDictionary()
+# Number of configuration files parsed and of the accesses served by the cache
+FTM_CACHE_STATS = Counter()
+
+
+def clear_fw_task_manager_cache():
+    """
+    Invalidates the cached FWTaskManagers and short single core specs. Changes in the configuration files
+    are detected from their modification time, this is only needed if a file is modified within the
+    resolution of the mtime or if the environment (e.g. FW_TASK_MANAGER) changes.
+    """
+    _FTM_CACHE.clear()
+    _SHORT_SINGLE_CORE_CACHE.clear()
+    FTM_CACHE_STATS.clear()
+
 
 def parse_workflow(fws, links_dict):
     new_list = []
@@ -80,37 +104,169 @@ def append_fw_to_wf(new_fw, wf):
     wf.fw_states[new_fw.fw_id] = new_fw.state
 
 
+# Default bounds (in bytes) for the direct insertion of workflows in the LaunchPad. Mongodb documents are limited
+#  to 16MB.
+DIRECT_INSERTION_MAX_BATCH_SIZE = 8 * 1024 ** 2
+DIRECT_INSERTION_MAX_DOCUMENT_SIZE = 15 * 1024 ** 2
+
+
+def insert_wf_as_detour(launchpad, wf, fw_id, max_batch_size=DIRECT_INSERTION_MAX_BATCH_SIZE,
+                        max_document_size=DIRECT_INSERTION_MAX_DOCUMENT_SIZE):
+    """
+    Inserts the fireworks of the workflow wf directly in the LaunchPad as a detour of the firework fw_id (i.e.
+    between fw_id and its children), instead of passing the workflow in the detours of the FWAction. The launch
+    document containing the FWAction is limited to 16MB, which is reached for workflows of around 1000 fireworks.
+    The fireworks are inserted with bulk inserts of at most max_batch_size bytes. The links, nodes and states of the
+    workflow containing fw_id are then updated with a single atomic update of the workflow document.
+    A ValueError is raised (and nothing is left in the LaunchPad) if one of the documents, including the updated
+    workflow document, would exceed max_document_size bytes. If the insertion or the update of the workflow fails,
+    the inserted fireworks are removed before the exception is raised again.
+
+    Args:
+        launchpad: the LaunchPad.
+        wf: Workflow with the new fireworks.
+        fw_id: id of the (running) firework to which the new fireworks are attached.
+        max_batch_size: maximum size in bytes of the documents inserted in one bulk insert.
+        max_document_size: maximum size in bytes of a document.
+
+    Returns:
+        The list of the fw_ids of the inserted fireworks.
+    """
+    from bson import BSON
+    from fireworks.core.launchpad import WFLock
+
+    fws = wf.fws
+    first_fw_id = launchpad.get_new_fw_id(quantity=len(fws))
+    old_new = {fw.fw_id: first_fw_id + i for i, fw in enumerate(fws)}
+    new_links = {old_new[parent]: [old_new[child] for child in children] for parent, children in wf.links.items()}
+    root_fw_ids = [old_new[i] for i in wf.root_fw_ids]
+    leaf_fw_ids = [old_new[i] for i in wf.leaf_fw_ids]
+    new_fw_ids = sorted(old_new.values())
+    new_fw_ids_set = set(new_fw_ids)
+
+    def check_size(doc, name):
+        size = len(BSON.encode(doc))
+        if size > max_document_size:
+            raise ValueError('Size of the {} ({:d} bytes) exceeds the maximum document size '
+                             '({:d} bytes)'.format(name, size, max_document_size))
+        return size
+
+    with WFLock(launchpad, fw_id):
+        wf_doc = launchpad.workflows.find_one({'nodes': fw_id})
+        if wf_doc is None:
+            raise ValueError('No workflow found for the firework with fw_id {}'.format(fw_id))
+
+        # Detour: the roots of the new workflow are the only children of fw_id and the previous children of fw_id
+        #  become children of the leaves of the new workflow
+        links_update = {str(k): v for k, v in new_links.items()}
+        old_children = wf_doc['links'].get(str(fw_id), [])
+        links_update[str(fw_id)] = root_fw_ids
+        for leaf_fw_id in leaf_fw_ids:
+            links_update[str(leaf_fw_id)] = list(old_children)
+        parent_links_update = {}
+        for parent, children in links_update.items():
+            for child in children:
+                if child in new_fw_ids_set:
+                    parent_links_update.setdefault(str(child), []).append(int(parent))
+        old_parent_links = wf_doc.get('parent_links', {})
+        for child in old_children:
+            parents = [p for p in old_parent_links.get(str(child), []) if p != fw_id]
+            parent_links_update[str(child)] = parents + leaf_fw_ids
+
+        set_update = {'links.{}'.format(k): v for k, v in links_update.items()}
+        if 'parent_links' in wf_doc:
+            set_update.update({'parent_links.{}'.format(k): v for k, v in parent_links_update.items()})
+        if 'fw_states' in wf_doc:
+            set_update.update({'fw_states.{}'.format(i): 'WAITING' for i in new_fw_ids})
+        set_update['updated_on'] = datetime.datetime.utcnow()
+
+        # Check the size of the updated workflow document before inserting anything
+        wf_doc['links'].update(links_update)
+        wf_doc.setdefault('parent_links', {}).update(parent_links_update)
+        wf_doc.setdefault('fw_states', {}).update({str(i): 'WAITING' for i in new_fw_ids})
+        wf_doc['nodes'] = wf_doc['nodes'] + new_fw_ids
+        check_size(wf_doc, 'workflow document')
+
+        try:
+            batch, batch_size = [], 0
+            for fw in fws:
+                fw.fw_id = old_new[fw.fw_id]
+                fw.state = 'WAITING'
+                fw_doc = fw.to_db_dict()
+                fw_doc_size = check_size(fw_doc, 'firework document of "{}"'.format(fw.name))
+                if batch and batch_size + fw_doc_size > max_batch_size:
+                    launchpad.fireworks.insert_many(batch)
+                    batch, batch_size = [], 0
+                batch.append(fw_doc)
+                batch_size += fw_doc_size
+            if batch:
+                launchpad.fireworks.insert_many(batch)
+
+            result = launchpad.workflows.update_one({'nodes': fw_id},
+                                                    {'$set': set_update, '$push': {'nodes': {'$each': new_fw_ids}}})
+            if result.matched_count != 1:
+                raise RuntimeError('The workflow of the firework with fw_id {} could not be updated'.format(fw_id))
+        except Exception:
+            # The fw_ids have been reserved for this insertion: a partially inserted batch is removed as well
+            launchpad.fireworks.delete_many({'fw_id': {'$in': new_fw_ids}})
+            raise
+
+    return new_fw_ids
+
+
 def get_short_single_core_spec(fw_manager=None, master_mem_overhead=0, return_qtk=False, timelimit=None):
+    """
+    Returns the subs dict of the qadapter selected for a short single core job.
+    The results are memoized for each manager, timelimit and master_mem_overhead: the returned dict is shared and
+    should not be modified. The qadapter returned if return_qtk is True is a copy and can be modified.
+
+    Args:
+        fw_manager: a FWTaskManager, the path of its configuration file or None to use the user configuration.
+        master_mem_overhead: memory overhead of the master process.
+        return_qtk: if True the qadapter is returned as well.
+        timelimit: timelimit of the job. If None the short_job_timelimit of the fw_policy is used.
+    """
     if isinstance(fw_manager, FWTaskManager):
         ftm = fw_manager
     elif fw_manager:
-        ftm = FWTaskManager.from_file(fw_manager)
+        ftm = FWTaskManager.from_file(fw_manager, cached=True)
+    else:
+        ftm = FWTaskManager.from_user_config(cached=True)
+
+    if timelimit is None:
+        #TODO make a FW_task_manager parameter
+        timelimit = ftm.fw_policy.short_job_timelimit
+
+    manager_cache = _SHORT_SINGLE_CORE_CACHE.setdefault(ftm, {})
+    key = (timelimit, master_mem_overhead)
+    if key not in manager_cache:
+        manager_cache[key] = _select_short_single_core_qadapter(ftm, timelimit, master_mem_overhead)
+    qadapter_spec, qadapter = manager_cache[key]
+
+    if qadapter is None:
+        # No taskmanger or no queue available
+        #FIXME return something else? exception?
+        return {}
+    if return_qtk:
+        return qadapter_spec, copy.deepcopy(qadapter)
     else:
-        ftm = FWTaskManager.from_user_config()
+        return qadapter_spec
 
+
+def _select_short_single_core_qadapter(ftm, timelimit, master_mem_overhead):
     if ftm.has_task_manager():
         #TODO add mem_per_cpu?
         pconf = ParalHints({}, [{'tot_ncpus': 1, 'mpi_ncpus': 1, 'efficiency': 1}])
         try:
             tm = ftm.task_manager
             tm.select_qadapter(pconf)
-            #TODO make a FW_task_manager parameter
-            if timelimit is None:
-                tm.qadapter.set_timelimit(timelimit=ftm.fw_policy.short_job_timelimit)
-            else:
-                tm.qadapter.set_timelimit(timelimit=timelimit)
+            tm.qadapter.set_timelimit(timelimit=timelimit)
             tm.qadapter.set_master_mem_overhead(master_mem_overhead)
-            qadapter_spec = tm.qadapter.get_subs_dict()
-            if return_qtk:
-                return qadapter_spec, tm.qadapter
-            else:
-                return qadapter_spec
+            return tm.qadapter.get_subs_dict(), copy.deepcopy(tm.qadapter)
         except RuntimeError as e:
             traceback.print_exc()
 
-    # No taskmanger or no queue available
-    #FIXME return something else? exception?
-    return {}
+    return {}, None
 
 
 def set_short_single_core_to_spec(spec={}, master_mem_overhead=0):
@@ -125,6 +281,76 @@ def set_short_single_core_to_spec(spec={}, master_mem_overhead=0):
         return spec
 
 
+class LayeredSpec(MutableMapping):
+    """
+    Copy-on-write spec made of a base dict, that can be shared among several fireworks, and a small overlay
+    specific to each firework. Setting a key only modifies the overlay and deleting a key present in the base only
+    hides it, so that the base is never modified. Copies share the same base and only duplicate the overlay.
+    The values of the base must not be modified in place: replace them with a new object instead.
+    The spec is flattened to a plain dict only when the firework is serialized (see to_dict).
+    """
+
+    def __init__(self, base=None, overlay=None, removed=None):
+        self.base = base if base is not None else {}
+        self.overlay = overlay if overlay is not None else {}
+        self.removed = removed if removed is not None else set()
+
+    @classmethod
+    def from_spec(cls, spec):
+        """
+        Returns a new layer from a spec. If the spec is already a LayeredSpec, the base is shared, otherwise
+        the spec is deep-copied once to become the base of the layer.
+        """
+        if isinstance(spec, LayeredSpec):
+            return spec.copy()
+        return cls(base=copy.deepcopy(spec) if spec else {})
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.overlay.pop(key, None)
+        if key in self.base:
+            self.removed.add(key)
+
+    def __contains__(self, key):
+        return key in self.overlay or (key in self.base and key not in self.removed)
+
+    def __iter__(self):
+        for key in self.overlay:
+            yield key
+        for key in self.base:
+            if key not in self.overlay and key not in self.removed:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.to_dict())
+
+    def copy(self):
+        return self.__class__(base=self.base, overlay=dict(self.overlay), removed=set(self.removed))
+
+    def to_dict(self):
+        """
+        Flattens the layers in a plain dict. Used by the fireworks serialization.
+        """
+        d = {k: v for k, v in self.base.items() if k not in self.removed}
+        d.update(self.overlay)
+        return d
+
+
 class FWTaskManager(object):
     """
     Object containing the configuration parameters and policies to run abipy.
@@ -148,11 +374,28 @@ class FWTaskManager(object):
                               cut3d_cmd='cut3d',
                               mpirun_cmd='mpirun',
                               copy_deps=False,
+                              copy_deps_methods=None,
+                              copy_deps_checksum=False,
+                              copy_deps_max_workers=4,
+                              scratch_dir=None,
+                              scratch_copy_back_exts=None,
                               walltime_command=None,
                               continue_unconverged_on_rerun=True,
                               allow_local_restart=False,
                               timelimit_buffer=120,
-                              short_job_timelimit=600)
+                              short_job_timelimit=600,
+                              monitor_interval=60,
+                              checkpoint_margin=None,
+                              checkpoint_method='file',
+                              checkpoint_grace_period=120,
+                              checkpoint_exts=None,
+                              autoparal_cache_dir=None,
+                              autoparal_cache_maxsize=1000,
+                              autoparal_planner=False,
+                              autoparal_calibration_dir=None,
+                              autoparal_calibration_machine=None,
+                              autoparal_max_workers=4,
+                              autoparal_timeout=None)
     FWPolicy = namedtuple("FWPolicy", fw_policy_defaults.keys())
 
     def __init__(self, **kwargs):
@@ -177,35 +420,78 @@ class FWTaskManager(object):
             self.task_manager = None
 
     @classmethod
-    def from_user_config(cls, fw_policy=None):
+    def get_user_config_path(cls):
+        """
+        Path of the configuration file used by from_user_config, None if no file is available.
+        """
+        # Try in the current directory then in user configuration directory.
+        paths = [os.path.join(os.getcwd(), cls.YAML_FILE), os.getenv("FW_TASK_MANAGER"),
+                 os.path.join(cls.USER_CONFIG_DIR, cls.YAML_FILE)]
+
+        for path in paths:
+            if path and os.path.exists(path):
+                return path
+
+        return None
+
+    @classmethod
+    def from_user_config(cls, fw_policy=None, cached=False):
         """
         Initialize the manager using the dict in the following order of preference:
         - the "fw_manager.yaml" file in the folder where the command is executed
         - a yaml file pointed by the "FW_TASK_MANAGER"
         - the "fw_manager.yaml" in the ~/.abinit/abipy folder
         - if no file available, fall back to default values
+        See from_file for the cached argument.
         """
 
         if fw_policy is None:
             fw_policy = {}
 
-        # Try in the current directory then in user configuration directory.
-        paths = [os.path.join(os.getcwd(), cls.YAML_FILE), os.getenv("FW_TASK_MANAGER"),
-                 os.path.join(cls.USER_CONFIG_DIR, cls.YAML_FILE)]
+        path = cls.get_user_config_path()
+        if path is None:
+            return cls._get_cached(None) if cached else cls()
 
-        config = {}
-        for path in paths:
-            if path and os.path.exists(path):
-                config = loadfn(path)
-                logger.info("Reading manager from {}.".format(path))
-                break
+        logger.info("Reading manager from {}.".format(path))
+        return cls.from_file(path, cached=cached)
 
-        return cls(**config)
+    @classmethod
+    def from_file(cls, path, cached=False):
+        """
+        Read the configuration parameters from the Yaml file filename.
+        The file is parsed only once per process, unless modified. If cached is True the manager shared by all the
+        callers is returned, and it should not be modified, otherwise a new copy is created.
+        """
+        ftm = cls._get_cached(path)
+        return ftm if cached else ftm.copy()
 
     @classmethod
-    def from_file(cls, path):
-        """Read the configuration parameters from the Yaml file filename."""
-        return cls(**(loadfn(path)))
+    def _get_cached(cls, path):
+        if path is None:
+            key, mtime = None, None
+        else:
+            key = os.path.abspath(path)
+            mtime = os.path.getmtime(key)
+        cached = _FTM_CACHE.get(key)
+        if cached is not None and cached[0] == mtime and isinstance(cached[1], cls):
+            FTM_CACHE_STATS['hits'] += 1
+            return cached[1]
+
+        if path is None:
+            ftm = cls()
+        else:
+            ftm = cls(**(loadfn(key)))
+            FTM_CACHE_STATS['parsed'] += 1
+        _FTM_CACHE[key] = (mtime, ftm)
+        return ftm
+
+    def copy(self):
+        """
+        Returns a new manager with the same configuration. Modifications of the fw_policy are preserved.
+        """
+        new = self.__class__(**copy.deepcopy(self._kwargs))
+        new.fw_policy = self.fw_policy
+        return new
 
     def has_task_manager(self):
         return self.task_manager is not None
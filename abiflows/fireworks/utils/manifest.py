@@ -0,0 +1,114 @@
+# coding: utf-8
+"""
+Manifests of the files produced by the tasks, allowing the following tasks to find them without listing the
+directories, which is slow on parallel filesystems (e.g. Lustre, GPFS).
+"""
+from __future__ import print_function, division, unicode_literals
+
+import io
+import json
+import logging
+import os
+import time
+
+from monty.fnmatch import WildCard
+from pymatgen.io.abinit.utils import Directory
+
+
+logger = logging.getLogger(__name__)
+
+
+MANIFEST_SUFFIX = '.manifest.json'
+
+# Coarsest resolution of the modification times of the filesystems (s), e.g. NFS, ext3 and some Lustre setups
+MTIME_RESOLUTION = 1
+
+# Maximum number of times the manifest is written, waiting for the modification time of the directory to be older
+# than MTIME_RESOLUTION
+MAX_WRITE_ATTEMPTS = 3
+
+
+def get_manifest_filepath(dirpath):
+    """
+    Path of the manifest of a directory. The manifest is stored next to the directory, so that writing it does
+    not modify the directory itself.
+    """
+    return os.path.normpath(os.path.abspath(dirpath)) + MANIFEST_SUFFIX
+
+
+def write_manifest(dirpath):
+    """
+    Writes the manifest of the files in a directory: name, extension (the part following the last underscore),
+    size and modification time of each file, and the modification time of the directory, used to detect changes
+    in the list of files.
+    With a coarse resolution of the modification times, a file created in the same second as the manifest would
+    not change the modification time of the directory. If the directory has been modified less than MTIME_RESOLUTION
+    before the manifest, the manifest is written again after waiting, so that it is not considered stale by
+    read_manifest.
+    The manifest is only an optimization: errors are logged and None is returned.
+    Returns the manifest as a dictionary.
+    """
+    dirpath = os.path.abspath(dirpath)
+    try:
+        manifest_filepath = get_manifest_filepath(dirpath)
+        tmp_filepath = manifest_filepath + '.tmp'
+        for attempt in range(MAX_WRITE_ATTEMPTS):
+            if attempt > 0:
+                time.sleep(MTIME_RESOLUTION)
+            files = []
+            for name in sorted(os.listdir(dirpath)):
+                filepath = os.path.join(dirpath, name)
+                if not os.path.isfile(filepath):
+                    continue
+                stat = os.stat(filepath)
+                files.append({'name': name, 'ext': name.split('_')[-1], 'size': stat.st_size,
+                              'mtime': stat.st_mtime})
+            manifest = {'dir_mtime': os.stat(dirpath).st_mtime, 'files': files}
+
+            with io.open(tmp_filepath, 'wt') as f:
+                f.write(json.dumps(manifest))
+            # both modification times are given by the same filesystem
+            if os.stat(tmp_filepath).st_mtime - manifest['dir_mtime'] >= MTIME_RESOLUTION:
+                break
+        os.rename(tmp_filepath, manifest_filepath)
+    except (IOError, OSError) as exc:
+        logger.warning('Could not write the manifest of {}: {}'.format(dirpath, str(exc)))
+        return None
+    return manifest
+
+
+def read_manifest(dirpath):
+    """
+    Returns the manifest of a directory, or None if it is missing, invalid, or stale (the directory has been
+    modified after the manifest has been written, or less than MTIME_RESOLUTION before it, so that later changes
+    may not be detected).
+    """
+    try:
+        with io.open(get_manifest_filepath(dirpath), 'rt') as f:
+            manifest = json.load(f)
+            manifest_mtime = os.fstat(f.fileno()).st_mtime
+        dir_mtime = os.stat(dirpath).st_mtime
+        if dir_mtime != manifest['dir_mtime'] or manifest_mtime - dir_mtime < MTIME_RESOLUTION:
+            logger.debug('Manifest of {} is stale'.format(dirpath))
+            return None
+        return manifest
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+class ManifestDirectory(Directory):
+    """
+    Directory listing its files from the manifest written by the task that produced them (see write_manifest),
+    if present and up to date, and from the filesystem otherwise. All the methods relying on list_filepaths
+    (has_abiext, find_1wf_files, find_last_timden_file, ...) benefit from the manifest.
+    """
+
+    def list_filepaths(self, wildcard=None):
+        manifest = read_manifest(self.path)
+        if manifest is None:
+            return super(ManifestDirectory, self).list_filepaths(wildcard=wildcard)
+        filepaths = [os.path.join(self.path, f['name']) for f in manifest['files']]
+        if wildcard is not None:
+            w = WildCard(wildcard)
+            filepaths = [path for path in filepaths if w.match(os.path.basename(path))]
+        return filepaths
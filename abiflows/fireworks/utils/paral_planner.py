@@ -0,0 +1,252 @@
+# coding: utf-8
+"""
+Analytical planner of the parallel configurations of abinit with paral_kgb = 1, an alternative to the autoparal
+dry run of abinit. The valid distributions of the processes over k-points, bands and FFT (npkpt, npband, npfft),
+the bandpp and the number of OpenMP threads are enumerated and scored with a simple cost model, and returned in the
+same format of the ParalHints produced by the autoparal.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import logging
+import math
+
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.utils.factors import divisors, next_smooth_number
+
+
+logger = logging.getLogger(__name__)
+
+
+BOHR_ANG = 0.52917720859
+
+# Parameters of the cost model. The efficiency of a configuration is the product of the load balance of the
+# k-points and of factors 1 / (1 + overhead * log2(n)) for the n processes or threads sharing the bands, the FFT
+# and the k-points.
+DEFAULT_COST_MODEL = dict(
+    # overheads for each doubling of the number of processes or threads
+    kpt_overhead=0.01,
+    band_overhead=0.08,
+    fft_overhead=0.15,
+    omp_overhead=0.05,
+    # factor applied if the bandpp is not a multiple of the number of threads, leaving threads idle
+    bandpp_omp_penalty=0.8,
+    # minimum number of planes of the FFT box along z for each process
+    min_fft_planes=4,
+    max_bandpp=16,
+    # maximum number of OpenMP threads. The autoparal of abinit only considers the number of threads of the
+    # environment, so by default only pure MPI configurations are proposed.
+    max_omp_threads=1,
+    # memory model: copies of the wavefunctions (blocks of LOBPCG), of the FFT box for each band in a block,
+    # of the densities and potentials on the FFT grid and fixed memory of each MPI process in Mb.
+    wf_copies=4,
+    fft_copies=2,
+    density_copies=6,
+    base_memory=150,
+    # maximum number of configurations returned, ordered by decreasing speedup
+    max_nconfs=50,
+)
+
+
+def _comm_efficiency(n, overhead):
+    return 1. / (1. + overhead * math.log(n, 2))
+
+
+def _even_smooth_number(n):
+    """
+    Lowest even number greater or equal to n with prime factors 2, 3 and 5, the sizes of the FFT used by abinit.
+    """
+    n = next_smooth_number(max(int(n), 2), factors=(2, 3, 5))
+    while n % 2:
+        n = next_smooth_number(n + 1, factors=(2, 3, 5))
+    return n
+
+
+def estimate_ngfft(structure, ecut, boxcutmin=2.0):
+    """
+    Estimates the FFT grid of the wavefunctions for a structure and a cutoff energy in Ha: the sphere inscribed in
+    the box in reciprocal space should have a radius of at least boxcutmin times the radius of the sphere of the
+    plane waves.
+    """
+    gmax = math.sqrt(2. * ecut)
+    # the distance between the faces of the box orthogonal to a_i is n_i * 2pi / |a_i|
+    return [_even_smooth_number(math.ceil(boxcutmin * gmax * a / BOHR_ANG / math.pi - 1e-8))
+            for a in structure.lattice.abc]
+
+
+def estimate_nkpt(structure, ngkpt, shiftk=((0.5, 0.5, 0.5),), kptopt=1):
+    """
+    Number of k-points in the irreducible Brillouin zone for a Monkhorst-Pack mesh, obtained with spglib.
+    Only shifts with components 0 or 0.5 and kptopt 1 or 3 are supported.
+    """
+    if kptopt == 3:
+        return int(ngkpt[0] * ngkpt[1] * ngkpt[2]) * len(shiftk)
+    if kptopt != 1:
+        raise ValueError('The number of k-points can not be estimated for kptopt {}'.format(kptopt))
+
+    from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
+    analyzer = SpacegroupAnalyzer(structure)
+    nkpt = 0
+    for shift in shiftk:
+        if any(abs(s) > 1e-8 and abs(s - 0.5) > 1e-8 for s in shift):
+            raise ValueError('The number of k-points can not be estimated for the shift {}'.format(shift))
+        is_shift = [int(abs(s - 0.5) < 1e-8) for s in shift]
+        nkpt += len(analyzer.get_ir_reciprocal_mesh(mesh=[int(n) for n in ngkpt], is_shift=is_shift))
+    return nkpt
+
+
+def _reshape_vectors(values):
+    values = list(values)
+    if values and not hasattr(values[0], '__len__'):
+        values = [values[i:i + 3] for i in range(0, len(values), 3)]
+    return values
+
+
+def get_input_sizes(abiinput):
+    """
+    Returns a dictionary with the sizes of an AbinitInput determining the parallel configurations: nkpt, nsppol,
+    nspinor, nspden, nband and ngfft. The quantities not explicitly set in the input are estimated.
+    Raises a ValueError if the input is not a ground state calculation with paral_kgb = 1 or if the sizes can not
+    be determined.
+    """
+    def get(var, default=None):
+        return abiinput[var] if var in abiinput else default
+
+    if int(get('optdriver', 0)) != 0 or int(get('paral_kgb', 0)) != 1:
+        raise ValueError('The planner only supports ground state calculations with paral_kgb 1')
+
+    sizes = dict(nsppol=int(get('nsppol', 1)), nspinor=int(get('nspinor', 1)))
+    sizes['nspden'] = int(get('nspden', sizes['nsppol']))
+
+    if get('kptopt', 1) == 0 or 'kpt' in abiinput:
+        sizes['nkpt'] = int(get('nkpt', 1))
+    elif 'ngkpt' in abiinput:
+        shiftk = get('shiftk', [0.5, 0.5, 0.5])
+        shiftk = [[float(s) for s in shift] for shift in _reshape_vectors(shiftk)]
+        sizes['nkpt'] = estimate_nkpt(abiinput.structure, get('ngkpt'), shiftk=shiftk, kptopt=int(get('kptopt', 1)))
+    else:
+        raise ValueError('The number of k-points can not be determined')
+
+    if 'nband' in abiinput:
+        sizes['nband'] = int(get('nband'))
+    else:
+        # default of abinit: the occupied bands, with some additional bands for metals
+        nocc = int(math.ceil(abiinput.num_valence_electrons * sizes['nspinor'] / 2.))
+        if int(get('occopt', 1)) in (3, 4, 5, 6, 7, 8):
+            nocc += max(4, int(math.ceil(0.2 * nocc)))
+        sizes['nband'] = nocc
+
+    if 'ngfft' in abiinput:
+        sizes['ngfft'] = [int(n) for n in get('ngfft')]
+    elif 'ecut' in abiinput:
+        sizes['ngfft'] = estimate_ngfft(abiinput.structure, float(get('ecut')), float(get('boxcutmin', 2.0)))
+    else:
+        raise ValueError('The FFT grid can not be determined')
+
+    return sizes
+
+
+def get_manager_resources(manager):
+    """
+    Returns the maximum number of cores, of cores per node and of memory per core in Mb among the qadapters of a
+    TaskManager.
+    """
+    qads = manager.qads
+    max_cores = max(qad.max_cores for qad in qads)
+    cores_per_node = max(qad.hw.cores_per_node for qad in qads)
+    max_mem_per_cpu = max(qad.hw.mem_per_core for qad in qads)
+    return max_cores, cores_per_node, max_mem_per_cpu
+
+
+def estimate_memory(sizes, npkpt, npband, npfft, bandpp, omp_ncpus, cost_model):
+    """
+    Estimated memory in Mb of each core for a configuration.
+    """
+    nfft = sizes['ngfft'][0] * sizes['ngfft'][1] * sizes['ngfft'][2]
+    # fraction of the FFT box occupied by the sphere of the plane waves
+    npw = math.pi / 48. * nfft * sizes['nspinor']
+    nkpt_per_proc = int(math.ceil(sizes['nkpt'] * sizes['nsppol'] / npkpt))
+    complex_size = 16.
+    wf_mem = cost_model['wf_copies'] * nkpt_per_proc * sizes['nband'] * npw * complex_size / (npband * npfft)
+    fft_mem = cost_model['fft_copies'] * bandpp * omp_ncpus * nfft * complex_size / npfft
+    density_mem = cost_model['density_copies'] * sizes['nspden'] * nfft * 8. / npfft
+    mem_per_proc = cost_model['base_memory'] + (wf_mem + fft_mem + density_mem) / 1024. ** 2
+    return mem_per_proc / omp_ncpus
+
+
+def plan_paral_confs(sizes, max_ncpus, cores_per_node=None, max_mem_per_cpu=None, cost_model=None):
+    """
+    Enumerates the valid parallel configurations with paral_kgb = 1 for the sizes of a calculation (see
+    get_input_sizes) and scores them with the cost model (DEFAULT_COST_MODEL updated with the cost_model dict).
+    For each distribution of the processes and number of threads only the bandpp with the lowest memory among the
+    most efficient is kept. The configurations whose memory per core exceeds max_mem_per_cpu are discarded.
+    Returns the configurations as dictionaries in the format of the autoparal, ordered by decreasing speedup.
+    """
+    unknown_keys = set(cost_model or {}) - set(DEFAULT_COST_MODEL)
+    if unknown_keys:
+        raise ValueError('Unknown key(s) in the cost model: {}'.format(', '.join(sorted(unknown_keys))))
+    cost_model = dict(DEFAULT_COST_MODEL, **(cost_model or {}))
+
+    nkpt_tot = sizes['nkpt'] * sizes['nsppol']
+    nband = sizes['nband']
+    ngfft = sizes['ngfft']
+    npfft_list = [n for n in divisors(ngfft[1]) if ngfft[2] % n == 0 and ngfft[2] // n >= cost_model['min_fft_planes']]
+    max_omp = min(cost_model['max_omp_threads'], cores_per_node or max_ncpus)
+    omp_list = [n for n in range(1, max_omp + 1) if not cores_per_node or cores_per_node % n == 0]
+
+    confs = []
+    for npkpt in range(1, min(nkpt_tot, max_ncpus) + 1):
+        kpt_eff = nkpt_tot / (npkpt * math.ceil(nkpt_tot / npkpt)) * \
+            _comm_efficiency(npkpt, cost_model['kpt_overhead'])
+        for npband in divisors(nband):
+            if npkpt * npband > max_ncpus:
+                break
+            band_eff = _comm_efficiency(npband, cost_model['band_overhead'])
+            for npfft in npfft_list:
+                mpi_ncpus = npkpt * npband * npfft
+                if mpi_ncpus > max_ncpus:
+                    break
+                fft_eff = _comm_efficiency(npfft, cost_model['fft_overhead'])
+                for omp_ncpus in omp_list:
+                    if mpi_ncpus * omp_ncpus > max_ncpus:
+                        break
+                    best = None
+                    for bandpp in divisors(nband // npband):
+                        if bandpp > cost_model['max_bandpp']:
+                            break
+                        omp_eff = _comm_efficiency(omp_ncpus, cost_model['omp_overhead'])
+                        if bandpp % omp_ncpus:
+                            omp_eff *= cost_model['bandpp_omp_penalty']
+                        efficiency = kpt_eff * band_eff * fft_eff * omp_eff
+                        mem_per_cpu = estimate_memory(sizes, npkpt, npband, npfft, bandpp, omp_ncpus, cost_model)
+                        if max_mem_per_cpu and mem_per_cpu > max_mem_per_cpu:
+                            continue
+                        if best is None or (efficiency, -mem_per_cpu) > (best['efficiency'], -best['mem_per_cpu']):
+                            best = {'tot_ncpus': mpi_ncpus * omp_ncpus, 'mpi_ncpus': mpi_ncpus,
+                                    'omp_ncpus': omp_ncpus, 'efficiency': round(efficiency, 4),
+                                    'mem_per_cpu': round(mem_per_cpu, 2),
+                                    'vars': {'npimage': 1, 'npkpt': npkpt, 'npspinor': 1, 'npfft': npfft,
+                                             'npband': npband, 'bandpp': bandpp}}
+                    if best is not None:
+                        confs.append(best)
+
+    confs.sort(key=lambda c: (-c['efficiency'] * c['tot_ncpus'], c['tot_ncpus'], c['mem_per_cpu']))
+    return confs[:cost_model['max_nconfs']]
+
+
+def plan_paral_hints(abiinput, manager, cost_model=None):
+    """
+    Returns the ParalHints for an AbinitInput and a TaskManager obtained with the analytical planner, using the
+    resources of the qadapters of the manager.
+    Raises a ValueError if the planner can not be used for the input.
+    """
+    sizes = get_input_sizes(abiinput)
+    max_cores, cores_per_node, max_mem_per_cpu = get_manager_resources(manager)
+    confs = plan_paral_confs(sizes, max_ncpus=max_cores, cores_per_node=cores_per_node,
+                             max_mem_per_cpu=max_mem_per_cpu, cost_model=cost_model)
+    if not confs:
+        raise ValueError('No parallel configuration fits in the resources of the manager')
+    info = {'autoparal': 1, 'planner': 'analytical', 'max_ncpus': max_cores, 'nkpt': sizes['nkpt'],
+            'nsppol': sizes['nsppol'], 'nspinor': sizes['nspinor'], 'mband': sizes['nband'],
+            'ngfft': sizes['ngfft']}
+    logger.info('Parallel configurations obtained with the analytical planner for the sizes {}'.format(sizes))
+    return ParalHints(info, confs)
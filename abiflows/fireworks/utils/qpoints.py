@@ -0,0 +1,84 @@
+# coding: utf-8
+"""
+Utilities to match q-points
+"""
+from __future__ import print_function, division, unicode_literals
+
+import itertools
+
+import numpy as np
+
+
+class QptIndex(object):
+    """
+    Index of a list of q-points allowing to find the ones matching a given q-point with the same tolerance of
+    np.allclose(qpt, query, rtol=rtol, atol=atol), without comparing the query with all the q-points.
+    The q-points are stored in a dictionary keyed by their cell in a regular grid with spacing equal to the largest
+    tolerance for the q-points of the index, so that only the few cells around the query need to be checked.
+    The candidates are then checked with np.allclose, so that the matches are exactly the same as those of a loop
+    over all the q-points.
+    """
+
+    def __init__(self, qpts, rtol=1e-05, atol=1e-08):
+        """
+        Args:
+            qpts: list of q-points in reduced coordinates.
+            rtol: relative tolerance, as in np.allclose.
+            atol: absolute tolerance, as in np.allclose.
+        """
+        self.qpts = np.array(qpts, dtype=float).reshape((-1, 3))
+        self.rtol = rtol
+        self.atol = atol
+        max_abs = np.abs(self.qpts).max() if len(self.qpts) else 0.
+        self.spacing = max(atol + rtol * max_abs, np.finfo(float).tiny)
+        self._cells = {}
+        for i, cell in enumerate(self._get_cells(self.qpts)):
+            self._cells.setdefault(tuple(cell), []).append(i)
+        if self._cells:
+            cells = np.array(list(self._cells.keys()))
+            self._min_cell = cells.min(axis=0)
+            self._max_cell = cells.max(axis=0)
+
+    def _get_cells(self, qpts):
+        return np.floor(np.asarray(qpts) / self.spacing).astype(int)
+
+    def __len__(self):
+        return len(self.qpts)
+
+    def find(self, qpt):
+        """
+        Returns the sorted list of the indices of the q-points matching qpt.
+        """
+        qpt = np.asarray(qpt, dtype=float)
+        if not self._cells or not np.all(np.isfinite(qpt)):
+            return self._find_all(qpt)
+
+        tol = self.atol + self.rtol * np.abs(qpt)
+        # One more cell on each side to be safe with respect to rounding errors, limited to the occupied cells
+        low = np.maximum(self._get_cells(qpt - tol) - 1, self._min_cell)
+        high = np.minimum(self._get_cells(qpt + tol) + 1, self._max_cell)
+        if np.any(low > high):
+            return []
+        # The tolerance of a query much larger than the q-points of the index spans many cells
+        if np.prod((high - low + 1).astype(float)) > len(self.qpts):
+            return self._find_all(qpt)
+        candidates = []
+        for cell in itertools.product(*[range(l, h + 1) for l, h in zip(low, high)]):
+            candidates.extend(self._cells.get(cell, []))
+        return sorted(i for i in candidates if np.allclose(self.qpts[i], qpt, rtol=self.rtol, atol=self.atol))
+
+    def _find_all(self, qpt):
+        return [i for i in range(len(self.qpts)) if np.allclose(self.qpts[i], qpt, rtol=self.rtol, atol=self.atol)]
+
+    def get_index(self, qpt):
+        """
+        Returns the index of the q-point matching qpt or None if no q-point matches.
+        Raises a ValueError if more than one q-point matches.
+        """
+        indices = self.find(qpt)
+        if not indices:
+            return None
+        if len(indices) > 1:
+            raise ValueError('Ambiguous match for q-point {}: q-points {} are all within the tolerance (rtol={}, '
+                             'atol={})'.format(list(qpt), [list(self.qpts[i]) for i in indices], self.rtol, self.atol))
+        return indices[0]
@@ -0,0 +1,261 @@
+# coding: utf-8
+"""
+Runs of abinit in a node-local scratch directory (e.g. $TMPDIR), to keep the I/O of the temporary and output files
+away from the shared filesystem. The input data are staged in the scratch directory before the run and only the
+output files with the configured extensions are copied back to the output directory of the task at the end of the
+run, or when a SIGTERM is received before the end of the walltime.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import contextlib
+import fnmatch
+import logging
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from abiflows.fireworks.tasks.abinit_common import INDIR_NAME, OUTDIR_NAME, TMPDIR_NAME
+from abiflows.fireworks.utils.staging import stage_files
+
+
+logger = logging.getLogger(__name__)
+
+# Time given to abinit to exit after a SIGTERM, before the copy back of the outputs (s)
+TERMINATE_TIMEOUT = 10
+
+
+def get_output_ext(filename):
+    """
+    Extension of an abinit output file, e.g. WFK for out_WFK, out_DS2_WFK and out_WFK.nc.
+    """
+    name = os.path.basename(filename)
+    if name.endswith('.nc'):
+        name = name[:-3]
+    return name.rsplit('_', 1)[-1]
+
+
+def match_exts(filename, exts):
+    """
+    True if the extension of the output file matches one of the exts. Shell-style wildcards are allowed, e.g. 1WF*.
+    If exts is None all the files match.
+    """
+    if exts is None:
+        return True
+    ext = get_output_ext(filename)
+    return any(fnmatch.fnmatchcase(ext, e) for e in exts)
+
+
+def get_scratch_root(scratch_dir):
+    """
+    Expands the environment variables and the user in the scratch_dir of the fw_policy. Returns None if a variable
+    is not defined or the directory does not exist.
+    """
+    root = os.path.expanduser(os.path.expandvars(scratch_dir))
+    if '$' in root or not os.path.isdir(root):
+        logger.warning('Scratch directory "{}" not available: running in the launch directory'.format(scratch_dir))
+        return None
+    return os.path.abspath(root)
+
+
+class ScratchRun(object):
+    """
+    Context manager running abinit in a scratch directory. At the enter the content of the indata directory of
+    the workdir is staged in the scratch directory. At the exit the files in the outdata directory of the scratch
+    with the extensions in copy_back_exts are copied back to the outdata of the workdir and the scratch directory is
+    removed. The same copy back is performed if a SIGTERM is received, before the signal is passed to the previous
+    handler.
+    """
+
+    def __init__(self, workdir, scratch_root, copy_back_exts=None, methods=None, max_workers=4):
+        """
+        Args:
+            workdir: the working directory of the task, on the shared filesystem.
+            scratch_root: the directory where the scratch directory of the run is created.
+            copy_back_exts: list of the extensions of the output files copied back. If None all the files in outdata
+                are copied back.
+            methods: the methods allowed for the staging (see staging.stage_file).
+            max_workers: maximum number of files staged at the same time.
+        """
+        self.workdir = os.path.abspath(workdir)
+        self.scratch_root = scratch_root
+        self.copy_back_exts = copy_back_exts
+        self.methods = methods
+        self.max_workers = max_workers
+        self.scratch_dir = None
+        self.process = None
+        self._previous_handler = None
+        self._handler_installed = False
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_fw_policy(cls, workdir, fw_policy):
+        """
+        Creates the ScratchRun from the scratch_dir and scratch_copy_back_exts of the fw_policy. Returns None if the
+        scratch is not used.
+        """
+        if not fw_policy.scratch_dir:
+            return None
+        scratch_root = get_scratch_root(fw_policy.scratch_dir)
+        if scratch_root is None:
+            return None
+        return cls(workdir, scratch_root, copy_back_exts=fw_policy.scratch_copy_back_exts,
+                   methods=fw_policy.copy_deps_methods, max_workers=fw_policy.copy_deps_max_workers)
+
+    @property
+    def outdir(self):
+        """The directory of the output data in the scratch."""
+        return os.path.join(self.scratch_dir, OUTDIR_NAME)
+
+    def setup(self):
+        """
+        Creates the scratch directory with its data directories and stages the input data.
+        """
+        self.scratch_dir = tempfile.mkdtemp(prefix='abiflows_', dir=self.scratch_root)
+        for dirname in (INDIR_NAME, OUTDIR_NAME, TMPDIR_NAME):
+            os.makedirs(os.path.join(self.scratch_dir, dirname))
+
+        # the links to the outputs of the previous tasks are followed
+        indir = os.path.join(self.workdir, INDIR_NAME)
+        files = []
+        if os.path.isdir(indir):
+            for f in os.listdir(indir):
+                source = os.path.join(indir, f)
+                if os.path.isfile(source):
+                    files.append((source, os.path.join(self.scratch_dir, INDIR_NAME, f)))
+        stage_files(files, methods=self.methods, max_workers=self.max_workers)
+        logger.info('Staged {} input files in the scratch directory {}'.format(len(files), self.scratch_dir))
+
+    def get_filesfile_string(self, filesfile_string):
+        """
+        The files file of the run in the scratch: the prefixes of the input, output and temporary data in the
+        workdir are replaced with those in the scratch directory.
+        """
+        lines = filesfile_string.splitlines()
+        for i in range(2, 5):
+            if os.path.dirname(os.path.dirname(lines[i])) != self.workdir:
+                raise ValueError('The prefix {} is not in the working directory {}'.format(lines[i], self.workdir))
+            lines[i] = os.path.join(self.scratch_dir, os.path.relpath(lines[i], self.workdir))
+        return "\n".join(lines)
+
+    def write_filesfile(self, filesfile_path):
+        """
+        Writes in the scratch directory the files file obtained from the one of the workdir. Returns its path.
+        """
+        with open(filesfile_path, 'r') as f:
+            filesfile_string = f.read()
+        path = os.path.join(self.scratch_dir, os.path.basename(filesfile_path))
+        with open(path, 'w') as f:
+            f.write(self.get_filesfile_string(filesfile_string))
+        return path
+
+    def copy_back(self):
+        """
+        Copies the output files with the copy_back_exts to the outdata of the workdir. Returns the list of the
+        files copied back.
+        """
+        with self._lock:
+            if self.scratch_dir is None:
+                return []
+            outdir = os.path.join(self.scratch_dir, OUTDIR_NAME)
+            dest_dir = os.path.join(self.workdir, OUTDIR_NAME)
+            if not os.path.isdir(dest_dir):
+                os.makedirs(dest_dir)
+            files = [(os.path.join(outdir, f), os.path.join(dest_dir, f)) for f in sorted(os.listdir(outdir))
+                     if os.path.isfile(os.path.join(outdir, f)) and match_exts(f, self.copy_back_exts)]
+            stage_files(files, methods=self.methods, max_workers=self.max_workers)
+            logger.info('Copied back {} output files from the scratch directory {}'.format(len(files),
+                                                                                         self.scratch_dir))
+            return [dest for source, dest in files]
+
+    def add_copy_back_exts(self, exts):
+        """
+        Adds exts to the extensions of the files copied back, e.g. those of the checkpoint files. Nothing changes if
+        all the files are copied back.
+        """
+        with self._lock:
+            if self.copy_back_exts is not None:
+                self.copy_back_exts = list(self.copy_back_exts) + [e for e in exts if e not in self.copy_back_exts]
+
+    def cleanup(self):
+        with self._lock:
+            if self.scratch_dir is not None:
+                shutil.rmtree(self.scratch_dir, ignore_errors=True)
+                self.scratch_dir = None
+
+    def terminate_process(self):
+        """
+        Terminates the abinit process, if running, so that the outputs are not copied while being written.
+        The process should be waited for in a thread other than the main one, where the signal is handled.
+        """
+        if self.process is None or self._has_exited():
+            return
+        self.process.terminate()
+        start = time.time()
+        while not self._has_exited() and time.time() - start < TERMINATE_TIMEOUT:
+            time.sleep(0.1)
+        if not self._has_exited():
+            self.process.kill()
+
+    def _has_exited(self):
+        # The returncode is set by the thread waiting for the process (e.g. with communicate) once it exits. The
+        # process should not be reaped here, otherwise Popen would lose its exit status. If the process is waited
+        # for in the interrupted frame it is killed after TERMINATE_TIMEOUT.
+        return self.process.returncode is not None
+
+    def _handle_sigterm(self, signum, frame):
+        logger.warning('SIGTERM received: copying back the outputs from the scratch directory')
+        previous_handler = self._previous_handler
+        self._restore_handler()
+        self.terminate_process()
+        try:
+            self.copy_back()
+        finally:
+            self.cleanup()
+        if callable(previous_handler):
+            previous_handler(signum, frame)
+        elif previous_handler != signal.SIG_IGN:
+            # default action: the signal is sent again with the default handler restored
+            os.kill(os.getpid(), signum)
+
+    def _install_handler(self):
+        try:
+            self._previous_handler = signal.signal(signal.SIGTERM, self._handle_sigterm)
+            self._handler_installed = True
+        except ValueError:
+            # signal handlers can be set only in the main thread
+            logger.warning('SIGTERM handler not installed: the outputs will not be copied back if the job is killed')
+
+    def _restore_handler(self):
+        if self._handler_installed:
+            # None if the previous handler was not installed from python
+            signal.signal(signal.SIGTERM, self._previous_handler or signal.SIG_DFL)
+            self._handler_installed = False
+
+    def __enter__(self):
+        self.setup()
+        self._install_handler()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._restore_handler()
+        try:
+            self.copy_back()
+        finally:
+            self.cleanup()
+
+
+@contextlib.contextmanager
+def scratch_run(workdir, fw_policy):
+    """
+    Context manager yielding the ScratchRun configured in the fw_policy (see ScratchRun.from_fw_policy) after
+    having entered it, or None if abinit should run in the workdir.
+    """
+    scratch = ScratchRun.from_fw_policy(workdir, fw_policy)
+    if scratch is None:
+        yield None
+    else:
+        with scratch:
+            yield scratch
@@ -0,0 +1,191 @@
+# coding: utf-8
+"""
+Staging of the files needed by a task (e.g. WFK, 1WF files produced by its parents) when they should be copied
+rather than symlinked. The cheapest available method is used: reflink, hard link, kernel space copy and finally
+a buffered copy.
+"""
+from __future__ import print_function, division, unicode_literals
+
+import errno
+import hashlib
+import io
+import logging
+import os
+import shutil
+import threading
+from multiprocessing.pool import ThreadPool
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+logger = logging.getLogger(__name__)
+
+
+# ioctl request for the FICLONE operation (linux/fs.h), supported by btrfs, xfs and other copy on write filesystems
+FICLONE = 0x40049409
+
+# Size of the chunks used by the kernel space copies and by the buffered copy
+COPY_CHUNK_SIZE = 64 * 1024 ** 2
+
+# Tolerance on the comparison of the modification times (s), to account for the precision of os.utime
+MTIME_TOLERANCE = 1e-3
+
+
+def _reflink(source, dest):
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "fcntl not available")
+    with io.open(source, 'rb') as fsrc, io.open(dest, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def _hardlink(source, dest):
+    os.link(source, dest)
+
+
+def _copy_file_range(source, dest):
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOTSUP, "copy_file_range not available")
+    with io.open(source, 'rb') as fsrc, io.open(dest, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(COPY_CHUNK_SIZE, size - copied))
+            if n == 0:
+                break
+            copied += n
+    if copied != size:
+        raise OSError(errno.EIO, "copy_file_range copied {} bytes out of {}".format(copied, size))
+
+
+def _sendfile(source, dest):
+    if not hasattr(os, 'sendfile'):
+        raise OSError(errno.ENOTSUP, "sendfile not available")
+    with io.open(source, 'rb') as fsrc, io.open(dest, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        copied = 0
+        while copied < size:
+            n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, min(COPY_CHUNK_SIZE, size - copied))
+            if n == 0:
+                break
+            copied += n
+    if copied != size:
+        raise OSError(errno.EIO, "sendfile copied {} bytes out of {}".format(copied, size))
+
+
+def _buffered_copy(source, dest):
+    with io.open(source, 'rb') as fsrc, io.open(dest, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst, COPY_CHUNK_SIZE)
+
+
+# Staging methods, in the order in which they are tried
+STAGING_METHODS = [('reflink', _reflink),
+                   ('hardlink', _hardlink),
+                   ('copy_file_range', _copy_file_range),
+                   ('sendfile', _sendfile),
+                   ('copy', _buffered_copy)]
+
+
+def get_checksum(filepath):
+    md5 = hashlib.md5()
+    with io.open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def is_staged(source, dest, checksum=False):
+    """
+    True if dest is a regular file with the same size and modification time of source and, if checksum is True,
+    with the same content.
+    """
+    if os.path.islink(dest) or not os.path.isfile(dest):
+        return False
+    source_stat, dest_stat = os.stat(source), os.stat(dest)
+    if (source_stat.st_dev, source_stat.st_ino) == (dest_stat.st_dev, dest_stat.st_ino):
+        return True
+    if source_stat.st_size != dest_stat.st_size or abs(source_stat.st_mtime - dest_stat.st_mtime) > MTIME_TOLERANCE:
+        return False
+    return not checksum or get_checksum(source) == get_checksum(dest)
+
+
+def stage_file(source, dest, methods=None, checksum=False):
+    """
+    Copies source to dest with the first of the methods that succeeds, unless dest already matches source (see
+    is_staged). The file is staged with a temporary name and then renamed, so that dest is never a partial copy.
+    The modification time of the source is preserved.
+
+    Args:
+        source: path of the file to be staged.
+        dest: destination path.
+        methods: list of the names of the methods that can be used, among those in STAGING_METHODS. The order of
+            STAGING_METHODS is always followed. If None all the methods are allowed.
+        checksum: if True the content of an existing dest is compared with the source before skipping it.
+
+    Returns:
+        The name of the method used or "skipped" if dest already matched the source.
+    """
+    # links are not followed by os.link
+    source = os.path.realpath(source)
+    if is_staged(source, dest, checksum=checksum):
+        logger.info("{} already staged as {}".format(source, dest))
+        return "skipped"
+
+    # unique for each process and thread staging to the same dest
+    tmp_dest = "{}.staging.{}.{}".format(dest, os.getpid(), threading.current_thread().ident)
+    for name, method in STAGING_METHODS:
+        if methods is not None and name not in methods:
+            continue
+        if os.path.lexists(tmp_dest):
+            os.remove(tmp_dest)
+        try:
+            method(source, tmp_dest)
+        except (IOError, OSError) as exc:
+            logger.debug("Staging of {} with {} failed: {}".format(source, name, exc))
+            continue
+        try:
+            if not os.path.samefile(source, tmp_dest):
+                stat = os.stat(source)
+                os.utime(tmp_dest, (stat.st_atime, stat.st_mtime))
+            if os.path.islink(dest):
+                os.remove(dest)
+            os.rename(tmp_dest, dest)
+        except BaseException:
+            if os.path.lexists(tmp_dest):
+                os.remove(tmp_dest)
+            raise
+        logger.info("Staged {} --> {} with {}".format(source, dest, name))
+        return name
+
+    if os.path.lexists(tmp_dest):
+        os.remove(tmp_dest)
+    raise IOError("Could not stage {} to {} with the methods {}".format(source, dest, methods))
+
+
+def stage_files(files, methods=None, checksum=False, max_workers=4):
+    """
+    Stages concurrently a list of independent files with stage_file.
+
+    Args:
+        files: list of (source, dest) tuples.
+        methods: the methods allowed, see stage_file.
+        checksum: see stage_file.
+        max_workers: maximum number of files staged at the same time.
+
+    Returns:
+        The list of the methods used for each file.
+    """
+    files = list(files)
+    if not files:
+        return []
+    if max_workers <= 1 or len(files) == 1:
+        return [stage_file(source, dest, methods=methods, checksum=checksum) for source, dest in files]
+
+    pool = ThreadPool(processes=min(max_workers, len(files)))
+    try:
+        return pool.map(lambda f: stage_file(f[0], f[1], methods=methods, checksum=checksum), files, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
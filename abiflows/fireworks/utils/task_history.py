@@ -4,11 +4,136 @@ Task history related objects
 """
 from __future__ import print_function, division, unicode_literals
 
-from monty.json import MontyDecoder, jsanitize, MSONable
+from monty.json import MontyDecoder, MontyEncoder, jsanitize, MSONable
+from monty.serialization import loadfn
 from pymatgen.serializers.json_coders import pmg_serialize
+from abiflows.fireworks.tasks.abinit_common import HISTORY_JSON, HISTORY_JSONL
 import collections
+import copy
+import heapq
+import io
+import json
+import logging
+import os
 import traceback
 
+logger = logging.getLogger(__name__)
+
+
+# Size of the blocks read from the end of a JSON lines history by read_last_events
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Classes of the serialized inputs stored as differences with respect to the previous input in the history
+DELTA_INPUT_CLASSES = ('AbinitInput', 'AnaddbInput')
+
+# Key identifying a serialized input stored as a delta
+INPUT_DELTA_KEY = '@input_delta'
+
+
+def _same_value(a, b):
+    return type(a) is type(b) and a == b
+
+
+def get_delta(ref, new, path=()):
+    """
+    Differences between two JSON-like objects (dicts, lists and scalars) as a list of operations transforming ref
+    into new: ["set", path, value] and ["del", path], where path is the list of the keys and indices
+    leading to the modified value. Dicts and lists of the same length are compared item by item.
+    """
+    if isinstance(ref, dict) and isinstance(new, dict):
+        ops = [['del', list(path) + [k]] for k in sorted(ref) if k not in new]
+        for k in sorted(new):
+            if k not in ref:
+                ops.append(['set', list(path) + [k], new[k]])
+            else:
+                ops.extend(get_delta(ref[k], new[k], path + (k,)))
+        return ops
+    if isinstance(ref, list) and isinstance(new, list) and len(ref) == len(new):
+        ops = []
+        for i, (r, n) in enumerate(zip(ref, new)):
+            ops.extend(get_delta(r, n, path + (i,)))
+        return ops
+    if not isinstance(ref, (dict, list)) and _same_value(ref, new):
+        return []
+    return [['set', list(path), new]]
+
+
+def apply_delta(ref, ops):
+    """
+    Applies the operations obtained from get_delta to a copy of ref.
+    """
+    new = copy.deepcopy(ref)
+    for op in ops:
+        path = op[1]
+        if not path:
+            if op[0] == 'del':
+                raise ValueError("The root of the object cannot be deleted")
+            new = copy.deepcopy(op[2])
+            continue
+        container = new
+        for k in path[:-1]:
+            container = container[k]
+        if op[0] == 'set':
+            container[path[-1]] = copy.deepcopy(op[2])
+        elif op[0] == 'del':
+            del container[path[-1]]
+        else:
+            raise ValueError("Unknown delta operation {}".format(op[0]))
+    return new
+
+
+def _is_delta_input(d):
+    return isinstance(d, dict) and d.get('@class') in DELTA_INPUT_CLASSES
+
+
+def _walk_inputs(obj, process):
+    """
+    Replaces the serialized inputs in obj with the output of process, exploring the dicts in the order of their
+    sorted keys, so that the order does not depend on the serialization.
+    """
+    if _is_delta_input(obj) or (isinstance(obj, dict) and INPUT_DELTA_KEY in obj):
+        return process(obj)
+    if isinstance(obj, dict):
+        return {k: _walk_inputs(obj[k], process) for k in sorted(obj)}
+    if isinstance(obj, list):
+        return [_walk_inputs(i, process) for i in obj]
+    return obj
+
+
+def encode_input_deltas(items):
+    """
+    Stores the first serialized input found in the items in full and each of the following ones as the delta
+    with respect to the previous one, if smaller.
+    """
+    inputs = []
+
+    def process(d):
+        delta = None
+        if inputs:
+            ops = get_delta(inputs[-1], d)
+            if len(json.dumps(ops, cls=MontyEncoder)) < len(json.dumps(d, cls=MontyEncoder)):
+                delta = {INPUT_DELTA_KEY: ops, 'ref': len(inputs) - 1}
+        inputs.append(d)
+        return delta if delta is not None else d
+
+    return [_walk_inputs(i, process) for i in items]
+
+
+def decode_input_deltas(items):
+    """
+    Rebuilds the serialized inputs encoded by encode_input_deltas.
+    """
+    inputs = []
+
+    def process(d):
+        if INPUT_DELTA_KEY in d:
+            d = apply_delta(inputs[d['ref']], d[INPUT_DELTA_KEY])
+        inputs.append(d)
+        return d
+
+    return [_walk_inputs(i, process) for i in items]
+
+
 class TaskHistory(collections.deque, MSONable):
     """
     History class for tracking the creation and actions performed during a task.
@@ -18,17 +143,228 @@ class TaskHistory(collections.deque, MSONable):
     Possibly, the first item should contain information about the starting point of the task.
     This object will be forwarded during task restarts and resets, in order to keep track of the full history of the
     task.
+    The events are indexed by type. If a log file is attached (see attach_log) each event is also appended to it
+    in the JSON lines format (one event per line) as soon as it is logged.
     """
 
+    def __init__(self, iterable=(), maxlen=None):
+        super(TaskHistory, self).__init__(maxlen=maxlen)
+        self.log_filepath = None
+        self._build_index()
+        self.extend(iterable)
+
+    def __reduce__(self):
+        # copies are not attached to the log file
+        return self.__class__, (list(self), self.maxlen)
+
+    def _build_index(self):
+        # event_type -> list of (position, event)
+        self._index = collections.defaultdict(list)
+        self._count = 0
+        for item in self:
+            self._add_to_index(item)
+
+    def _add_to_index(self, item):
+        event_type = getattr(item, 'event_type', None)
+        if event_type is not None:
+            self._index[event_type].append((self._count, item))
+        self._count += 1
+
+    def append(self, item):
+        # with maxlen the first item is discarded and the positions change
+        full = self.maxlen is not None and len(self) == self.maxlen
+        super(TaskHistory, self).append(item)
+        if full:
+            self._build_index()
+        else:
+            self._add_to_index(item)
+        if self.log_filepath is not None:
+            with io.open(self.log_filepath, 'at') as f:
+                f.write(self._to_json_line(item))
+
+    def extend(self, iterable):
+        for item in iterable:
+            self.append(item)
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def clear(self):
+        super(TaskHistory, self).clear()
+        self._build_index()
+
+    # The history is meant to be append only. The other methods modifying the deque are still supported,
+    # rebuilding the index, but are not reflected in the log file.
+    def appendleft(self, item):
+        super(TaskHistory, self).appendleft(item)
+        self._build_index()
+
+    def extendleft(self, iterable):
+        super(TaskHistory, self).extendleft(iterable)
+        self._build_index()
+
+    def insert(self, i, item):
+        super(TaskHistory, self).insert(i, item)
+        self._build_index()
+
+    def pop(self):
+        item = super(TaskHistory, self).pop()
+        self._build_index()
+        return item
+
+    def popleft(self):
+        item = super(TaskHistory, self).popleft()
+        self._build_index()
+        return item
+
+    def remove(self, value):
+        super(TaskHistory, self).remove(value)
+        self._build_index()
+
+    def rotate(self, n=1):
+        super(TaskHistory, self).rotate(n)
+        self._build_index()
+
+    def __setitem__(self, i, item):
+        super(TaskHistory, self).__setitem__(i, item)
+        self._build_index()
+
+    def __delitem__(self, i):
+        super(TaskHistory, self).__delitem__(i)
+        self._build_index()
+
+    @staticmethod
+    def _to_json_line(item):
+        d = item.as_dict() if hasattr(item, "as_dict") else item
+        # json.dumps never splits the object on several lines without indent
+        return json.dumps(d, cls=MontyEncoder) + '\n'
+
+    def attach_log(self, filepath=HISTORY_JSONL):
+        """
+        Attaches a JSON lines log file to the history: the file is (re)written with the current events and each
+        event logged afterwards is appended to it.
+        The file is written to a temporary file and then renamed, so that the history is never lost.
+        """
+        filepath = os.path.abspath(filepath)
+        tmp_filepath = filepath + '.tmp'
+        with io.open(tmp_filepath, 'wt') as f:
+            for item in self:
+                f.write(self._to_json_line(item))
+        os.rename(tmp_filepath, filepath)
+        self.log_filepath = filepath
+
+    def detach_log(self):
+        self.log_filepath = None
+
+    @staticmethod
+    def _parse_lines(lines, filepath, last_may_be_truncated=True):
+        """
+        Decodes the lines (bytes) of a JSON lines history. An invalid last line, left by a crash while writing it,
+        is skipped.
+        """
+        dec = MontyDecoder()
+        items = []
+        lines = [l for l in lines if l.strip()]
+        for i, line in enumerate(lines):
+            try:
+                d = json.loads(line.decode('utf-8'))
+            except ValueError:
+                if i == len(lines) - 1 and last_may_be_truncated:
+                    logger.warning("Skipping the truncated last line of the history {}".format(filepath))
+                    break
+                raise ValueError("Invalid line {} in the history {}".format(i + 1, filepath))
+            items.append(dec.process_decoded(d))
+        return items
+
+    @classmethod
+    def from_jsonl(cls, filepath):
+        """
+        Reads the whole history from a JSON lines file.
+        """
+        with io.open(filepath, 'rb') as f:
+            return cls(cls._parse_lines(f.read().split(b'\n'), filepath))
+
+    @classmethod
+    def read_last_events(cls, filepath, n):
+        """
+        Reads the last n events of a JSON lines history, reading the file backwards from its end.
+        """
+        if n <= 0:
+            return []
+        with io.open(filepath, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            pos = f.tell()
+            data = b''
+            # one more line than needed to account for a truncated last line
+            while pos > 0 and len([l for l in data.split(b'\n')[1:] if l.strip()]) <= n:
+                block_size = min(TAIL_BLOCK_SIZE, pos)
+                pos -= block_size
+                f.seek(pos)
+                data = f.read(block_size) + data
+        lines = data.split(b'\n')
+        if pos > 0:
+            # the first line is incomplete
+            lines = lines[1:]
+        lines = [l for l in lines if l.strip()][-(n + 1):]
+        return cls._parse_lines(lines, filepath)[-n:]
+
+    @classmethod
+    def read_events_by_types(cls, filepath, types):
+        """
+        Reads the events of the selected types from a JSON lines history. types can be a single type or a list.
+        Only the lines containing the event types are decoded.
+        """
+        types = types if isinstance(types, (list, tuple)) else [types]
+        keys = [('"event_type": ' + json.dumps(t)).encode('utf-8') for t in types]
+        with io.open(filepath, 'rb') as f:
+            lines = f.read().split(b'\n')
+        # a line matching none of the types might still be a truncated last line
+        last_line = lines[-1] if lines[-1].strip() else (lines[-2] if len(lines) > 1 else b'')
+        selected = [l for l in lines if any(k in l for k in keys)]
+        truncated = bool(selected) and selected[-1] is last_line
+        events = cls._parse_lines(selected, filepath, last_may_be_truncated=truncated)
+        return [e for e in events if getattr(e, 'event_type', None) in types]
+
+    @classmethod
+    def from_file(cls, filepath, types=None):
+        """
+        Reads a history from a JSON lines file or from a JSON file with the serialized TaskHistory, depending on
+        the extension. If types is not None only the events of the selected types are read.
+        """
+        if filepath.endswith('.jsonl'):
+            if types is not None:
+                return cls(cls.read_events_by_types(filepath, types))
+            return cls.from_jsonl(filepath)
+
+        history = loadfn(filepath)
+        if not isinstance(history, TaskHistory):
+            history = cls.from_dict(history)
+        if types is not None:
+            history = cls(history.get_events_by_types(types))
+        return history
+
+    @classmethod
+    def from_launch_dir(cls, launch_dir, types=None):
+        """
+        Reads the history of the task executed in launch_dir. The JSON lines history is preferred, the
+        history.json files written by older versions are still supported.
+        """
+        jsonl_filepath = os.path.join(launch_dir, HISTORY_JSONL)
+        if os.path.isfile(jsonl_filepath):
+            return cls.from_file(jsonl_filepath, types=types)
+        return cls.from_file(os.path.join(launch_dir, HISTORY_JSON), types=types)
+
     @pmg_serialize
     def as_dict(self):
         items = [i.as_dict() if hasattr(i, "as_dict") else i for i in self]
-        return dict(items=items)
+        # the inputs change little between the events and the restarts: only the differences are stored
+        return dict(items=encode_input_deltas(items))
 
     @classmethod
     def from_dict(cls, d):
         dec = MontyDecoder()
-        return cls([dec.process_decoded(i) for i in d['items']])
+        return cls([dec.process_decoded(i) for i in decode_input_deltas(d['items'])])
 
     def log_initialization(self, task, initialization_info=None):
         details = {'task_class': task.__class__.__name__}
@@ -78,6 +414,19 @@ class TaskHistory(collections.deque, MSONable):
     def log_abinit_stop(self, run_time=None):
         self.append(TaskEvent(TaskEvent.ABINIT_STOP, details={'run_time': run_time}))
 
+    def log_checkpoint(self, checkpoint_info):
+        self.append(TaskEvent(TaskEvent.CHECKPOINT, details=checkpoint_info))
+
+    def get_last_checkpoint(self):
+        """
+        The details of the checkpoint event of the last run of abinit, None if the last run was not stopped before
+        the walltime. The checkpoint event is logged after the abinit stop event of the same run.
+        """
+        events = self.get_events_by_types([TaskEvent.ABINIT_STOP, TaskEvent.CHECKPOINT])
+        if not events or events[-1].event_type != TaskEvent.CHECKPOINT:
+            return None
+        return events[-1].details
+
 
     def get_events_by_types(self, types):
         """
@@ -86,7 +435,7 @@ class TaskHistory(collections.deque, MSONable):
 
         types = types if isinstance(types, (list, tuple)) else [types]
 
-        events = [e for e in self if e.event_type in types]
+        events = [e for p, e in heapq.merge(*[self._index.get(t, []) for t in set(types)])]
 
         return events
 
@@ -116,6 +465,7 @@ class TaskEvent(MSONable):
     UNCONVERGED_PARAMS = 'unconverged parameters'
     ERROR = 'error'
     ABINIT_STOP = 'abinit stop'
+    CHECKPOINT = 'checkpoint'
 
     def __init__(self, event_type, details=None):
         self.event_type = event_type
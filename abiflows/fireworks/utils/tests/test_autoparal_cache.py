@@ -0,0 +1,162 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+from abipy.core.testing import AbipyTest
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.autoparal_cache import AutoparalCache, get_autoparal_key
+
+
+FAKE_AUTOPARAL = """from __future__ import print_function
+import json
+import sys
+
+# Count the invocations
+with open(sys.argv[1], 'a') as f:
+    f.write('autoparal\\n')
+nband = int(sys.argv[2])
+confs = [{'tot_ncpus': n, 'mpi_ncpus': n, 'omp_ncpus': 1, 'mem_per_cpu': 1000.0 / n, 'efficiency': 1.0 - 0.01 * n,
+          'vars': {'npband': n, 'nband': nband}} for n in [1, 2, 4, 8] if nband % n == 0]
+print(json.dumps({'info': {'autoparal': 1}, 'confs': confs}))
+"""
+
+
+class FakePolicy(object):
+
+    def __init__(self, autoparal=1, mode='default'):
+        self.autoparal = autoparal
+        self.mode = mode
+
+
+class FakeManager(object):
+
+    def __init__(self, max_cores=8):
+        self.max_cores = max_cores
+        self.policy = FakePolicy()
+
+
+class FakePseudo(object):
+
+    def __init__(self, filepath, md5):
+        self.filepath = filepath
+        self.md5 = md5
+
+
+class FakeAbinitInput(object):
+    """
+    Minimal AbinitInput whose autoparal runs a fake executable counting its invocations.
+    """
+
+    def __init__(self, script_filepath, counter_filepath, **abivars):
+        self.script_filepath = script_filepath
+        self.counter_filepath = counter_filepath
+        self.structure = Structure(Lattice.cubic(5.43), ['Si', 'Si'], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        self.pseudos = [FakePseudo('/path/to/Si.psp8', 'b5b4d5ffa0e8ca2b0d9a4cc48bd7d4ab')]
+        self.vars = dict(ecut=10, ngkpt=[4, 4, 4], nband=8, nsppol=1)
+        self.vars.update(abivars)
+
+    def __contains__(self, key):
+        return key in self.vars
+
+    def __getitem__(self, key):
+        return self.vars[key]
+
+    def abiget_autoparal_pconfs(self, max_ncpus, workdir=None, manager=None):
+        output = subprocess.check_output([sys.executable, self.script_filepath, self.counter_filepath,
+                                          str(self.vars['nband'])])
+        d = json.loads(output.decode('utf-8'))
+        return ParalHints(d['info'], [conf for conf in d['confs'] if conf['tot_ncpus'] <= max_ncpus])
+
+
+class TestAutoparalCache(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'autoparal_cache')
+        self.script_filepath = os.path.join(self.tmp_dir, 'fake_autoparal.py')
+        self.counter_filepath = os.path.join(self.tmp_dir, 'invocations')
+        with io.open(self.script_filepath, 'w') as f:
+            f.write(FAKE_AUTOPARAL)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    @property
+    def ninvocations(self):
+        if not os.path.exists(self.counter_filepath):
+            return 0
+        with io.open(self.counter_filepath, 'r') as f:
+            return len(f.readlines())
+
+    def get_input(self, **abivars):
+        return FakeAbinitInput(self.script_filepath, self.counter_filepath, **abivars)
+
+    def test_repeated_setups(self):
+        manager = FakeManager()
+        # Several setups (e.g. restarts) of the same calculation, with a new cache object as in each setup task
+        pconfs_list = [AutoparalCache(self.cache_dir).get_pconfs(self.get_input(), manager, self.tmp_dir)
+                       for i in range(3)]
+        self.assertEqual(self.ninvocations, 1)
+        for pconfs in pconfs_list:
+            self.assertEqual(pconfs.as_dict(), pconfs_list[0].as_dict())
+        self.assertEqual(len(pconfs_list[0]), 4)
+
+        # Variables not affecting the parallelization do not change the key
+        AutoparalCache(self.cache_dir).get_pconfs(self.get_input(tolvrs=1e-10), manager, self.tmp_dir)
+        self.assertEqual(self.ninvocations, 1)
+
+        # Different parallelization variables, structure, or policy
+        AutoparalCache(self.cache_dir).get_pconfs(self.get_input(nband=12), manager, self.tmp_dir)
+        self.assertEqual(self.ninvocations, 2)
+        abiinput = self.get_input()
+        abiinput.structure.perturb(0.01)
+        AutoparalCache(self.cache_dir).get_pconfs(abiinput, manager, self.tmp_dir)
+        self.assertEqual(self.ninvocations, 3)
+        AutoparalCache(self.cache_dir).get_pconfs(self.get_input(), FakeManager(max_cores=4), self.tmp_dir)
+        self.assertEqual(self.ninvocations, 4)
+        self.assertNotEqual(get_autoparal_key(self.get_input(), manager),
+                            get_autoparal_key(self.get_input(), FakeManager(max_cores=4)))
+
+    def test_concurrent_access(self):
+        manager = FakeManager()
+        results = []
+
+        def setup():
+            results.append(AutoparalCache(self.cache_dir).get_pconfs(self.get_input(), manager, self.tmp_dir))
+
+        threads = [threading.Thread(target=setup) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 8)
+        self.assertEqual(self.ninvocations, 1)
+
+    def test_eviction_and_corrupted_entries(self):
+        manager = FakeManager()
+        cache = AutoparalCache(self.cache_dir, maxsize=2)
+        for nband in [8, 12, 16]:
+            cache.get_pconfs(self.get_input(nband=nband), manager, self.tmp_dir)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.nmisses, 3)
+        # The least recently used entry has been removed
+        self.assertIsNone(cache.get(self.get_input(nband=8), manager))
+        self.assertIsNotNone(cache.get(self.get_input(nband=16), manager))
+
+        # A corrupted entry is ignored and recomputed
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.json'):
+                with io.open(os.path.join(self.cache_dir, filename), 'w') as f:
+                    f.write('{"key": ')
+        cache.get_pconfs(self.get_input(nband=16), manager, self.tmp_dir)
+        self.assertEqual(cache.nmisses, 4)
@@ -0,0 +1,124 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import math
+import random
+import shutil
+import tempfile
+
+import numpy as np
+
+from abipy.core.testing import AbipyTest
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.autoparal_calibration import AutoparalCalibration, CALIBRATION_LEVELS, get_work, \
+    get_features
+from abiflows.fireworks.utils.paral_planner import plan_paral_confs
+from abiflows.fireworks.utils.task_history import TaskHistory
+
+
+SIZES = [dict(nkpt=2, nsppol=1, nspinor=1, nspden=1, nband=16, ngfft=[24, 24, 24]),
+         dict(nkpt=10, nsppol=2, nspinor=1, nspden=2, nband=24, ngfft=[30, 30, 40]),
+         dict(nkpt=6, nsppol=1, nspinor=1, nspden=1, nband=48, ngfft=[36, 36, 36])]
+
+# Correction coefficients of the synthetic machine: the band parallelization is more efficient than predicted
+TRUE_COEFFICIENTS = {'npkpt': 0., 'npband': -0.1, 'npfft': 0.35, 'bandpp': 0., 'omp_ncpus': 0.}
+
+
+def true_wall_time(sizes, conf):
+    correction = math.exp(-np.dot([TRUE_COEFFICIENTS[level] for level in CALIBRATION_LEVELS], get_features(conf)))
+    efficiency = conf.get('predicted_efficiency', conf['efficiency'])
+    return 1e-7 * get_work(sizes) / (conf['tot_ncpus'] * efficiency * correction)
+
+
+def get_pconfs(sizes):
+    return ParalHints({}, plan_paral_confs(sizes, 40, cost_model={'max_nconfs': 10000}))
+
+
+def conf_key(conf):
+    return conf['tot_ncpus'], conf['vars']['npkpt'], conf['vars']['npband'], conf['vars']['npfft']
+
+
+class TestAutoparalCalibration(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_store(self):
+        calibration = AutoparalCalibration(self.tmp_dir, machine='cluster')
+        self.assertEqual(calibration.get_records(), [])
+        self.assertEqual(calibration.fit(), {level: 0. for level in CALIBRATION_LEVELS})
+
+        conf = {'tot_ncpus': 4, 'mpi_ncpus': 4, 'omp_ncpus': 1, 'efficiency': 0.9,
+                'vars': {'npkpt': 2, 'npband': 2, 'npfft': 1, 'bandpp': 1}}
+        calibration.add_record(SIZES[0], conf, 100.)
+        with self.assertRaises(ValueError):
+            calibration.add_record(SIZES[0], conf, 0)
+
+        # Records from the history: only the runs after the last autoparal are considered
+        history = TaskHistory()
+        history.log_autoparal(dict(conf, tot_ncpus=2, mpi_ncpus=2))
+        history.log_abinit_stop(run_time=50.)
+        history.log_autoparal(conf)
+        history.log_abinit_stop(run_time=20.)
+        history.log_abinit_stop(run_time=30.)
+        self.assertTrue(calibration.add_history_record(history, SIZES[0]))
+        self.assertFalse(calibration.add_history_record(TaskHistory(), SIZES[0]))
+
+        # A partially written record is ignored
+        with io.open(calibration.filepath, 'ab') as f:
+            f.write(b'{"sizes": ')
+        records = AutoparalCalibration(self.tmp_dir, machine='cluster').get_records()
+        self.assertEqual(len(records), 2)
+        self.assertEqual([r['wall_time'] for r in records], [100., 50.])
+        self.assertEqual(records[1]['conf']['tot_ncpus'], 4)
+        self.assertEqual(records[1]['predicted_efficiency'], 0.9)
+        self.assertEqual(AutoparalCalibration(self.tmp_dir, machine='other').get_records(), [])
+
+    def test_calibrate(self):
+        calibration = AutoparalCalibration(self.tmp_dir, machine='cluster')
+        pconfs = get_pconfs(SIZES[1])
+        calibrated = calibration.calibrate(pconfs, coefficients=dict(TRUE_COEFFICIENTS, npfft=10.))
+        confs = list(calibrated)
+        self.assertEqual(len(confs), len(pconfs))
+        self.assertTrue(all(conf['vars']['npfft'] == 1 for conf in confs[:5]))
+        speedups = [conf['efficiency'] * conf['tot_ncpus'] for conf in confs]
+        self.assertEqual(speedups, sorted(speedups, reverse=True))
+        # The original efficiency is kept and used for the records
+        for conf in confs:
+            if conf['vars']['npfft'] == 1 and conf['vars']['npband'] == 1:
+                self.assertAlmostEqual(conf['efficiency'], conf['predicted_efficiency'])
+        recalibrated = calibration.calibrate(calibrated, coefficients={level: 0. for level in CALIBRATION_LEVELS})
+        self.assertEqual(sorted(c['efficiency'] for c in recalibrated), sorted(c['efficiency'] for c in pconfs))
+
+    def test_convergence(self):
+        """
+        Runs on a synthetic machine with a different efficiency of the parallelization levels: the configurations
+        chosen with the calibration converge to the fastest ones.
+        """
+        calibration = AutoparalCalibration(self.tmp_dir, machine='cluster')
+        rng = random.Random(0)
+
+        def best(pconfs, key):
+            return conf_key(sorted(pconfs, key=key)[0])
+
+        def fastest(sizes):
+            return best(get_pconfs(sizes), key=lambda c: true_wall_time(sizes, c))
+
+        def chosen(sizes):
+            return best(calibration.calibrate(get_pconfs(sizes)), key=lambda c: -c['efficiency'] * c['tot_ncpus'])
+
+        self.assertNotEqual([chosen(sizes) for sizes in SIZES], [fastest(sizes) for sizes in SIZES])
+
+        for irun in range(30):
+            sizes = SIZES[irun % len(SIZES)]
+            pconfs = calibration.calibrate(get_pconfs(sizes))
+            conf = sorted(pconfs, key=lambda c: -c['efficiency'] * c['tot_ncpus'])[0]
+            # measured time with some noise
+            calibration.add_record(sizes, conf, true_wall_time(sizes, conf) * math.exp(rng.gauss(0, 0.03)))
+
+        self.assertEqual([chosen(sizes) for sizes in SIZES], [fastest(sizes) for sizes in SIZES])
+        self.assertEqual(len(calibration.get_records()), 30)
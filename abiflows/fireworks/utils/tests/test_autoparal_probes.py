@@ -0,0 +1,181 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import collections
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from abipy.core.testing import AbipyTest
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+from pymatgen.io.abinit.tasks import ParalHints
+from abiflows.fireworks.utils.autoparal_probes import run_autoparal_probes
+
+
+FAKE_AUTOPARAL = """from __future__ import print_function
+import json
+import os
+import sys
+import time
+
+log_filepath, nband, sleep = sys.argv[1], int(sys.argv[2]), float(sys.argv[3])
+with open(log_filepath, 'a') as f:
+    f.write('start {} {} {}\\n'.format(nband, time.time(), os.getpid()))
+time.sleep(sleep)
+if nband < 0:
+    sys.exit(1)
+with open(log_filepath, 'a') as f:
+    f.write('end {} {} {}\\n'.format(nband, time.time(), os.getpid()))
+confs = [{'tot_ncpus': n, 'mpi_ncpus': n, 'omp_ncpus': 1, 'mem_per_cpu': 1000.0 / n, 'efficiency': 1.0 - 0.01 * n,
+          'vars': {'npband': n}} for n in [1, 2, 4, 8] if nband % n == 0]
+print(json.dumps({'info': {'autoparal': 1}, 'confs': confs}))
+"""
+
+FWPolicy = collections.namedtuple('FWPolicy', ['autoparal_planner', 'autoparal_cache_dir', 'autoparal_cache_maxsize',
+                                               'autoparal_calibration_dir', 'autoparal_calibration_machine'])
+
+
+class FakePolicy(object):
+
+    def __init__(self, autoparal=1, mode='default'):
+        self.autoparal = autoparal
+        self.mode = mode
+
+
+class FakeManager(object):
+
+    def __init__(self, max_cores=8):
+        self.max_cores = max_cores
+        self.policy = FakePolicy()
+
+
+class FakePseudo(object):
+
+    def __init__(self, filepath, md5):
+        self.filepath = filepath
+        self.md5 = md5
+
+
+class FakeAbinitInput(object):
+    """
+    Minimal AbinitInput whose autoparal runs a fake executable sleeping for the given time. A negative nband makes
+    the executable fail.
+    """
+
+    def __init__(self, script_filepath, log_filepath, nband, sleep):
+        self.script_filepath = script_filepath
+        self.log_filepath = log_filepath
+        self.sleep = sleep
+        self.structure = Structure(Lattice.cubic(5.43), ['Si', 'Si'], [[0, 0, 0], [0.25, 0.25, 0.25]])
+        self.pseudos = [FakePseudo('/path/to/Si.psp8', 'b5b4d5ffa0e8ca2b0d9a4cc48bd7d4ab')]
+        self.vars = dict(ecut=10, ngkpt=[4, 4, 4], nband=nband)
+
+    def __contains__(self, key):
+        return key in self.vars
+
+    def __getitem__(self, key):
+        return self.vars[key]
+
+    def abiget_autoparal_pconfs(self, max_ncpus, workdir=None, manager=None):
+        output = subprocess.check_output([sys.executable, self.script_filepath, self.log_filepath,
+                                          str(self.vars['nband']), str(self.sleep)])
+        d = json.loads(output.decode('utf-8'))
+        return ParalHints(d['info'], [conf for conf in d['confs'] if conf['tot_ncpus'] <= max_ncpus])
+
+
+def is_running(pid):
+    """
+    True if the process exists and is not a zombie waiting to be reaped.
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    try:
+        with io.open('/proc/{}/stat'.format(pid), 'r') as f:
+            return f.read().rsplit(')', 1)[-1].split()[0] != 'Z'
+    except IOError:
+        return True
+
+
+class TestAutoparalProbes(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.script_filepath = os.path.join(self.tmp_dir, 'fake_autoparal.py')
+        self.log_filepath = os.path.join(self.tmp_dir, 'probes.log')
+        with io.open(self.script_filepath, 'w') as f:
+            f.write(FAKE_AUTOPARAL)
+        self.fw_policy = FWPolicy(autoparal_planner=False, autoparal_cache_dir=None, autoparal_cache_maxsize=1000,
+                                  autoparal_calibration_dir=None, autoparal_calibration_machine=None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_log(self):
+        events = []
+        with io.open(self.log_filepath, 'r') as f:
+            for line in f:
+                kind, nband, t, pid = line.split()
+                events.append((float(t), kind, int(nband), int(pid)))
+        return sorted(events)
+
+    def run_probes(self, inputs, **kwargs):
+        workdirs = [os.path.join(self.tmp_dir, 'autoparal_{}'.format(i)) for i in range(len(inputs))]
+        return run_autoparal_probes(inputs, FakeManager(), self.fw_policy, workdirs, **kwargs)
+
+    def test_concurrency(self):
+        inputs = [FakeAbinitInput(self.script_filepath, self.log_filepath, nband, 0.5) for nband in [4, 6, 8, 10]]
+        # an identical input is not probed again
+        inputs.append(FakeAbinitInput(self.script_filepath, self.log_filepath, 8, 0.5))
+        start = time.time()
+        pconfs_list = self.run_probes(inputs, max_workers=2)
+        elapsed = time.time() - start
+
+        self.assertEqual(len(pconfs_list), 5)
+        for inp, pconfs in zip(inputs, pconfs_list):
+            self.assertEqual([conf['vars']['npband'] for conf in pconfs],
+                             [n for n in [1, 2, 4, 8] if inp['nband'] % n == 0])
+        self.assertEqual(pconfs_list[4].as_dict(), pconfs_list[2].as_dict())
+
+        events = self.read_log()
+        self.assertEqual(len([e for e in events if e[1] == 'start']), 4)
+        nrunning, max_running = 0, 0
+        for event in events:
+            nrunning += 1 if event[1] == 'start' else -1
+            max_running = max(max_running, nrunning)
+        self.assertEqual(max_running, 2)
+        # two rounds of two concurrent probes, faster than four sequential probes
+        self.assertLess(elapsed, 1.9)
+
+    def test_failures_and_timeouts(self):
+        inputs = [FakeAbinitInput(self.script_filepath, self.log_filepath, 4, 0.2),
+                  FakeAbinitInput(self.script_filepath, self.log_filepath, -1, 0.2),
+                  FakeAbinitInput(self.script_filepath, self.log_filepath, 8, 60),
+                  FakeAbinitInput(self.script_filepath, self.log_filepath, 6, 0.2)]
+        start = time.time()
+        pconfs_list = self.run_probes(inputs, max_workers=4, timeout=2)
+        elapsed = time.time() - start
+
+        self.assertIsNotNone(pconfs_list[0])
+        self.assertIsNone(pconfs_list[1])
+        self.assertIsNone(pconfs_list[2])
+        self.assertIsNotNone(pconfs_list[3])
+        self.assertLess(elapsed, 10)
+
+        # the fake executable of the probe that timed out has been killed
+        pid = [e[3] for e in self.read_log() if e[1] == 'start' and e[2] == 8][0]
+        for i in range(20):
+            if not is_running(pid):
+                break
+            time.sleep(0.1)
+        self.assertFalse(is_running(pid))
+
+        with self.assertRaises(ValueError):
+            run_autoparal_probes(inputs, FakeManager(), self.fw_policy, [self.tmp_dir])
@@ -0,0 +1,192 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import collections
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.utils.checkpoint import CheckpointSupervisor, ABINIT_EXIT_FILE
+from abiflows.fireworks.utils.scratch import ScratchRun
+from abiflows.fireworks.utils.task_history import TaskHistory, TaskEvent
+
+
+# Fake abinit: runs for the time given as first argument, then writes its outputs. When the abinit.exit file
+# appears in the current directory or SIGUSR1 is received it writes the checkpoint and exits, unless "ignore" is given
+# as second argument.
+FAKE_ABINIT = """from __future__ import print_function
+import io
+import os
+import signal
+import sys
+import time
+
+run_time, mode = float(sys.argv[1]), sys.argv[2]
+outdir = sys.argv[3]
+stop = []
+
+def write(name, content):
+    with io.open(os.path.join(outdir, name), 'wb') as f:
+        f.write(content)
+
+def handler(signum, frame):
+    stop.append(signum)
+
+signal.signal(signal.SIGUSR1, handler if mode != 'ignore' else signal.SIG_IGN)
+start = time.time()
+while time.time() - start < run_time:
+    if stop or (mode != 'ignore' and os.path.exists('abinit.exit')):
+        # partial results written before exiting
+        write('out_WFK', b'checkpoint')
+        write('out_DEN', b'checkpoint')
+        write('out_EIG', b'checkpoint')
+        sys.exit(0)
+    time.sleep(0.02)
+write('out_WFK', b'final')
+"""
+
+FWPolicy = collections.namedtuple('FWPolicy', ['checkpoint_margin', 'checkpoint_method', 'checkpoint_grace_period',
+                                               'checkpoint_exts'])
+
+
+class TestCheckpointSupervisor(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.workdir = os.path.join(self.tmp_dir, 'launch')
+        self.outdir = os.path.join(self.workdir, 'outdata')
+        os.makedirs(self.outdir)
+        self.fake_abinit = os.path.join(self.tmp_dir, 'fake_abinit.py')
+        with io.open(self.fake_abinit, 'wt') as f:
+            f.write(FAKE_ABINIT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def run_supervised(self, supervisor, run_time, mode='trap', outdir=None):
+        """
+        Runs the fake abinit as in the run_abinit of the tasks: the process is waited for in a separate thread.
+        """
+        outdir = outdir or self.outdir
+
+        def run():
+            process = subprocess.Popen([sys.executable, self.fake_abinit, str(run_time), mode, outdir],
+                                       cwd=self.workdir)
+            supervisor.start(process)
+            process.communicate()
+            self.returncode = process.returncode
+            supervisor.stop()
+
+        start = time.time()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive())
+        return time.time() - start
+
+    def read_outdata(self, name):
+        with io.open(os.path.join(self.outdir, name), 'rb') as f:
+            return f.read()
+
+    def test_trigger_file(self):
+        supervisor = CheckpointSupervisor(time.time() + 60.5, 60, self.workdir, self.outdir, grace_period=10)
+        elapsed = self.run_supervised(supervisor, 30)
+        self.assertLess(elapsed, 10)
+
+        self.assertTrue(supervisor.triggered)
+        self.assertTrue(supervisor.exited)
+        self.assertFalse(supervisor.killed)
+        self.assertEqual(self.returncode, 0)
+        # only the files used for the restarts
+        self.assertEqual(supervisor.checkpoint_files, ['out_DEN', 'out_WFK'])
+        self.assertTrue(supervisor.checkpoint_written)
+        self.assertEqual(self.read_outdata('out_WFK'), b'checkpoint')
+        # the trigger file would stop the following runs
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, ABINIT_EXIT_FILE)))
+
+        # recorded in the history
+        history = TaskHistory()
+        history.log_abinit_stop(run_time=elapsed)
+        history.log_checkpoint(supervisor.as_dict())
+        history = TaskHistory.from_dict(history.as_dict())
+        checkpoint = history.get_last_checkpoint()
+        self.assertTrue(checkpoint['checkpoint_written'])
+        self.assertEqual(checkpoint['checkpoint_files'], ['out_DEN', 'out_WFK'])
+        self.assertAlmostEqual(checkpoint['time_left'], 60, delta=2)
+        self.assertEqual(len(history.get_events_by_types(TaskEvent.CHECKPOINT)), 1)
+        self.assertIsNone(TaskHistory().get_last_checkpoint())
+        # the following run was not stopped
+        history.log_abinit_stop(run_time=elapsed)
+        self.assertIsNone(history.get_last_checkpoint())
+
+    def test_signal(self):
+        supervisor = CheckpointSupervisor(time.time() + 10.5, 10, self.workdir, self.outdir, method='SIGUSR1',
+                                          grace_period=10, checkpoint_exts=['WFK'])
+        self.run_supervised(supervisor, 30)
+        self.assertTrue(supervisor.exited)
+        self.assertEqual(supervisor.checkpoint_files, ['out_WFK'])
+        self.assertFalse(os.path.exists(os.path.join(self.workdir, ABINIT_EXIT_FILE)))
+
+        with self.assertRaises(ValueError):
+            CheckpointSupervisor(time.time(), 10, self.workdir, self.outdir, method='SIGWRONG')
+
+    def test_killed(self):
+        supervisor = CheckpointSupervisor(time.time() + 10.2, 10, self.workdir, self.outdir, method='SIGUSR1',
+                                          grace_period=0.5)
+        elapsed = self.run_supervised(supervisor, 30, mode='ignore')
+        self.assertLess(elapsed, 10)
+        self.assertTrue(supervisor.triggered)
+        self.assertFalse(supervisor.exited)
+        self.assertTrue(supervisor.killed)
+        self.assertFalse(supervisor.checkpoint_written)
+        self.assertNotEqual(self.returncode, 0)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+    def test_not_triggered(self):
+        supervisor = CheckpointSupervisor(time.time() + 60, 30, self.workdir, self.outdir)
+        elapsed = self.run_supervised(supervisor, 0.2)
+        self.assertLess(elapsed, 10)
+        self.assertFalse(supervisor.triggered)
+        self.assertFalse(supervisor.exited)
+        self.assertEqual(supervisor.as_dict()['time_left'], None)
+        self.assertEqual(self.read_outdata('out_WFK'), b'final')
+
+    def test_scratch(self):
+        # only the DDB files would be copied back from the scratch
+        scratch_root = os.path.join(self.tmp_dir, 'scratch')
+        os.makedirs(scratch_root)
+        with ScratchRun(self.workdir, scratch_root, copy_back_exts=['DDB']) as scratch:
+            supervisor = CheckpointSupervisor(time.time() + 10.5, 10, self.workdir, scratch.outdir, grace_period=10,
+                                              scratch=scratch)
+            self.run_supervised(supervisor, 30, outdir=scratch.outdir)
+        self.assertTrue(supervisor.checkpoint_written)
+        self.assertEqual(supervisor.checkpoint_files, ['out_DEN', 'out_WFK'])
+        # the checkpoint files are copied back before the scratch directory is removed
+        self.assertEqual(sorted(os.listdir(self.outdir)), ['out_DEN', 'out_WFK'])
+        self.assertEqual(self.read_outdata('out_WFK'), b'checkpoint')
+        self.assertEqual(os.listdir(scratch_root), [])
+
+        # not triggered: the copy back is unchanged
+        with ScratchRun(self.workdir, scratch_root, copy_back_exts=['DDB']) as scratch:
+            supervisor = CheckpointSupervisor(time.time() + 60, 30, self.workdir, scratch.outdir, scratch=scratch)
+            self.run_supervised(supervisor, 0.2, outdir=scratch.outdir)
+            self.assertEqual(scratch.copy_back_exts, ['DDB'])
+        self.assertFalse(supervisor.triggered)
+
+    def test_from_fw_policy(self):
+        policy = FWPolicy(checkpoint_margin=None, checkpoint_method='file', checkpoint_grace_period=120,
+                          checkpoint_exts=None)
+        self.assertIsNone(CheckpointSupervisor.from_fw_policy(policy, time.time(), self.workdir, self.outdir))
+        policy = policy._replace(checkpoint_margin=300)
+        self.assertIsNone(CheckpointSupervisor.from_fw_policy(policy, None, self.workdir, self.outdir))
+        # the margin is larger than the time left
+        self.assertIsNone(CheckpointSupervisor.from_fw_policy(policy, time.time() + 200, self.workdir, self.outdir))
+        supervisor = CheckpointSupervisor.from_fw_policy(policy, time.time() + 600, self.workdir, self.outdir)
+        self.assertEqual(supervisor.margin, 300)
+        self.assertIn('1WF*', supervisor.checkpoint_exts)
@@ -0,0 +1,191 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.utils.ddb_utils import get_ddb_section, patch_ddb_section, DdbIndex
+
+
+HEADER = """ **** DERIVATIVE DATABASE ****
++DDB, Version number    100401
+
+ Version 8.0.8 of ABINIT
+ usepaw   1
+   natom         2
+   ntypat        1
+   acell    1.0260000000000000D+01  1.0260000000000000D+01  1.0260000000000000D+01
+"""
+
+PAW_DESCRIPTION = """ ==============================================================================
+ Description of the PAW dataset(s)
+   - Atom type  1  : {name}
+{lines}"""
+
+NO_POTENTIALS = """ No information on the potentials yet
+"""
+
+DATABASE = """
+ **** Database of total energy derivatives ****
+ Number of data blocks=  {nblocks}
+"""
+
+BLOCK_2ND = """
+ 2nd derivatives (non-stat.)  - # elements :      {nelements}
+ qpt  {q[0]:.8E}  {q[1]:.8E}  {q[2]:.8E}   1.0
+{elements}"""
+
+TOTAL_ENERGY = """
+ Total energy                 - # elements :       1
+   -0.1717591830D+02
+"""
+
+
+def get_paw_description(name, nlines):
+    lines = ''.join('   - line {} of the PAW dataset {}\n'.format(i, name) for i in range(nlines))
+    return PAW_DESCRIPTION.format(name=name, lines=lines)
+
+
+def get_block(qpt, natom=2):
+    perts = [(idir, ipert) for ipert in range(1, natom + 1) for idir in range(1, 4)]
+    elements = ''.join('   {}   {}   {}   {}  {:.10E}  0.0000000000E+00\n'.format(d1, p1, d2, p2, 0.1 * (d1 + p2))
+                       for d1, p1 in perts for d2, p2 in perts)
+    return BLOCK_2ND.format(nelements=len(perts) ** 2, q=qpt, elements=elements)
+
+
+QPTS = [[0, 0, 0], [0.5, 0, 0], [0.25, 0.25, 0], [0.5, 0.5, 0.5]]
+
+
+def old_patch(ddb_files, out_ddb):
+    """
+    In-memory implementation of the fix of the PAW datasets description previously used in MergeDdbAbinitTask.
+    """
+    fname_with_psp = None
+    psp_lines = []
+
+    for fname in ddb_files:
+        in_psp_info = False
+        with open(fname, 'r') as fh:
+            dd = fh.readlines()
+            for iline, line in enumerate(dd):
+                if 'No information on the potentials yet' in line:
+                    break
+                if 'Description of the PAW dataset(s)' in line:
+                    in_psp_info = True
+                    fname_with_psp = fname
+                if in_psp_info:
+                    if '**** Database of total energy derivatives ****' in line:
+                        break
+                    psp_lines.append(line)
+        if fname_with_psp:
+            break
+
+    if not fname_with_psp:
+        raise ValueError('Should have at least one DDB with the psp info ...')
+
+    out_ddb_backup = '{}.backup'.format(out_ddb)
+    shutil.move(out_ddb, out_ddb_backup)
+
+    fw = open(out_ddb, 'w')
+    with open(out_ddb_backup, 'r') as fh:
+        dd = fh.readlines()
+        just_copy = True
+        for line in dd:
+            if 'Description of the PAW dataset(s)' in line:
+                just_copy = False
+                for pspline in psp_lines:
+                    fw.write(pspline)
+            if just_copy:
+                fw.write(line)
+                continue
+            if '**** Database of total energy derivatives ****' in line:
+                just_copy = True
+                fw.write(line)
+                continue
+    fw.close()
+
+
+class TestDdbUtils(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, filename, content):
+        filepath = os.path.join(self.tmp_dir, filename)
+        with io.open(filepath, 'w') as f:
+            f.write(content)
+        return filepath
+
+    def read_bytes(self, filepath):
+        with io.open(filepath, 'rb') as f:
+            return f.read()
+
+    def get_merged_ddb(self, filename='out_DDB', nlines=3):
+        blocks = ''.join(get_block(q) for q in QPTS) + TOTAL_ENERGY
+        return self.write(filename, HEADER + get_paw_description('wrong', nlines) +
+                          DATABASE.format(nblocks=len(QPTS) + 1) + blocks)
+
+    def test_patch(self):
+        gs_ddb = self.write('gs_DDB', HEADER + get_paw_description('Si', 20) + DATABASE.format(nblocks=1) +
+                            TOTAL_ENERGY)
+        strain_ddb = self.write('strain_DDB', HEADER + NO_POTENTIALS + DATABASE.format(nblocks=1) +
+                                get_block(QPTS[0]))
+
+        for ddb_files in [[gs_ddb, strain_ddb], [strain_ddb, gs_ddb]]:
+            for nlines in [0, 3, 50]:
+                ref_ddb = self.get_merged_ddb('ref_DDB', nlines=nlines)
+                old_patch(ddb_files, ref_ddb)
+                out_ddb = self.get_merged_ddb('out_DDB', nlines=nlines)
+
+                psp_lines = None
+                for fname in ddb_files:
+                    psp_lines = get_ddb_section(fname)
+                    if psp_lines is not None:
+                        break
+                patch_ddb_section(out_ddb, psp_lines)
+                self.assertEqual(self.read_bytes(out_ddb), self.read_bytes(ref_ddb))
+
+        self.assertIsNone(get_ddb_section(strain_ddb))
+        # No temporary file left
+        self.assertEqual(sorted(f for f in os.listdir(self.tmp_dir) if f.endswith('.tmp')), [])
+
+    def test_index(self):
+        out_ddb = self.get_merged_ddb()
+        with io.open(out_ddb, 'r') as f:
+            content = f.read()
+        patch_ddb_section(out_ddb, get_paw_description('Si', 5).splitlines(True))
+
+        index = DdbIndex.from_ddb(out_ddb)
+        # The index saved by the patch is up to date
+        self.assertTrue(index.is_up_to_date(out_ddb))
+        self.assertEqual(len(index), len(QPTS) + 1)
+
+        for qpt in QPTS:
+            blocks = index.find(qpt=qpt)
+            self.assertEqual(len(blocks), 1)
+            self.assertEqual(blocks[0]['nelements'], 36)
+            self.assertEqual(DdbIndex.read_block(out_ddb, blocks[0]), get_block(qpt).lstrip('\n'))
+        self.assertEqual(index.find(qpt=[0.5, 0.25, 0]), [])
+        self.assertEqual(len(index.find(perturbation=[3, 2], block_type='2nd derivatives')), len(QPTS))
+        self.assertEqual(index.find(perturbation=[3, 3]), [])
+        energy_block = index.find(block_type='Total energy')[0]
+        self.assertEqual(DdbIndex.read_block(out_ddb, energy_block), TOTAL_ENERGY.lstrip('\n'))
+
+        # The database is unchanged by the patch
+        self.assertEqual(self.read_bytes(out_ddb).split(b'**** Database')[1],
+                         content.encode('utf-8').split(b'**** Database')[1])
+
+        # The index is rebuilt if the file changes
+        with io.open(out_ddb, 'a') as f:
+            f.write(get_block([0.75, 0, 0]))
+        index = DdbIndex.from_ddb(out_ddb)
+        self.assertEqual(len(index), len(QPTS) + 2)
+        self.assertEqual(DdbIndex.read_block(out_ddb, index.find(qpt=[0.75, 0, 0])[0]),
+                         get_block([0.75, 0, 0]).lstrip('\n'))
+        self.assertMSONable(index)
@@ -0,0 +1,151 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+
+import mock
+
+from abipy.core.testing import AbipyTest
+from fireworks.core.firework import Firework
+from fireworks.user_objects.firetasks.script_task import ScriptTask
+from abiflows.fireworks.utils.fw_utils import LayeredSpec, FWTaskManager, get_short_single_core_spec, \
+    clear_fw_task_manager_cache, FTM_CACHE_STATS
+
+
+MANAGER = """
+fw_policy:
+    short_job_timelimit: {timelimit}
+qadapters:
+    - priority: 1
+      queue:
+        qtype: slurm
+        qname: main
+      limits:
+        timelimit: 2:00:00
+        min_cores: 1
+        max_cores: 16
+      hardware:
+        num_nodes: 10
+        sockets_per_node: 1
+        cores_per_socket: 16
+        mem_per_node: 64 Gb
+      job:
+        mpi_runner: mpirun
+"""
+
+
+class TestLayeredSpec(AbipyTest):
+
+    def test_layers(self):
+        base = {'a': 1, 'b': {'c': 2}, 'd': [1, 2]}
+        spec = LayeredSpec(base=base)
+        spec['a'] = 10
+        spec['e'] = 5
+        del spec['d']
+        self.assertEqual(spec['a'], 10)
+        self.assertEqual(spec['e'], 5)
+        self.assertNotIn('d', spec)
+        self.assertRaises(KeyError, spec.__getitem__, 'd')
+        self.assertRaises(KeyError, spec.__delitem__, 'd')
+        self.assertEqual(len(spec), 3)
+        self.assertEqual(spec.to_dict(), {'a': 10, 'b': {'c': 2}, 'e': 5})
+        self.assertEqual(spec.pop('missing', None), None)
+        # the base is never modified and the nested values are shared
+        self.assertEqual(base, {'a': 1, 'b': {'c': 2}, 'd': [1, 2]})
+        self.assertIs(spec['b'], base['b'])
+
+        # copies share the base but not the overlay
+        spec_copy = spec.copy()
+        self.assertIs(spec_copy.base, base)
+        spec_copy['d'] = 3
+        self.assertNotIn('d', spec)
+        self.assertEqual(spec_copy['d'], 3)
+
+        # from_spec deep-copies plain dicts and shares the base of layered specs
+        new_spec = LayeredSpec.from_spec(base)
+        self.assertIsNot(new_spec['b'], base['b'])
+        self.assertEqual(new_spec.to_dict(), base)
+        self.assertIs(LayeredSpec.from_spec(spec).base, base)
+
+    def test_firework_serialization(self):
+        base = {'a': 1, 'b': {'c': 2}}
+        spec = LayeredSpec(base=base)
+        spec['a'] = 2
+        fw = Firework(ScriptTask.from_str('echo test'), spec=spec)
+        fw_dict = fw.to_dict()
+        self.assertEqual(fw_dict['spec']['a'], 2)
+        self.assertEqual(fw_dict['spec']['b'], {'c': 2})
+        self.assertIn('_tasks', fw_dict['spec'])
+        self.assertNotIn('_tasks', base)
+        self.assertEqual(Firework.from_dict(fw_dict).spec['a'], 2)
+
+
+class TestFWTaskManagerCache(AbipyTest):
+
+    def setUp(self):
+        clear_fw_task_manager_cache()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'fw_manager.yaml')
+        self.write_manager(timelimit=600)
+
+    def tearDown(self):
+        clear_fw_task_manager_cache()
+        shutil.rmtree(self.tmp_dir)
+
+    def write_manager(self, timelimit, mtime=None):
+        with io.open(self.filepath, 'w') as f:
+            f.write(MANAGER.format(timelimit=timelimit))
+        if mtime is not None:
+            os.utime(self.filepath, (mtime, mtime))
+
+    def test_cache(self):
+        ftm1 = FWTaskManager.from_file(self.filepath)
+        ftm2 = FWTaskManager.from_file(self.filepath)
+        self.assertEqual(FTM_CACHE_STATS['parsed'], 1)
+        # The callers get independent copies
+        self.assertIsNot(ftm1, ftm2)
+        ftm1.update_fw_policy({'short_job_timelimit': 100})
+        self.assertEqual(ftm2.fw_policy.short_job_timelimit, 600)
+        self.assertIs(FWTaskManager.from_file(self.filepath, cached=True),
+                      FWTaskManager.from_file(self.filepath, cached=True))
+        self.assertTrue(ftm1.has_task_manager())
+
+        with mock.patch.dict(os.environ, {'FW_TASK_MANAGER': self.filepath}):
+            ftm = FWTaskManager.from_user_config()
+            self.assertEqual(ftm.fw_policy.short_job_timelimit, 600)
+            self.assertEqual(FTM_CACHE_STATS['parsed'], 1)
+
+        # A modified file is parsed again
+        self.write_manager(timelimit=300, mtime=os.path.getmtime(self.filepath) + 10)
+        self.assertEqual(FWTaskManager.from_file(self.filepath).fw_policy.short_job_timelimit, 300)
+        self.assertEqual(FTM_CACHE_STATS['parsed'], 2)
+
+        # Explicit invalidation
+        clear_fw_task_manager_cache()
+        FWTaskManager.from_file(self.filepath)
+        self.assertEqual(FTM_CACHE_STATS['parsed'], 1)
+
+    def test_short_single_core_spec(self):
+        with mock.patch.dict(os.environ, {'FW_TASK_MANAGER': self.filepath}):
+            spec = get_short_single_core_spec()
+            ref_spec = get_short_single_core_spec(FWTaskManager.from_file(self.filepath))
+            self.assertEqual(spec, ref_spec)
+            self.assertIs(get_short_single_core_spec(), spec)
+            self.assertEqual(spec['ntasks'], 1)
+            self.assertNotEqual(get_short_single_core_spec(timelimit=1200), spec)
+            self.assertNotEqual(get_short_single_core_spec(master_mem_overhead=1000), spec)
+            self.assertEqual(FTM_CACHE_STATS['parsed'], 1)
+
+            # The qadapter can be modified by the caller
+            spec, qadapter = get_short_single_core_spec(return_qtk=True)
+            qadapter.set_timelimit(timelimit=3600)
+            self.assertEqual(get_short_single_core_spec(return_qtk=True)[1].timelimit, 600)
+            self.assertEqual(get_short_single_core_spec(), ref_spec)
+
+            # The timelimit of the modified fw_policy is used
+            ftm = FWTaskManager.from_file(self.filepath)
+            ftm.update_fw_policy({'short_job_timelimit': 100})
+            self.assertEqual(get_short_single_core_spec(ftm, return_qtk=True)[1].timelimit, 100)
@@ -0,0 +1,90 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import io
+import os
+import shutil
+import tempfile
+
+import mock
+
+from abipy.core.testing import AbipyTest
+from pymatgen.io.abinit.utils import Directory
+from abiflows.fireworks.utils.manifest import ManifestDirectory, write_manifest, read_manifest, get_manifest_filepath
+
+
+class TestManifest(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.tmp_dir, 'outdata')
+        os.makedirs(os.path.join(self.outdir, 'subdir'))
+        for name in ['out_DDB', 'out_1WF4', 'out_1WF7', 'out_TIM1_DEN', 'out_TIM2_DEN', 'out_GSR.nc', 'out_WFK']:
+            self.touch(name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def touch(self, name):
+        with io.open(os.path.join(self.outdir, name), 'wb') as f:
+            f.write(name.encode('utf-8'))
+
+    def get_results(self, directory):
+        return (sorted(directory.list_filepaths()), directory.has_abiext('DDB'), directory.has_abiext('GSR'),
+                directory.find_1wf_files(), directory.find_last_timden_file(),
+                sorted(directory.list_filepaths(wildcard='*WF*')))
+
+    def test_manifest(self):
+        ref_results = self.get_results(Directory(self.outdir))
+
+        # Without a manifest the directory is listed
+        with mock.patch('os.listdir', wraps=os.listdir) as listdir:
+            self.assertEqual(self.get_results(ManifestDirectory(self.outdir)), ref_results)
+            self.assertGreater(listdir.call_count, 0)
+
+        manifest = write_manifest(self.outdir)
+        self.assertTrue(os.path.isfile(get_manifest_filepath(self.outdir)))
+        self.assertEqual(len(manifest['files']), 7)
+        self.assertEqual(read_manifest(self.outdir), manifest)
+        ddb = [f for f in manifest['files'] if f['name'] == 'out_DDB'][0]
+        self.assertEqual(ddb['ext'], 'DDB')
+        self.assertEqual(ddb['size'], len('out_DDB'))
+
+        # With the manifest the directory is never listed
+        with mock.patch('os.listdir', wraps=os.listdir) as listdir:
+            self.assertEqual(self.get_results(ManifestDirectory(self.outdir)), ref_results)
+            self.assertEqual(listdir.call_count, 0)
+
+        # A new file makes the manifest stale
+        self.touch('out_1WF10')
+        stat = os.stat(self.outdir)
+        os.utime(self.outdir, (stat.st_atime, stat.st_mtime + 10))
+        self.assertIsNone(read_manifest(self.outdir))
+        with mock.patch('os.listdir', wraps=os.listdir) as listdir:
+            results = self.get_results(ManifestDirectory(self.outdir))
+            self.assertGreater(listdir.call_count, 0)
+        self.assertEqual(results, self.get_results(Directory(self.outdir)))
+        self.assertIn(os.path.join(self.outdir, 'out_1WF10'), results[0])
+
+    def test_same_second(self):
+        # The manifest is written once the directory is older than the resolution of the modification times
+        manifest = write_manifest(self.outdir)
+        manifest_filepath = get_manifest_filepath(self.outdir)
+        self.assertGreaterEqual(os.stat(manifest_filepath).st_mtime - manifest['dir_mtime'], 1)
+        self.assertEqual(read_manifest(self.outdir), manifest)
+
+        # With a resolution of 1 s, a file created in the same second as the manifest does not change the
+        # modification time of the directory
+        self.touch('out_1WF10')
+        dir_mtime = manifest['dir_mtime']
+        os.utime(self.outdir, (dir_mtime, dir_mtime))
+        os.utime(manifest_filepath, (dir_mtime + 0.5, dir_mtime + 0.5))
+        self.assertIsNone(read_manifest(self.outdir))
+        self.assertIn(os.path.join(self.outdir, 'out_1WF10'), ManifestDirectory(self.outdir).list_filepaths())
+
+    def test_invalid_manifest(self):
+        with io.open(get_manifest_filepath(self.outdir), 'w') as f:
+            f.write('{"files": ')
+        self.assertIsNone(read_manifest(self.outdir))
+        self.assertEqual(sorted(ManifestDirectory(self.outdir).list_filepaths()),
+                         sorted(Directory(self.outdir).list_filepaths()))
@@ -0,0 +1,259 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import collections
+
+import mock
+import yaml
+
+from abipy.core.testing import AbipyTest
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+from abiflows.fireworks.utils.autoparal_cache import get_autoparal_pconfs
+from abiflows.fireworks.utils.paral_planner import plan_paral_confs, plan_paral_hints, get_input_sizes, \
+    estimate_ngfft, estimate_nkpt
+
+
+# Synthetic tables in the YAML format of the autoparal of abinit (paral_kgb 1), with the sizes of the calculations
+# in the info. They were written by hand (abinit is not available to record real outputs) with the ranking of the
+# configurations expected for these sizes: the tests only check that the planner is consistent with such a ranking.
+AUTOPARAL_SI = """
+--- !Autoparal
+info:
+    autoparal: 1
+    max_ncpus: 16
+    nkpt: 2
+    nsppol: 1
+    nspinor: 1
+    mband: 16
+    ngfft: [24, 24, 24]
+configurations:
+    - tot_ncpus: 16
+      mpi_ncpus: 16
+      omp_ncpus: 1
+      mem_per_cpu: 2.5
+      efficiency: 0.800
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 1, npband: 8, bandpp: 1}
+    - tot_ncpus: 16
+      mpi_ncpus: 16
+      omp_ncpus: 1
+      mem_per_cpu: 2.4
+      efficiency: 0.770
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 2, npband: 4, bandpp: 1}
+    - tot_ncpus: 12
+      mpi_ncpus: 12
+      omp_ncpus: 1
+      mem_per_cpu: 2.7
+      efficiency: 0.700
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 3, npband: 2, bandpp: 1}
+    - tot_ncpus: 8
+      mpi_ncpus: 8
+      omp_ncpus: 1
+      mem_per_cpu: 3.1
+      efficiency: 0.890
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 1, npband: 4, bandpp: 1}
+    - tot_ncpus: 8
+      mpi_ncpus: 8
+      omp_ncpus: 1
+      mem_per_cpu: 3.0
+      efficiency: 0.830
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 2, npband: 2, bandpp: 1}
+    - tot_ncpus: 4
+      mpi_ncpus: 4
+      omp_ncpus: 1
+      mem_per_cpu: 4.2
+      efficiency: 0.950
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 1, npband: 2, bandpp: 1}
+    - tot_ncpus: 2
+      mpi_ncpus: 2
+      omp_ncpus: 1
+      mem_per_cpu: 6.5
+      efficiency: 1.000
+      vars: {npimage: 1, npkpt: 2, npspinor: 1, npfft: 1, npband: 1, bandpp: 1}
+...
+"""
+
+AUTOPARAL_FE = """
+--- !Autoparal
+info:
+    autoparal: 1
+    max_ncpus: 40
+    nkpt: 10
+    nsppol: 2
+    nspinor: 1
+    mband: 24
+    ngfft: [30, 30, 40]
+configurations:
+    - tot_ncpus: 40
+      mpi_ncpus: 40
+      omp_ncpus: 1
+      mem_per_cpu: 5.1
+      efficiency: 0.930
+      vars: {npimage: 1, npkpt: 20, npspinor: 1, npfft: 1, npband: 2, bandpp: 1}
+    - tot_ncpus: 40
+      mpi_ncpus: 40
+      omp_ncpus: 1
+      mem_per_cpu: 5.3
+      efficiency: 0.880
+      vars: {npimage: 1, npkpt: 10, npspinor: 1, npfft: 1, npband: 4, bandpp: 1}
+    - tot_ncpus: 40
+      mpi_ncpus: 40
+      omp_ncpus: 1
+      mem_per_cpu: 5.0
+      efficiency: 0.860
+      vars: {npimage: 1, npkpt: 20, npspinor: 1, npfft: 2, npband: 1, bandpp: 1}
+    - tot_ncpus: 40
+      mpi_ncpus: 40
+      omp_ncpus: 1
+      mem_per_cpu: 5.2
+      efficiency: 0.850
+      vars: {npimage: 1, npkpt: 10, npspinor: 1, npfft: 2, npband: 2, bandpp: 1}
+    - tot_ncpus: 30
+      mpi_ncpus: 30
+      omp_ncpus: 1
+      mem_per_cpu: 6.0
+      efficiency: 0.900
+      vars: {npimage: 1, npkpt: 10, npspinor: 1, npfft: 1, npband: 3, bandpp: 1}
+    - tot_ncpus: 20
+      mpi_ncpus: 20
+      omp_ncpus: 1
+      mem_per_cpu: 8.3
+      efficiency: 0.990
+      vars: {npimage: 1, npkpt: 20, npspinor: 1, npfft: 1, npband: 1, bandpp: 1}
+...
+"""
+
+
+def load_autoparal(s):
+    d = yaml.safe_load(s.replace('--- !Autoparal', '---'))
+    info = d['info']
+    sizes = dict(nkpt=info['nkpt'], nsppol=info['nsppol'], nspinor=info['nspinor'], nspden=info['nsppol'],
+                 nband=info['mband'], ngfft=info['ngfft'])
+    return sizes, info['max_ncpus'], d['configurations']
+
+
+def conf_key(conf):
+    v = conf['vars']
+    return conf['tot_ncpus'], v['npkpt'], v['npband'], v['npfft']
+
+
+def top_keys(confs, n):
+    confs = sorted(confs, key=lambda c: -c['efficiency'] * c['tot_ncpus'])
+    return [conf_key(c) for c in confs[:n]]
+
+
+Hardware = collections.namedtuple('Hardware', ['cores_per_node', 'mem_per_core'])
+
+
+class FakeQadapter(object):
+
+    def __init__(self, max_cores, cores_per_node, mem_per_core):
+        self.max_cores = max_cores
+        self.hw = Hardware(cores_per_node, mem_per_core)
+
+
+class FakeManager(object):
+
+    def __init__(self, qads):
+        self.qads = qads
+        self.max_cores = max(qad.max_cores for qad in qads)
+
+
+class FakeAbinitInput(dict):
+
+    def __init__(self, structure, **abivars):
+        super(FakeAbinitInput, self).__init__(**abivars)
+        self.structure = structure
+        self.abiget_autoparal_pconfs = mock.Mock(side_effect=RuntimeError('autoparal of abinit should not run'))
+
+
+class FakePolicy(object):
+
+    def __init__(self, autoparal_planner):
+        self.autoparal_planner = autoparal_planner
+        self.autoparal_cache_dir = None
+        self.autoparal_calibration_dir = None
+
+
+class TestParalPlanner(AbipyTest):
+
+    def setUp(self):
+        self.si = Structure(Lattice.from_parameters(3.84, 3.84, 3.84, 60, 60, 60), ['Si', 'Si'],
+                            [[0, 0, 0], [0.25, 0.25, 0.25]])
+
+    def test_overlap_with_synthetic_autoparal(self):
+        for autoparal in [AUTOPARAL_SI, AUTOPARAL_FE]:
+            sizes, max_ncpus, ref_confs = load_autoparal(autoparal)
+            confs = plan_paral_confs(sizes, max_ncpus)
+            ref_top = top_keys(ref_confs, 3)
+            top = top_keys(confs, 3)
+            self.assertGreaterEqual(len(set(top) & set(ref_top)), 2)
+            self.assertIn(top[0], ref_top)
+            # all the configurations of the synthetic tables are considered valid by the planner
+            all_confs = plan_paral_confs(sizes, max_ncpus, cost_model={'max_nconfs': 10000})
+            self.assertTrue(set(conf_key(c) for c in ref_confs) <= set(conf_key(c) for c in all_confs))
+
+    def test_valid_confs(self):
+        sizes = dict(nkpt=10, nsppol=2, nspinor=1, nspden=2, nband=24, ngfft=[30, 30, 40])
+        confs = plan_paral_confs(sizes, 64, cores_per_node=16, cost_model={'max_omp_threads': 4, 'max_nconfs': 1000})
+        self.assertTrue(any(c['omp_ncpus'] == 4 for c in confs))
+        speedups = [c['efficiency'] * c['tot_ncpus'] for c in confs]
+        self.assertEqual(speedups, sorted(speedups, reverse=True))
+        for c in confs:
+            v = c['vars']
+            self.assertEqual(v['npkpt'] * v['npband'] * v['npfft'], c['mpi_ncpus'])
+            self.assertEqual(c['mpi_ncpus'] * c['omp_ncpus'], c['tot_ncpus'])
+            self.assertLessEqual(c['tot_ncpus'], 64)
+            self.assertEqual(sizes['nband'] % (v['npband'] * v['bandpp']), 0)
+            self.assertEqual(sizes['ngfft'][1] % v['npfft'], 0)
+            self.assertEqual(sizes['ngfft'][2] % v['npfft'], 0)
+            self.assertLessEqual(c['efficiency'], 1)
+
+        # The memory limit excludes the configurations with few processes
+        mem_confs = plan_paral_confs(sizes, 64, max_mem_per_cpu=155, cost_model={'max_nconfs': 1000})
+        self.assertTrue(mem_confs)
+        self.assertTrue(all(c['mem_per_cpu'] <= 155 for c in mem_confs))
+        self.assertLess(len(mem_confs), len(plan_paral_confs(sizes, 64, cost_model={'max_nconfs': 1000})))
+
+        # A higher cost of the FFT parallelization removes npfft from the best configuration
+        best = plan_paral_confs(sizes, 60, cost_model={'fft_overhead': 10})[0]
+        self.assertEqual(best['vars']['npfft'], 1)
+
+        with self.assertRaises(ValueError):
+            plan_paral_confs(sizes, 64, cost_model={'unknown': 1})
+
+    def test_input_sizes(self):
+        ngfft = estimate_ngfft(self.si, ecut=10)
+        self.assertEqual(ngfft, [24, 24, 24])
+        self.assertGreater(estimate_ngfft(self.si, ecut=40)[0], ngfft[0])
+
+        self.assertEqual(estimate_nkpt(self.si, [4, 4, 4], kptopt=3), 64)
+        nkpt = estimate_nkpt(self.si, [4, 4, 4], shiftk=[[0.0, 0.0, 0.0]])
+        self.assertTrue(1 < nkpt < 64)
+
+        abiinput = FakeAbinitInput(self.si, ecut=10, ngkpt=[4, 4, 4], shiftk=[0.0, 0.0, 0.0], nband=8, paral_kgb=1)
+        sizes = get_input_sizes(abiinput)
+        self.assertEqual(sizes, dict(nkpt=nkpt, nsppol=1, nspinor=1, nspden=1, nband=8, ngfft=ngfft))
+        with self.assertRaises(ValueError):
+            get_input_sizes(FakeAbinitInput(self.si, ecut=10, ngkpt=[4, 4, 4], nband=8))
+        with self.assertRaises(ValueError):
+            get_input_sizes(FakeAbinitInput(self.si, ecut=10, ngkpt=[4, 4, 4], nband=8, paral_kgb=1, optdriver=1))
+
+    def test_get_autoparal_pconfs(self):
+        manager = FakeManager([FakeQadapter(8, 8, 2000), FakeQadapter(32, 16, 4000)])
+        abiinput = FakeAbinitInput(self.si, ecut=10, nkpt=2, kpt=[[0, 0, 0], [0.5, 0, 0]], nband=16, paral_kgb=1)
+        pconfs = get_autoparal_pconfs(abiinput, manager, workdir=None, fw_policy=FakePolicy(True))
+        self.assertEqual(abiinput.abiget_autoparal_pconfs.call_count, 0)
+        self.assertEqual(pconfs.info['max_ncpus'], 32)
+        self.assertTrue(all(conf['tot_ncpus'] <= 32 for conf in pconfs))
+        self.assertEqual(pconfs.as_dict()['confs'], plan_paral_hints(abiinput, manager).as_dict()['confs'])
+
+        # The cost model is taken from the policy
+        pconfs = get_autoparal_pconfs(abiinput, manager, workdir=None, fw_policy=FakePolicy({'max_nconfs': 3}))
+        self.assertEqual(len(pconfs), 3)
+
+        # Unsupported inputs fall back to the autoparal of abinit
+        abiinput = FakeAbinitInput(self.si, ecut=10, nkpt=2, kpt=[[0, 0, 0], [0.5, 0, 0]], nband=16)
+        abiinput.abiget_autoparal_pconfs = mock.Mock(return_value='pconfs')
+        self.assertEqual(get_autoparal_pconfs(abiinput, manager, workdir=None, fw_policy=FakePolicy(True)), 'pconfs')
+        abiinput.abiget_autoparal_pconfs.assert_called_once_with(max_ncpus=32, workdir=None, manager=manager)
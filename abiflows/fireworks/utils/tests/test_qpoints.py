@@ -0,0 +1,65 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import numpy as np
+
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.utils.qpoints import QptIndex
+
+
+def get_qmesh(ngqpt, shift=(0, 0, 0)):
+    return [(np.array([i, j, k]) + shift) / ngqpt for i in range(ngqpt) for j in range(ngqpt) for k in range(ngqpt)]
+
+
+def loop_match(qpts, qpt):
+    """
+    Matching of the q-points with the loop previously used in the generation of the phonon workflows.
+    """
+    for i, q in enumerate(qpts):
+        if np.allclose(q, qpt):
+            return i
+    return None
+
+
+class TestQptIndex(AbipyTest):
+
+    def assert_same_matches(self, qpts, queries):
+        index = QptIndex(qpts)
+        for query in queries:
+            self.assertEqual(index.get_index(query), loop_match(qpts, query))
+
+    def test_mesh(self):
+        qpts = get_qmesh(6)
+        # Exact q-points, shuffled, with noise inside and outside the tolerance and q-points not in the mesh
+        rng = np.random.RandomState(0)
+        queries = [qpts[i] for i in rng.permutation(len(qpts))]
+        queries += [q + rng.uniform(-1e-8, 1e-8, 3) for q in qpts[:100]]
+        queries += [q + rng.uniform(-1e-6, 1e-6, 3) for q in qpts[:100]]
+        queries += [np.array(q) + 1 for q in qpts[:20]]
+        queries += get_qmesh(3, shift=(0.5, 0.5, 0.5))
+        self.assert_same_matches(qpts, queries)
+
+    def test_tolerance_boundaries(self):
+        qpts = [[0, 0, 0], [0.5, 0, 0], [-0.25, 0.5, 1e-3], [1e4, 0, 0]]
+        queries = []
+        for q in qpts:
+            q = np.array(q, dtype=float)
+            tol = 1e-8 + 1e-5 * np.abs(q)
+            for factor in [0.999, 1.001]:
+                for sign in [-1, 1]:
+                    queries.append(q + sign * factor * tol)
+        # Large queries, with a tolerance spanning many cells
+        queries += [[1e4 + 0.05, 0, 0], [1e6, 1e6, 1e6], [-1e4, 0, 0]]
+        self.assert_same_matches(qpts, queries)
+
+    def test_ambiguous(self):
+        index = QptIndex([[0, 0, 0], [0.5, 0, 0], [0.5, 0, 1e-9]])
+        self.assertEqual(index.get_index([0, 0, 0]), 0)
+        self.assertEqual(index.find([0.5, 0, 0]), [1, 2])
+        with self.assertRaises(ValueError):
+            index.get_index([0.5, 0, 0])
+
+    def test_empty(self):
+        index = QptIndex([])
+        self.assertEqual(len(index), 0)
+        self.assertIsNone(index.get_index([0, 0, 0]))
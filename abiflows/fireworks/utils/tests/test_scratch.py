@@ -0,0 +1,214 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import collections
+import io
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import abiflows
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.utils.scratch import ScratchRun, scratch_run, get_output_ext, match_exts
+
+
+# Fake abinit: reads the files file from stdin, writes the outputs and temporary files with the prefixes and then
+# sleeps for the time given as argument, creating the "running" file in the current directory in the meanwhile.
+FAKE_ABINIT = """from __future__ import print_function
+import io
+import sys
+import time
+
+sleep = float(sys.argv[1])
+input_path, output_path, idata, odata, tdata = [l.strip() for l in sys.stdin.readlines()[:5]]
+with io.open(idata + '_DEN', 'rb') as f:
+    den = f.read()
+for name, content in [(odata + '_WFK', b'wfk' + den), (odata + '_DEN', b'den'), (odata + '_GSR.nc', b'gsr'),
+                      (odata + '_1WF7', b'1wf'), (tdata + '_WFK', b'tmp')]:
+    with io.open(name, 'wb') as f:
+        f.write(content)
+with io.open(output_path, 'wt') as f:
+    f.write(u'{}\\n{}\\n{}\\n'.format(idata, odata, tdata))
+io.open('running', 'wb').close()
+time.sleep(sleep)
+"""
+
+# Runs the fake abinit in the scratch in a separate process, that can be killed with a SIGTERM. As in the run
+# tasks, abinit is waited for in a separate thread, or in the main thread with the "main" argument. With the
+# "continue" argument the previous SIGTERM handler lets the execution continue. The returncode of abinit is written
+# in the returncode file.
+RUN_SCRATCH = """from __future__ import print_function
+import io
+import os
+import signal
+import subprocess
+import sys
+import threading
+from abiflows.fireworks.utils import scratch as scratch_module
+from abiflows.fireworks.utils.scratch import ScratchRun
+
+workdir, scratch_root, fake_abinit, mode, waiter = sys.argv[1:6]
+scratch_module.TERMINATE_TIMEOUT = 1
+if mode == 'continue':
+    signal.signal(signal.SIGTERM, lambda signum, frame: None)
+with ScratchRun(workdir, scratch_root, copy_back_exts=['WFK']) as scratch:
+    filesfile_path = scratch.write_filesfile(os.path.join(workdir, 'run.files'))
+    with open(filesfile_path, 'r') as stdin:
+        scratch.process = subprocess.Popen([sys.executable, fake_abinit, '60'], stdin=stdin, cwd=workdir)
+    if waiter == 'main':
+        scratch.process.wait()
+    else:
+        thread = threading.Thread(target=scratch.process.communicate)
+        thread.start()
+        while thread.is_alive():
+            thread.join(0.1)
+with io.open(os.path.join(workdir, 'returncode'), 'wt') as f:
+    f.write(u'{}'.format(scratch.process.returncode))
+"""
+
+FWPolicy = collections.namedtuple('FWPolicy', ['scratch_dir', 'scratch_copy_back_exts', 'copy_deps_methods',
+                                               'copy_deps_max_workers'])
+
+
+class TestScratch(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # the launch directory on the shared filesystem and the node-local scratch
+        self.workdir = os.path.join(self.tmp_dir, 'shared', 'launch')
+        self.scratch_root = os.path.join(self.tmp_dir, 'scratch')
+        self.prev_outdir = os.path.join(self.tmp_dir, 'shared', 'previous', 'outdata')
+        for d in ['indata', 'outdata', 'tmpdata']:
+            os.makedirs(os.path.join(self.workdir, d))
+        os.makedirs(self.scratch_root)
+        os.makedirs(self.prev_outdir)
+
+        # dependency linked from a previous task
+        with io.open(os.path.join(self.prev_outdir, 'out_DEN'), 'wb') as f:
+            f.write(b'previous_den')
+        os.symlink(os.path.join(self.prev_outdir, 'out_DEN'), os.path.join(self.workdir, 'indata', 'in_DEN'))
+
+        self.filesfile_path = os.path.join(self.workdir, 'run.files')
+        with io.open(self.filesfile_path, 'wt') as f:
+            f.write('\n'.join([os.path.join(self.workdir, 'run.abi'), os.path.join(self.workdir, 'run.abo'),
+                               os.path.join(self.workdir, 'indata', 'in'), os.path.join(self.workdir, 'outdata', 'out'),
+                               os.path.join(self.workdir, 'tmpdata', 'tmp'), '/path/to/Si.psp8']))
+
+        self.fake_abinit = os.path.join(self.tmp_dir, 'fake_abinit.py')
+        with io.open(self.fake_abinit, 'wt') as f:
+            f.write(FAKE_ABINIT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_exts(self):
+        self.assertEqual(get_output_ext('out_WFK'), 'WFK')
+        self.assertEqual(get_output_ext('/path/to/out_DS2_GSR.nc'), 'GSR')
+        self.assertTrue(match_exts('out_1WF7', ['WFK', '1WF*']))
+        self.assertFalse(match_exts('out_DEN', ['WFK', '1WF*']))
+        self.assertTrue(match_exts('out_DEN', None))
+
+    def test_run(self):
+        with ScratchRun(self.workdir, self.scratch_root, copy_back_exts=['WFK', 'GSR']) as scratch:
+            scratch_dir = scratch.scratch_dir
+            self.assertTrue(scratch_dir.startswith(self.scratch_root))
+            # the dependency is a regular file in the scratch
+            scratch_den = os.path.join(scratch_dir, 'indata', 'in_DEN')
+            self.assertFalse(os.path.islink(scratch_den))
+            with io.open(scratch_den, 'rb') as f:
+                self.assertEqual(f.read(), b'previous_den')
+
+            filesfile_path = scratch.write_filesfile(self.filesfile_path)
+            with open(filesfile_path, 'r') as stdin:
+                subprocess.check_call([sys.executable, self.fake_abinit, '0'], stdin=stdin, cwd=self.workdir)
+
+        # main output in the launch directory, data prefixes in the scratch
+        with io.open(os.path.join(self.workdir, 'run.abo'), 'rt') as f:
+            prefixes = f.read().split()
+        self.assertEqual(prefixes, [os.path.join(scratch_dir, d) for d in ['indata/in', 'outdata/out', 'tmpdata/tmp']])
+
+        # only the configured extensions are copied back, the temporary files are never copied
+        self.assertEqual(sorted(os.listdir(os.path.join(self.workdir, 'outdata'))), ['out_GSR.nc', 'out_WFK'])
+        self.assertEqual(os.listdir(os.path.join(self.workdir, 'tmpdata')), [])
+        with io.open(os.path.join(self.workdir, 'outdata', 'out_WFK'), 'rb') as f:
+            self.assertEqual(f.read(), b'wfkprevious_den')
+        # the files file in the launch dir is untouched and the scratch is removed
+        with io.open(self.filesfile_path, 'rt') as f:
+            self.assertIn(os.path.join(self.workdir, 'outdata', 'out'), f.read())
+        self.assertFalse(os.path.exists(scratch_dir))
+        self.assertEqual(os.listdir(self.scratch_root), [])
+
+    def test_copy_back_on_exception(self):
+        with self.assertRaises(RuntimeError):
+            with ScratchRun(self.workdir, self.scratch_root, copy_back_exts=['1WF*']) as scratch:
+                filesfile_path = scratch.write_filesfile(self.filesfile_path)
+                with open(filesfile_path, 'r') as stdin:
+                    subprocess.check_call([sys.executable, self.fake_abinit, '0'], stdin=stdin, cwd=self.workdir)
+                raise RuntimeError("walltime")
+        self.assertEqual(os.listdir(os.path.join(self.workdir, 'outdata')), ['out_1WF7'])
+        self.assertEqual(os.listdir(self.scratch_root), [])
+
+    def run_sigterm(self, mode, waiter='thread'):
+        script = os.path.join(self.tmp_dir, 'run_scratch.py')
+        with io.open(script, 'wt') as f:
+            f.write(RUN_SCRATCH)
+        env = dict(os.environ)
+        repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(abiflows.__file__)))
+        env['PYTHONPATH'] = os.pathsep.join([repo_dir] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+        process = subprocess.Popen([sys.executable, script, self.workdir, self.scratch_root, self.fake_abinit, mode,
+                                    waiter], env=env)
+
+        # wait for the fake abinit to write its outputs in the scratch
+        start = time.time()
+        while not os.path.exists(os.path.join(self.workdir, 'running')):
+            self.assertIsNone(process.poll())
+            self.assertLess(time.time() - start, 30)
+            time.sleep(0.05)
+        self.assertEqual(os.listdir(os.path.join(self.workdir, 'outdata')), [])
+
+        # SIGTERM sent by the scheduler before the walltime
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+        self.assertLess(time.time() - start, 30)
+
+        self.assertEqual(os.listdir(os.path.join(self.workdir, 'outdata')), ['out_WFK'])
+        self.assertEqual(os.listdir(self.scratch_root), [])
+        return process.returncode
+
+    def test_sigterm(self):
+        self.assertEqual(self.run_sigterm('default'), -signal.SIGTERM)
+
+    def test_sigterm_previous_handler(self):
+        # the previous handler lets the execution continue: the exit status of the terminated abinit is kept
+        for waiter in ['thread', 'main']:
+            self.assertEqual(self.run_sigterm('continue', waiter=waiter), 0)
+            with io.open(os.path.join(self.workdir, 'returncode'), 'rt') as f:
+                self.assertNotEqual(int(f.read()), 0)
+            os.remove(os.path.join(self.workdir, 'outdata', 'out_WFK'))
+            os.remove(os.path.join(self.workdir, 'running'))
+
+    def test_from_fw_policy(self):
+        policy = FWPolicy(scratch_dir=None, scratch_copy_back_exts=None, copy_deps_methods=None,
+                          copy_deps_max_workers=4)
+        self.assertIsNone(ScratchRun.from_fw_policy(self.workdir, policy))
+        with scratch_run(self.workdir, policy) as scratch:
+            self.assertIsNone(scratch)
+
+        os.environ['ABIFLOWS_TEST_SCRATCH'] = self.scratch_root
+        try:
+            policy = policy._replace(scratch_dir='$ABIFLOWS_TEST_SCRATCH', scratch_copy_back_exts=['DEN'])
+            scratch = ScratchRun.from_fw_policy(self.workdir, policy)
+            self.assertEqual(scratch.scratch_root, self.scratch_root)
+            self.assertEqual(scratch.copy_back_exts, ['DEN'])
+        finally:
+            del os.environ['ABIFLOWS_TEST_SCRATCH']
+        # undefined variable: runs in the launch directory
+        self.assertIsNone(ScratchRun.from_fw_policy(self.workdir, policy))
+
+        with scratch_run(self.workdir, policy._replace(scratch_dir=self.scratch_root)) as scratch:
+            self.assertTrue(os.path.isdir(os.path.join(scratch.scratch_dir, 'tmpdata')))
+        self.assertEqual(os.listdir(self.scratch_root), [])
@@ -0,0 +1,151 @@
+# coding: utf-8
+from __future__ import unicode_literals, division, print_function
+
+import errno
+import io
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+import mock
+
+from abipy.core.testing import AbipyTest
+from abiflows.fireworks.utils import staging
+from abiflows.fireworks.utils.staging import stage_file, stage_files, is_staged, STAGING_METHODS
+
+
+class TestStaging(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmp_dir, 'source', 'outdata')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest', 'indata')
+        os.makedirs(self.source_dir)
+        os.makedirs(self.dest_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_source(self, name, size=3 * 1024 ** 2 + 17):
+        filepath = os.path.join(self.source_dir, name)
+        with io.open(filepath, 'wb') as f:
+            f.write(os.urandom(size))
+        return filepath
+
+    def assert_same_content(self, filepath1, filepath2):
+        with io.open(filepath1, 'rb') as f1, io.open(filepath2, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def get_recording_methods(self, failing):
+        """
+        Returns fake staging methods, recording the calls in self.calls and failing for the names in failing,
+        independently of the support of the methods by the filesystem.
+        """
+        self.calls = []
+
+        def fake_method(name):
+            def method(source, dest):
+                self.calls.append(name)
+                if name in failing:
+                    # a failed attempt can leave a partial file
+                    io.open(dest, 'wb').close()
+                    raise OSError(errno.EOPNOTSUPP, "{} not supported".format(name))
+                shutil.copyfile(source, dest)
+            return method
+
+        return [(name, fake_method(name)) for name, method in STAGING_METHODS]
+
+    def test_fallback_order(self):
+        names = [name for name, method in STAGING_METHODS]
+        self.assertEqual(names, ['reflink', 'hardlink', 'copy_file_range', 'sendfile', 'copy'])
+        source = self.write_source('out_WFK')
+
+        for i, name in enumerate(names):
+            dest = os.path.join(self.dest_dir, 'in_WFK_{}'.format(i))
+            with mock.patch.object(staging, 'STAGING_METHODS', self.get_recording_methods(failing=names[:i])):
+                self.assertEqual(stage_file(source, dest), name)
+            self.assertEqual(self.calls, names[:i + 1])
+            self.assert_same_content(source, dest)
+            self.assertTrue(is_staged(source, dest))
+            self.assertAlmostEqual(os.path.getmtime(source), os.path.getmtime(dest), places=3)
+        # No partial file left
+        self.assertEqual(len(os.listdir(self.dest_dir)), len(names))
+
+        # All the methods failing
+        with mock.patch.object(staging, 'STAGING_METHODS', self.get_recording_methods(failing=names)):
+            with self.assertRaises(IOError):
+                stage_file(source, os.path.join(self.dest_dir, 'in_WFK_failed'))
+        self.assertEqual(len(os.listdir(self.dest_dir)), len(names))
+
+    def test_real_methods(self):
+        source = self.write_source('out_1WF7')
+        # Same filesystem: reflink or hard link
+        dest = os.path.join(self.dest_dir, 'in_1WF7')
+        self.assertIn(stage_file(source, dest), ['reflink', 'hardlink'])
+        self.assert_same_content(source, dest)
+
+        # Copies in chunks smaller than the file, as on a different filesystem
+        with mock.patch.object(staging, 'COPY_CHUNK_SIZE', 1024 ** 2):
+            for name in ['copy_file_range', 'sendfile', 'copy']:
+                if name == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+                    continue
+                dest = os.path.join(self.dest_dir, 'in_1WF7_' + name)
+                self.assertEqual(stage_file(source, dest, methods=[name]), name)
+                self.assert_same_content(source, dest)
+
+        # Cross device hard link
+        with mock.patch('os.link', side_effect=OSError(errno.EXDEV, 'Invalid cross-device link')):
+            dest = os.path.join(self.dest_dir, 'in_1WF7_xdev')
+            self.assertNotIn(stage_file(source, dest, methods=['hardlink', 'copy_file_range', 'sendfile', 'copy']),
+                             ['reflink', 'hardlink'])
+            self.assert_same_content(source, dest)
+
+    def test_skip(self):
+        source = self.write_source('out_WFK')
+        dest = os.path.join(self.dest_dir, 'in_WFK')
+        self.assertEqual(stage_file(source, dest, methods=['copy']), 'copy')
+        self.assertEqual(stage_file(source, dest, methods=['copy']), 'skipped')
+
+        # Same size and mtime but different content: detected only with the checksum
+        stat = os.stat(dest)
+        with io.open(dest, 'r+b') as f:
+            f.write(b'modified')
+        os.utime(dest, (stat.st_atime, stat.st_mtime))
+        self.assertEqual(stage_file(source, dest, methods=['copy']), 'skipped')
+        self.assertEqual(stage_file(source, dest, methods=['copy'], checksum=True), 'copy')
+        self.assert_same_content(source, dest)
+
+        # Symlinks to the source are replaced with a copy
+        link = os.path.join(self.dest_dir, 'in_DEN')
+        os.symlink(source, link)
+        self.assertEqual(stage_file(source, link, methods=['copy']), 'copy')
+        self.assertFalse(os.path.islink(link))
+
+        # Different size
+        with io.open(dest, 'ab') as f:
+            f.write(b'extra')
+        self.assertEqual(stage_file(source, dest, methods=['copy']), 'copy')
+        self.assert_same_content(source, dest)
+
+    def test_parallel(self):
+        files = [(self.write_source('out_{}_WFK'.format(i), size=1024 ** 2 * (i + 1)),
+                  os.path.join(self.dest_dir, 'in_{}_WFK'.format(i))) for i in range(6)]
+        self.assertEqual(stage_files(files, methods=['copy'], max_workers=3), ['copy'] * 6)
+        for source, dest in files:
+            self.assert_same_content(source, dest)
+        self.assertEqual(stage_files(files, methods=['copy'], max_workers=3), ['skipped'] * 6)
+
+    def test_same_dest_concurrently(self):
+        # threads of the same process staging the same file do not share the temporary file
+        source = self.write_source('out_WFK', size=8 * 1024 ** 2)
+        dest = os.path.join(self.dest_dir, 'in_WFK')
+        pool = ThreadPool(processes=8)
+        try:
+            results = pool.map(lambda i: stage_file(source, dest, methods=['copy']), range(8))
+        finally:
+            pool.close()
+            pool.join()
+        self.assertTrue(set(results) <= {'copy', 'skipped'})
+        self.assert_same_content(source, dest)
+        self.assertEqual(os.listdir(self.dest_dir), ['in_WFK'])
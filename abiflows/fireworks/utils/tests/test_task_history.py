@@ -1,12 +1,18 @@
 # coding: utf-8
 from __future__ import unicode_literals, division, print_function
 
+import io
+import json
 import os
+import shutil
+import tempfile
+import mock
 import abipy.data as abidata
 import abipy.abilab as abilab
 from abiflows.fireworks.tasks.abinit_tasks import RestartInfo
-from abiflows.fireworks.utils.task_history import TaskHistory, TaskEvent
+from abiflows.fireworks.utils.task_history import TaskHistory, TaskEvent, get_delta, apply_delta
 from abipy.core.testing import AbipyTest
+from monty.json import MontyEncoder
 from abipy.abio.factories import ion_ioncell_relax_input
 from pymatgen.io.abinit.events import Correction, DilatmxErrorHandler, DilatmxError
 
@@ -53,4 +59,175 @@ class TestTaskHistory(AbipyTest):
 
         self.assertEqual(total_run_time, 300)
 
+    def test_index(self):
+        th = TaskHistory()
+        th.log_initialization(th)
+        for i in range(5):
+            th.log_abinit_stop(run_time=10)
+            th.log_unconverged()
+        th.log_finalized()
+
+        events = th.get_events_by_types([TaskEvent.FINALIZED, TaskEvent.INITIALIZED, TaskEvent.UNCONVERGED])
+        self.assertEqual([e.event_type for e in events],
+                         [TaskEvent.INITIALIZED] + [TaskEvent.UNCONVERGED] * 5 + [TaskEvent.FINALIZED])
+        self.assertEqual(th.get_events_by_types(TaskEvent.ERROR), [])
+        self.assertEqual(th.get_events_by_types(TaskEvent.FINALIZED)[0].details['total_run_time'], 50)
+
+        # copies and other modifications of the deque keep the index consistent
+        th2 = TaskHistory(th)
+        th2.popleft()
+        self.assertEqual(th2.get_events_by_types(TaskEvent.INITIALIZED), [])
+        self.assertEqual(len(th2.get_events_by_types([TaskEvent.UNCONVERGED, TaskEvent.FINALIZED])), 6)
+        self.assertEqual(len(th.get_events_by_types(TaskEvent.INITIALIZED)), 1)
+
+    def test_delta(self):
+        ref = {'a': 1, 'b': [1, 2, {'c': 'x'}], 'd': {'e': True, 'f': None}, 'g': [1, 2]}
+        new = {'a': 1.0, 'b': [1, 3, {'c': 'y', 'h': 2}], 'd': {'e': 1}, 'g': [1, 2, 3]}
+        ops = get_delta(ref, new)
+        self.assertEqual(len(ops), 7)
+        self.assertEqual(apply_delta(ref, ops), new)
+        self.assertEqual(ref['b'][2], {'c': 'x'})
+        self.assertEqual(get_delta(ref, ref), [])
+        self.assertEqual(apply_delta(ref, get_delta(ref, [1])), [1])
+
+    def test_input_deltas(self):
+        si = abilab.Structure.from_file(abidata.cif_file("si.cif"))
+        previous_input = ion_ioncell_relax_input(si, abidata.pseudos("14si.pspnc"), ecut=2).split_datasets()[0]
+        abiinput = ion_ioncell_relax_input(si, abidata.pseudos("14si.pspnc"), ecut=2).split_datasets()[1]
+
+        # inputs stored where the tasks store them: at the initialization and at the end of the task
+        th = TaskHistory()
+        th.log_initialization(th, {'previous_input': previous_input, 'initial_input': abiinput.deepcopy()})
+        inputs = [previous_input, abiinput.deepcopy()]
+        # synthetic chain of restarts of a relaxation, the restarts do not store the input
+        for i in range(10):
+            th.log_unconverged()
+            th.log_restart(RestartInfo(os.path.abspath('.'), num_restarts=i + 1))
+        structure = abiinput.structure.copy()
+        structure.translate_sites([0], [0.001, 0, 0.0005])
+        abiinput.set_structure(structure)
+        abiinput.set_vars(irdwfk=1)
+        th.log_finalized(abiinput)
+        inputs.append(abiinput)
+
+        d = th.as_dict()
+        th_decoded = TaskHistory.from_dict(json.loads(json.dumps(d, cls=MontyEncoder, sort_keys=True)))
+        initialization_info = th_decoded[0].details['initialization_info']
+        decoded_inputs = [initialization_info['previous_input'], initialization_info['initial_input'],
+                          th_decoded.get_events_by_types(TaskEvent.FINALIZED)[0].details['final_input']]
+
+        for inp, decoded in zip(inputs, decoded_inputs):
+            self.assertEqual(decoded.as_dict(), inp.as_dict())
+        self.assertEqual([e.as_dict() for e in th_decoded], [e.as_dict() for e in th])
+        self.assertTrue(all('input' not in e.details for e in th_decoded.get_events_by_types(TaskEvent.RESTART)))
+
+        # net reduction with respect to the serialization without the delta encoding: more than the size of one
+        #  of the three inputs is saved
+        full_size = len(json.dumps([e.as_dict() for e in th], cls=MontyEncoder))
+        delta_size = len(json.dumps(d, cls=MontyEncoder))
+        input_size = len(json.dumps(abiinput.as_dict(), cls=MontyEncoder))
+        self.assertLess(delta_size, full_size - input_size)
+
+
+class TestTaskHistoryLog(AbipyTest):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.tmp_dir, 'history.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_history(self, nrestarts=20):
+        th = TaskHistory()
+        th.log_initialization(th, {'kppa': 1000})
+        th.attach_log(self.filepath)
+        for i in range(nrestarts):
+            th.log_abinit_stop(run_time=i)
+            th.log_unconverged()
+            th.log_restart(RestartInfo(os.path.abspath('.'), reset=False, num_restarts=i + 1))
+        th.log_finalized()
+        return th
+
+    def assert_same_events(self, events1, events2):
+        self.assertEqual([e.as_dict() for e in events1], [e.as_dict() for e in events2])
+
+    def test_round_trip(self):
+        th = self.get_history()
+        with io.open(self.filepath, 'rt') as f:
+            self.assertEqual(len(f.readlines()), len(th))
+
+        th_read = TaskHistory.from_jsonl(self.filepath)
+        self.assert_same_events(th_read, th)
+        self.assertEqual(th_read.get_total_run_time(), th.get_total_run_time())
+        self.assertIsInstance(th_read[-1], TaskEvent)
+
+        # The history and the copies sent to other tasks are not attached to the file
+        th_copy = TaskHistory(th)
+        th_copy.log_error(RuntimeError())
+        self.assertEqual(len(TaskHistory.from_jsonl(self.filepath)), len(th))
+
+        # A new attachment rewrites the file
+        th_copy.attach_log(self.filepath)
+        self.assert_same_events(TaskHistory.from_jsonl(self.filepath), th_copy)
+
+    def test_partial_reads(self):
+        th = self.get_history()
+        for n in [1, 3, len(th), len(th) + 5]:
+            self.assert_same_events(TaskHistory.read_last_events(self.filepath, n), list(th)[-n:])
+        self.assertEqual(TaskHistory.read_last_events(self.filepath, 0), [])
+
+        # small blocks, to read the file in several steps
+        with mock.patch('abiflows.fireworks.utils.task_history.TAIL_BLOCK_SIZE', 50):
+            self.assert_same_events(TaskHistory.read_last_events(self.filepath, 7), list(th)[-7:])
+
+        for types in [TaskEvent.RESTART, [TaskEvent.INITIALIZED, TaskEvent.FINALIZED], TaskEvent.ERROR]:
+            self.assert_same_events(TaskHistory.read_events_by_types(self.filepath, types),
+                                    th.get_events_by_types(types))
+
+        # only the selected lines are decoded
+        with mock.patch('json.loads', wraps=json.loads) as loads:
+            TaskHistory.read_events_by_types(self.filepath, TaskEvent.FINALIZED)
+            self.assertEqual(loads.call_count, 1)
+            # one more line in case the last one is truncated
+            TaskHistory.read_last_events(self.filepath, 2)
+            self.assertEqual(loads.call_count, 4)
+
+    def test_truncated_last_line(self):
+        th = self.get_history(nrestarts=3)
+        with io.open(self.filepath, 'rb') as f:
+            content = f.read()
+        # simulate a crash while writing the last event
+        last_line_start = content.rstrip(b'\n').rfind(b'\n') + 1
+        with io.open(self.filepath, 'wb') as f:
+            f.write(content[:last_line_start + 25])
+
+        events = list(th)[:-1]
+        self.assert_same_events(TaskHistory.from_jsonl(self.filepath), events)
+        self.assert_same_events(TaskHistory.read_last_events(self.filepath, 2), events[-2:])
+        self.assertEqual(TaskHistory.read_events_by_types(self.filepath, TaskEvent.FINALIZED), [])
+        self.assert_same_events(TaskHistory.read_events_by_types(self.filepath, TaskEvent.RESTART),
+                                th.get_events_by_types(TaskEvent.RESTART))
+
+        # Only the last line can be truncated
+        with io.open(self.filepath, 'wb') as f:
+            f.write(content[:last_line_start - 10] + b'\n' + content[last_line_start:])
+        with self.assertRaises(ValueError):
+            TaskHistory.from_jsonl(self.filepath)
+
+    def test_from_launch_dir(self):
+        th = self.get_history(nrestarts=2)
+        th_read = TaskHistory.from_launch_dir(self.tmp_dir)
+        self.assert_same_events(th_read, th)
+        self.assert_same_events(TaskHistory.from_launch_dir(self.tmp_dir, types=TaskEvent.FINALIZED),
+                                th.get_events_by_types(TaskEvent.FINALIZED))
 
+        # history.json written by the previous versions
+        os.remove(self.filepath)
+        with io.open(os.path.join(self.tmp_dir, 'history.json'), 'wt') as f:
+            f.write(json.dumps(th, cls=MontyEncoder, indent=4, sort_keys=4))
+        th_read = TaskHistory.from_launch_dir(self.tmp_dir)
+        self.assertIsInstance(th_read, TaskHistory)
+        self.assert_same_events(th_read, th)
+        self.assert_same_events(TaskHistory.from_launch_dir(self.tmp_dir, types=TaskEvent.INITIALIZED),
+                                th.get_events_by_types(TaskEvent.INITIALIZED))
@@ -46,7 +46,7 @@ from abiflows.fireworks.utils.fw_utils import append_fw_to_wf, get_short_single_
 from abiflows.fireworks.utils.fw_utils import set_short_single_core_to_spec, get_last_completed_launch
 from abiflows.fireworks.utils.fw_utils import get_time_report_for_wf
 from abiflows.database.mongoengine.abinit_results import RelaxResult, PhononResult, DteResult
-from abiflows.fireworks.utils.task_history import TaskEvent
+from abiflows.fireworks.utils.task_history import TaskEvent, TaskHistory
 from pymatgen.io.abinit.abiobjects import KSampling
 
 # logging.basicConfig()
@@ -429,7 +429,7 @@ class RelaxFWWorkflow(AbstractFWWorkflow):
         #TODO add a cycle to find the instance of AbiFireTask?
         myfw.tasks[-1].set_workdir(workdir=last_launch.launch_dir)
         structure = myfw.tasks[-1].get_final_structure()
-        history = loadfn(os.path.join(last_launch.launch_dir, 'history.json'))
+        history = TaskHistory.from_launch_dir(last_launch.launch_dir)
 
         return {'structure': structure.as_dict(), 'history': history}
 
@@ -467,8 +467,8 @@ class RelaxFWWorkflow(AbstractFWWorkflow):
         relax_task = last_ioncell_fw.tasks[-1]
         relax_task.set_workdir(workdir=last_ioncell_launch.launch_dir)
         structure = relax_task.get_final_structure()
-        history_ioncell = loadfn(os.path.join(last_ioncell_launch.launch_dir, 'history.json'))
-        history_ion = loadfn(os.path.join(last_ion_launch.launch_dir, 'history.json'))
+        history_ioncell = TaskHistory.from_launch_dir(last_ioncell_launch.launch_dir)
+        history_ion = TaskHistory.from_launch_dir(last_ion_launch.launch_dir)
 
         document = RelaxResult()
 
@@ -623,7 +623,7 @@ class RelaxFWWorkflowSRCOld(AbstractFWWorkflow):
         #TODO add a cycle to find the instance of AbiFireTask?
         myfw.tasks[-1].set_workdir(workdir=last_launch.launch_dir)
         structure = myfw.tasks[-1].get_final_structure()
-        history = loadfn(os.path.join(last_launch.launch_dir, 'history.json'))
+        history = TaskHistory.from_launch_dir(last_launch.launch_dir)
 
         return {'structure': structure.as_dict(), 'history': history}
 
@@ -1027,7 +1027,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
     workflow_class = 'PhononFWWorkflow'
     workflow_module = 'abiflows.fireworks.workflows.abinit_workflows'
 
-    def __init__(self, scf_inp, phonon_factory, autoparal=False, spec=None, initialization_info=None):
+    def __init__(self, scf_inp, phonon_factory, autoparal=False, spec=None, initialization_info=None,
+                 direct_insertion=False):
         if spec is None:
             spec = {}
         if initialization_info is None:
@@ -1050,9 +1051,13 @@ class PhononFWWorkflow(AbstractFWWorkflow):
         self.scf_fw = Firework(scf_task, spec=spec, name=rf+"_"+scf_task.task_type)
 
         ph_generation_task = GeneratePhononFlowFWAbinitTask(phonon_factory, previous_task_type=scf_task.task_type,
-                                                            with_autoparal=autoparal)
+                                                            with_autoparal=autoparal,
+                                                            direct_insertion=direct_insertion)
 
         spec['wf_task_index'] = 'gen_ph'
+        # The direct insertion of the fireworks of the perturbations requires access to the LaunchPad
+        if direct_insertion:
+            spec['_add_launchpad_and_fw_id'] = True
 
         self.ph_generation_fw = Firework(ph_generation_task, spec=spec, name=rf+"_gen_ph")
 
@@ -1065,7 +1070,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
                      spin_mode="polarized", smearing="fermi_dirac:0.1 eV", charge=0.0, scf_algorithm=None,
                      shift_mode="Symmetric", ph_ngqpt=None, qpoints=None, qppa=None, with_ddk=True, with_dde=True,
                      with_bec=False, scf_tol=None, ph_tol=None, ddk_tol=None, dde_tol=None, wfq_tol=None,
-                     qpoints_to_skip=None, extra_abivars=None, decorators=None, autoparal=False, spec=None, initialization_info=None):
+                     qpoints_to_skip=None, extra_abivars=None, decorators=None, autoparal=False, spec=None, initialization_info=None,
+                     direct_insertion=False):
 
         if extra_abivars is None:
             extra_abivars = {}
@@ -1100,7 +1106,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
                                            qpoints_to_skip=qpoints_to_skip, extra_abivars=extra_abivars,
                                            decorators=decorators)
 
-        ph_wf = cls(scf_fact, phonon_fact, autoparal=autoparal, spec=spec, initialization_info=initialization_info)
+        ph_wf = cls(scf_fact, phonon_fact, autoparal=autoparal, spec=spec, initialization_info=initialization_info,
+                    direct_insertion=direct_insertion)
 
         # if all the q points for a grid are calculated in this WF, add an anaddb task
         if ph_ngqpt and not qpoints_to_skip:
@@ -1111,7 +1118,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
     @classmethod
     def from_gs_input(cls, pseudos, gs_input, structure=None, ph_ngqpt=None, qpoints=None, qppa=None, with_ddk=True,
                       with_dde=True, with_bec=False, scf_tol=None, ph_tol=None, ddk_tol=None, dde_tol=None, wfq_tol=None,
-                      qpoints_to_skip=None, extra_abivars=None, decorators=None, autoparal=False, spec=None, initialization_info=None):
+                      qpoints_to_skip=None, extra_abivars=None, decorators=None, autoparal=False, spec=None, initialization_info=None,
+                      direct_insertion=False):
         if extra_abivars is None:
             extra_abivars = {}
         if decorators is None:
@@ -1154,7 +1162,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
                                            qpoints_to_skip=qpoints_to_skip, extra_abivars=extra_abivars,
                                            decorators=decorators)
 
-        ph_wf = cls(scf_inp, phonon_fact, autoparal=autoparal, spec=spec, initialization_info=initialization_info)
+        ph_wf = cls(scf_inp, phonon_fact, autoparal=autoparal, spec=spec, initialization_info=initialization_info,
+                    direct_insertion=direct_insertion)
 
         # if all the q points for a grid are calculated in this WF, add an anaddb task
         if ph_ngqpt and not qpoints_to_skip:
@@ -1222,7 +1231,8 @@ class PhononFWWorkflow(AbstractFWWorkflow):
                     wfq_fw = fw
 
         scf_launch = get_last_completed_launch(scf_fw)
-        scf_history = loadfn(os.path.join(scf_launch.launch_dir, 'history.json'))
+        scf_history = TaskHistory.from_launch_dir(scf_launch.launch_dir,
+                                                   types=[TaskEvent.FINALIZED, TaskEvent.INITIALIZED])
         scf_task = scf_fw.tasks[-1]
         scf_task.set_workdir(workdir=scf_launch.launch_dir)
 
@@ -1767,7 +1777,8 @@ class DteFWWorkflow(AbstractFWWorkflow):
                     dte_fw = fw
 
         scf_launch = get_last_completed_launch(scf_fw)
-        scf_history = loadfn(os.path.join(scf_launch.launch_dir, 'history.json'))
+        scf_history = TaskHistory.from_launch_dir(scf_launch.launch_dir,
+                                                   types=[TaskEvent.FINALIZED, TaskEvent.INITIALIZED])
         scf_task = scf_fw.tasks[-1]
         scf_task.set_workdir(workdir=scf_launch.launch_dir)
 
@@ -1926,7 +1937,7 @@ class PiezoElasticFWWorkflow(AbstractFWWorkflow):
         #TODO add a cycle to find the instance of AbiFireTask?
         myfw.tasks[-1].set_workdir(workdir=last_launch.launch_dir)
         elastic_tensor = myfw.tasks[-1].get_elastic_tensor()
-        history = loadfn(os.path.join(last_launch.launch_dir, 'history.json'))
+        history = TaskHistory.from_launch_dir(last_launch.launch_dir)
 
         return {'elastic_properties': elastic_tensor.extended_dict(), 'history': history}
 
@@ -1947,7 +1958,7 @@ class PiezoElasticFWWorkflow(AbstractFWWorkflow):
         #TODO add a cycle to find the instance of AbiFireTask?
         myfw.tasks[-1].set_workdir(workdir=last_launch.launch_dir)
         elastic_tensor = myfw.tasks[-1].get_elastic_tensor()
-        history = loadfn(os.path.join(last_launch.launch_dir, 'history.json'))
+        history = TaskHistory.from_launch_dir(last_launch.launch_dir)
 
         return {'elastic_properties': elastic_tensor.extended_dict(), 'history': history}
 
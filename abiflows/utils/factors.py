@@ -2,38 +2,163 @@
 """
 Utilities to get factors of a given number or related things ...
 """
+from __future__ import print_function, division, unicode_literals
+
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+
+# Initial size and maximum size of the table of the smallest prime factors. Larger numbers are factorized by trial
+# division, using the table for the cofactors.
+SIEVE_INITIAL_SIZE = 2 ** 12
+SIEVE_MAX_SIZE = 2 ** 20
+
+# Smallest prime factor of each integer, extended on demand by _extend_sieve
+_spf = array(str('l'))
+
+# Memoized divisors of the numbers
+_divisors_cache = {}
+_DIVISORS_CACHE_MAXSIZE = 100000
+
+# Smooth numbers generated so far for each tuple of factors: list of the numbers, list of the exponents and generator
+_smooth_sequences = {}
+_smooth_lock = threading.Lock()
+
+
+def _extend_sieve(n):
+    """
+    Extends the table of the smallest prime factors to include n, doubling its size at least.
+    """
+    global _spf
+    size = min(max(n + 1, 2 * len(_spf), SIEVE_INITIAL_SIZE), SIEVE_MAX_SIZE)
+    if size <= len(_spf):
+        return
+    spf = array(str('l'), range(size))
+    # going downwards the multiples of i are finally assigned to their smallest prime factor
+    i = int(size ** 0.5) + 1
+    while i >= 2:
+        if i * i < size:
+            spf[i * i::i] = array(str('l'), [i]) * len(range(i * i, size, i))
+        i -= 1
+    _spf = spf
+
+
+def factorize(n):
+    """
+    Prime factorization of a natural integer as a list of (prime, multiplicity) tuples in ascending order of the
+    primes. Empty for 1.
+    """
+    n = int(n)
+    if n < 1:
+        raise ValueError('Number n should be >= 1')
+    factors = []
+
+    def add(p):
+        if factors and factors[-1][0] == p:
+            factors[-1] = (p, factors[-1][1] + 1)
+        else:
+            factors.append((p, 1))
+
+    if len(_spf) <= n < SIEVE_MAX_SIZE:
+        _extend_sieve(n)
+    # trial division for the numbers beyond the table
+    p = 2
+    while n >= len(_spf):
+        if p * p > n:
+            add(n)
+            return factors
+        while n % p == 0:
+            add(p)
+            n //= p
+        p += 1 if p == 2 else 2
+    while n > 1:
+        p = _spf[n]
+        add(p)
+        n //= p
+    return factors
+
+
+def prime_factors(n):
+    """
+    List of the prime factors of a natural integer, from greatest to smallest, with repetitions. [1] for 1.
+    """
+    if n == 1:
+        return [1]
+    return [p for p, e in reversed(factorize(n)) for _ in range(e)]
+
+
+def divisors(n):
+    """
+    Divisors of a natural integer, as a tuple in ascending order. The results are memoized.
+    """
+    n = int(n)
+    try:
+        return _divisors_cache[n]
+    except KeyError:
+        pass
+
+    divs = [1]
+    for p, e in factorize(n):
+        divs = [d * p ** k for d in divs for k in range(e + 1)]
+    divs = tuple(sorted(divs))
+
+    if len(_divisors_cache) >= _DIVISORS_CACHE_MAXSIZE:
+        _divisors_cache.clear()
+    _divisors_cache[n] = divs
+    return divs
+
+
+def smooth_numbers(factors=(2, 3, 5, 7)):
+    """
+    Generator of the products of powers of the factors in ascending order, starting from 1, together with the
+    exponents of each factor. A number that can be obtained with different exponents (e.g. 4 with the factors 2
+    and 4) is yielded once for each of them, the smallest exponents in lexicographic order first.
+    """
+    factors = tuple(factors)
+    if any(factor < 2 for factor in factors):
+        raise ValueError('The factors should all be > 1')
+    heap = [(1, (0,) * len(factors))]
+    while heap:
+        nn, exponents = heapq.heappop(heap)
+        yield nn, exponents
+        # each combination of exponents is generated only once, increasing only the exponents from the last
+        # nonzero one
+        last = max([i for i, e in enumerate(exponents) if e > 0] or [0])
+        for i in range(last, len(factors)):
+            new_exponents = exponents[:i] + (exponents[i] + 1,) + exponents[i + 1:]
+            heapq.heappush(heap, (nn * factors[i], new_exponents))
 
-import itertools
-import math
 
 def lowest_nn_gte_mm(mm, factors):
+    """
+    Lowest number greater or equal to mm that is a product of powers of the factors. Returns the number and the
+    tuple of the exponents of the factors (the smallest in lexicographic order if not unique).
+    """
     if mm < 1:
         raise ValueError('Number mm should be >= 1')
     if not any([factor > 1 for factor in factors]):
         raise ValueError('At least one factor should be > 1')
     if len(set(factors)) != len(factors):
         raise ValueError('The factors should all be different')
-    lowest = -1
-    current_exponents = -1
-    max_exponents_factors = [int(math.ceil(math.log(float(mm), factor))) for factor in factors]
-
-    exponents_possibilities = [range(max_exponent+1) for max_exponent in max_exponents_factors]
-    for exponents in itertools.product(*exponents_possibilities):
-        nn = 1
-        for ifactor, factor in enumerate(factors):
-            nn *= factor ** exponents[ifactor]
-        if nn < mm:
-            continue
-        elif nn == mm:
-            lowest = nn
-            current_exponents = exponents
-            break
-        else:
-            if lowest == -1:
-                lowest = nn
-                current_exponents = exponents
-            elif nn < lowest:
-                lowest = nn
-                current_exponents = exponents
-
-    return lowest, current_exponents
\ No newline at end of file
+
+    with _smooth_lock:
+        key = tuple(factors)
+        if key not in _smooth_sequences:
+            _smooth_sequences[key] = ([], [], smooth_numbers(key))
+        numbers, exponents, generator = _smooth_sequences[key]
+        while not numbers or numbers[-1] < mm:
+            nn, nn_exponents = next(generator)
+            numbers.append(nn)
+            exponents.append(nn_exponents)
+        i = bisect_left(numbers, mm)
+        return numbers[i], exponents[i]
+
+
+def next_smooth_number(n, factors=(2, 3, 5, 7)):
+    """
+    Lowest number greater or equal to n whose prime factors are all among the factors (by default the 7-smooth
+    numbers, the sizes for which the FFTs are efficient).
+    """
+    return lowest_nn_gte_mm(n, factors)[0]
@@ -1,8 +1,65 @@
 # coding: utf-8
 from __future__ import unicode_literals, division, print_function
 
+import itertools
+import math
+import random
+from functools import reduce
+
 from abipy.core.testing import AbipyTest
-from abiflows.utils.factors import lowest_nn_gte_mm
+from abiflows.utils import factors
+from abiflows.utils.factors import lowest_nn_gte_mm, prime_factors, divisors, factorize, smooth_numbers, \
+    next_smooth_number
+
+
+def ref_prime_factors(n):
+    """
+    Previous implementation of prime_factors, based on recursive trial division.
+    """
+    i = 2
+    while i <= math.sqrt(n):
+        if n % i == 0:
+            l = ref_prime_factors(n // i)
+            l.append(i)
+            return l
+        i += 1
+    return [n]
+
+
+def ref_divisors(n):
+    """
+    Previous implementation of divisors, based on the cartesian product of the powers of the prime factors.
+    """
+    factors = {}
+    for p in ref_prime_factors(n):
+        factors[p] = factors.get(p, 0) + 1
+    listexponents = [[k ** x for x in range(0, factors[k] + 1)] for k in factors]
+    return sorted(reduce(lambda x, y: x * y, f, 1) for f in itertools.product(*listexponents))
+
+
+def ref_lowest_nn_gte_mm(mm, factors):
+    """
+    Previous implementation of lowest_nn_gte_mm, based on the product of all the possible exponents.
+    """
+    lowest = -1
+    current_exponents = -1
+    max_exponents_factors = [int(math.ceil(math.log(float(mm), factor))) for factor in factors]
+    exponents_possibilities = [range(max_exponent + 1) for max_exponent in max_exponents_factors]
+    for exponents in itertools.product(*exponents_possibilities):
+        nn = 1
+        for ifactor, factor in enumerate(factors):
+            nn *= factor ** exponents[ifactor]
+        if nn < mm:
+            continue
+        elif nn == mm:
+            lowest = nn
+            current_exponents = exponents
+            break
+        elif lowest == -1 or nn < lowest:
+            lowest = nn
+            current_exponents = exponents
+    return lowest, current_exponents
+
 
 class TestFactors(AbipyTest):
     def test_lowest_nn_gte_mm(self):
@@ -28,4 +85,47 @@ class TestFactors(AbipyTest):
 
         ll, exponents = lowest_nn_gte_mm(101322142377, [7, 2, 13])
         self.assertEqual(ll, 102820990636)
-        self.assertEqual(exponents, (11, 2, 1))
\ No newline at end of file
+        self.assertEqual(exponents, (11, 2, 1))
+
+    def test_lowest_nn_gte_mm_reference(self):
+        for factors_list in [[2, 3, 5], [2, 3, 5, 7], [7, 2, 13], [3], [2, 4, 6]]:
+            for mm in range(1, 600):
+                self.assertEqual(lowest_nn_gte_mm(mm, factors_list), ref_lowest_nn_gte_mm(mm, factors_list))
+        rng = random.Random(0)
+        for mm in [rng.randint(1, 10 ** 8) for _ in range(10)]:
+            self.assertEqual(lowest_nn_gte_mm(mm, [2, 3, 5, 7]), ref_lowest_nn_gte_mm(mm, [2, 3, 5, 7]))
+
+        with self.assertRaises(ValueError):
+            lowest_nn_gte_mm(0, [2, 3])
+        with self.assertRaises(ValueError):
+            lowest_nn_gte_mm(10, [2, 2])
+
+    def test_smooth_numbers(self):
+        smooth = []
+        for nn, exponents in smooth_numbers():
+            if nn > 5000:
+                break
+            smooth.append(nn)
+        self.assertEqual(smooth, [n for n in range(1, 5001) if max(prime_factors(n)) <= 7])
+        self.assertEqual(next_smooth_number(1), 1)
+        self.assertEqual(next_smooth_number(11), 12)
+        self.assertEqual(next_smooth_number(97), 98)
+        self.assertEqual(next_smooth_number(121, factors=(2, 3, 5)), 125)
+
+    def test_prime_factors_and_divisors(self):
+        rng = random.Random(0)
+        numbers = list(range(2, 20000)) + [rng.randint(1, 10 ** 7) for _ in range(200)]
+        # beyond the maximum size of the table: trial division
+        numbers += [factors.SIEVE_MAX_SIZE - 1, factors.SIEVE_MAX_SIZE, factors.SIEVE_MAX_SIZE + 1,
+                    2 ** 40, 3 ** 25, 999999937, 2 * 999999937, 2 ** 10 * 999983]
+        for n in numbers:
+            self.assertEqual(prime_factors(n), ref_prime_factors(n))
+            if n < 10 ** 7:
+                self.assertEqual(list(divisors(n)), ref_divisors(n))
+            self.assertEqual(reduce(lambda x, y: x * y, [p ** e for p, e in factorize(n)], 1), n)
+
+        self.assertEqual(prime_factors(1), [1])
+        self.assertEqual(divisors(1), (1,))
+        self.assertEqual(divisors(60), (1, 2, 3, 4, 5, 6, 10, 12, 15, 20, 30, 60))
+        with self.assertRaises(ValueError):
+            factorize(0)